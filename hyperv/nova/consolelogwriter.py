@@ -0,0 +1,521 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import errno
+import gzip
+import os
+import shutil
+
+from eventlet import patcher
+from nova.i18n import _LE, _LW  # noqa
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import pathutils
+from hyperv.nova import utilsfactory
+
+hyperv_opts = [
+    cfg.FloatOpt('console_log_flush_interval',
+                 default=1,
+                 help='The interval, in seconds, at which the buffered '
+                      'instance console output is written to the console '
+                      'log files.'),
+    cfg.IntOpt('console_log_flush_size',
+               default=64 * units.Ki,
+               help='The amount of buffered console output, in bytes, '
+                    'summed for all the instances, that triggers writing '
+                    'it to the console log files before the flush interval '
+                    'elapses.'),
+    cfg.IntOpt('console_log_max_pending_size',
+               default=units.Mi,
+               min=1,
+               help='The maximum amount of console output, in bytes, '
+                    'buffered for each instance while waiting to be '
+                    'written to the console log. When exceeded, for '
+                    'example if the disk is too slow, the oldest buffered '
+                    'output is dropped.'),
+    cfg.IntOpt('console_log_max_file_size',
+               default=constants.MAX_CONSOLE_LOG_FILE_SIZE,
+               min=1,
+               help='The size, in bytes, at which the instance console log '
+                    'files are rotated.'),
+    cfg.IntOpt('console_log_max_total_size',
+               default=0,
+               min=0,
+               help='The maximum disk space, in bytes, used by the console '
+                    'logs of all the instances on this host. When exceeded, '
+                    'the oldest rotated console logs are removed. Live '
+                    'console logs are never removed. 0 means unlimited.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+CONF.import_opt('console_log_archive_count', 'hyperv.nova.pathutils',
+                'hyperv')
+
+LOG = logging.getLogger(__name__)
+
+threading = patcher.original('threading')
+time = patcher.original('time')
+
+_MAX_FILE_IN_USE_RETRIES = 5
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """Returns the console log writer, starting it if needed."""
+    global _log_writer
+
+    with _log_writer_lock:
+        if not _log_writer:
+            _log_writer = ConsoleLogWriter()
+            _log_writer.start()
+        return _log_writer
+
+
+def _retry_if_file_in_use(f, *args, **kwargs):
+    # The log files might be in use if the console log is requested
+    # while a log rotation is attempted.
+    retry_count = 0
+    while True:
+        try:
+            return f(*args, **kwargs)
+        except WindowsError as err:
+            if (err.errno == errno.EACCES and
+                    retry_count < _MAX_FILE_IN_USE_RETRIES):
+                retry_count += 1
+                time.sleep(1)
+            else:
+                raise
+
+
+class _ConsoleLog(object):
+    def __init__(self, path):
+        self.path = path
+        # Data chunks that were not written to the log file yet.
+        self.pending_data = collections.deque()
+        self.pending_size = 0
+        self.bytes_dropped = 0
+        self.file_handle = None
+        self.size = 0
+
+
+class ConsoleLogWriter(threading.Thread):
+    """Writes the console logs of all the instances.
+
+    Console output is buffered in memory and written to the log files
+    in batches, either periodically or when enough data is buffered.
+    Log file sizes are tracked in memory and logs are rotated by this
+    thread, so the named pipe readers never block on disk I/O.
+    """
+
+    def __init__(self):
+        super(ConsoleLogWriter, self).__init__()
+        self.setDaemon(True)
+
+        self._logs = {}
+        self._pending_bytes = 0
+
+        # Protects the log map and the buffered data.
+        self._lock = threading.Lock()
+        # Serializes log file operations.
+        self._io_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+
+        self._archiver = ConsoleLogArchiver()
+
+    def start(self):
+        self._archiver.start()
+        super(ConsoleLogWriter, self).start()
+
+    def open_log(self, log_path):
+        with self._lock:
+            if log_path not in self._logs:
+                self._logs[log_path] = _ConsoleLog(log_path)
+
+    def close_log(self, log_path):
+        """Writes the buffered data and releases the log file."""
+        with self._io_lock:
+            with self._lock:
+                log = self._logs.pop(log_path, None)
+
+            if log:
+                self._write_log(log)
+                self._close_log_file(log)
+
+        if log and log.bytes_dropped:
+            LOG.warning(_LW("%(bytes_dropped)d bytes of console output "
+                            "were dropped while waiting to be written to "
+                            "the console log %(log_path)s."),
+                        {'bytes_dropped': log.bytes_dropped,
+                         'log_path': log_path})
+
+    def write(self, log_path, data):
+        """Buffers data to be written to the specified log."""
+        with self._lock:
+            log = self._logs.get(log_path)
+            if not log:
+                return
+
+            log.pending_data.append(data)
+            log.pending_size += len(data)
+            self._pending_bytes += len(data)
+            dropped = self._drop_oldest_pending_data(log)
+            flush_needed = (self._pending_bytes >=
+                            CONF.hyperv.console_log_flush_size)
+
+        if dropped and log.bytes_dropped == dropped:
+            # Only the first drop is logged, the total amount of dropped
+            # data being logged when the log is closed.
+            LOG.warning(_LW("The console output of %(log_path)s is "
+                            "produced faster than it can be written, "
+                            "%(bytes_dropped)d bytes of output being "
+                            "dropped. Further drops are not logged."),
+                        {'log_path': log_path, 'bytes_dropped': dropped})
+
+        if flush_needed:
+            self._flush_requested.set()
+
+    def _drop_oldest_pending_data(self, log):
+        # Expects the lock to be held. Returns the number of dropped bytes.
+        excess = log.pending_size - CONF.hyperv.console_log_max_pending_size
+        dropped = 0
+        while excess > 0:
+            chunk = log.pending_data[0]
+            if len(chunk) <= excess:
+                log.pending_data.popleft()
+                dropped += len(chunk)
+                excess -= len(chunk)
+            else:
+                log.pending_data[0] = chunk[excess:]
+                dropped += excess
+                excess = 0
+
+        log.pending_size -= dropped
+        log.bytes_dropped += dropped
+        self._pending_bytes -= dropped
+        return dropped
+
+    def flush_log(self, log_path):
+        """Writes the data buffered for the specified log."""
+        with self._io_lock:
+            with self._lock:
+                log = self._logs.get(log_path)
+
+            if log:
+                self._write_log(log)
+
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                logs = list(self._logs.values())
+
+            for log in logs:
+                self._write_log(log)
+
+    def run(self):
+        while True:
+            self._flush_requested.wait(
+                CONF.hyperv.console_log_flush_interval)
+            self._flush_requested.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception(_LE('Unexpected console log writer error.'))
+
+    def _write_log(self, log):
+        try:
+            self._write_pending_data(log)
+        except Exception as err:
+            # The buffered data is dropped, the log file being reopened
+            # on the next write.
+            LOG.error(_LE("Failed to write console log %(log_path)s. "
+                          "Error: %(err)s"),
+                      {'log_path': log.path, 'err': err})
+            self._close_log_file(log)
+
+    def _write_pending_data(self, log):
+        # The I/O lock is expected to be held by the caller.
+        with self._lock:
+            chunks = log.pending_data
+            log.pending_data = collections.deque()
+            self._pending_bytes -= log.pending_size
+            log.pending_size = 0
+
+        if not chunks:
+            return
+
+        if not log.file_handle:
+            self._open_log_file(log)
+
+        for chunk in chunks:
+            if (log.size + len(chunk) >=
+                    CONF.hyperv.console_log_max_file_size):
+                self._rotate_log(log)
+            log.file_handle.write(chunk)
+            log.size += len(chunk)
+        log.file_handle.flush()
+
+    def _open_log_file(self, log):
+        log.file_handle = open(log.path, 'ab')
+        log.size = os.path.getsize(log.path)
+
+    def _close_log_file(self, log):
+        if log.file_handle:
+            log.file_handle.close()
+            log.file_handle = None
+
+    def _rotate_log(self, log):
+        if not self._archiver.can_rotate(log.path):
+            # The log is rotated once the previously rotated log is
+            # compressed, growing beyond its maximum size meanwhile.
+            return
+
+        log.file_handle.flush()
+        self._close_log_file(log)
+
+        self._archiver.rotate(log.path)
+
+        self._open_log_file(log)
+
+
+class ConsoleLogArchiver(threading.Thread):
+    """Keeps the rotated console logs of all the instances.
+
+    Rotated logs are compressed by this thread, so that log rotation
+    does not hold up the console log writer. The host console log disk
+    budget is enforced after each log rotation, the oldest rotated logs
+    being removed first.
+    """
+
+    _COMPRESS_LEVEL = 6
+
+    def __init__(self):
+        super(ConsoleLogArchiver, self).__init__()
+        self.setDaemon(True)
+
+        self._pathutils = utilsfactory.get_pathutils()
+
+        # Uncompressed rotated logs.
+        self._pending_logs = collections.deque()
+        # Serializes operations on the rotated log files. The logs are
+        # compressed without holding the lock.
+        self._lock = threading.Lock()
+        self._compression_done = threading.Condition(self._lock)
+        self._compressing_log = None
+        # Rotated logs which could not be compressed.
+        self._failed_logs = set()
+        self._archive_requested = threading.Event()
+
+    def can_rotate(self, log_path):
+        """Returns whether the log can be rotated right away.
+
+        The previously rotated log has to be compressed first, which is
+        requested if needed, so that the caller does not wait for it.
+        """
+        pending_path = self._pathutils.get_console_log_archive_path(
+            log_path, 1, compressed=False)
+
+        with self._lock:
+            if self._compressing_log == pending_path:
+                return False
+            if (not os.path.exists(pending_path) or
+                    self._remove_if_compressed(pending_path) or
+                    pending_path in self._failed_logs):
+                return True
+            if pending_path not in self._pending_logs:
+                # The log was left behind by a previous run of the
+                # service.
+                self._pending_logs.append(pending_path)
+
+        self._archive_requested.set()
+        return False
+
+    def rotate(self, log_path):
+        """Archives the specified log, which must not be open for writing.
+
+        The log is renamed right away, being compressed in the background.
+        can_rotate is expected to be checked first.
+        """
+        archive_paths = self._pathutils.get_console_log_archive_paths(
+            log_path)
+        pending_path = archive_paths[0]
+        archive_paths = archive_paths[1:]
+
+        with self._lock:
+            while self._compressing_log == pending_path:
+                self._compression_done.wait()
+
+            if os.path.exists(pending_path):
+                # The previously rotated log could not be compressed.
+                LOG.warning(_LW("Removing console log %s, which could not "
+                                "be compressed."), pending_path)
+                _retry_if_file_in_use(os.remove, pending_path)
+            self._failed_logs.discard(pending_path)
+
+            if not archive_paths:
+                _retry_if_file_in_use(os.remove, log_path)
+                return
+
+            if os.path.exists(archive_paths[-1]):
+                _retry_if_file_in_use(os.remove, archive_paths[-1])
+            for idx in range(len(archive_paths) - 1, 0, -1):
+                if os.path.exists(archive_paths[idx - 1]):
+                    _retry_if_file_in_use(os.rename,
+                                          archive_paths[idx - 1],
+                                          archive_paths[idx])
+
+            _retry_if_file_in_use(os.rename, log_path, pending_path)
+            self._pending_logs.append(pending_path)
+
+        self._archive_requested.set()
+
+    def run(self):
+        while True:
+            self._archive_requested.wait()
+            self._archive_requested.clear()
+
+            try:
+                self._archive_pending_logs()
+                self._enforce_disk_budget()
+            except Exception:
+                LOG.exception(_LE('Unexpected console log archiver error.'))
+
+    def _archive_pending_logs(self):
+        while True:
+            with self._lock:
+                if not self._pending_logs:
+                    return
+
+                log_path = self._pending_logs.popleft()
+                # The log may have been compressed in the meantime by a
+                # subsequent rotation.
+                if (not os.path.exists(log_path) or
+                        self._remove_if_compressed(log_path)):
+                    continue
+                self._compressing_log = log_path
+
+            # The lock is not held while compressing the log, so that the
+            # logs of the other instances can be rotated meanwhile. The
+            # rotation of this log is deferred until the compression
+            # finishes.
+            tmp_path = None
+            try:
+                tmp_path = self._write_compressed_log(log_path)
+            except Exception:
+                # The log is kept uncompressed, still being available to
+                # console output requests, until the next rotation.
+                pass
+
+            with self._lock:
+                self._compressing_log = None
+                self._compression_done.notify_all()
+                compressed = False
+                if tmp_path:
+                    try:
+                        self._replace_log(log_path, tmp_path)
+                        compressed = True
+                    except Exception:
+                        pass
+                if not compressed:
+                    # The log is removed by its next rotation.
+                    self._failed_logs.add(log_path)
+
+    def _remove_if_compressed(self, log_path):
+        # The archive is moved in place before removing the log, which may
+        # be left behind if the removal fails or if the service stops.
+        if not os.path.exists(log_path + pathutils.CONSOLE_LOG_ARCHIVE_EXT):
+            return False
+
+        _retry_if_file_in_use(os.remove, log_path)
+        return True
+
+    def _write_compressed_log(self, log_path):
+        # Returns the path of the temporary compressed log.
+        tmp_path = log_path + pathutils.CONSOLE_LOG_ARCHIVE_EXT + '.tmp'
+        try:
+            with open(log_path, 'rb') as src:
+                dest = gzip.open(tmp_path, 'wb', self._COMPRESS_LEVEL)
+                try:
+                    shutil.copyfileobj(src, dest)
+                finally:
+                    dest.close()
+        except Exception as err:
+            LOG.error(_LE("Failed to compress console log %(log_path)s. "
+                          "Error: %(err)s"),
+                      {'log_path': log_path, 'err': err})
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def _replace_log(self, log_path, tmp_path):
+        # The archive is moved in place before removing the log, so that
+        # the console output remains available at any time. The console
+        # output readers skip the logs having archives.
+        archive_path = log_path + pathutils.CONSOLE_LOG_ARCHIVE_EXT
+        try:
+            os.rename(tmp_path, archive_path)
+        except Exception as err:
+            LOG.error(_LE("Failed to archive console log %(log_path)s. "
+                          "Error: %(err)s"),
+                      {'log_path': log_path, 'err': err})
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _retry_if_file_in_use(os.remove, log_path)
+
+    def _enforce_disk_budget(self):
+        max_total_size = CONF.hyperv.console_log_max_total_size
+        if not max_total_size:
+            return
+
+        with self._lock:
+            total_size = 0
+            archives = []
+
+            instances_dir = self._pathutils.get_instances_dir()
+            for dir_name in os.listdir(instances_dir):
+                log_path = os.path.join(instances_dir, dir_name,
+                                        pathutils.CONSOLE_LOG_FILE_NAME)
+                archive_paths = (
+                    self._pathutils.get_console_log_archive_paths(log_path))
+                for path in [log_path] + archive_paths:
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+
+                    total_size += stat.st_size
+                    if path != log_path:
+                        archives.append((stat.st_mtime, stat.st_size, path))
+
+            for mtime, size, path in sorted(archives):
+                if total_size <= max_total_size:
+                    break
+
+                try:
+                    os.remove(path)
+                    total_size -= size
+                except OSError as err:
+                    LOG.warning(_LW("Failed to remove console log "
+                                    "%(log_path)s. Error: %(err)s"),
+                                {'log_path': path, 'err': err})
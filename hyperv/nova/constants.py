@@ -89,6 +89,7 @@ DISK_FORMAT_VHDX = "VHDX"
 
 VHD_TYPE_FIXED = 2
 VHD_TYPE_DYNAMIC = 3
+VHD_TYPE_DIFFERENCING = 4
 
 SCSI_CONTROLLER_SLOTS_NUMBER = 64
 IDE_CONTROLLER_SLOTS_NUMBER = 2
@@ -112,6 +113,11 @@ REMOTEFX_MAX_RES_2560x1600 = "2560x1600"
 
 FLAVOR_REMOTE_FX_EXTRA_SPEC_KEY = "hyperv:remotefx"
 
+# Properties of the incremental snapshot images, which hold only the
+# differencing disk of the instance root disk.
+IMAGE_PROP_PARENT_IMAGE_ID = "hyperv_parent_image_id"
+IMAGE_PROP_PARENT_ROOT_GB = "hyperv_parent_root_gb"
+
 IMAGE_PROP_INTERACTIVE_SERIAL_PORT = "interactive_serial_port"
 IMAGE_PROP_LOGGING_SERIAL_PORT = "logging_serial_port"
 
@@ -22,19 +22,23 @@ import platform
 from nova import exception
 from nova.virt import driver
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
 from oslo_utils import excutils
 
 from hyperv.i18n import _, _LE
+from hyperv.nova import ephemeraldiskpool
 from hyperv.nova import eventhandler
 from hyperv.nova import hostops
 from hyperv.nova import hostutils
 from hyperv.nova import imagecache
+from hyperv.nova import imageprefetcher
 from hyperv.nova import livemigrationops
 from hyperv.nova import migrationops
 from hyperv.nova import rdpconsoleops
 from hyperv.nova import serialconsoleops
 from hyperv.nova import snapshotops
 from hyperv.nova import vmops
+from hyperv.nova import vmshellpool
 from hyperv.nova import volumeops
 
 LOG = logging.getLogger(__name__)
@@ -63,6 +67,9 @@ class HyperVDriver(driver.ComputeDriver):
         self._rdpconsoleops = rdpconsoleops.RDPConsoleOps()
         self._serialconsoleops = serialconsoleops.SerialConsoleOps()
         self._imagecache = imagecache.ImageCache()
+        self._imageprefetcher = imageprefetcher.ImagePrefetcher()
+        self._ephemeral_disk_pool = ephemeraldiskpool.EphemeralDiskPool()
+        self._vm_shell_pool = vmshellpool.VMShellPool()
 
     def _check_minimum_windows_version(self):
         if not hostutils.HostUtils().check_min_windows_version(6, 2):
@@ -84,6 +91,9 @@ class HyperVDriver(driver.ComputeDriver):
         event_handler = eventhandler.InstanceEventHandler(
             state_change_callback=self.emit_event)
         event_handler.start_listener()
+        self._imageprefetcher.start()
+        self._ephemeral_disk_pool.start()
+        self._vm_shell_pool.start()
 
     def list_instance_uuids(self):
         return self._vmops.list_instance_uuids()
@@ -218,7 +228,8 @@ class HyperVDriver(driver.ComputeDriver):
             context, instance, dest_check_data)
 
     def get_instance_disk_info(self, instance, block_device_info=None):
-        pass
+        return jsonutils.dumps(
+            self._vmops.get_instance_disk_info(instance.name))
 
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
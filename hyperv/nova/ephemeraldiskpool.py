@@ -0,0 +1,230 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Pool of pre-created empty ephemeral disks.
+"""
+import collections
+import os
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import excutils
+from oslo_utils import units
+from oslo_utils import uuidutils
+
+from hyperv.i18n import _LW
+from hyperv.nova import utilsfactory
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.ListOpt('ephemeral_disk_pool_sizes',
+                default=[],
+                help='Flavor ephemeral disk sizes, in GB, for which empty '
+                     'disks are created in advance, in the background. '
+                     'The instance ephemeral disks having those sizes are '
+                     'taken from the pool instead of being created when '
+                     'the instances are spawned or resized. An empty list '
+                     'disables the pool.'),
+    cfg.IntOpt('ephemeral_disk_pool_depth',
+               default=2,
+               min=1,
+               help='The number of empty disks kept in the pool for each '
+                    'of the configured ephemeral disk sizes.'),
+    cfg.IntOpt('ephemeral_disk_pool_refill_interval',
+               default=60,
+               min=1,
+               help='The interval, in seconds, at which the ephemeral disks '
+                    'taken from the pool are replaced.'),
+    cfg.FloatOpt('ephemeral_disk_pool_throttle_interval',
+                 default=1,
+                 min=0,
+                 help='The time, in seconds, to wait between the creation '
+                      'of the pooled ephemeral disks, limiting the impact '
+                      'on the running instances.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+# Pooled disk file names have the following format:
+# eph_<size_gb>gb_<disk_id>.<format_ext>
+_DISK_FILE_PREFIX = 'eph_'
+# The disks are created using temporary file names, so that they are not
+# claimed before being complete.
+_TMP_FILE_PREFIX = 'tmp_'
+
+# Shared by all the EphemeralDiskPool instances.
+_pool_stats = collections.Counter()
+
+
+class EphemeralDiskPool(object):
+    """Keeps empty dynamic disks ready for the instance ephemeral disks.
+
+    The disks are placed in a directory of the instances path, so that
+    they are claimed by renaming them into the instance directories,
+    which is atomic. Claimed disks are replaced periodically, one disk
+    at a time, pausing in between.
+    """
+
+    def __init__(self):
+        self._pathutils = utilsfactory.get_pathutils()
+        self._vhdutils = utilsfactory.get_vhdutils()
+
+    def start(self):
+        if not self._get_pool_sizes():
+            return
+
+        eventlet.spawn_n(self._refill_periodically)
+
+    def _refill_periodically(self):
+        while True:
+            try:
+                self.refill()
+            except Exception as ex:
+                LOG.warning(_LW("Ephemeral disk pool refill failed. "
+                                "Error: %s"), ex)
+            eventlet.sleep(CONF.hyperv.ephemeral_disk_pool_refill_interval)
+
+    def _get_pool_sizes(self):
+        pool_sizes = []
+        for pool_size in CONF.hyperv.ephemeral_disk_pool_sizes:
+            try:
+                size_gb = int(pool_size)
+            except ValueError:
+                size_gb = 0
+            if size_gb > 0:
+                pool_sizes.append(size_gb)
+            else:
+                LOG.warning(_LW("Invalid ephemeral disk pool size: %s"),
+                            pool_size)
+        return sorted(set(pool_sizes))
+
+    @staticmethod
+    def _get_disk_file_prefix(size_gb):
+        return '%s%sgb_' % (_DISK_FILE_PREFIX, size_gb)
+
+    def _list_pool_files(self, pool_dir):
+        try:
+            return sorted(os.listdir(pool_dir))
+        except OSError:
+            return []
+
+    def _list_disks(self, pool_dir, size_gb, vhd_format):
+        prefix = self._get_disk_file_prefix(size_gb)
+        format_ext = '.' + vhd_format.lower()
+        return [os.path.join(pool_dir, file_name)
+                for file_name in self._list_pool_files(pool_dir)
+                if file_name.startswith(prefix) and
+                file_name.lower().endswith(format_ext)]
+
+    def claim_disk(self, size_gb, vhd_format, dest_path):
+        """Moves a pooled empty disk to the specified path.
+
+        Returns whether a pooled disk having the requested size and format
+        was available.
+        """
+        if size_gb not in self._get_pool_sizes():
+            return False
+
+        pool_dir = self._pathutils.get_ephemeral_disk_pool_dir()
+        for disk_path in self._list_disks(pool_dir, size_gb, vhd_format):
+            try:
+                self._pathutils.rename(disk_path, dest_path)
+            except OSError:
+                # The disk was claimed by a concurrent operation.
+                continue
+
+            _pool_stats['hits'] += 1
+            LOG.debug("Claimed pooled ephemeral disk %(disk_path)s as "
+                      "%(dest_path)s",
+                      {'disk_path': disk_path, 'dest_path': dest_path})
+            return True
+
+        _pool_stats['misses'] += 1
+        return False
+
+    def _throttle(self):
+        eventlet.sleep(CONF.hyperv.ephemeral_disk_pool_throttle_interval)
+
+    def refill(self):
+        """Creates the missing pooled disks.
+
+        The pooled disks which are no longer needed, such as the ones
+        having sizes which are no longer configured, are removed.
+        """
+        pool_sizes = self._get_pool_sizes()
+        vhd_format = self._vhdutils.get_best_supported_vhd_format()
+        pool_dir = self._pathutils.get_ephemeral_disk_pool_dir()
+
+        self._remove_stale_disks(pool_dir, pool_sizes, vhd_format)
+        for size_gb in pool_sizes:
+            while (len(self._list_disks(pool_dir, size_gb, vhd_format)) <
+                    CONF.hyperv.ephemeral_disk_pool_depth):
+                self._create_disk(pool_dir, size_gb, vhd_format)
+                self._throttle()
+
+        LOG.debug("Ephemeral disk pool statistics: %s",
+                  self.get_pool_stats())
+
+    def _remove_stale_disks(self, pool_dir, pool_sizes, vhd_format):
+        pooled_disks = set()
+        for size_gb in pool_sizes:
+            pooled_disks.update(self._list_disks(pool_dir, size_gb,
+                                                 vhd_format))
+
+        for file_name in self._list_pool_files(pool_dir):
+            path = os.path.join(pool_dir, file_name)
+            if path not in pooled_disks:
+                LOG.debug("Removing stale pooled ephemeral disk %s", path)
+                self._pathutils.remove(path)
+
+    def _create_disk(self, pool_dir, size_gb, vhd_format):
+        disk_id = uuidutils.generate_uuid()
+        format_ext = vhd_format.lower()
+        tmp_path = os.path.join(pool_dir, '%s%s.%s' % (
+            _TMP_FILE_PREFIX, disk_id, format_ext))
+        disk_path = os.path.join(pool_dir, '%s%s.%s' % (
+            self._get_disk_file_prefix(size_gb), disk_id, format_ext))
+
+        try:
+            self._vhdutils.create_dynamic_vhd(tmp_path, size_gb * units.Gi,
+                                              vhd_format)
+            self._pathutils.rename(tmp_path, disk_path)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if self._pathutils.exists(tmp_path):
+                    self._pathutils.remove(tmp_path)
+
+        LOG.debug("Created pooled ephemeral disk %s", disk_path)
+
+    def get_pool_stats(self):
+        """Returns the pool hit and miss counters along with the pool depth.
+
+        Only the claims of ephemeral disks having the configured sizes
+        are accounted.
+        """
+        if not self._get_pool_sizes():
+            return {}
+
+        pool_dir = self._pathutils.get_ephemeral_disk_pool_dir()
+        depth = len([file_name
+                     for file_name in self._list_pool_files(pool_dir)
+                     if file_name.startswith(_DISK_FILE_PREFIX)])
+        return {'ephemeral_disk_pool_hits': _pool_stats['hits'],
+                'ephemeral_disk_pool_misses': _pool_stats['misses'],
+                'ephemeral_disk_pool_depth': depth}
@@ -0,0 +1,176 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Locks shared by multiple hosts through lock files.
+"""
+import errno
+import os
+import time
+
+import eventlet
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+
+from hyperv.i18n import _LE, _LW
+
+LOG = logging.getLogger(__name__)
+
+CONF = cfg.CONF
+CONF.import_opt('host', 'nova.netconf')
+
+LOCK_FILE_EXT = '.lock'
+
+
+class FileLock(object):
+    """Lock held through a lock file, usually placed on an SMB share.
+
+    The lock is acquired by exclusively creating the lock file. While
+    the lock is held, its lease is renewed by updating the lock file
+    modification time. Locks whose lease was not renewed in time are
+    considered to be left behind by hosts that stopped unexpectedly,
+    being broken.
+    """
+
+    _RETRY_INTERVAL = 1
+
+    def __init__(self, path, lease_timeout):
+        self._path = path
+        self._lease_timeout = lease_timeout
+        self._lease_renewer = None
+        # Identifies the lock owner, being written to the lock file. It
+        # includes a unique id, as multiple green threads of the same
+        # process may use the same lock.
+        self._owner = '%s:%s:%s' % (CONF.host, os.getpid(),
+                                    uuidutils.generate_uuid())
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self):
+        while not self._try_acquire():
+            self._break_if_stale()
+            time.sleep(self._RETRY_INTERVAL)
+
+        self._lease_renewer = eventlet.spawn(self._renew_lease)
+
+    def _try_acquire(self):
+        try:
+            fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as err:
+            # EACCES is raised on Windows while the lock file is being
+            # removed by its owner.
+            if err.errno in (errno.EEXIST, errno.EACCES):
+                return False
+            raise
+
+        try:
+            os.write(fd, self._owner.encode('utf-8'))
+        finally:
+            os.close(fd)
+        return True
+
+    def _get_lease_age(self, path):
+        # The lease age compares the local time with the lock file
+        # modification time, set by the file server. The lease timeout
+        # must therefore exceed the clock skew between the hosts and the
+        # file server.
+        return time.time() - os.path.getmtime(path)
+
+    def _break_if_stale(self):
+        try:
+            lease_age = self._get_lease_age(self._path)
+        except OSError:
+            # The lock was released meanwhile.
+            return
+
+        if lease_age <= self._lease_timeout:
+            return
+
+        # The lock file is moved out of the way before being removed, so
+        # that only one of the hosts breaking the lock succeeds. As the
+        # lock may have been released and acquired again after its lease
+        # was checked, the lease of the moved lock file is checked once
+        # more.
+        stale_path = '%s.%s' % (self._path, uuidutils.generate_uuid())
+        try:
+            os.rename(self._path, stale_path)
+            lease_age = self._get_lease_age(stale_path)
+        except OSError:
+            # The lock was released or broken by another host meanwhile.
+            return
+
+        if lease_age <= self._lease_timeout:
+            self._restore_lock_file(stale_path)
+            return
+
+        LOG.warning(_LW("Breaking stale lock %(path)s, its lease "
+                        "having expired %(lease_age)d seconds ago."),
+                    {'path': self._path,
+                     'lease_age': lease_age - self._lease_timeout})
+        try:
+            os.remove(stale_path)
+        except OSError as err:
+            LOG.warning(_LW("Failed to remove lock file %(path)s. "
+                            "Error: %(err)s"),
+                        {'path': stale_path, 'err': err})
+
+    def _restore_lock_file(self, stale_path):
+        # The lock is held by another host, which is still renewing its
+        # lease. Renaming does not replace existing files on Windows, so
+        # the lock cannot be restored if acquired by a third host.
+        try:
+            os.rename(stale_path, self._path)
+        except OSError as err:
+            LOG.error(_LE("Failed to restore lock file %(path)s, its "
+                          "owner renewing its lease. Error: %(err)s"),
+                      {'path': self._path, 'err': err})
+
+    def _renew_lease(self):
+        while True:
+            time.sleep(self._lease_timeout / 3.0)
+            try:
+                os.utime(self._path, None)
+            except OSError as err:
+                LOG.warning(_LW("Failed to renew lock %(path)s lease. "
+                                "Error: %(err)s"),
+                            {'path': self._path, 'err': err})
+
+    def release(self):
+        if self._lease_renewer:
+            self._lease_renewer.kill()
+            self._lease_renewer = None
+
+        # The lock may have been broken by another host while its lease
+        # could not be renewed, in which case the lock file is left in
+        # place, belonging to its new owner.
+        try:
+            with open(self._path, 'rb') as f:
+                owner = f.read().decode('utf-8')
+            if owner != self._owner:
+                LOG.warning(_LW("Lock %(path)s was broken while being held, "
+                                "being owned by %(owner)s."),
+                            {'path': self._path, 'owner': owner})
+                return
+
+            os.remove(self._path)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW("Failed to remove lock file %(path)s. "
+                            "Error: %(err)s"),
+                        {'path': self._path, 'err': err})
@@ -38,8 +38,12 @@ from oslo_utils import units
 
 from hyperv.i18n import _, _LE, _LI
 from hyperv.nova import constants
+from hyperv.nova import ephemeraldiskpool
+from hyperv.nova import imagecache
 from hyperv.nova import utilsfactory
 from hyperv.nova import vmops
+from hyperv.nova import vmshellpool
+from hyperv.nova import vmutils
 
 hyper_host_opts = [
     cfg.IntOpt('evacuate_task_state_timeout',
@@ -61,6 +65,9 @@ class HostOps(object):
         self._pathutils = utilsfactory.get_pathutils()
         self._vmutils = utilsfactory.get_vmutils()
         self._vmops = vmops.VMOps()
+        self._imagecache = imagecache.ImageCache()
+        self._ephemeral_disk_pool = ephemeraldiskpool.EphemeralDiskPool()
+        self._vm_shell_pool = vmshellpool.VMShellPool()
         self._api = api.API()
 
     def _get_cpu_info(self):
@@ -108,6 +115,28 @@ class HostOps(object):
         used_gb = total_gb - free_gb
         return (total_gb, free_gb, used_gb)
 
+    def _get_disk_over_committed_size_gb(self):
+        """Returns the space still to be allocated by the instance disks.
+
+        This is the difference between the virtual size and the file
+        size of the dynamic and differencing instance disks. The block
+        allocation tables are not read, as this is called on each
+        resource update.
+        """
+        over_committed_size = 0
+        for instance_name in self._vmops.list_instances():
+            try:
+                over_committed_size += (
+                    self._vmops.get_instance_over_committed_disk_size(
+                        instance_name))
+            except (exception.InstanceNotFound,
+                    vmutils.HyperVException) as ex:
+                # The instance may have been removed meanwhile.
+                LOG.debug("Could not get the disk info of instance "
+                          "%(instance_name)s: %(ex)s",
+                          {'instance_name': instance_name, 'ex': ex})
+        return over_committed_size // units.Gi
+
     def _get_hypervisor_version(self):
         """Get hypervisor version.
         :returns: hypervisor version (ex. 6003)
@@ -184,6 +213,8 @@ class HostOps(object):
                'memory_mb_used': used_mem_mb,
                'local_gb': total_hdd_gb,
                'local_gb_used': used_hdd_gb,
+               'disk_available_least': (
+                   free_hdd_gb - self._get_disk_over_committed_size_gb()),
                'hypervisor_type': "hyperv",
                'hypervisor_version': self._get_hypervisor_version(),
                'hypervisor_hostname': platform.node(),
@@ -195,6 +226,14 @@ class HostOps(object):
                }
         dic.update(gpu_info)
 
+        # Only the well known resources are copied to the compute node
+        # record, the driver specific ones being published as stats.
+        stats = {'image_cache_size_bytes': self._imagecache.get_cache_size()}
+        stats.update(self._imagecache.get_cache_stats())
+        stats.update(self._ephemeral_disk_pool.get_pool_stats())
+        stats.update(self._vm_shell_pool.get_pool_stats())
+        dic['stats'] = stats
+
         numa_topology = self._get_host_numa_topology()
         if numa_topology:
             dic['numa_topology'] = numa_topology._to_json()
@@ -15,8 +15,9 @@
 """
 Image caching and management.
 """
+import collections
 import os
-import re
+import time
 
 from nova import exception
 from nova import utils
@@ -28,22 +29,57 @@ from oslo_utils import excutils
 from oslo_utils import units
 from oslo_utils import uuidutils
 
-from hyperv.i18n import _
+from hyperv.i18n import _, _LI, _LW
+from hyperv.nova import constants
+from hyperv.nova import filelock
+from hyperv.nova import imagecacheindex
+from hyperv.nova import imagefetcher
 from hyperv.nova import utilsfactory
+from hyperv.nova import vmutils
 
 LOG = logging.getLogger(__name__)
 
+hyperv_opts = [
+    cfg.IntOpt('image_cache_max_size',
+               default=0,
+               min=0,
+               help='The maximum size, in bytes, of the cached images. '
+                    'When exceeded, the least recently used images that '
+                    'are not used by any instance are removed, along with '
+                    'their resized copies, regardless of their age. '
+                    '0 means unlimited.'),
+    cfg.IntOpt('shared_image_cache_lock_timeout',
+               default=120,
+               min=10,
+               help='The time, in seconds, after which the image lock '
+                    'files placed in the shared base image directory are '
+                    'considered stale, if not renewed by their owner. '
+                    'The age of the lock files is determined by comparing '
+                    'the local time with their modification time, which '
+                    'is set by the file server, so this must be well above '
+                    'the clock skew between the hosts and the file '
+                    'server.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
 CONF.import_opt('use_cow_images', 'nova.virt.driver')
 CONF.import_opt('instances_path', 'nova.compute.manager')
 CONF.import_opt('remove_unused_original_minimum_age_seconds',
                 'nova.virt.imagecache')
+CONF.import_opt('host', 'nova.netconf')
+
+_LEASES_DIR_NAME = '.leases'
+
+# Shared by all the ImageCache instances.
+_cache_stats = collections.Counter()
 
 
 def synchronize_with_path(f):
     def wrapper(self, image_path):
 
-        @utils.synchronized(image_path)
+        # Use the same lock as the image fetch or resize operations.
+        @self._synchronized(os.path.splitext(image_path)[0])
         def inner():
             return f(self, image_path)
         return inner()
@@ -56,10 +92,92 @@ class ImageCache(imagecache.ImageCacheManager):
         super(ImageCache, self).__init__()
         self._pathutils = utilsfactory.get_pathutils()
         self._vhdutils = utilsfactory.get_vhdutils()
+        self._fetcher = imagefetcher.ImageFetcher()
         self.used_images = []
-        self.unexplained_images = []
         self.originals = []
 
+    def _get_index(self):
+        base_vhd_dir = self._pathutils.get_base_vhd_dir()
+        if self._pathutils.is_base_vhd_dir_shared():
+            # Each host keeps track of the images it uses.
+            index_file_name = 'imagecache-%s%s' % (
+                CONF.host, imagecacheindex.INDEX_FILE_EXT)
+        else:
+            index_file_name = imagecacheindex.INDEX_FILE_NAME
+        return imagecacheindex.get_image_cache_index(base_vhd_dir,
+                                                     index_file_name)
+
+    def _synchronized(self, path):
+        """Returns a decorator serializing the cached image operations.
+
+        When the base image dir is shared, the operations are serialized
+        across hosts as well, using lock files.
+        """
+        def decorator(f):
+            @utils.synchronized(path)
+            def inner(*args, **kwargs):
+                if not self._pathutils.is_base_vhd_dir_shared():
+                    return f(*args, **kwargs)
+
+                with filelock.FileLock(
+                        path + filelock.LOCK_FILE_EXT,
+                        CONF.hyperv.shared_image_cache_lock_timeout):
+                    return f(*args, **kwargs)
+            return inner
+        return decorator
+
+    @staticmethod
+    def _get_image_id(image_path):
+        # Cached image file names have the following format:
+        # <image_id>[_<root_gb>].<format_ext>
+        file_name = os.path.splitext(os.path.basename(image_path))[0]
+        return file_name.split('_')[0]
+
+    def _get_image_lease_dir(self, image_id):
+        return os.path.join(self._pathutils.get_base_vhd_dir(),
+                            _LEASES_DIR_NAME, image_id)
+
+    def _renew_image_leases(self, image_ids):
+        # Lets the other hosts sharing the base image dir know that
+        # the images are in use.
+        for image_id in image_ids:
+            lease_dir = self._get_image_lease_dir(image_id)
+            lease_path = os.path.join(lease_dir, CONF.host)
+            try:
+                if not self._pathutils.exists(lease_dir):
+                    self._pathutils.makedirs(lease_dir)
+                with open(lease_path, 'a'):
+                    pass
+                os.utime(lease_path, None)
+            except (IOError, OSError) as err:
+                LOG.warning(_LW("Failed to renew image %(image_id)s lease. "
+                                "Error: %(err)s"),
+                            {'image_id': image_id, 'err': err})
+
+    def _is_image_leased_by_peers(self, image_id):
+        if not self._pathutils.is_base_vhd_dir_shared():
+            return False
+
+        lease_dir = self._get_image_lease_dir(image_id)
+        try:
+            hosts = os.listdir(lease_dir)
+        except OSError:
+            return False
+
+        max_age_seconds = CONF.remove_unused_original_minimum_age_seconds
+        for host in hosts:
+            if host == CONF.host:
+                continue
+
+            try:
+                lease_age = time.time() - os.path.getmtime(
+                    os.path.join(lease_dir, host))
+            except OSError:
+                continue
+            if lease_age < max_age_seconds:
+                return True
+        return False
+
     def _get_root_vhd_size_gb(self, instance):
         if instance.old_flavor:
             return instance.old_flavor.root_gb
@@ -67,10 +185,23 @@ class ImageCache(imagecache.ImageCacheManager):
             return instance.root_gb
 
     def _resize_and_cache_vhd(self, instance, vhd_path):
+        root_vhd_size_gb = self._get_root_vhd_size_gb(instance)
+        resized_vhd_path, cached = self.cache_resized_vhd(vhd_path,
+                                                          root_vhd_size_gb)
+        if resized_vhd_path:
+            self._record_cache_access('resize', cached)
+        return resized_vhd_path
+
+    def cache_resized_vhd(self, vhd_path, root_vhd_size_gb):
+        """Caches a copy of the VHD image, resized to the specified size.
+
+        Returns the resized image path, None if the image already has
+        the requested size, along with whether the resized image was
+        already cached.
+        """
         vhd_info = self._vhdutils.get_vhd_info(vhd_path)
         vhd_size = vhd_info['MaxInternalSize']
 
-        root_vhd_size_gb = self._get_root_vhd_size_gb(instance)
         root_vhd_size = root_vhd_size_gb * units.Gi
 
         root_vhd_internal_size = (
@@ -86,67 +217,160 @@ class ImageCache(imagecache.ImageCacheManager):
                                             root_vhd_size_gb,
                                             path_parts[1])
 
-            @utils.synchronized(resized_vhd_path)
+            @self._synchronized(os.path.splitext(resized_vhd_path)[0])
             def copy_and_resize_vhd():
-                if not self._pathutils.exists(resized_vhd_path):
-                    try:
-                        LOG.debug("Copying VHD %(vhd_path)s to "
-                                  "%(resized_vhd_path)s",
-                                  {'vhd_path': vhd_path,
-                                   'resized_vhd_path': resized_vhd_path})
-                        self._pathutils.copyfile(vhd_path, resized_vhd_path)
-                        LOG.debug("Resizing VHD %(resized_vhd_path)s to new "
-                                  "size %(root_vhd_size)s",
-                                  {'resized_vhd_path': resized_vhd_path,
-                                   'root_vhd_size': root_vhd_size})
-                        self._vhdutils.resize_vhd(resized_vhd_path,
-                                                  root_vhd_internal_size,
-                                                  is_file_max_size=False)
-                    except Exception:
-                        with excutils.save_and_reraise_exception():
-                            if self._pathutils.exists(resized_vhd_path):
-                                self._pathutils.remove(resized_vhd_path)
-
-            copy_and_resize_vhd()
-            return resized_vhd_path
-
-    def get_cached_image(self, context, instance, rescue_image_id=None):
-        image_id = rescue_image_id or instance.image_ref
-        image_type = instance.system_metadata['image_disk_format']
+                if self._pathutils.exists(resized_vhd_path):
+                    return True
 
+                try:
+                    LOG.debug("Copying VHD %(vhd_path)s to "
+                              "%(resized_vhd_path)s",
+                              {'vhd_path': vhd_path,
+                               'resized_vhd_path': resized_vhd_path})
+                    self._pathutils.copyfile(vhd_path, resized_vhd_path)
+                    LOG.debug("Resizing VHD %(resized_vhd_path)s to new "
+                              "size %(root_vhd_size)s",
+                              {'resized_vhd_path': resized_vhd_path,
+                               'root_vhd_size': root_vhd_size})
+                    self._vhdutils.resize_vhd(resized_vhd_path,
+                                              root_vhd_internal_size,
+                                              is_file_max_size=False)
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        if self._pathutils.exists(resized_vhd_path):
+                            self._pathutils.remove(resized_vhd_path)
+
+                image_id = os.path.splitext(
+                    os.path.basename(vhd_path))[0]
+                self._get_index().add_resized_image(
+                    image_id, root_vhd_size_gb,
+                    os.path.getsize(resized_vhd_path))
+                return False
+
+            cached = copy_and_resize_vhd()
+            return resized_vhd_path, cached
+        return None, True
+
+    def cache_image(self, context, image_id, image_type=None):
+        """Fetches the image, unless already cached.
+
+        If the image type is not provided, the detected image format is
+        used. Returns the cached image path along with whether the image
+        was already cached.
+        """
         base_image_dir = self._pathutils.get_base_vhd_dir()
         base_image_path = os.path.join(base_image_dir, image_id)
+        index = self._get_index()
+        is_shared = self._pathutils.is_base_vhd_dir_shared()
 
-        @utils.synchronized(base_image_path)
+        @self._synchronized(base_image_path)
         def fetch_image_if_not_existing():
-            image_path = None
-            for format_ext in ['vhd', 'vhdx', 'iso']:
-                test_path = base_image_path + '.' + format_ext
-                if self._pathutils.exists(test_path):
-                    image_path = test_path
+            image_path = index.get_image_path(image_id)
+            if image_path:
+                if self._pathutils.exists(image_path):
                     self._update_image_timestamp(image_id)
-                    break
-
-            if not image_path:
-                try:
-                    images.fetch(context, image_id, base_image_path,
-                                 instance.user_id,
-                                 instance.project_id)
-                    if image_type == 'iso':
-                        format_ext = 'iso'
-                    else:
-                        format_ext = self._vhdutils.get_vhd_format(
-                            base_image_path)
-                    image_path = base_image_path + '.' + format_ext.lower()
+                else:
+                    # The image was removed without updating the index.
+                    index.remove_image_file(image_path)
+                    image_path = None
+
+            if not image_path and is_shared:
+                # The image may have been fetched by another host.
+                image_path = self._pathutils.lookup_image_basepath(image_id)
+                if image_path:
+                    index.add_image(image_id,
+                                    os.path.splitext(image_path)[1][1:],
+                                    os.path.getsize(image_path))
+
+            if is_shared:
+                self._renew_image_leases([image_id])
+
+            if image_path:
+                return image_path, True
+
+            try:
+                image_meta = self._fetcher.get_image_meta(context, image_id)
+                image_format = self._fetcher.fetch(context, image_id,
+                                                   base_image_path,
+                                                   image_meta=image_meta)
+                if image_type == 'iso' or (
+                        image_type is None and
+                        image_format == constants.DVD_FORMAT):
+                    format_ext = 'iso'
+                elif image_format in (constants.DISK_FORMAT_VHD,
+                                      constants.DISK_FORMAT_VHDX):
+                    format_ext = image_format
+                else:
+                    raise vmutils.HyperVException(
+                        _('Unsupported virtual disk format'))
+                image_path = base_image_path + '.' + format_ext.lower()
+                image_props = image_meta.get('properties') or {}
+                if (format_ext != 'iso' and
+                        image_props.get(constants.IMAGE_PROP_PARENT_IMAGE_ID)):
+                    self._rebuild_incremental_image(
+                        context, image_id, image_props, base_image_path,
+                        image_path)
+                else:
                     self._pathutils.rename(base_image_path, image_path)
-                except Exception:
-                    with excutils.save_and_reraise_exception():
-                        if self._pathutils.exists(base_image_path):
-                            self._pathutils.remove(base_image_path)
+                index.add_image(image_id, format_ext,
+                                os.path.getsize(image_path))
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    if self._pathutils.exists(base_image_path):
+                        self._pathutils.remove(base_image_path)
+
+            return image_path, False
+
+        return fetch_image_if_not_existing()
+
+    def _rebuild_incremental_image(self, context, image_id, image_props,
+                                   diff_path, image_path):
+        """Rebuilds an image holding only the differencing disk of its
+        parent image.
+
+        The parent image is fetched into the cache, unless already cached,
+        the differencing disk being merged with it into a standalone image.
+        """
+        parent_image_id = image_props[constants.IMAGE_PROP_PARENT_IMAGE_ID]
+        parent_root_gb = image_props.get(constants.IMAGE_PROP_PARENT_ROOT_GB)
+
+        parent_path = self.cache_image(context, parent_image_id)[0]
+        if parent_root_gb:
+            # The snapshot disk is based on a resized copy of the parent.
+            resized_parent_path = self.cache_resized_vhd(
+                parent_path, int(parent_root_gb))[0]
+            parent_path = resized_parent_path or parent_path
+
+        # The differencing disk needs a VHD / VHDX file extension.
+        diff_vhd_path = '%s.diff%s' % (diff_path,
+                                       os.path.splitext(image_path)[1])
+        self._pathutils.rename(diff_path, diff_vhd_path)
+        try:
+            self._vhdutils.reconnect_parent_vhd(diff_vhd_path, parent_path)
+            if not self._vhdutils.merge_vhd_chain(diff_vhd_path,
+                                                  image_path):
+                self._pathutils.copyfile(parent_path, image_path)
+                self._vhdutils.reconnect_parent_vhd(diff_vhd_path,
+                                                    image_path)
+                self._vhdutils.merge_vhd(diff_vhd_path, image_path)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if self._pathutils.exists(image_path):
+                    self._pathutils.remove(image_path)
+        finally:
+            if self._pathutils.exists(diff_vhd_path):
+                self._pathutils.remove(diff_vhd_path)
+
+        LOG.info(_LI("Rebuilt incremental snapshot image %(image_id)s on "
+                     "top of the cached parent image %(parent_path)s."),
+                 {'image_id': image_id, 'parent_path': parent_path})
 
-            return image_path
+    def get_cached_image(self, context, instance, rescue_image_id=None):
+        image_id = rescue_image_id or instance.image_ref
+        image_type = instance.system_metadata['image_disk_format']
 
-        image_path = fetch_image_if_not_existing()
+        image_path, cached = self.cache_image(context, image_id, image_type)
+        self._record_cache_access('image', cached)
 
         # Note: rescue images are not resized.
         is_vhd = image_path.split('.')[-1].lower() == 'vhd'
@@ -163,6 +387,21 @@ class ImageCache(imagecache.ImageCacheManager):
 
         return image_path
 
+    @staticmethod
+    def _record_cache_access(kind, cached):
+        _cache_stats['%s_%s' % (kind, 'hits' if cached else 'misses')] += 1
+
+    def get_cache_stats(self):
+        """Returns the image cache hit and miss counters.
+
+        Only the images requested by instances are accounted, the
+        resized image counters covering the resized VHD copies.
+        """
+        return {'image_cache_hits': _cache_stats['image_hits'],
+                'image_cache_misses': _cache_stats['image_misses'],
+                'image_cache_resize_hits': _cache_stats['resize_hits'],
+                'image_cache_resize_misses': _cache_stats['resize_misses']}
+
     def _verify_rescue_image(self, instance, rescue_image_id,
                              rescue_image_path):
         rescue_image_info = self._vhdutils.get_vhd_info(rescue_image_path)
@@ -194,50 +433,157 @@ class ImageCache(imagecache.ImageCacheManager):
                 self._remove_if_old_image(img)
 
     def _update_image_timestamp(self, image_name):
-        backing_files = self._get_image_backing_files(image_name)
-        for img in backing_files:
-            os.utime(img, None)
+        self._get_index().mark_used(image_name)
 
     def _get_image_backing_files(self, image_name):
-        backing_files = [self._pathutils.lookup_image_basepath(image_name)]
-        resize_re = re.compile('%s_[0-9]+$' % image_name)
-        for img in self.unexplained_images:
-            match = resize_re.match(img)
-            if match:
-                backing_files.append(
-                    self._pathutils.lookup_image_basepath(img))
-
-        return backing_files
+        image_files = self._get_index().get_image_files(image_name)
+        return [path for path, size in image_files]
 
     def _remove_if_old_image(self, image_name):
         max_age_seconds = CONF.remove_unused_original_minimum_age_seconds
-        backing_files = self._get_image_backing_files(image_name)
-        for img in backing_files:
-            age_seconds = self._pathutils.get_age_of_file(img)
-            if age_seconds > max_age_seconds:
+        image = self._get_index().get_image(image_name)
+        if not image:
+            return
+
+        age_seconds = time.time() - image['last_used']
+        if age_seconds > max_age_seconds:
+            for img in self._get_image_backing_files(image_name):
                 self.remove_old_image(img)
 
     @synchronize_with_path
     def remove_old_image(self, img):
+        """Removes the cached image, unless used by other hosts.
+
+        Returns True if the image was removed.
+        """
+        image_id = self._get_image_id(img)
+        if self._is_image_leased_by_peers(image_id):
+            LOG.debug("Not removing cached image %s as it is used by "
+                      "other hosts.", img)
+            return False
+
         self._pathutils.remove(img)
+        self._get_index().remove_image_file(img)
+        return True
+
+    def list_recently_used_images(self, max_images):
+        """Returns the most recently used cached images."""
+        index = self._get_index()
+        images = []
+        for image_id in index.list_images():
+            record = index.get_image(image_id)
+            if record and record['format']:
+                images.append((record['last_used'], image_id))
+
+        images.sort(reverse=True)
+        return [image_id for last_used, image_id in images[:max_images]]
+
+    def get_cache_size(self):
+        """Returns the size of the cached images, in bytes."""
+        return self._get_index().get_cache_size()
+
+    def get_cached_images_disk_info(self):
+        """Returns the virtual and the actually used size of the cached
+        images, including their resized copies.
+        """
+        index = self._get_index()
+        disk_info = []
+        for image_id in index.list_images():
+            for path, size in index.get_image_files(image_id):
+                image_info = {'image_id': image_id,
+                              'path': path,
+                              'disk_size': size}
+                if path.lower().endswith(('.vhd', '.vhdx')):
+                    try:
+                        allocation_info = (
+                            self._vhdutils.get_vhd_allocation_info(path))
+                    except vmutils.HyperVException as ex:
+                        LOG.debug("Could not get the allocation info of "
+                                  "image %(path)s: %(ex)s",
+                                  {'path': path, 'ex': ex})
+                    else:
+                        image_info.update(
+                            disk_size=allocation_info['FileSize'],
+                            virt_disk_size=allocation_info[
+                                'MaxInternalSize'],
+                            allocated_size=allocation_info[
+                                'AllocatedBytes'])
+                disk_info.append(image_info)
+        return disk_info
+
+    def _evict_least_recently_used_images(self, base_dir):
+        max_cache_size = CONF.hyperv.image_cache_max_size
+        if not max_cache_size:
+            return
+
+        index = self._get_index()
+        cache_size = index.get_cache_size()
+        if cache_size <= max_cache_size:
+            return
+
+        unused_images = []
+        for img in self.originals:
+            if img in self.used_images:
+                continue
+
+            image = index.get_image(img)
+            image_files = index.get_image_files(img)
+            if image and image_files:
+                unused_images.append((image['last_used'], img, image_files))
+
+        for last_used, img, image_files in sorted(unused_images):
+            if cache_size <= max_cache_size:
+                break
+
+            LOG.info(_LI("Removing unused image %(image)s as the image "
+                         "cache exceeds %(max_cache_size)s bytes."),
+                     {'image': img, 'max_cache_size': max_cache_size})
+            for path, size in image_files:
+                try:
+                    if self.remove_old_image(path):
+                        cache_size -= size
+                except Exception as ex:
+                    LOG.warning(_LW("Failed to remove cached image "
+                                    "%(path)s. Error: %(ex)s"),
+                                {'path': path, 'ex': ex})
+
+        if cache_size > max_cache_size:
+            LOG.warning(_LW("The image cache size (%(cache_size)s bytes) "
+                            "exceeds the configured maximum size "
+                            "(%(max_cache_size)s bytes), the remaining "
+                            "images being in use."),
+                        {'cache_size': cache_size,
+                         'max_cache_size': max_cache_size})
 
     def update(self, context, all_instances):
         base_vhd_dir = self._pathutils.get_base_vhd_dir()
 
         running = self._list_running_instances(context, all_instances)
         self.used_images = running['used_images'].keys()
-        all_files = self.list_base_images(base_vhd_dir)
-        self.originals = all_files['originals']
-        self.unexplained_images = all_files['unexplained_images']
+
+        if self._pathutils.is_base_vhd_dir_shared():
+            self._renew_image_leases(self.used_images)
+
+        index = self._get_index()
+        refcounts = {}
+        for image_id, (local, remote, instance_names) in (
+                running['used_images'].items()):
+            refcounts[image_id] = local + remote
+        index.update_refcounts(refcounts)
+        self.originals = index.list_images()
 
         self._age_and_verify_cached_images(context, all_instances,
                                            base_vhd_dir)
+        self._evict_least_recently_used_images(base_vhd_dir)
 
     def list_base_images(self, base_dir):
         unexplained_images = []
         originals = []
 
         for entry in os.listdir(base_dir):
+            if entry.endswith(imagecacheindex.INDEX_FILE_EXT):
+                continue
+
             # remove file extension
             file_name = os.path.splitext(entry)[0]
             if uuidutils.is_uuid_like(file_name):
@@ -0,0 +1,318 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Persistent metadata index of the cached images.
+"""
+import copy
+import json
+import os
+import re
+import threading
+import time
+
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+
+from hyperv.i18n import _LW
+
+LOG = logging.getLogger(__name__)
+
+INDEX_FILE_EXT = '.idx'
+INDEX_FILE_NAME = 'imagecache' + INDEX_FILE_EXT
+
+# Cached image file names, e.g. <image_id>.vhdx or <image_id>_<root_gb>.vhd
+# for the resized copies.
+_IMAGE_FILE_RE = re.compile(
+    r'^(?P<image_id>[^_.]+)(?:_(?P<root_gb>[0-9]+))?'
+    r'\.(?P<format>vhdx?|iso)$', re.IGNORECASE)
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_image_cache_index(base_dir, index_file_name=INDEX_FILE_NAME):
+    """Returns the index of the specified base image dir, loading it if
+    needed.
+    """
+    with _indexes_lock:
+        index = _indexes.get(base_dir)
+        if not index:
+            index = ImageCacheIndex(base_dir, index_file_name)
+            index.load()
+            _indexes[base_dir] = index
+        return index
+
+
+class ImageCacheIndex(object):
+    """Keeps track of the images cached in a base image directory.
+
+    For each image, the index records the image format and size, the
+    resized copies, the number of instances using it and the last time
+    it was used. The index is kept in memory, changes being appended to
+    a journal stored along with the cached images. The journal is
+    compacted when loaded, the base image directory being scanned at
+    this point, accounting for changes made while the index was not in
+    use.
+    """
+
+    # The journal is compacted once it holds this many entries for each
+    # cached image.
+    _JOURNAL_COMPACT_RATIO = 8
+    _JOURNAL_MIN_ENTRIES = 128
+
+    def __init__(self, base_dir, index_file_name=INDEX_FILE_NAME):
+        self._base_dir = base_dir
+        self._journal_path = os.path.join(base_dir, index_file_name)
+        self._images = {}
+        self._journal_entries = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            self._images = {}
+
+            tmp_journal_path = self._journal_path + '.tmp'
+            if os.path.exists(self._journal_path):
+                self._replay_journal(self._journal_path)
+            elif os.path.exists(tmp_journal_path):
+                # The service stopped while compacting the journal.
+                self._replay_journal(tmp_journal_path)
+
+            self._reconcile()
+            if os.path.isdir(self._base_dir):
+                self._compact_journal()
+
+    def _replay_journal(self, journal_path):
+        with open(journal_path, 'r') as journal:
+            for line in journal:
+                try:
+                    image_id, record = json.loads(line)
+                except ValueError:
+                    # Incomplete entry, written while the service stopped.
+                    LOG.warning(_LW("Ignoring invalid image cache index "
+                                    "entry: %s"), line)
+                    continue
+
+                if record:
+                    self._images[image_id] = record
+                else:
+                    self._images.pop(image_id, None)
+
+    def _reconcile(self):
+        scanned_files = {}
+        if os.path.isdir(self._base_dir):
+            for entry in os.listdir(self._base_dir):
+                match = _IMAGE_FILE_RE.match(entry)
+                if not (match and
+                        uuidutils.is_uuid_like(match.group('image_id'))):
+                    continue
+
+                image_files = scanned_files.setdefault(
+                    match.group('image_id'), {})
+                image_files[match.group('root_gb')] = (
+                    match.group('format').lower())
+
+        for image_id in set(self._images) | set(scanned_files):
+            record = self._images.get(image_id) or self._new_record()
+            image_files = scanned_files.get(image_id, {})
+
+            image_format = image_files.pop(None, None)
+            if image_format != record['format']:
+                record['format'] = None
+                record['size'] = 0
+                if image_format:
+                    size = self._stat_image_file(
+                        record, self._get_path(image_id, image_format))
+                    if size is not None:
+                        record['format'] = image_format
+                        record['size'] = size
+
+            resized = {}
+            for root_gb, resized_format in image_files.items():
+                if root_gb in record['resized']:
+                    resized[root_gb] = record['resized'][root_gb]
+                    continue
+
+                size = self._stat_image_file(
+                    record, self._get_path(image_id, resized_format, root_gb))
+                if size is not None:
+                    resized[root_gb] = size
+            record['resized'] = resized
+
+            if record['format'] or record['resized']:
+                self._images[image_id] = record
+            else:
+                self._images.pop(image_id, None)
+
+    def _stat_image_file(self, record, path):
+        # Returns the file size, None if the file was removed meanwhile.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        # Files that were not indexed are considered last used when
+        # modified.
+        record['last_used'] = max(record['last_used'], stat.st_mtime)
+        return stat.st_size
+
+    def _compact_journal(self):
+        tmp_journal_path = self._journal_path + '.tmp'
+        try:
+            with open(tmp_journal_path, 'w') as journal:
+                for image_id, record in self._images.items():
+                    journal.write(self._get_journal_entry(image_id, record))
+
+            if os.path.exists(self._journal_path):
+                os.remove(self._journal_path)
+            os.rename(tmp_journal_path, self._journal_path)
+            self._journal_entries = len(self._images)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW("Failed to write the image cache index "
+                            "%(path)s. Error: %(err)s"),
+                        {'path': self._journal_path, 'err': err})
+
+    def _get_journal_entry(self, image_id, record):
+        return json.dumps([image_id, record]) + '\n'
+
+    def _save_image(self, image_id):
+        # The lock is expected to be held by the caller.
+        record = self._images.get(image_id)
+        if record and not (record['format'] or record['resized']):
+            del self._images[image_id]
+            record = None
+
+        try:
+            with open(self._journal_path, 'a') as journal:
+                journal.write(self._get_journal_entry(image_id, record))
+            self._journal_entries += 1
+        except (IOError, OSError) as err:
+            # The index is rebuilt from the base image dir when loaded.
+            LOG.warning(_LW("Failed to write the image cache index "
+                            "%(path)s. Error: %(err)s"),
+                        {'path': self._journal_path, 'err': err})
+            return
+
+        max_entries = max(self._JOURNAL_MIN_ENTRIES,
+                          len(self._images) * self._JOURNAL_COMPACT_RATIO)
+        if self._journal_entries > max_entries:
+            self._compact_journal()
+
+    @staticmethod
+    def _new_record():
+        return {'format': None,
+                'size': 0,
+                'resized': {},
+                'refcount': 0,
+                'last_used': 0}
+
+    def _get_path(self, image_id, image_format, root_gb=None):
+        if root_gb:
+            file_name = '%s_%s.%s' % (image_id, root_gb, image_format)
+        else:
+            file_name = '%s.%s' % (image_id, image_format)
+        return os.path.join(self._base_dir, file_name)
+
+    def list_images(self):
+        with self._lock:
+            return list(self._images)
+
+    def get_image(self, image_id):
+        """Returns a copy of the image record, or None if not cached."""
+        with self._lock:
+            return copy.deepcopy(self._images.get(image_id))
+
+    def get_image_path(self, image_id):
+        with self._lock:
+            record = self._images.get(image_id)
+            if record and record['format']:
+                return self._get_path(image_id, record['format'])
+
+    def get_image_files(self, image_id):
+        """Returns the paths and sizes of the cached image files,
+
+        including the resized copies.
+        """
+        with self._lock:
+            record = self._images.get(image_id)
+            if not record:
+                return []
+
+            image_files = []
+            if record['format']:
+                image_files.append(
+                    (self._get_path(image_id, record['format']),
+                     record['size']))
+            # The resized copies always have the original image format.
+            image_format = record['format'] or 'vhd'
+            for root_gb, size in sorted(record['resized'].items()):
+                image_files.append(
+                    (self._get_path(image_id, image_format, root_gb), size))
+            return image_files
+
+    def get_cache_size(self):
+        with self._lock:
+            return sum(record['size'] + sum(record['resized'].values())
+                       for record in self._images.values())
+
+    def add_image(self, image_id, image_format, size):
+        with self._lock:
+            record = self._images.setdefault(image_id, self._new_record())
+            record['format'] = image_format.lower()
+            record['size'] = size
+            record['last_used'] = time.time()
+            self._save_image(image_id)
+
+    def add_resized_image(self, image_id, root_gb, size):
+        with self._lock:
+            record = self._images.setdefault(image_id, self._new_record())
+            record['resized'][str(root_gb)] = size
+            record['last_used'] = time.time()
+            self._save_image(image_id)
+
+    def remove_image_file(self, path):
+        match = _IMAGE_FILE_RE.match(os.path.basename(path))
+        if not match:
+            return
+
+        image_id = match.group('image_id')
+        with self._lock:
+            record = self._images.get(image_id)
+            if not record:
+                return
+
+            root_gb = match.group('root_gb')
+            if root_gb:
+                record['resized'].pop(root_gb, None)
+            else:
+                record['format'] = None
+                record['size'] = 0
+            self._save_image(image_id)
+
+    def mark_used(self, image_id):
+        with self._lock:
+            record = self._images.get(image_id)
+            if record:
+                record['last_used'] = time.time()
+                self._save_image(image_id)
+
+    def update_refcounts(self, refcounts):
+        """Sets the number of instances using each cached image."""
+        with self._lock:
+            for image_id, record in list(self._images.items()):
+                refcount = refcounts.get(image_id, 0)
+                if record['refcount'] != refcount:
+                    record['refcount'] = refcount
+                    self._save_image(image_id)
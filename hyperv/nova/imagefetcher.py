@@ -0,0 +1,305 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Streaming image downloads.
+"""
+import hashlib
+import os
+
+from nova import exception
+from nova import image
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import excutils
+from oslo_utils import units
+
+from hyperv.i18n import _, _LI, _LW
+from hyperv.nova import constants
+from hyperv.nova import ioutils
+from hyperv.nova import vhdutils
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.IntOpt('image_fetch_buffer_size',
+               default=8 * units.Mi,
+               min=units.Mi,
+               help='The amount of image data, in bytes, buffered before '
+                    'being written to disk when fetching images.'),
+    cfg.IntOpt('image_fetch_retries',
+               default=3,
+               min=0,
+               help='The number of times an interrupted image download is '
+                    'resumed before giving up.'),
+    cfg.ListOpt('image_cache_peer_dirs',
+                default=[],
+                help='Base image directories of other compute nodes, '
+                     'usually SMB shares, from which cached images are '
+                     'copied instead of being downloaded from Glance. '
+                     'The copied images are verified against the Glance '
+                     'image checksum, images without a checksum always '
+                     'being downloaded from Glance.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+PARTIAL_FILE_EXT = '.part'
+
+_ISO_SIGNATURE = b'CD001'
+_ISO_SIGNATURE_OFFSET = 0x8001
+
+
+class _ImageFormatDetector(object):
+    """Detects the image format while the image is being streamed."""
+
+    _HEADER_SIZE = _ISO_SIGNATURE_OFFSET + len(_ISO_SIGNATURE)
+    _FOOTER_SIZE = 512
+
+    def __init__(self):
+        self._header = b''
+        self._footer = b''
+        self.size = 0
+
+    def update(self, chunk):
+        if len(self._header) < self._HEADER_SIZE:
+            self._header += chunk[:self._HEADER_SIZE - len(self._header)]
+        self._footer = (self._footer +
+                        chunk[-self._FOOTER_SIZE:])[-self._FOOTER_SIZE:]
+        self.size += len(chunk)
+
+    def get_format(self):
+        if self._header[:8] == vhdutils.VHDX_SIGNATURE:
+            return constants.DISK_FORMAT_VHDX
+        if (self.size >= self._FOOTER_SIZE and
+                self._footer[:8] == vhdutils.VHD_SIGNATURE):
+            return constants.DISK_FORMAT_VHD
+        if (self._header[_ISO_SIGNATURE_OFFSET:self._HEADER_SIZE] ==
+                _ISO_SIGNATURE):
+            return constants.DVD_FORMAT
+
+
+class ImageFetcher(object):
+    """Streams images from Glance or from peer image caches to disk.
+
+    The image format is detected and the image checksum is verified
+    while the image is being downloaded, so the image is not read back
+    from disk. Image data is buffered and written in large chunks,
+    aligned to the disk sector size.
+    """
+
+    _IMAGE_FILE_EXTENSIONS = ('vhd', 'vhdx', 'iso')
+
+    _WRITE_ALIGNMENT = 4 * units.Ki
+
+    def __init__(self):
+        self._image_api = image.API()
+
+    def get_image_meta(self, context, image_id):
+        return self._image_api.get(context, image_id)
+
+    def fetch(self, context, image_id, path, image_meta=None):
+        """Downloads the image to the specified path, returning its format.
+
+        The image is written to a partial file, renamed once the download
+        completes. Interrupted downloads are retried, the data already
+        written to the partial file being kept. As Glance does not serve
+        image ranges, the image is streamed again from the beginning,
+        without writing the existing data again.
+
+        Images already cached by peer compute nodes are copied from
+        their base image directories, Glance being used as a fallback.
+
+        The image metadata is retrieved, unless provided.
+
+        None is returned if the image format could not be detected.
+        """
+        if image_meta is None:
+            image_meta = self.get_image_meta(context, image_id)
+        partial_path = path + PARTIAL_FILE_EXT
+
+        try:
+            copied, image_format = self._copy_from_peers(
+                image_id, image_meta, partial_path)
+            if not copied:
+                image_format = self._download_from_glance(
+                    context, image_id, image_meta, partial_path)
+
+            os.rename(partial_path, path)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+        return image_format
+
+    def _get_peer_image_paths(self, image_id):
+        for peer_dir in CONF.hyperv.image_cache_peer_dirs:
+            for format_ext in self._IMAGE_FILE_EXTENSIONS:
+                peer_image_path = os.path.join(
+                    peer_dir, '%s.%s' % (image_id, format_ext))
+                if os.path.exists(peer_image_path):
+                    yield peer_image_path
+                    break
+
+    def _copy_from_peers(self, image_id, image_meta, partial_path):
+        # Returns whether the image was copied, along with its format.
+        if not image_meta.get('checksum'):
+            return False, None
+
+        for peer_image_path in self._get_peer_image_paths(image_id):
+            try:
+                image_format = self._copy_from_peer(
+                    image_id, image_meta, peer_image_path, partial_path)
+            except Exception as ex:
+                LOG.warning(_LW("Failed to copy image %(image_id)s from "
+                                "%(peer_image_path)s. Error: %(ex)s"),
+                            {'image_id': image_id,
+                             'peer_image_path': peer_image_path,
+                             'ex': ex})
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                continue
+
+            LOG.info(_LI("Copied image %(image_id)s from "
+                         "%(peer_image_path)s."),
+                     {'image_id': image_id,
+                      'peer_image_path': peer_image_path})
+            return True, image_format
+
+        return False, None
+
+    def _copy_from_peer(self, image_id, image_meta, peer_image_path,
+                        partial_path):
+        buffer_size = CONF.hyperv.image_fetch_buffer_size
+        with open(peer_image_path, 'rb') as peer_image:
+            image_chunks = iter(
+                lambda: ioutils.avoid_blocking_call(peer_image.read,
+                                                    buffer_size),
+                b'')
+            return self._write_image(image_id, image_meta, image_chunks,
+                                     partial_path)
+
+    def _download_from_glance(self, context, image_id, image_meta,
+                              partial_path):
+        retries = 0
+        while True:
+            try:
+                image_chunks = self._image_api.download(context, image_id)
+                return self._write_image(image_id, image_meta, image_chunks,
+                                         partial_path)
+            except exception.ImageUnacceptable:
+                raise
+            except Exception as ex:
+                if retries >= CONF.hyperv.image_fetch_retries:
+                    raise
+
+                retries += 1
+                LOG.warning(_LW("Image %(image_id)s download was "
+                                "interrupted, resuming. Attempt "
+                                "%(attempt)s of %(max_attempts)s. "
+                                "Error: %(ex)s"),
+                            {'image_id': image_id,
+                             'attempt': retries,
+                             'max_attempts': CONF.hyperv.image_fetch_retries,
+                             'ex': ex})
+
+    def _get_resume_offset(self, partial_path):
+        if not os.path.exists(partial_path):
+            return 0
+
+        # Keep the disk writes aligned.
+        partial_size = os.path.getsize(partial_path)
+        return partial_size - partial_size % self._WRITE_ALIGNMENT
+
+    def _write_image(self, image_id, image_meta, image_chunks,
+                     partial_path):
+        resume_offset = self._get_resume_offset(partial_path)
+        if resume_offset:
+            LOG.debug("Resuming image %(image_id)s transfer at offset "
+                      "%(offset)s.",
+                      {'image_id': image_id, 'offset': resume_offset})
+
+        buffer_size = CONF.hyperv.image_fetch_buffer_size
+        checksum = hashlib.md5()
+        format_detector = _ImageFormatDetector()
+
+        with open(partial_path, 'r+b' if resume_offset else 'wb') as f:
+            f.seek(resume_offset)
+            f.truncate()
+
+            stream_offset = 0
+            pending_chunks = []
+            pending_size = 0
+            for chunk in image_chunks:
+                checksum.update(chunk)
+                format_detector.update(chunk)
+
+                # Skip the data that was already written.
+                skip_size = min(len(chunk),
+                                max(0, resume_offset - stream_offset))
+                stream_offset += len(chunk)
+                if skip_size:
+                    chunk = chunk[skip_size:]
+                    if not chunk:
+                        continue
+
+                pending_chunks.append(chunk)
+                pending_size += len(chunk)
+                if pending_size >= buffer_size:
+                    pending_chunks = self._write_chunks(f, pending_chunks)
+                    pending_size = sum(len(c) for c in pending_chunks)
+
+            self._write_chunks(f, pending_chunks, partial_write=True)
+            f.flush()
+            ioutils.avoid_blocking_call(os.fsync, f.fileno())
+
+        self._verify_image(image_id, image_meta, format_detector.size,
+                           checksum.hexdigest())
+        return format_detector.get_format()
+
+    def _write_chunks(self, f, chunks, partial_write=False):
+        # Writes the chunks, returning the remaining unaligned data.
+        data = b''.join(chunks)
+        write_size = len(data)
+        if not partial_write:
+            write_size -= write_size % self._WRITE_ALIGNMENT
+
+        if write_size < len(data):
+            ioutils.avoid_blocking_call(f.write, data[:write_size])
+            return [data[write_size:]]
+
+        if data:
+            ioutils.avoid_blocking_call(f.write, data)
+        return []
+
+    def _verify_image(self, image_id, image_meta, size, checksum):
+        expected_size = image_meta.get('size')
+        if expected_size is not None and expected_size != size:
+            reason = _('Downloaded image size %(size)s does not match the '
+                       'expected size %(expected_size)s.') % {
+                'size': size, 'expected_size': expected_size}
+            raise exception.ImageUnacceptable(image_id=image_id,
+                                              reason=reason)
+
+        expected_checksum = image_meta.get('checksum')
+        if expected_checksum and expected_checksum != checksum:
+            reason = _('Downloaded image checksum %(checksum)s does not '
+                       'match the expected checksum '
+                       '%(expected_checksum)s.') % {
+                'checksum': checksum,
+                'expected_checksum': expected_checksum}
+            raise exception.ImageUnacceptable(image_id=image_id,
+                                              reason=reason)
@@ -0,0 +1,156 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Background image prefetching.
+"""
+import eventlet
+from nova import context as nova_context
+from nova import exception
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from hyperv.i18n import _LI, _LW
+from hyperv.nova import imagecache
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.IntOpt('image_prefetch_interval',
+               default=0,
+               min=0,
+               help='The interval, in seconds, at which the configured and '
+                    'recently used images are prefetched and resized in '
+                    'the background. 0 disables image prefetching.'),
+    cfg.ListOpt('image_prefetch_images',
+                default=[],
+                help='IDs of the images that are always kept cached.'),
+    cfg.IntOpt('image_prefetch_recent_images',
+               default=5,
+               min=0,
+               help='The number of most recently used cached images for '
+                    'which resized copies are prepared, in addition to '
+                    'the images configured through image_prefetch_images.'),
+    cfg.ListOpt('image_prefetch_root_gb',
+                default=[],
+                help='Flavor root disk sizes, in GB, to which the '
+                     'prefetched VHD images are resized in advance, if '
+                     'use_cow_images is enabled. VHDX images are not '
+                     'resized when cached.'),
+    cfg.FloatOpt('image_prefetch_throttle_interval',
+                 default=10,
+                 min=0,
+                 help='The time, in seconds, to wait between image '
+                      'prefetch or resize operations, limiting the '
+                      'impact on the running instances.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+CONF.import_opt('use_cow_images', 'nova.virt.driver')
+
+
+class ImagePrefetcher(object):
+    """Prepares the cached images before the instances need them.
+
+    The configured images are fetched if not already cached, while
+    copies of the configured and the most recently used VHD images are
+    resized to the common flavor root disk sizes. Operations are
+    performed one at a time, pausing in between. Prefetching is
+    skipped while the image cache exceeds its maximum size, so that
+    images are not evicted just to be fetched again.
+    """
+
+    def __init__(self):
+        self._imagecache = imagecache.ImageCache()
+
+    def start(self):
+        if not CONF.hyperv.image_prefetch_interval:
+            return
+
+        eventlet.spawn_n(self._prefetch_images_periodically)
+
+    def _prefetch_images_periodically(self):
+        while True:
+            try:
+                self.prefetch_images()
+            except Exception as ex:
+                LOG.warning(_LW("Image prefetching failed. Error: %s"), ex)
+            eventlet.sleep(CONF.hyperv.image_prefetch_interval)
+
+    def _get_root_gb_sizes(self):
+        if not CONF.use_cow_images:
+            return []
+
+        root_gb_sizes = []
+        for root_gb in CONF.hyperv.image_prefetch_root_gb:
+            try:
+                root_gb_sizes.append(int(root_gb))
+            except ValueError:
+                LOG.warning(_LW("Invalid image prefetch root disk size: "
+                                "%s"), root_gb)
+        return sorted(set(root_gb_sizes))
+
+    def _is_cache_full(self):
+        max_cache_size = CONF.hyperv.image_cache_max_size
+        return bool(max_cache_size and
+                    self._imagecache.get_cache_size() >= max_cache_size)
+
+    def _throttle(self):
+        eventlet.sleep(CONF.hyperv.image_prefetch_throttle_interval)
+
+    def prefetch_images(self):
+        context = nova_context.get_admin_context()
+
+        image_ids = list(CONF.hyperv.image_prefetch_images)
+        for image_id in self._imagecache.list_recently_used_images(
+                CONF.hyperv.image_prefetch_recent_images):
+            if image_id not in image_ids:
+                image_ids.append(image_id)
+
+        for image_id in image_ids:
+            if self._is_cache_full():
+                LOG.info(_LI("Stopping image prefetching as the image "
+                             "cache is full."))
+                return
+
+            try:
+                self._prefetch_image(context, image_id)
+            except Exception as ex:
+                LOG.warning(_LW("Failed to prefetch image %(image_id)s. "
+                                "Error: %(ex)s"),
+                            {'image_id': image_id, 'ex': ex})
+
+        LOG.debug("Image cache statistics: %s",
+                  self._imagecache.get_cache_stats())
+
+    def _prefetch_image(self, context, image_id):
+        image_path, cached = self._imagecache.cache_image(context, image_id)
+        if not cached:
+            LOG.info(_LI("Prefetched image %s."), image_id)
+            self._throttle()
+
+        if not image_path.lower().endswith('.vhd'):
+            return
+
+        for root_gb in self._get_root_gb_sizes():
+            try:
+                resized_image_path, cached = (
+                    self._imagecache.cache_resized_vhd(image_path, root_gb))
+            except exception.FlavorDiskSmallerThanImage:
+                continue
+
+            if not cached:
+                LOG.debug("Prepared resized image %s.", resized_image_path)
+                self._throttle()
@@ -13,12 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import ctypes
 import six
 import struct
 import sys
 
 from eventlet import patcher
+from eventlet import tpool
 from nova.i18n import _
 from oslo_log import log as logging
 from oslo_utils import units
@@ -28,12 +30,25 @@ from hyperv.nova import vmutils
 
 LOG = logging.getLogger(__name__)
 
+threading = patcher.original('threading')
+
 # Avoid using six.moves.queue as we need a non monkey patched class
 if sys.version_info > (3, 0):
     Queue = patcher.original('queue')
 else:
     Queue = patcher.original('Queue')
 
+
+def avoid_blocking_call(f, *args, **kwargs):
+    """Ensures that the invoked method will not block other greenthreads.
+
+    When eventlet monkey patching is used, the call is performed in a
+    native thread using tpool.
+    """
+    if patcher.is_monkey_patched('thread'):
+        return tpool.execute(f, *args, **kwargs)
+    return f(*args, **kwargs)
+
 if sys.platform == 'win32':
     from ctypes import wintypes
 
@@ -89,6 +104,9 @@ WAIT_INFINITE_TIMEOUT = 0xFFFFFFFF
 IO_QUEUE_TIMEOUT = 2
 IO_QUEUE_BURST_TIMEOUT = 0.05
 
+IO_QUEUE_OVERFLOW_BLOCK = 'block'
+IO_QUEUE_OVERFLOW_DROP_OLDEST = 'drop_oldest'
+
 
 class HyperVIOError(vmutils.HyperVException):
     msg_fmt = _("IO operation failed while executing "
@@ -144,9 +162,12 @@ class IOUtils(object):
 
     def wait_named_pipe(self, pipe_name, timeout=WAIT_PIPE_DEFAULT_TIMEOUT):
         """Wait a given ammount of time for a pipe to become available."""
-        self._run_and_check_output(kernel32.WaitNamedPipeW,
-                                   ctypes.c_wchar_p(pipe_name),
-                                   timeout * units.k)
+        # The last error code is thread specific, so it must be retrieved
+        # from the same thread.
+        avoid_blocking_call(self._run_and_check_output,
+                            kernel32.WaitNamedPipeW,
+                            ctypes.c_wchar_p(pipe_name),
+                            timeout * units.k)
 
     def open(self, path, desired_access=None, share_mode=None,
              creation_disposition=None, flags_and_attributes=None):
@@ -243,9 +264,63 @@ class IOUtils(object):
 
 
 class IOQueue(Queue.Queue):
-    def __init__(self, client_connected):
-        Queue.Queue.__init__(self)
+    """Queue holding data chunks, bounded by the number of queued bytes.
+
+    When the queue is full, the overflow policy decides whether writers
+    will block until there is enough room or the oldest queued bytes will
+    be dropped in order to make room for the new data.
+    """
+
+    def __init__(self, client_connected, max_size_bytes=0,
+                 overflow_policy=IO_QUEUE_OVERFLOW_BLOCK):
+        Queue.Queue.__init__(self, max_size_bytes)
         self._client_connected = client_connected
+        self._overflow_policy = overflow_policy
+        self._put_callback = None
+        self._drop_callback = None
+
+        self._queued_bytes = 0
+        self.bytes_queued = 0
+        self.bytes_dropped = 0
+
+    def _init(self, maxsize):
+        self.queue = collections.deque()
+
+    def _qsize(self):
+        # The queue size is expressed in bytes, so that the Queue.Queue
+        # blocking logic applies to the amount of queued data. As the
+        # last queued chunk may exceed the capacity while the Python 2.7
+        # Queue.Queue checks whether the size equals the capacity, the
+        # returned size is capped.
+        if self.maxsize > 0:
+            return min(self._queued_bytes, self.maxsize)
+        return self._queued_bytes
+
+    def _put(self, item):
+        self.queue.append(item)
+        self._queued_bytes += len(item)
+        self.bytes_queued += len(item)
+
+    def _get(self):
+        item = self.queue.popleft()
+        self._queued_bytes -= len(item)
+        return item
+
+    def set_put_callback(self, callback):
+        """Sets a function to be called each time data is queued."""
+        self._put_callback = callback
+
+    def _notify_put(self):
+        callback = self._put_callback
+        if callback:
+            callback()
+
+    def set_drop_callback(self, callback):
+        """Sets a function to be called each time queued data is dropped.
+
+        The callback receives the number of dropped bytes.
+        """
+        self._drop_callback = callback
 
     def get(self, timeout=IO_QUEUE_TIMEOUT, continue_on_timeout=True):
         while self._client_connected.isSet():
@@ -259,10 +334,73 @@ class IOQueue(Queue.Queue):
 
     def put(self, item, timeout=IO_QUEUE_TIMEOUT):
         while self._client_connected.isSet():
+            if self._overflow_policy == IO_QUEUE_OVERFLOW_DROP_OLDEST:
+                self._put_dropping_oldest(item)
+            else:
+                try:
+                    Queue.Queue.put(self, item, timeout=timeout)
+                except Queue.Full:
+                    continue
+            self._notify_put()
+            return
+
+    def put_nowait(self, item):
+        """Queues the item, raising Queue.Full if there is no room."""
+        Queue.Queue.put(self, item, block=False)
+        self._notify_put()
+
+    def _put_dropping_oldest(self, item):
+        with self.mutex:
+            bytes_dropped = self.bytes_dropped
+            if self.maxsize > 0:
+                item = self._make_room(item)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            dropped = self.bytes_dropped - bytes_dropped
+
+        callback = self._drop_callback
+        if dropped and callback:
+            callback(dropped)
+
+    def _make_room(self, item):
+        # Expects the queue mutex to be held. Drops the oldest queued
+        # bytes so that the item fits, returning the item, which may be
+        # trimmed itself if it exceeds the queue capacity.
+        dropped = 0
+        if len(item) > self.maxsize:
+            dropped += len(item) - self.maxsize
+            item = item[-self.maxsize:]
+
+        excess = self._queued_bytes + len(item) - self.maxsize
+        while excess > 0:
+            chunk = self.queue[0]
+            if len(chunk) <= excess:
+                self._get()
+                dropped += len(chunk)
+                excess -= len(chunk)
+            else:
+                self.queue[0] = chunk[excess:]
+                self._queued_bytes -= excess
+                dropped += excess
+                excess = 0
+
+        self.bytes_dropped += dropped
+        return item
+
+    def get_burst_nowait(self,
+                         max_size=constants.SERIAL_CONSOLE_BUFFER_SIZE):
+        """Returns the data already available, without blocking."""
+        chunks = []
+        size = 0
+        while size < max_size:
             try:
-                return Queue.Queue.put(self, item, timeout=timeout)
-            except Queue.Full:
-                continue
+                chunk = Queue.Queue.get(self, block=False)
+            except Queue.Empty:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)
 
     def get_burst(self, timeout=IO_QUEUE_TIMEOUT,
                   burst_timeout=IO_QUEUE_BURST_TIMEOUT,
@@ -270,12 +408,62 @@ class IOQueue(Queue.Queue):
         # Get as much data as possible from the queue
         # to avoid sending small chunks.
         data = self.get(timeout=timeout)
+        if not data:
+            return data
 
-        while data and not (len(data) > max_size):
+        chunks = [data]
+        size = len(data)
+        while not (size > max_size):
             chunk = self.get(timeout=burst_timeout,
                              continue_on_timeout=False)
             if chunk:
-                data += chunk
+                chunks.append(chunk)
+                size += len(chunk)
             else:
                 break
-        return data
+        return b''.join(chunks)
+
+
+class RingBuffer(object):
+    """Fixed size buffer holding the most recently written bytes."""
+
+    def __init__(self, size):
+        self.size = size
+        self._buffer = bytearray(size)
+        self._pos = 0
+        self._lock = threading.Lock()
+
+        self.bytes_written = 0
+
+    @property
+    def bytes_available(self):
+        return min(self.bytes_written, self.size)
+
+    def write(self, data):
+        if not self.size:
+            return
+
+        with self._lock:
+            self.bytes_written += len(data)
+
+            # Only the last bytes are kept if the data exceeds the size.
+            data = data[-self.size:]
+            first_chunk_size = min(len(data), self.size - self._pos)
+            self._buffer[self._pos:self._pos + first_chunk_size] = (
+                data[:first_chunk_size])
+            self._buffer[:len(data) - first_chunk_size] = (
+                data[first_chunk_size:])
+
+            self._pos = (self._pos + len(data)) % self.size
+
+    def read(self, num_bytes=None):
+        """Returns the last num_bytes bytes, or all the available data."""
+        with self._lock:
+            available = self.bytes_available
+            if num_bytes is None or num_bytes > available:
+                num_bytes = available
+
+            start = (self._pos - num_bytes) % self.size if self.size else 0
+            if start + num_bytes <= self.size:
+                return bytes(self._buffer[start:start + num_bytes])
+            return bytes(self._buffer[start:] + self._buffer[:self._pos])
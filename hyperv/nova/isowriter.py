@@ -0,0 +1,397 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process creation of ISO 9660 images, such as config drives.
+
+Along with the ISO 9660 directory tree, whose file names are restricted
+to upper case characters, digits and underscores, the images have a
+Joliet directory tree exposing the original file names. Both trees
+reference the same file data.
+"""
+import os
+import struct
+import time
+
+from oslo_utils import excutils
+from oslo_utils import fileutils
+import six
+
+from hyperv.i18n import _
+from hyperv.nova import vmutils
+
+SECTOR_SIZE = 2048
+
+_SYSTEM_AREA_SECTORS = 16
+# The primary and Joliet volume descriptors, followed by the terminator.
+_VOLUME_DESCRIPTOR_SECTORS = 3
+_STANDARD_ID = b'CD001'
+_VD_TYPE_PRIMARY = 1
+_VD_TYPE_SUPPLEMENTARY = 2
+_VD_TYPE_TERMINATOR = 255
+# UCS-2 level 3 escape sequence.
+_JOLIET_ESCAPE_SEQUENCE = b'%/E'
+
+_DIR_RECORD_HEADER_SIZE = 33
+_PATH_TABLE_RECORD_HEADER_SIZE = 8
+_FILE_FLAG_DIRECTORY = 2
+
+_MAX_DIR_DEPTH = 8
+_MAX_FILE_SIZE = 0xFFFFFFFF
+# ISO 9660 level 2 identifier lengths.
+_MAX_ISO_FILE_NAME_LENGTH = 30
+_MAX_ISO_DIR_NAME_LENGTH = 31
+_MAX_JOLIET_NAME_LENGTH = 64
+_ISO_NAME_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+_JOLIET_INVALID_NAME_CHARS = frozenset('*/:;?\\')
+
+_PRIMARY = 0
+_JOLIET = 1
+
+
+class _Entry(object):
+    """A file or a directory of the image."""
+
+    def __init__(self, name, parent=None, data=None):
+        self.name = name
+        self.parent = parent or self
+        self.data = data
+        self.children = {} if data is None else None
+        # The file data extent.
+        self.extent = 0
+        # The directory extents and sizes, for each directory tree.
+        self.dir_extents = [0, 0]
+        self.dir_sizes = [0, 0]
+
+    @property
+    def is_dir(self):
+        return self.data is None
+
+
+def _both_endian_16(value):
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both_endian_32(value):
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _get_sector_count(size):
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def _get_iso_name(name, is_dir):
+    # ISO 9660 identifiers only use d-characters, file identifiers having
+    # an extension separator and a version number.
+    def to_iso_chars(text):
+        return ''.join(c if c in _ISO_NAME_CHARS else '_'
+                       for c in text.upper())
+
+    if is_dir:
+        return to_iso_chars(name)[:_MAX_ISO_DIR_NAME_LENGTH]
+
+    base_name, sep, ext = name.rpartition('.')
+    if not sep:
+        base_name, ext = ext, ''
+    ext = to_iso_chars(ext)[:_MAX_ISO_FILE_NAME_LENGTH // 2]
+    base_name = to_iso_chars(base_name)[
+        :_MAX_ISO_FILE_NAME_LENGTH - len(ext)]
+    return '%s.%s;1' % (base_name, ext)
+
+
+def _get_identifier(entry, tree):
+    if tree == _JOLIET:
+        name = entry.name if entry.is_dir else entry.name + ';1'
+        return name.encode('utf-16-be')
+    return _get_iso_name(entry.name, entry.is_dir).encode('ascii')
+
+
+def _get_dir_record_length(identifier):
+    # Records have an even length.
+    length = _DIR_RECORD_HEADER_SIZE + len(identifier)
+    return length + length % 2
+
+
+def _build_dir_record(identifier, extent, size, is_dir, timestamp):
+    length = _get_dir_record_length(identifier)
+    record = (struct.pack('<BB', length, 0) +
+              _both_endian_32(extent) +
+              _both_endian_32(size) +
+              struct.pack('<6Bb', timestamp.tm_year - 1900, timestamp.tm_mon,
+                          timestamp.tm_mday, timestamp.tm_hour,
+                          timestamp.tm_min, timestamp.tm_sec, 0) +
+              struct.pack('<BBB', _FILE_FLAG_DIRECTORY if is_dir else 0,
+                          0, 0) +
+              _both_endian_16(1) +
+              struct.pack('<B', len(identifier)) +
+              identifier)
+    return record.ljust(length, b'\x00')
+
+
+def _get_path_table_record_length(identifier):
+    length = _PATH_TABLE_RECORD_HEADER_SIZE + len(identifier)
+    return length + length % 2
+
+
+def _build_path_table_record(identifier, extent, parent_number, byte_order):
+    record = (struct.pack(byte_order + 'BBIH', len(identifier), 0, extent,
+                          parent_number) +
+              identifier)
+    return record.ljust(_get_path_table_record_length(identifier), b'\x00')
+
+
+def _get_volume_date(timestamp):
+    # The date digits are followed by the GMT offset.
+    return time.strftime('%Y%m%d%H%M%S00', timestamp).encode('ascii') + b'\0'
+
+
+class _ISOImage(object):
+    def __init__(self, volume_id, publisher):
+        self._volume_id = volume_id
+        self._publisher = publisher
+        self._root = _Entry(u'')
+
+    def add_file(self, path, data):
+        if isinstance(path, six.binary_type):
+            path = path.decode('utf-8')
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        if len(data) > _MAX_FILE_SIZE:
+            raise vmutils.HyperVException(
+                _("The file %s is too large.") % path)
+
+        names = [name for name in path.split('/') if name]
+        if not names or len(names) > _MAX_DIR_DEPTH:
+            raise vmutils.HyperVException(
+                _("Unsupported file path: %s") % path)
+
+        directory = self._root
+        for name in names[:-1]:
+            child = directory.children.get(name)
+            if child is None:
+                self._check_name(name)
+                child = _Entry(name, parent=directory)
+                directory.children[name] = child
+            elif not child.is_dir:
+                raise vmutils.HyperVException(
+                    _("Unsupported file path: %s") % path)
+            directory = child
+
+        name = names[-1]
+        self._check_name(name)
+        if name in directory.children:
+            raise vmutils.HyperVException(
+                _("Duplicate file path: %s") % path)
+        directory.children[name] = _Entry(name, parent=directory,
+                                          data=data)
+
+    @staticmethod
+    def _check_name(name):
+        if (name in ('.', '..') or len(name) > _MAX_JOLIET_NAME_LENGTH - 2 or
+                _JOLIET_INVALID_NAME_CHARS.intersection(name)):
+            raise vmutils.HyperVException(
+                _("Unsupported file name: %s") % name)
+
+    def _get_children(self, directory, tree):
+        # Directory records are sorted by their identifiers.
+        children = sorted(((_get_identifier(child, tree), child)
+                           for child in directory.children.values()),
+                          key=lambda child: child[0])
+        for idx in range(1, len(children)):
+            if children[idx][0] == children[idx - 1][0]:
+                raise vmutils.HyperVException(
+                    _("The names of the files %(name)s and %(other_name)s "
+                      "are not distinct on ISO 9660 images.") %
+                    {'name': children[idx][1].name,
+                     'other_name': children[idx - 1][1].name})
+        return children
+
+    def _get_dir_records(self, directory, tree):
+        # Returns the (identifier, entry) pairs of the directory records.
+        return ([(b'\x00', directory), (b'\x01', directory.parent)] +
+                self._get_children(directory, tree))
+
+    def _get_directories(self, tree):
+        # Returns the (directory, identifier, parent number) tuples of a
+        # directory tree, in path table order.
+        directories = [(self._root, b'\x00', 1)]
+        idx = 0
+        while idx < len(directories):
+            for identifier, child in self._get_children(directories[idx][0],
+                                                        tree):
+                if child.is_dir:
+                    directories.append((child, identifier, idx + 1))
+            idx += 1
+        return directories
+
+    def _get_dir_size(self, directory, tree):
+        # Directory records may not span sectors.
+        size = 0
+        for identifier, entry in self._get_dir_records(directory, tree):
+            length = _get_dir_record_length(identifier)
+            if size % SECTOR_SIZE + length > SECTOR_SIZE:
+                size = _get_sector_count(size) * SECTOR_SIZE
+            size += length
+        return _get_sector_count(size) * SECTOR_SIZE
+
+    def _build_dir(self, directory, tree, timestamp):
+        data = b''
+        for identifier, entry in self._get_dir_records(directory, tree):
+            if entry.is_dir:
+                extent = entry.dir_extents[tree]
+                size = entry.dir_sizes[tree]
+            else:
+                extent = entry.extent
+                size = len(entry.data)
+            record = _build_dir_record(identifier, extent, size,
+                                       entry.is_dir, timestamp)
+            if len(data) % SECTOR_SIZE + len(record) > SECTOR_SIZE:
+                data = data.ljust(_get_sector_count(len(data)) * SECTOR_SIZE,
+                                  b'\x00')
+            data += record
+        return data.ljust(directory.dir_sizes[tree], b'\x00')
+
+    def _build_path_table(self, directories, tree, byte_order):
+        return b''.join(
+            _build_path_table_record(identifier, directory.dir_extents[tree],
+                                     parent_number, byte_order)
+            for directory, identifier, parent_number in directories)
+
+    def _build_volume_descriptor(self, tree, sector_count, path_table_size,
+                                 path_table_extents, timestamp):
+        if tree == _JOLIET:
+            def encode(text, length):
+                return (text.encode('utf-16-be') +
+                        b'\x00 ' * length)[:length]
+        else:
+            def encode(text, length):
+                return text.encode('ascii').ljust(length, b' ')
+
+        descriptor = bytearray(SECTOR_SIZE)
+        struct.pack_into(
+            '<B5sB', descriptor, 0,
+            _VD_TYPE_SUPPLEMENTARY if tree == _JOLIET else _VD_TYPE_PRIMARY,
+            _STANDARD_ID, 1)
+        descriptor[8:40] = encode(u'', 32)
+        descriptor[40:72] = encode(self._volume_id, 32)
+        descriptor[80:88] = _both_endian_32(sector_count)
+        if tree == _JOLIET:
+            descriptor[88:91] = _JOLIET_ESCAPE_SEQUENCE
+        descriptor[120:124] = _both_endian_16(1)
+        descriptor[124:128] = _both_endian_16(1)
+        descriptor[128:132] = _both_endian_16(SECTOR_SIZE)
+        descriptor[132:140] = _both_endian_32(path_table_size)
+        l_path_table_extent, m_path_table_extent = path_table_extents
+        struct.pack_into('<I', descriptor, 140, l_path_table_extent)
+        struct.pack_into('>I', descriptor, 148, m_path_table_extent)
+        descriptor[156:190] = _build_dir_record(
+            b'\x00', self._root.dir_extents[tree], self._root.dir_sizes[tree],
+            True, timestamp)
+        descriptor[190:318] = encode(u'', 128)
+        descriptor[318:446] = encode(self._publisher, 128)
+        descriptor[446:702] = encode(u'', 256)
+        descriptor[702:813] = encode(u'', 111)
+        descriptor[813:830] = _get_volume_date(timestamp)
+        descriptor[830:847] = _get_volume_date(timestamp)
+        descriptor[847:864] = b'0' * 16 + b'\0'
+        descriptor[864:881] = b'0' * 16 + b'\0'
+        descriptor[881] = 1
+        return bytes(descriptor)
+
+    def write(self, f):
+        """Writes the image, returning its size."""
+        timestamp = time.gmtime()
+        trees = (_PRIMARY, _JOLIET)
+        tree_dirs = [self._get_directories(tree) for tree in trees]
+
+        # Lay out the path tables, the directories and the file data.
+        sector = _SYSTEM_AREA_SECTORS + _VOLUME_DESCRIPTOR_SECTORS
+        path_table_sizes = []
+        path_table_extents = []
+        for tree in trees:
+            size = sum(_get_path_table_record_length(identifier)
+                       for directory, identifier, parent_number
+                       in tree_dirs[tree])
+            path_table_sizes.append(size)
+            # The little endian path table, followed by the big endian one.
+            path_table_extents.append(
+                (sector, sector + _get_sector_count(size)))
+            sector += 2 * _get_sector_count(size)
+
+        for tree in trees:
+            for directory, identifier, parent_number in tree_dirs[tree]:
+                directory.dir_extents[tree] = sector
+                directory.dir_sizes[tree] = self._get_dir_size(directory,
+                                                               tree)
+                sector += directory.dir_sizes[tree] // SECTOR_SIZE
+
+        files = []
+        for directory, identifier, parent_number in tree_dirs[_JOLIET]:
+            for identifier, child in self._get_children(directory,
+                                                        _JOLIET):
+                if not child.is_dir:
+                    child.extent = sector
+                    sector += _get_sector_count(len(child.data))
+                    files.append(child)
+        sector_count = sector
+
+        f.write(b'\x00' * _SYSTEM_AREA_SECTORS * SECTOR_SIZE)
+        for tree in trees:
+            f.write(self._build_volume_descriptor(
+                tree, sector_count, path_table_sizes[tree],
+                path_table_extents[tree], timestamp))
+        f.write(struct.pack('<B5sB', _VD_TYPE_TERMINATOR, _STANDARD_ID,
+                            1).ljust(SECTOR_SIZE, b'\x00'))
+
+        for tree in trees:
+            for byte_order in '<>':
+                path_table = self._build_path_table(tree_dirs[tree], tree,
+                                                    byte_order)
+                f.write(path_table.ljust(
+                    _get_sector_count(len(path_table)) * SECTOR_SIZE,
+                    b'\x00'))
+
+        for tree in trees:
+            for directory, identifier, parent_number in tree_dirs[tree]:
+                f.write(self._build_dir(directory, tree, timestamp))
+
+        for entry in files:
+            f.write(entry.data)
+            f.write(b'\x00' * (-len(entry.data) % SECTOR_SIZE))
+        return sector_count * SECTOR_SIZE
+
+
+def write_iso(path, files, volume_id, publisher=u''):
+    """Writes an ISO 9660 image with Joliet extensions.
+
+    :param files: iterable of (path, data) tuples, the file paths being
+                  relative to the image root and using '/' separators.
+    :returns: the size of the image.
+    :raises vmutils.HyperVException: if the files cannot be stored on
+                                     ISO 9660 images.
+    """
+    image = _ISOImage(volume_id, publisher)
+    for file_path, data in files:
+        image.add_file(file_path, data)
+
+    try:
+        with open(path, 'wb') as f:
+            image_size = image.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            fileutils.delete_if_exists(path)
+    return image_size
@@ -69,12 +69,16 @@ class LiveMigrationOps(object):
         instance_name = instance_ref["name"]
 
         try:
-            self._vmops.copy_vm_dvd_disks(instance_name, dest)
-
             # We must make sure that the console log workers are stopped,
             # otherwise we won't be able to delete / move VM log files.
-            self._serial_console_ops.stop_console_handler(instance_name)
+            # The handler is stopped while the DVD disks are copied.
+            handler_stop_event = (
+                self._serial_console_ops.stop_console_handler_async(
+                    instance_name))
 
+            self._vmops.copy_vm_dvd_disks(instance_name, dest)
+
+            handler_stop_event.wait()
             self._pathutils.copy_vm_console_logs(instance_name, dest)
             self._livemigrutils.live_migrate_vm(instance_name,
                                                 dest)
@@ -94,6 +98,11 @@ class LiveMigrationOps(object):
         LOG.debug("pre_live_migration called", instance=instance)
         self._livemigrutils.check_live_migration_config()
 
+        # The configuration files of the VMs taken from the VM shell pool
+        # are placed in the pool directory, which is expected to exist on
+        # the destination as well, even if the pool is disabled here.
+        self._pathutils.get_vm_shell_pool_dir()
+
         if CONF.use_cow_images:
             boot_from_volume = self._block_dev_man.is_boot_from_volume(
                 block_device_info)
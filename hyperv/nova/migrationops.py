@@ -29,6 +29,7 @@ from hyperv.i18n import _, _LE
 from hyperv.nova import block_device_manager
 from hyperv.nova import constants
 from hyperv.nova import imagecache
+from hyperv.nova import serialconsoleops
 from hyperv.nova import utilsfactory
 from hyperv.nova import vmops
 from hyperv.nova import volumeops
@@ -46,6 +47,7 @@ class MigrationOps(object):
         self._vmops = vmops.VMOps()
         self._imagecache = imagecache.ImageCache()
         self._block_dev_manager = block_device_manager.BlockDeviceInfoManager()
+        self._serial_console_ops = serialconsoleops.SerialConsoleOps()
 
     def _migrate_disk_files(self, instance_name, disk_files, dest):
         # TODO(mikal): it would be nice if this method took a full instance,
@@ -139,6 +141,8 @@ class MigrationOps(object):
         self._check_target_flavor(instance, flavor, block_device_info)
 
         self._vmops.power_off(instance, timeout, retry_interval)
+        # The console log files are moved along with the instance files.
+        self._serial_console_ops.wait_for_console_handler_stop(instance.name)
 
         (disk_files,
          volume_drives) = self._vmutils.get_vm_storage_paths(instance.name)
@@ -214,25 +218,12 @@ class MigrationOps(object):
         base_vhd_copy_path = os.path.join(os.path.dirname(diff_vhd_path),
                                           os.path.basename(base_vhd_path))
         try:
-            LOG.debug('Copying base disk %(base_vhd_path)s to '
-                      '%(base_vhd_copy_path)s',
-                      {'base_vhd_path': base_vhd_path,
-                       'base_vhd_copy_path': base_vhd_copy_path})
-            self._pathutils.copyfile(base_vhd_path, base_vhd_copy_path)
-
-            LOG.debug("Reconnecting copied base VHD "
-                      "%(base_vhd_copy_path)s and diff "
-                      "VHD %(diff_vhd_path)s",
-                      {'base_vhd_copy_path': base_vhd_copy_path,
-                       'diff_vhd_path': diff_vhd_path})
-            self._vhdutils.reconnect_parent_vhd(diff_vhd_path,
-                                                base_vhd_copy_path)
-
-            LOG.debug("Merging base disk %(base_vhd_copy_path)s and "
-                      "diff disk %(diff_vhd_path)s",
-                      {'base_vhd_copy_path': base_vhd_copy_path,
-                       'diff_vhd_path': diff_vhd_path})
-            self._vhdutils.merge_vhd(diff_vhd_path, base_vhd_copy_path)
+            # The chain is merged in a single pass when possible, without
+            # copying the base disk first.
+            if not self._vhdutils.merge_vhd_chain(diff_vhd_path,
+                                                  base_vhd_copy_path):
+                self._copy_and_merge_base_vhd(diff_vhd_path, base_vhd_path,
+                                              base_vhd_copy_path)
 
             # Replace the differential VHD with the merged one
             self._pathutils.rename(base_vhd_copy_path, diff_vhd_path)
@@ -241,6 +232,28 @@ class MigrationOps(object):
                 if self._pathutils.exists(base_vhd_copy_path):
                     self._pathutils.remove(base_vhd_copy_path)
 
+    def _copy_and_merge_base_vhd(self, diff_vhd_path, base_vhd_path,
+                                 base_vhd_copy_path):
+        LOG.debug('Copying base disk %(base_vhd_path)s to '
+                  '%(base_vhd_copy_path)s',
+                  {'base_vhd_path': base_vhd_path,
+                   'base_vhd_copy_path': base_vhd_copy_path})
+        self._pathutils.copyfile(base_vhd_path, base_vhd_copy_path)
+
+        LOG.debug("Reconnecting copied base VHD "
+                  "%(base_vhd_copy_path)s and diff "
+                  "VHD %(diff_vhd_path)s",
+                  {'base_vhd_copy_path': base_vhd_copy_path,
+                   'diff_vhd_path': diff_vhd_path})
+        self._vhdutils.reconnect_parent_vhd(diff_vhd_path,
+                                            base_vhd_copy_path)
+
+        LOG.debug("Merging base disk %(base_vhd_copy_path)s and "
+                  "diff disk %(diff_vhd_path)s",
+                  {'base_vhd_copy_path': base_vhd_copy_path,
+                   'diff_vhd_path': diff_vhd_path})
+        self._vhdutils.merge_vhd(diff_vhd_path, base_vhd_copy_path)
+
     def _check_resize_vhd(self, vhd_path, vhd_info, new_size):
         curr_size = vhd_info['MaxInternalSize']
         if new_size < curr_size:
@@ -13,13 +13,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import errno
-import os
-
 from eventlet import patcher
 from nova.i18n import _, _LE  # noqa
 from oslo_log import log as logging
 
+from hyperv.nova import consolelogwriter
 from hyperv.nova import constants
 from hyperv.nova import ioutils
 from hyperv.nova import vmutils
@@ -33,14 +31,13 @@ LOG = logging.getLogger(__name__)
 class NamedPipeHandler(object):
     """Handles asyncronous I/O operations on a specified named pipe."""
 
-    _MAX_LOG_ROTATE_RETRIES = 5
-
     def __init__(self, pipe_name, input_queue=None, output_queue=None,
-                 connect_event=None, log_file=None):
+                 connect_event=None, log_file=None, log_tail_buffer=None):
         self._pipe_name = pipe_name
         self._input_queue = input_queue
         self._output_queue = output_queue
         self._log_file_path = log_file
+        self._log_tail_buffer = log_tail_buffer
 
         self._connect_event = connect_event
         self._stopped = threading.Event()
@@ -56,7 +53,8 @@ class NamedPipeHandler(object):
             self._open_pipe()
 
             if self._log_file_path:
-                self._log_file_handle = open(self._log_file_path, 'ab', 1)
+                self._log_writer = consolelogwriter.get_log_writer()
+                self._log_writer.open_log(self._log_file_path)
 
             jobs = [self._read_from_pipe]
             if (self._input_queue and self._connect_event):
@@ -88,8 +86,8 @@ class NamedPipeHandler(object):
                 worker.join()
 
         self._close_pipe()
-        if self._log_file_handle:
-            self._log_file_handle.close()
+        if self._log_writer:
+            self._log_writer.close_log(self._log_file_path)
 
     def _setup_io_structures(self):
         self._r_buffer = self._ioutils.get_buffer(
@@ -104,7 +102,7 @@ class NamedPipeHandler(object):
             self._read_callback)
         self._w_completion_routine = self._ioutils.get_completion_routine()
 
-        self._log_file_handle = None
+        self._log_writer = None
 
     def _open_pipe(self):
         """Opens a named pipe in overlapped mode for asyncronous I/O."""
@@ -163,7 +161,7 @@ class NamedPipeHandler(object):
         if self._output_queue:
             self._output_queue.put(data)
 
-        if self._log_file_handle:
+        if self._log_writer:
             self._write_to_log(data)
 
     def _get_data_to_write(self):
@@ -180,42 +178,9 @@ class NamedPipeHandler(object):
         if self._stopped.isSet():
             return
 
-        try:
-            log_size = self._log_file_handle.tell() + len(data)
-            if (log_size >= constants.MAX_CONSOLE_LOG_FILE_SIZE):
-                self._rotate_logs()
-            self._log_file_handle.write(data)
-        except Exception:
-            self._stopped.set()
+        if self._log_tail_buffer:
+            self._log_tail_buffer.write(data)
 
-    def _rotate_logs(self):
-        self._log_file_handle.flush()
-        self._log_file_handle.close()
-
-        log_archive_path = self._log_file_path + '.1'
-
-        if os.path.exists(log_archive_path):
-            self._retry_if_file_in_use(os.remove,
-                                       log_archive_path)
-
-        self._retry_if_file_in_use(os.rename,
-                                   self._log_file_path,
-                                   log_archive_path)
-
-        self._log_file_handle = open(
-            self._log_file_path, 'ab', 1)
-
-    def _retry_if_file_in_use(self, f, *args, **kwargs):
-        # The log files might be in use if the console log is requested
-        # while a log rotation is attempted.
-        retry_count = 0
-        while True:
-            try:
-                return f(*args, **kwargs)
-            except WindowsError as err:
-                if (err.errno == errno.EACCES and
-                        retry_count < self._MAX_LOG_ROTATE_RETRIES):
-                    retry_count += 1
-                    time.sleep(1)
-                else:
-                    raise
+        # The data is buffered by the log writer, which takes care of
+        # rotating the logs as well.
+        self._log_writer.write(self._log_file_path, data)
@@ -13,8 +13,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import gzip
 import os
 import shutil
+import struct
 import sys
 import time
 
@@ -28,6 +30,8 @@ from oslo_log import log as logging
 
 from hyperv.i18n import _
 from hyperv.nova import constants
+from hyperv.nova import ioutils
+from hyperv.nova import vhdcopier
 from hyperv.nova import vmutils
 
 LOG = logging.getLogger(__name__)
@@ -40,6 +44,28 @@ hyperv_opts = [
                     'to copy files to the target host. If left blank, an '
                     'administrative share will be used, looking for the same '
                     '"instances_path" used locally'),
+    cfg.IntOpt('console_log_archive_count',
+               default=5,
+               min=0,
+               help='The number of rotated console log files kept for each '
+                    'instance. Rotated console logs are compressed.'),
+    cfg.StrOpt('shared_base_vhd_dir',
+               default=None,
+               help='A directory, usually an SMB share, holding the cached '
+                    'base images of multiple Hyper-V hosts. Image fetching, '
+                    'resizing and removal are coordinated between hosts '
+                    'through lock and lease files, so that images are '
+                    'downloaded once per cluster. If not set, the images '
+                    'are cached in the "_base" subdirectory of '
+                    '"instances_path".'),
+    cfg.BoolOpt('sparse_vhd_copy',
+                default=False,
+                help='Copy only the metadata and the allocated blocks of '
+                     'VHD / VHDX images, the other ranges reading back as '
+                     'zeros. The copies are not marked as sparse files, so '
+                     'that they can be attached to instances. Other files '
+                     'and images which cannot be parsed are copied '
+                     'entirely.'),
 ]
 
 CONF = cfg.CONF
@@ -49,6 +75,9 @@ CONF.import_opt('instances_path', 'nova.compute.manager')
 ERROR_INVALID_NAME = 123
 ERROR_DIR_IS_NOT_EMPTY = 145
 
+CONSOLE_LOG_FILE_NAME = 'console.log'
+CONSOLE_LOG_ARCHIVE_EXT = '.gz'
+
 
 class PathUtils(object):
     def __init__(self):
@@ -92,6 +121,9 @@ class PathUtils(object):
         self.copy(src, dest)
 
     def copy(self, src, dest):
+        if self._copy_vhd(src, dest):
+            return
+
         # With large files this is 2x-3x faster than shutil.copy(src, dest),
         # especially when copying to a UNC target.
         # shutil.copyfileobj(...) with a proper buffer is better than
@@ -104,6 +136,37 @@ class PathUtils(object):
             raise IOError(_('The file copy from %(src)s to %(dest)s failed')
                            % {'src': src, 'dest': dest})
 
+    def _copy_vhd(self, src, dest):
+        """Copies the image metadata and allocated blocks of VHD / VHDX
+        images, returning False if the file is not a supported image.
+        """
+        format_ext = os.path.splitext(src)[1][1:].upper()
+        if (not CONF.hyperv.sparse_vhd_copy or
+                format_ext not in (constants.DISK_FORMAT_VHD,
+                                   constants.DISK_FORMAT_VHDX)):
+            return False
+
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+
+        LOG.debug('Copying image from %s to %s', src, dest)
+        start_time = time.time()
+        try:
+            # The copy is performed in a native thread, not blocking the
+            # other greenthreads.
+            bytes_written = ioutils.avoid_blocking_call(
+                vhdcopier.copy_vhd, src, dest)
+        except vmutils.HyperVException as ex:
+            LOG.debug('Falling back to copying the entire file %(src)s. '
+                      '%(ex)s', {'src': src, 'ex': ex})
+            return False
+
+        LOG.debug('Copied image %(src)s to %(dest)s, writing %(bytes)s '
+                  'bytes in %(elapsed).3f seconds.',
+                  {'src': src, 'dest': dest, 'bytes': bytes_written,
+                   'elapsed': time.time() - start_time})
+        return True
+
     def move_folder_files(self, src_dir, dest_dir):
         """Moves the files of the given src_dir to dest_dir.
         It will ignore any nested folders.
@@ -118,6 +181,12 @@ class PathUtils(object):
             if os.path.isfile(src):
                 self.rename(src, os.path.join(dest_dir, fname))
 
+    def get_dir_size(self, path):
+        """Returns the total size of the files stored in a directory."""
+        return sum(os.path.getsize(os.path.join(dir_path, fname))
+                   for dir_path, _dir_names, fnames in os.walk(path)
+                   for fname in fnames)
+
     def rmtree(self, path):
         # This will be removed once support for Windows Server 2008R2 is
         # stopped
@@ -237,18 +306,67 @@ class PathUtils(object):
         return os.path.join(instance_path, eph_name + '.' + format_ext.lower())
 
     def get_base_vhd_dir(self):
+        if CONF.hyperv.shared_base_vhd_dir:
+            return CONF.hyperv.shared_base_vhd_dir
         return self._get_instances_sub_dir('_base')
 
+    def get_ephemeral_disk_pool_dir(self):
+        return self._get_instances_sub_dir('_ephemeral_pool')
+
+    def get_vm_shell_pool_dir(self):
+        return self._get_instances_sub_dir('_vm_shells')
+
+    def is_base_vhd_dir_shared(self):
+        return bool(CONF.hyperv.shared_base_vhd_dir)
+
     def get_export_dir(self, instance_name):
         dir_name = os.path.join('export', instance_name)
         return self._get_instances_sub_dir(dir_name, create_dir=True,
                                            remove_dir=True)
 
     def get_vm_console_log_paths(self, vm_name, remote_server=None):
+        """Returns the console log paths, starting with the live log.
+
+        The live log is followed by the rotated logs, newest first. The
+        most recently rotated log may not be compressed yet, in which case
+        it's available at the uncompressed archive path.
+        """
         instance_dir = self.get_instance_dir(vm_name,
                                              remote_server)
-        console_log_path = os.path.join(instance_dir, 'console.log')
-        return console_log_path, console_log_path + '.1'
+        console_log_path = os.path.join(instance_dir, CONSOLE_LOG_FILE_NAME)
+        return ([console_log_path] +
+                self.get_console_log_archive_paths(console_log_path))
+
+    def get_console_log_archive_path(self, console_log_path, generation,
+                                     compressed=True):
+        archive_path = '%s.%d' % (console_log_path, generation)
+        if compressed:
+            archive_path += CONSOLE_LOG_ARCHIVE_EXT
+        return archive_path
+
+    def get_console_log_archive_paths(self, console_log_path):
+        archive_count = CONF.hyperv.console_log_archive_count
+        return ([self.get_console_log_archive_path(console_log_path, 1,
+                                                   compressed=False)] +
+                [self.get_console_log_archive_path(console_log_path, gen)
+                 for gen in range(1, archive_count + 1)])
+
+    def open_console_log(self, log_path):
+        """Opens a console log for reading, decompressing archives."""
+        if log_path.endswith(CONSOLE_LOG_ARCHIVE_EXT):
+            return gzip.open(log_path, 'rb')
+        return open(log_path, 'rb')
+
+    def get_console_log_size(self, log_path):
+        """Returns the size of the console output stored in a log file."""
+        if log_path.endswith(CONSOLE_LOG_ARCHIVE_EXT):
+            # The gzip trailer contains the uncompressed data size, which
+            # fits in 32 bits as console log files are rotated far
+            # before reaching 4 GiB.
+            with open(log_path, 'rb') as fp:
+                fp.seek(-4, os.SEEK_END)
+                return struct.unpack('<I', fp.read(4))[0]
+        return os.path.getsize(log_path)
 
     def copy_vm_console_logs(self, instance_name, dest_host):
         local_log_paths = self.get_vm_console_log_paths(
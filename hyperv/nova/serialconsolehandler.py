@@ -13,13 +13,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
 from eventlet import patcher
 from nova.console import serial as serial_console
 from nova.console import type as ctype
 from nova import exception
-from nova.i18n import _, _LI  # noqa
+from nova.i18n import _, _LI, _LW  # noqa
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import units
 import six
 
 from hyperv.nova import constants
@@ -28,7 +31,34 @@ from hyperv.nova import namedpipe
 from hyperv.nova import serialproxy
 from hyperv.nova import utilsfactory
 
+hyperv_opts = [
+    cfg.IntOpt('serial_console_queue_size',
+               default=64 * units.Ki,
+               help='The maximum number of bytes buffered by each serial '
+                    'console queue while transferring data between the '
+                    'instance serial port and the console client. '
+                    '0 means unlimited.'),
+    cfg.StrOpt('serial_console_output_overflow_policy',
+               default=ioutils.IO_QUEUE_OVERFLOW_DROP_OLDEST,
+               choices=(ioutils.IO_QUEUE_OVERFLOW_BLOCK,
+                        ioutils.IO_QUEUE_OVERFLOW_DROP_OLDEST),
+               help='Decides what happens when a serial console client '
+                    'reads the instance output slower than it is produced '
+                    'and the console output queue becomes full. Either '
+                    'block the serial port reader, delaying the console '
+                    'log as well, or drop the oldest queued output.'),
+    cfg.IntOpt('console_log_tail_buffer_size',
+               default=128 * units.Ki,
+               help='The amount of recent console output, in bytes, kept '
+                    'in memory for each instance. Console output requests '
+                    'not exceeding this size are served from memory, so '
+                    'this should not be lower than the '
+                    'console_output_max_bytes option. 0 disables the '
+                    'in-memory console output buffer.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
 LOG = logging.getLogger(__name__)
 
 threading = patcher.original('threading')
@@ -43,10 +73,12 @@ class SerialConsoleHandler(object):
         self._instance_name = instance_name
         self._log_path = self._pathutils.get_vm_console_log_paths(
             self._instance_name)[0]
+        self._log_tail_buffer = None
 
         self._client_connected = None
         self._input_queue = None
         self._output_queue = None
+        self._output_dropped = False
 
         self._serial_proxy = None
         self._workers = []
@@ -65,12 +97,65 @@ class SerialConsoleHandler(object):
             serial_console.release_port(self._listen_host,
                                         self._listen_port)
 
+        if self._output_queue:
+            LOG.info(_LI('Serial console output queue of instance '
+                         '%(instance_name)s statistics: %(bytes_queued)d '
+                         'bytes queued, %(bytes_dropped)d bytes dropped.'),
+                     {'instance_name': self._instance_name,
+                      'bytes_queued': self._output_queue.bytes_queued,
+                      'bytes_dropped': self._output_queue.bytes_dropped})
+
     def _setup_handlers(self):
         if CONF.serial_console.enabled:
             self._setup_serial_proxy_handler()
 
+        self._setup_log_tail_buffer()
         self._setup_named_pipe_handlers()
 
+    def _setup_log_tail_buffer(self):
+        buffer_size = CONF.hyperv.console_log_tail_buffer_size
+        if not buffer_size:
+            return
+
+        self._log_tail_buffer = ioutils.RingBuffer(buffer_size)
+
+        # The buffer is preloaded with the existing console output, so that
+        # it always mirrors the end of the console log.
+        console_log_paths = self._pathutils.get_vm_console_log_paths(
+            self._instance_name)
+        try:
+            # Only the newest log files are read, as rotated logs have to
+            # be decompressed.
+            chunks = []
+            remaining = buffer_size
+            for log_path in console_log_paths:
+                if remaining <= 0:
+                    break
+                if os.path.exists(log_path):
+                    log_size = self._pathutils.get_console_log_size(log_path)
+                    with self._pathutils.open_console_log(log_path) as fp:
+                        fp.seek(max(log_size - remaining, 0))
+                        chunks.append(fp.read())
+                    remaining -= len(chunks[-1])
+
+            for data in reversed(chunks):
+                self._log_tail_buffer.write(data)
+        except (IOError, OSError) as err:
+            # Console output requests will be served from disk.
+            LOG.warning(_LW('Could not load the console output of instance '
+                            '%(instance_name)s. Error: %(err)s'),
+                        {'instance_name': self._instance_name, 'err': err})
+            self._log_tail_buffer = None
+
+    def get_console_log_tail(self, num_bytes):
+        """Returns the last bytes of console output, if available.
+
+        None is returned if the requested amount of data exceeds the size
+        of the in-memory console output buffer.
+        """
+        if self._log_tail_buffer and num_bytes <= self._log_tail_buffer.size:
+            return self._log_tail_buffer.read(num_bytes)
+
     def _setup_serial_proxy_handler(self):
         self._listen_host = (
             CONF.serial_console.proxyclient_address)
@@ -87,10 +172,17 @@ class SerialConsoleHandler(object):
         # Use this event in order to manage
         # pending queue operations.
         self._client_connected = threading.Event()
+        queue_size = CONF.hyperv.serial_console_queue_size
+        # Client input is never dropped, the serial proxy will stop
+        # reading from the client socket while the input queue is full.
         self._input_queue = ioutils.IOQueue(
-            client_connected=self._client_connected)
+            client_connected=self._client_connected,
+            max_size_bytes=queue_size)
         self._output_queue = ioutils.IOQueue(
-            client_connected=self._client_connected)
+            client_connected=self._client_connected,
+            max_size_bytes=queue_size,
+            overflow_policy=CONF.hyperv.serial_console_output_overflow_policy)
+        self._output_queue.set_drop_callback(self._on_output_dropped)
 
         self._serial_proxy = serialproxy.SerialProxy(
             self._instance_name, self._listen_host,
@@ -99,6 +191,21 @@ class SerialConsoleHandler(object):
 
         self._workers.append(self._serial_proxy)
 
+    def _on_output_dropped(self, bytes_dropped):
+        # Only the first drop is logged, the total amount of dropped data
+        # being logged when the handler is stopped.
+        if self._output_dropped:
+            return
+
+        self._output_dropped = True
+        LOG.warning(_LW('The serial console client of instance '
+                        '%(instance_name)s reads the console output slower '
+                        'than it is produced, %(bytes_dropped)d bytes of '
+                        'output being dropped. Further drops are not '
+                        'logged.'),
+                    {'instance_name': self._instance_name,
+                     'bytes_dropped': bytes_dropped})
+
     def _setup_named_pipe_handlers(self):
         # At most 2 named pipes will be used to access the vm serial ports.
         #
@@ -127,6 +234,7 @@ class SerialConsoleHandler(object):
                       'connect_event': self._client_connected}
         if enable_logging:
             kwargs['log_file'] = self._log_path
+            kwargs['log_tail_buffer'] = self._log_tail_buffer
 
         handler = namedpipe.NamedPipeHandler(pipe_path, **kwargs)
         return handler
@@ -13,24 +13,57 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import functools
 import os
+import time
 
+import eventlet
+from eventlet import event
 from nova import exception
-from nova.i18n import _LI, _LE  # noqa
+from nova.i18n import _LI, _LE, _LW  # noqa
 from nova import utils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import units
 import six
 
+from hyperv.nova import consolelogwriter
+from hyperv.nova import ioutils
+from hyperv.nova import pathutils
 from hyperv.nova import serialconsolehandler
 from hyperv.nova import utilsfactory
 
+hyperv_opts = [
+    cfg.IntOpt('console_output_max_bytes',
+               default=128 * units.Ki,
+               min=0,
+               help='The maximum amount of instance console output, in '
+                    'bytes, returned when the console log is requested '
+                    'without specifying a byte range. Only the most recent '
+                    'output is returned, being served from memory if not '
+                    'exceeding console_log_tail_buffer_size. The rotated '
+                    'console logs are read only if the recent output '
+                    'does not suffice. 0 means that the whole console log, '
+                    'including the rotated logs, is returned.'),
+    cfg.IntOpt('console_handler_startup_workers',
+               default=16,
+               min=1,
+               help='The maximum number of instance serial console '
+                    'handlers started concurrently when the compute '
+                    'service starts.'),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
 
 LOG = logging.getLogger(__name__)
 
 _console_handlers = {}
+# Completion events of the console handlers being stopped.
+_pending_handler_stops = {}
+
+CONSOLE_OUTPUT_CHUNK_SIZE = units.Mi
 
 
 def instance_synchronized(func):
@@ -71,14 +104,56 @@ class SerialConsoleOps(object):
     def stop_console_handler(self, instance_name):
         self._stop_console_handler(instance_name)
 
+    @instance_synchronized
+    def stop_console_handler_async(self, instance_name):
+        """Stops the instance console handler in the background.
+
+        Returns an event that is sent once the handler is stopped, which
+        can be waited for by callers needing the console log files to be
+        released.
+        """
+        return self._stop_console_handler_async(instance_name)
+
+    def wait_for_console_handler_stop(self, instance_name):
+        """Waits for a pending console handler stop, if any."""
+        stop_event = _pending_handler_stops.get(instance_name)
+        if stop_event:
+            stop_event.wait()
+
     def _stop_console_handler(self, instance_name):
-        handler = _console_handlers.get(instance_name)
-        if handler:
-            LOG.info(_LI("Stopping instance %(instance_name)s "
-                         "serial console handler."),
-                     {'instance_name': instance_name})
-            handler.stop()
-            del _console_handlers[instance_name]
+        self._stop_console_handler_async(instance_name).wait()
+
+    def _stop_console_handler_async(self, instance_name):
+        handler = _console_handlers.pop(instance_name, None)
+        if not handler:
+            stop_event = _pending_handler_stops.get(instance_name)
+            if not stop_event:
+                stop_event = event.Event()
+                stop_event.send()
+            return stop_event
+
+        LOG.info(_LI("Stopping instance %(instance_name)s "
+                     "serial console handler."),
+                 {'instance_name': instance_name})
+        stop_event = event.Event()
+        _pending_handler_stops[instance_name] = stop_event
+        eventlet.spawn_n(self._stop_handler, instance_name, handler,
+                         stop_event)
+        return stop_event
+
+    def _stop_handler(self, instance_name, handler, stop_event):
+        try:
+            # Stopping the handler implies joining native threads.
+            ioutils.avoid_blocking_call(handler.stop)
+        except Exception as exc:
+            LOG.error(_LE('Instance %(instance_name)s serial console handler '
+                          'could not be stopped. Exception %(exc)s'),
+                      {'instance_name': instance_name,
+                       'exc': exc})
+        finally:
+            if _pending_handler_stops.get(instance_name) is stop_event:
+                del _pending_handler_stops[instance_name]
+            stop_event.send()
 
     @instance_synchronized
     def get_serial_console(self, instance_name):
@@ -87,30 +162,168 @@ class SerialConsoleOps(object):
             raise exception.ConsoleTypeUnavailable(console_type='serial')
         return handler.get_serial_console()
 
+    def get_console_output(self, instance_name, offset=None, length=None):
+        """Returns the instance console output.
+
+        Unless a byte range is requested, the last console_output_max_bytes
+        bytes of output are returned, or the whole console log if this
+        limit is not set. A negative offset is relative to the end of the
+        console log.
+        """
+        if offset is None and length is None:
+            max_bytes = CONF.hyperv.console_output_max_bytes
+            offset = -max_bytes if max_bytes else 0
+
+        if offset < 0 and length is None:
+            # Recent console output may be available in memory.
+            handler = _console_handlers.get(instance_name)
+            output = (handler.get_console_log_tail(-offset)
+                      if handler else None)
+            if output is not None:
+                return output
+
+        return b''.join(self.iter_console_output(
+            instance_name, offset=offset or 0, length=length))
+
+    def iter_console_output(self, instance_name, offset=0, length=None,
+                            chunk_size=CONSOLE_OUTPUT_CHUNK_SIZE):
+        """Returns a generator yielding the requested console output.
+
+        The console log files are read in chunks, so that large logs may be
+        streamed without loading them in memory.
+        """
+        # Only the newest console logs are needed when reading the end of
+        # the console output.
+        max_bytes = -offset if offset < 0 else None
+        segments = self._get_console_log_segments(instance_name,
+                                                  max_bytes=max_bytes)
+        total_size = sum(size for log_path, size in segments)
+
+        start = offset if offset >= 0 else max(total_size + offset, 0)
+        end = total_size
+        if length is not None:
+            end = min(start + length, total_size)
+
+        return self._read_console_log_segments(instance_name, segments,
+                                               start, end, chunk_size)
+
     @instance_synchronized
-    def get_console_output(self, instance_name):
+    def _get_console_log_segments(self, instance_name, max_bytes=None):
+        # Returns the console log paths along with their sizes, starting
+        # with the oldest console log file. If max_bytes is set, the older
+        # console logs are skipped once the newer ones hold enough output,
+        # so that archives are not decompressed needlessly.
         console_log_paths = self._pathutils.get_vm_console_log_paths(
             instance_name)
+        # Make sure that the buffered console output is included.
+        consolelogwriter.get_log_writer().flush_log(console_log_paths[0])
+
+        segments = []
+        total_size = 0
+        for log_path in console_log_paths:
+            if max_bytes is not None and total_size >= max_bytes:
+                break
+            if self._pathutils.exists(
+                    log_path + pathutils.CONSOLE_LOG_ARCHIVE_EXT):
+                # The log was compressed, being about to be removed.
+                continue
+            try:
+                log_size = self._pathutils.get_console_log_size(log_path)
+            except (IOError, OSError) as err:
+                # Rotated logs may be missing or get compressed meanwhile.
+                if err.errno != errno.ENOENT:
+                    raise exception.ConsoleLogOutputException(
+                        instance_id=instance_name,
+                        reason=six.text_type(err))
+                continue
+            segments.append((log_path, log_size))
+            total_size += log_size
+        return segments[::-1]
 
+    def _read_console_log_segments(self, instance_name, segments,
+                                   start, end, chunk_size):
+        segment_start = 0
+        for log_path, segment_size in segments:
+            segment_end = segment_start + segment_size
+            pos = max(start, segment_start) - segment_start
+            read_end = min(end, segment_end) - segment_start
+
+            while pos < read_end:
+                data = self._read_console_log_chunk(
+                    instance_name, log_path, pos,
+                    min(chunk_size, read_end - pos))
+                if not data:
+                    # The log was rotated in the meantime.
+                    break
+                pos += len(data)
+                yield data
+
+            segment_start = segment_end
+
+    def _read_console_log_chunk(self, instance_name, log_path, pos, size):
+        # The file is not kept open between reads in order to avoid
+        # preventing log rotation while the output is being streamed.
         try:
-            log = b''
-            # Start with the oldest console log file.
-            for log_path in console_log_paths[::-1]:
-                if os.path.exists(log_path):
-                    with open(log_path, 'rb') as fp:
-                        log += fp.read()
-            return log
-        except IOError as err:
+            with self._pathutils.open_console_log(log_path) as fp:
+                fp.seek(pos)
+                return fp.read(size)
+        except (IOError, OSError) as err:
+            if err.errno == errno.ENOENT:
+                # The log was rotated in the meantime.
+                return b''
             raise exception.ConsoleLogOutputException(
                 instance_id=instance_name, reason=six.text_type(err))
 
     def start_console_handlers(self):
+        """Starts the console handlers of the active instances.
+
+        The handlers are started in the background, so that the compute
+        service is not held up while waiting for the instance serial
+        ports to become available.
+        """
+        eventlet.spawn_n(self._start_console_handlers)
+
+    def _start_console_handlers(self):
+        start_time = time.time()
         active_instances = self._vmutils.get_active_instances()
-        for instance_name in active_instances:
+
+        pool = eventlet.GreenPool(
+            CONF.hyperv.console_handler_startup_workers)
+        results = list(pool.imap(self._start_console_handler_on_startup,
+                                 active_instances))
+        failed_instances = [instance_name for instance_name, started
+                            in zip(active_instances, results)
+                            if started is False]
+
+        if failed_instances:
+            LOG.warning(_LW('The serial console handlers of the following '
+                            'instances could not be started: '
+                            '%(instances)s'),
+                        {'instances': ', '.join(failed_instances)})
+        LOG.info(_LI('Started %(started_count)d serial console handlers in '
+                     '%(elapsed).2f seconds, %(failed_count)d failed.'),
+                 {'started_count': results.count(True),
+                  'elapsed': time.time() - start_time,
+                  'failed_count': len(failed_instances)})
+
+    def _start_console_handler_on_startup(self, instance_name):
+        # Returns whether the console handler was started, or None if the
+        # instance is skipped.
+        try:
             instance_path = self._pathutils.get_instance_dir(instance_name)
 
             # Skip instances that are not created by Nova
             if not os.path.exists(instance_path):
-                continue
+                return None
 
-            self.start_console_handler(instance_name)
+            # The handler may have been started meanwhile, if the instance
+            # was restarted.
+            if instance_name not in _console_handlers:
+                self.start_console_handler(instance_name)
+            return instance_name in _console_handlers
+        except Exception as exc:
+            LOG.error(_LE('Instance %(instance_name)s serial console handler '
+                          'could not start. Exception %(exc)s'),
+                      {'instance_name': instance_name,
+                       'exc': exc})
+            return False
@@ -15,15 +15,38 @@
 
 from eventlet import patcher
 
+import collections
+import errno
 import functools
 import socket
 
 from nova import exception
-from nova.i18n import _
+from nova.i18n import _, _LE  # noqa
+from oslo_log import log as logging
 
 from hyperv.nova import constants
+from hyperv.nova import ioutils
+
+LOG = logging.getLogger(__name__)
 
 threading = patcher.original('threading')
+select = patcher.original('select')
+
+try:
+    selectors = patcher.original('selectors')
+except ImportError:
+    # Python 2.7 does not provide the selectors module.
+    selectors = None
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+# Used for retrying to pass client input to the input queue
+# after it was found to be full.
+BLOCKED_INPUT_RETRY_INTERVAL = ioutils.IO_QUEUE_BURST_TIMEOUT
+
+_proxy_service = None
+_proxy_service_lock = threading.Lock()
 
 
 def handle_socket_errors(func):
@@ -31,20 +54,115 @@ def handle_socket_errors(func):
     def wrapper(self, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
-        except socket.error:
-            self._client_connected.clear()
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # The socket is not ready yet, the operation will be
+                # retried when the event loop reports it as ready.
+                return
+            self._disconnect_client()
     return wrapper
 
 
-class SerialProxy(threading.Thread):
+def get_proxy_service():
+    """Returns the serial proxy service, starting it if needed."""
+    global _proxy_service
+
+    with _proxy_service_lock:
+        if not _proxy_service:
+            _proxy_service = SerialProxyService()
+            _proxy_service.start()
+        return _proxy_service
+
+
+def _socketpair():
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    # socket.socketpair is not available on Windows when using Python 2.7.
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listen_sock.bind(('127.0.0.1', 0))
+        listen_sock.listen(1)
+
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_sock.connect(listen_sock.getsockname())
+        server_sock, client_addr = listen_sock.accept()
+    finally:
+        listen_sock.close()
+    return server_sock, client_sock
+
+
+_SelectorKey = collections.namedtuple('_SelectorKey',
+                                      ['fileobj', 'fd', 'events', 'data'])
+
+
+class _SelectSelector(object):
+    """Minimal select based selector used when 'selectors' is missing."""
+
+    def __init__(self):
+        self._keys = {}
+
+    def _get_fd(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd < 0:
+            raise ValueError("Invalid file descriptor: %s" % fd)
+        return fd
+
+    def register(self, fileobj, events, data=None):
+        fd = self._get_fd(fileobj)
+        if fd in self._keys:
+            raise KeyError("%s is already registered" % fileobj)
+
+        key = _SelectorKey(fileobj, fd, events, data)
+        self._keys[fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        for fd, key in list(self._keys.items()):
+            if key.fileobj is fileobj or fd == fileobj:
+                return self._keys.pop(fd)
+        raise KeyError("%s is not registered" % fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        self.unregister(fileobj)
+        return self.register(fileobj, events, data)
+
+    def select(self, timeout=None):
+        r_fds = [fd for fd, key in self._keys.items()
+                 if key.events & EVENT_READ]
+        w_fds = [fd for fd, key in self._keys.items()
+                 if key.events & EVENT_WRITE]
+
+        r_fds, w_fds, x_fds = select.select(r_fds, w_fds, [], timeout)
+
+        ready = collections.defaultdict(int)
+        for fd in r_fds:
+            ready[fd] |= EVENT_READ
+        for fd in w_fds:
+            ready[fd] |= EVENT_WRITE
+        return [(self._keys[fd], events)
+                for fd, events in ready.items() if fd in self._keys]
+
+
+def _get_selector():
+    if selectors:
+        return selectors.DefaultSelector()
+    return _SelectSelector()
+
+
+class SerialProxy(object):
+    """Serial console proxy handling connections to a given instance.
+
+    The actual socket I/O is performed by the serial proxy service, which
+    serves the console sockets of all the instances using a single thread.
+    """
+
     def __init__(self, instance_name, addr, port, input_queue,
                  output_queue, client_connected):
-        super(SerialProxy, self).__init__()
-        self.setDaemon(True)
-
         self._instance_name = instance_name
         self._addr = addr
         self._port = port
+        self._sock = None
         self._conn = None
 
         self._input_queue = input_queue
@@ -52,6 +170,13 @@ class SerialProxy(threading.Thread):
         self._client_connected = client_connected
         self._stopped = threading.Event()
 
+        # Data retrieved from the output queue, not sent yet.
+        self._send_buffer = b''
+        # Data received from the client that did not fit the input queue.
+        self._pending_input = None
+
+        self._proxy_service = None
+
     def _setup_socket(self):
         try:
             self._sock = socket.socket(socket.AF_INET,
@@ -61,6 +186,7 @@ class SerialProxy(threading.Thread):
                                   1)
             self._sock.bind((self._addr, self._port))
             self._sock.listen(1)
+            self._sock.setblocking(False)
         except socket.error as err:
             self._sock.close()
             msg = (_('Failed to initialize serial proxy on'
@@ -71,52 +197,252 @@ class SerialProxy(threading.Thread):
                     'error': err})
             raise exception.NovaException(msg)
 
+    @property
+    def stopped(self):
+        return self._stopped.isSet()
+
+    def start(self):
+        self._setup_socket()
+
+        self._proxy_service = get_proxy_service()
+        self._output_queue.set_put_callback(
+            functools.partial(self._proxy_service.notify, self))
+        self._proxy_service.notify(self)
+
     def stop(self):
         self._stopped.set()
         self._client_connected.clear()
-        if self._conn:
-            self._conn.shutdown(socket.SHUT_RDWR)
-            self._conn.close()
+
+        conn = self._conn
+        if conn:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
         self._sock.close()
 
-    def run(self):
-        self._setup_socket()
-        while not self._stopped.isSet():
+        if self._proxy_service:
+            self._output_queue.set_put_callback(None)
+            self._proxy_service.notify(self)
+
+    def get_io_events(self):
+        """Returns the socket to be watched along with the event mask."""
+        if not self._conn:
+            return self._sock, EVENT_READ
+
+        events = 0
+        if self._pending_input is None:
+            events |= EVENT_READ
+        if self._send_buffer:
+            events |= EVENT_WRITE
+        return self._conn, events
+
+    def handle_io_events(self, events):
+        if not self._conn:
             self._accept_conn()
+            return
 
-    @handle_socket_errors
-    def _accept_conn(self):
-        self._conn, client_addr = self._sock.accept()
-        self._client_connected.set()
+        if events & EVENT_READ:
+            self._get_data()
+        if events & EVENT_WRITE and self._conn:
+            self._send_data()
 
-        workers = []
-        for job in [self._get_data, self._send_data]:
-            worker = threading.Thread(target=job)
-            worker.setDaemon(True)
-            worker.start()
-            workers.append(worker)
+    @property
+    def input_blocked(self):
+        return self._pending_input is not None
 
-        for worker in workers:
-            worker_running = (worker.is_alive() and
-                              worker is not threading.current_thread())
-            if worker_running:
-                worker.join()
+    def flush_pending_input(self):
+        """Passes pending client input to the input queue, if possible.
 
-        self._conn.close()
-        self._conn = None
+        Returns True if there is no more pending input.
+        """
+        if self._pending_input is not None:
+            try:
+                self._input_queue.put_nowait(self._pending_input)
+            except ioutils.Queue.Full:
+                return False
+            self._pending_input = None
+        return True
+
+    def fill_send_buffer(self):
+        if self._conn and not self._send_buffer:
+            self._send_buffer = self._output_queue.get_burst_nowait()
+
+    @handle_socket_errors
+    def _accept_conn(self):
+        conn, client_addr = self._sock.accept()
+        conn.setblocking(False)
+
+        self._conn = conn
+        self._client_connected.set()
 
     @handle_socket_errors
     def _get_data(self):
-        while self._client_connected.isSet():
-            data = self._conn.recv(constants.SERIAL_CONSOLE_BUFFER_SIZE)
-            if not data:
-                self._client_connected.clear()
-                return
-            self._input_queue.put(data)
+        data = self._conn.recv(constants.SERIAL_CONSOLE_BUFFER_SIZE)
+        if not data:
+            self._disconnect_client()
+            return
+
+        self._pending_input = data
+        self.flush_pending_input()
 
     @handle_socket_errors
     def _send_data(self):
-        while self._client_connected.isSet():
-            data = self._output_queue.get_burst()
-            if data:
-                self._conn.sendall(data)
+        sent = self._conn.send(self._send_buffer)
+        self._send_buffer = self._send_buffer[sent:]
+
+    def _disconnect_client(self):
+        self._client_connected.clear()
+        self._send_buffer = b''
+        self._pending_input = None
+
+        if self._conn:
+            try:
+                self._conn.close()
+            except socket.error:
+                pass
+            self._conn = None
+
+
+class SerialProxyService(threading.Thread):
+    """Serves the serial console sockets of all the instances.
+
+    A single event loop moves data between the console sockets and the
+    named pipe handler queues, so no threads are spawned per instance or
+    per client connection.
+    """
+
+    def __init__(self):
+        super(SerialProxyService, self).__init__()
+        self.setDaemon(True)
+
+        self._selector = _get_selector()
+        self._lock = threading.Lock()
+
+        # Proxies that have to be (re)evaluated by the event loop.
+        self._pending_proxies = set()
+        # Proxies waiting for room in their input queue.
+        self._blocked_proxies = set()
+        # Maps proxies to the socket and events currently watched.
+        self._registered_proxies = {}
+
+        self._wakeup_reader, self._wakeup_writer = _socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, EVENT_READ)
+
+    def notify(self, proxy):
+        """Requests the event loop to reevaluate the proxy state."""
+        with self._lock:
+            self._pending_proxies.add(proxy)
+
+        try:
+            self._wakeup_writer.send(b'\0')
+        except socket.error:
+            # The wakeup socket buffer is full, the event loop
+            # is going to be woken up anyway.
+            pass
+
+    def run(self):
+        while True:
+            try:
+                self._run_once()
+            except Exception:
+                LOG.exception(_LE('Unexpected serial proxy service error.'))
+
+    def _run_once(self):
+        with self._lock:
+            pending_proxies = self._pending_proxies
+            self._pending_proxies = set()
+
+        # Stopped proxies are handled first so that their sockets get
+        # unregistered before any other socket reuses the same fd.
+        for proxy in sorted(pending_proxies,
+                            key=lambda proxy: not proxy.stopped):
+            self._update_proxy(proxy)
+
+        for proxy in list(self._blocked_proxies):
+            if proxy.stopped or proxy.flush_pending_input():
+                self._blocked_proxies.discard(proxy)
+                self._update_proxy(proxy)
+
+        timeout = (BLOCKED_INPUT_RETRY_INTERVAL
+                   if self._blocked_proxies else None)
+        try:
+            ready = self._selector.select(timeout)
+        except (select.error, socket.error, ValueError):
+            # One of the watched sockets was closed in the meantime.
+            self._purge_stopped_proxies()
+            return
+
+        for key, events in ready:
+            proxy = key.data
+            if not proxy:
+                self._drain_wakeup_socket()
+                continue
+
+            if not proxy.stopped:
+                proxy.handle_io_events(events)
+            self._update_proxy(proxy)
+
+    def _update_proxy(self, proxy):
+        sock, events = None, 0
+        if proxy.stopped:
+            self._blocked_proxies.discard(proxy)
+        else:
+            proxy.fill_send_buffer()
+            sock, events = proxy.get_io_events()
+
+            if proxy.input_blocked:
+                self._blocked_proxies.add(proxy)
+
+        registered_sock, registered_events = (
+            self._registered_proxies.get(proxy, (None, 0)))
+        if registered_sock is not None and (registered_sock is not sock or
+                                            not events):
+            self._unregister(proxy, registered_sock)
+            registered_sock = None
+
+        if not events:
+            return
+
+        if registered_sock is None:
+            self._register(proxy, sock, events)
+        elif registered_events != events:
+            self._selector.modify(sock, events, proxy)
+            self._registered_proxies[proxy] = (sock, events)
+
+    def _register(self, proxy, sock, events):
+        try:
+            self._selector.register(sock, events, proxy)
+        except KeyError:
+            # The fd belonged to a socket that was closed but not yet
+            # unregistered.
+            self._selector.unregister(sock.fileno())
+            self._selector.register(sock, events, proxy)
+        except ValueError:
+            # The socket was closed in the meantime.
+            return
+        self._registered_proxies[proxy] = (sock, events)
+
+    def _unregister(self, proxy, sock):
+        self._registered_proxies.pop(proxy, None)
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _purge_stopped_proxies(self):
+        for proxy, (sock, events) in list(self._registered_proxies.items()):
+            if proxy.stopped:
+                self._unregister(proxy, sock)
+                self._blocked_proxies.discard(proxy)
+
+    def _drain_wakeup_socket(self):
+        buff_size = constants.SERIAL_CONSOLE_BUFFER_SIZE
+        try:
+            while self._wakeup_reader.recv(buff_size):
+                pass
+        except socket.error:
+            pass
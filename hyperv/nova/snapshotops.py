@@ -1,35 +1,105 @@
-# Copyright 2012 Cloudbase Solutions Srl
-# All Rights Reserved.
-#
-#    Licensed under the Apache License, Version 2.0 (the "License"); you may
-#    not use this file except in compliance with the License. You may obtain
-#    a copy of the License at
-#
-#         http://www.apache.org/licenses/LICENSE-2.0
-#
-#    Unless required by applicable law or agreed to in writing, software
-#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
-#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
-#    License for the specific language governing permissions and limitations
-#    under the License.
-
 """
 Management class for VM snapshot operations.
 """
 import os
+import time
 
 from nova.compute import task_states
+from nova import exception
 from nova.image import glance
 from nova import utils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import units
+from oslo_utils import uuidutils
 
-from hyperv.i18n import _LW
+from hyperv.i18n import _LI, _LW
+from hyperv.nova import constants
+from hyperv.nova import ioutils
 from hyperv.nova import utilsfactory
+from hyperv.nova import vmutils
 
-CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+hyperv_opts = [
+    cfg.BoolOpt('stream_snapshots',
+                default=True,
+                help='Upload instance snapshots to Glance while the '
+                     'instance disk chain is being merged, without writing '
+                     'the merged image to the local disk. The merged image '
+                     'is exported to disk first if the disk chain cannot '
+                     'be read in process.'),
+    cfg.BoolOpt('incremental_snapshots',
+                default=False,
+                help='Upload only the differencing disk of the instance '
+                     'root disk when taking snapshots of instances based '
+                     'on cached images, along with the parent image id. '
+                     'The snapshot image is rebuilt on top of the cached '
+                     'parent image when used, so the parent images must '
+                     'be kept in Glance as long as the snapshots are in '
+                     'use. Such snapshots can be used only by Hyper-V '
+                     'compute nodes.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+
+class _ImageStream(object):
+    """File like object reading the chunks of a generated image.
+
+    Glance clients read the image data in small chunks, while the image
+    is generated in large chunks, read in native threads so that the
+    other greenthreads are not blocked. The completion callback is
+    invoked as soon as the last chunk is read.
+    """
+
+    _ITER_CHUNK_SIZE = units.Mi
+
+    def __init__(self, chunks, on_complete):
+        self._chunks = iter(chunks)
+        self._on_complete = on_complete
+        self._chunk = b''
+        self._chunk_pos = 0
+        self._eof = False
+        self.bytes_read = 0
+
+    def _read_chunk(self):
+        chunk = ioutils.avoid_blocking_call(next, self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            self._on_complete()
+        else:
+            self._chunk = chunk
+            self._chunk_pos = 0
+
+    def read(self, size=-1):
+        data = []
+        remaining = size
+        while remaining and not self._eof:
+            if self._chunk_pos == len(self._chunk):
+                self._read_chunk()
+                continue
+
+            end = len(self._chunk)
+            if remaining > 0:
+                end = min(end, self._chunk_pos + remaining)
+                remaining -= end - self._chunk_pos
+            data.append(self._chunk[self._chunk_pos:end])
+            self._chunk_pos = end
+
+        data = b''.join(data)
+        self.bytes_read += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(self._ITER_CHUNK_SIZE), b'')
+
+    def close(self):
+        # Releases the images being read if the upload is interrupted.
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+
 
 class SnapshotOps(object):
     def __init__(self):
@@ -37,15 +107,119 @@ class SnapshotOps(object):
         self._vmutils = utilsfactory.get_vmutils()
         self._vhdutils = utilsfactory.get_vhdutils()
 
-    def _save_glance_image(self, context, image_id, image_vhd_path):
+    def _save_glance_image(self, context, image_id, image_vhd_path,
+                           properties=None):
+        with self._pathutils.open(image_vhd_path, 'rb') as f:
+            self._upload_glance_image(context, image_id, f, properties)
+
+    def _upload_glance_image(self, context, image_id, data, properties=None):
         (glance_image_service,
          image_id) = glance.get_remote_image_service(context, image_id)
         image_metadata = {"is_public": False,
                           "disk_format": "vhd",
                           "container_format": "bare",
-                          "properties": {}}
-        with self._pathutils.open(image_vhd_path, 'rb') as f:
-            glance_image_service.update(context, image_id, image_metadata, f)
+                          "properties": properties or {}}
+        glance_image_service.update(context, image_id, image_metadata, data)
+
+    def _is_glance_image_available(self, context, image_id):
+        (glance_image_service,
+         image_id) = glance.get_remote_image_service(context, image_id)
+        try:
+            image_meta = glance_image_service.show(context, image_id)
+        except exception.ImageNotFound:
+            return False
+        return image_meta.get('status') == 'active'
+
+    def _get_incremental_image_properties(self, context, src_vhd_path):
+        """Returns the properties of the incremental snapshot image, or
+        None if the instance root disk is not based on a cached image.
+        """
+        if not CONF.hyperv.incremental_snapshots:
+            return
+
+        parent_path = self._vhdutils.get_vhd_parent_path(src_vhd_path)
+        if not parent_path:
+            return
+
+        base_vhd_dir = self._pathutils.get_base_vhd_dir()
+        if (os.path.normcase(os.path.dirname(parent_path)) !=
+                os.path.normcase(os.path.normpath(base_vhd_dir))):
+            return
+
+        # Cached image file names have the following format:
+        # <image_id>[_<root_gb>].<format_ext>
+        file_name = os.path.splitext(os.path.basename(parent_path))[0]
+        parent_image_id, sep, root_gb = file_name.partition('_')
+        if not uuidutils.is_uuid_like(parent_image_id):
+            return
+
+        if not self._is_glance_image_available(context, parent_image_id):
+            LOG.warning(_LW("The parent image %(parent_image_id)s of disk "
+                            "%(path)s is no longer available, uploading "
+                            "the full snapshot image."),
+                        {'parent_image_id': parent_image_id,
+                         'path': src_vhd_path})
+            return
+
+        properties = {constants.IMAGE_PROP_PARENT_IMAGE_ID: parent_image_id}
+        if root_gb:
+            properties[constants.IMAGE_PROP_PARENT_ROOT_GB] = root_gb
+        return properties
+
+    def _get_image_stream(self, src_vhd_path, on_complete):
+        """Returns a stream of the merged instance disk chain, or None if
+        the chain cannot be merged in process.
+        """
+        if not CONF.hyperv.stream_snapshots:
+            return
+
+        try:
+            chunks = self._vhdutils.get_merged_vhd_chunks(src_vhd_path)
+        except vmutils.HyperVException as ex:
+            LOG.warning(_LW("Cannot stream the snapshot of disk %(path)s, "
+                            "exporting it instead. Error: %(ex)s"),
+                        {'path': src_vhd_path, 'ex': ex})
+            return
+        return _ImageStream(chunks, on_complete)
+
+    def _remove_vm_snapshot(self, instance_name, snapshot_path):
+        try:
+            LOG.debug("Removing snapshot %s", snapshot_path)
+            self._vmutils.remove_vm_snapshot(snapshot_path)
+        except Exception as ex:
+            LOG.exception(ex)
+            LOG.warning(_LW('Failed to remove snapshot for VM %s'),
+                        instance_name)
+
+    def _copy_and_merge_vhd(self, src_vhd_path, dest_vhd_path,
+                            src_base_disk_path, export_dir):
+        LOG.debug('Copying VHD %(src_vhd_path)s to %(dest_vhd_path)s',
+                  {'src_vhd_path': src_vhd_path,
+                   'dest_vhd_path': dest_vhd_path})
+        self._pathutils.copyfile(src_vhd_path, dest_vhd_path)
+
+        basename = os.path.basename(src_base_disk_path)
+        dest_base_disk_path = os.path.join(export_dir, basename)
+        LOG.debug('Copying base disk %(src_vhd_path)s to '
+                  '%(dest_base_disk_path)s',
+                  {'src_vhd_path': src_vhd_path,
+                   'dest_base_disk_path': dest_base_disk_path})
+        self._pathutils.copyfile(src_base_disk_path, dest_base_disk_path)
+
+        LOG.debug("Reconnecting copied base VHD "
+                  "%(dest_base_disk_path)s and diff "
+                  "VHD %(dest_vhd_path)s",
+                  {'dest_base_disk_path': dest_base_disk_path,
+                   'dest_vhd_path': dest_vhd_path})
+        self._vhdutils.reconnect_parent_vhd(dest_vhd_path,
+                                            dest_base_disk_path)
+
+        LOG.debug("Merging base disk %(dest_base_disk_path)s and "
+                  "diff disk %(dest_vhd_path)s",
+                  {'dest_base_disk_path': dest_base_disk_path,
+                   'dest_vhd_path': dest_vhd_path})
+        self._vhdutils.merge_vhd(dest_vhd_path, dest_base_disk_path)
+        return dest_base_disk_path
 
     def snapshot(self, context, instance, image_id, update_task_state):
         # While the snapshot operation is not synchronized within the manager,
@@ -65,69 +239,130 @@ class SnapshotOps(object):
         update_task_state(task_state=task_states.IMAGE_PENDING_UPLOAD)
 
         export_dir = None
+        image_stream = None
+        snapshot_paths = [snapshot_path]
+
+        def release_vm_snapshot():
+            # The VM snapshot is not needed anymore once the disk chain
+            # is read.
+            while snapshot_paths:
+                self._remove_vm_snapshot(instance_name, snapshot_paths.pop())
 
         try:
             src_vhd_path = self._pathutils.lookup_root_vhd_path(instance_name)
 
-            LOG.debug("Getting info for VHD %s", src_vhd_path)
-            src_base_disk_path = self._vhdutils.get_vhd_parent_path(
-                src_vhd_path)
-
-            export_dir = self._pathutils.get_export_dir(instance_name)
+            image_properties = self._get_incremental_image_properties(
+                context, src_vhd_path)
+            if not image_properties:
+                image_stream = self._get_image_stream(src_vhd_path,
+                                                      release_vm_snapshot)
 
-            dest_vhd_path = os.path.join(export_dir, os.path.basename(
-                src_vhd_path))
-            LOG.debug('Copying VHD %(src_vhd_path)s to %(dest_vhd_path)s',
-                      {'src_vhd_path': src_vhd_path,
-                       'dest_vhd_path': dest_vhd_path})
-            self._pathutils.copyfile(src_vhd_path, dest_vhd_path)
+            if image_properties:
+                self._upload_incremental_image(
+                    context, instance_name, image_id, src_vhd_path,
+                    image_properties, update_task_state)
+            elif image_stream:
+                LOG.debug("Streaming the merged disk %(src_vhd_path)s to "
+                          "Glance image %(image_id)s",
+                          {'src_vhd_path': src_vhd_path,
+                           'image_id': image_id})
+                update_task_state(
+                    task_state=task_states.IMAGE_UPLOADING,
+                    expected_state=task_states.IMAGE_PENDING_UPLOAD)
+                start_time = time.time()
+                self._upload_glance_image(context, image_id, image_stream)
 
-            image_vhd_path = None
-            if not src_base_disk_path:
-                image_vhd_path = dest_vhd_path
+                elapsed = max(time.time() - start_time, 0.001)
+                LOG.info(_LI("Streamed snapshot image %(image_id)s of "
+                             "instance %(instance_name)s: %(bytes)s bytes "
+                             "uploaded in %(elapsed).2f seconds "
+                             "(%(throughput).2f MB/s), no data being "
+                             "written to the local disk."),
+                         {'image_id': image_id,
+                          'instance_name': instance_name,
+                          'bytes': image_stream.bytes_read,
+                          'elapsed': elapsed,
+                          'throughput': (image_stream.bytes_read /
+                                         float(units.Mi) / elapsed)})
             else:
-                basename = os.path.basename(src_base_disk_path)
-                dest_base_disk_path = os.path.join(export_dir, basename)
-                LOG.debug('Copying base disk %(src_vhd_path)s to '
-                          '%(dest_base_disk_path)s',
-                          {'src_vhd_path': src_vhd_path,
-                           'dest_base_disk_path': dest_base_disk_path})
-                self._pathutils.copyfile(src_base_disk_path,
-                                         dest_base_disk_path)
-
-                LOG.debug("Reconnecting copied base VHD "
-                          "%(dest_base_disk_path)s and diff "
-                          "VHD %(dest_vhd_path)s",
-                          {'dest_base_disk_path': dest_base_disk_path,
-                           'dest_vhd_path': dest_vhd_path})
-                self._vhdutils.reconnect_parent_vhd(dest_vhd_path,
-                                                    dest_base_disk_path)
-
-                LOG.debug("Merging base disk %(dest_base_disk_path)s and "
-                          "diff disk %(dest_vhd_path)s",
-                          {'dest_base_disk_path': dest_base_disk_path,
-                           'dest_vhd_path': dest_vhd_path})
-                self._vhdutils.merge_vhd(dest_vhd_path, dest_base_disk_path)
-                image_vhd_path = dest_base_disk_path
-
-            LOG.debug("Updating Glance image %(image_id)s with content from "
-                      "merged disk %(image_vhd_path)s",
-                      {'image_id': image_id, 'image_vhd_path': image_vhd_path})
-            update_task_state(task_state=task_states.IMAGE_UPLOADING,
-                              expected_state=task_states.IMAGE_PENDING_UPLOAD)
-            self._save_glance_image(context, image_id, image_vhd_path)
+                export_dir = self._pathutils.get_export_dir(instance_name)
+                self._export_and_upload_image(context, instance_name,
+                                              image_id, src_vhd_path,
+                                              export_dir, update_task_state)
 
             LOG.debug("Snapshot image %(image_id)s updated for VM "
                       "%(instance_name)s",
                       {'image_id': image_id, 'instance_name': instance_name})
         finally:
-            try:
-                LOG.debug("Removing snapshot %s", image_id)
-                self._vmutils.remove_vm_snapshot(snapshot_path)
-            except Exception as ex:
-                LOG.exception(ex)
-                LOG.warning(_LW('Failed to remove snapshot for VM %s'),
-                            instance_name)
+            if image_stream:
+                image_stream.close()
+            release_vm_snapshot()
             if export_dir:
                 LOG.debug('Removing directory: %s', export_dir)
                 self._pathutils.rmtree(export_dir)
+
+    def _upload_incremental_image(self, context, instance_name, image_id,
+                                  src_vhd_path, image_properties,
+                                  update_task_state):
+        # The root disk is not modified while the VM snapshot exists, the
+        # VM writing to a new differencing disk.
+        LOG.debug("Uploading differencing disk %(src_vhd_path)s to Glance "
+                  "image %(image_id)s",
+                  {'src_vhd_path': src_vhd_path, 'image_id': image_id})
+        update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                          expected_state=task_states.IMAGE_PENDING_UPLOAD)
+        start_time = time.time()
+        self._save_glance_image(context, image_id, src_vhd_path,
+                                image_properties)
+
+        LOG.info(_LI("Uploaded incremental snapshot image %(image_id)s of "
+                     "instance %(instance_name)s, based on image "
+                     "%(parent_image_id)s: %(bytes)s bytes uploaded in "
+                     "%(elapsed).2f seconds."),
+                 {'image_id': image_id, 'instance_name': instance_name,
+                  'parent_image_id': image_properties[
+                      constants.IMAGE_PROP_PARENT_IMAGE_ID],
+                  'bytes': os.path.getsize(src_vhd_path),
+                  'elapsed': time.time() - start_time})
+
+    def _export_and_upload_image(self, context, instance_name, image_id,
+                                 src_vhd_path, export_dir,
+                                 update_task_state):
+        LOG.debug("Getting info for VHD %s", src_vhd_path)
+        src_base_disk_path = self._vhdutils.get_vhd_parent_path(
+            src_vhd_path)
+
+        dest_vhd_path = os.path.join(export_dir, os.path.basename(
+            src_vhd_path))
+
+        image_vhd_path = None
+        if not src_base_disk_path:
+            LOG.debug('Copying VHD %(src_vhd_path)s to %(dest_vhd_path)s',
+                      {'src_vhd_path': src_vhd_path,
+                       'dest_vhd_path': dest_vhd_path})
+            self._pathutils.copyfile(src_vhd_path, dest_vhd_path)
+            image_vhd_path = dest_vhd_path
+        elif self._vhdutils.merge_vhd_chain(src_vhd_path, dest_vhd_path):
+            # The differencing chain is merged in a single pass, the
+            # base disk not being copied.
+            image_vhd_path = dest_vhd_path
+        else:
+            image_vhd_path = self._copy_and_merge_vhd(
+                src_vhd_path, dest_vhd_path, src_base_disk_path,
+                export_dir)
+
+        LOG.debug("Updating Glance image %(image_id)s with content from "
+                  "merged disk %(image_vhd_path)s",
+                  {'image_id': image_id, 'image_vhd_path': image_vhd_path})
+        update_task_state(task_state=task_states.IMAGE_UPLOADING,
+                          expected_state=task_states.IMAGE_PENDING_UPLOAD)
+        start_time = time.time()
+        self._save_glance_image(context, image_id, image_vhd_path)
+
+        LOG.info(_LI("Uploaded snapshot image %(image_id)s of instance "
+                     "%(instance_name)s in %(elapsed).2f seconds, "
+                     "%(local_bytes)s bytes being written to the local "
+                     "disk."),
+                 {'image_id': image_id, 'instance_name': instance_name,
+                  'elapsed': time.time() - start_time,
+                  'local_bytes': self._pathutils.get_dir_size(export_dir)})
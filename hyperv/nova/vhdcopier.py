@@ -0,0 +1,186 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Allocation aware copy of VHD / VHDX images.
+
+Only the image metadata and the blocks having data are copied. The other
+file ranges, such as the space left by discarded blocks or the empty
+VHDX log, along with the zeroed ranges, are not written, reading back as
+zeros.
+
+The destination files are not marked as sparse, as Hyper-V refuses to
+attach sparse virtual disks. The copied and merged images are attached to
+instances or used as differencing image parents.
+"""
+import os
+
+from oslo_utils import excutils
+from oslo_utils import fileutils
+from oslo_utils import units
+
+from hyperv.i18n import _
+from hyperv.nova import constants
+from hyperv.nova import vhdparser
+from hyperv.nova import vmutils
+
+COPY_CHUNK_SIZE = 4 * units.Mi
+# The granularity at which zeroed ranges are skipped.
+ZERO_RANGE_SIZE = 64 * units.Ki
+
+_ZERO_RANGE = b'\x00' * ZERO_RANGE_SIZE
+# Image properties which must be identical after the copy.
+_VERIFIED_PROPERTIES = ('Format', 'Type', 'MaxInternalSize', 'BlockSize',
+                        'FileSize', 'BlockOffsets', 'SectorBitmapOffsets',
+                        'MetadataRanges')
+
+
+def copy_vhd(src_path, dest_path):
+    """Copies a VHD or VHDX image, skipping the unused file ranges.
+
+    The destination image has the same layout as the source image, an
+    existing destination file being overwritten.
+
+    :returns: the number of bytes written.
+    :raises vmutils.HyperVException: if the source is not a supported
+                                     image or if the copy does not match
+                                     the source image.
+    """
+    allocation_map = vhdparser.get_vhd_allocation_map(src_path)
+    file_ranges = get_used_file_ranges(allocation_map)
+
+    try:
+        with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+            bytes_written = _copy_file_ranges(src, dest, file_ranges)
+            dest.truncate(allocation_map['FileSize'])
+            dest.flush()
+            os.fsync(dest.fileno())
+
+        _verify_copy(allocation_map, dest_path)
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            fileutils.delete_if_exists(dest_path)
+    return bytes_written
+
+
+def write_image(dest_path, chunks):
+    """Writes the image chunks to a file, skipping zeroed ranges.
+
+    An existing destination file is overwritten, being removed if the
+    image cannot be written.
+
+    :returns: the number of bytes written.
+    """
+    try:
+        with open(dest_path, 'wb') as dest:
+            offset = 0
+            bytes_written = 0
+            for chunk in chunks:
+                bytes_written += _write_non_zeroed_ranges(dest, offset,
+                                                          chunk)
+                offset += len(chunk)
+            dest.truncate(offset)
+            dest.flush()
+            os.fsync(dest.fileno())
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            fileutils.delete_if_exists(dest_path)
+    return bytes_written
+
+
+def get_used_file_ranges(allocation_map):
+    """Returns the sorted (offset, length) image file ranges in use.
+
+    Those are the ranges holding the image metadata and the data of the
+    allocated blocks, adjacent ranges being merged.
+    """
+    block_size = allocation_map['BlockSize']
+    block_offset_unit = allocation_map['BlockOffsetUnit']
+    # The data of the VHD blocks is preceded by the sector bitmap.
+    bitmap_size = 0
+    if (allocation_map['Format'] == vhdparser.VHD_FORMAT and
+            allocation_map['Type'] != constants.VHD_TYPE_FIXED):
+        bitmap_size = vhdparser.get_vhd_sector_bitmap_size(block_size)
+
+    file_ranges = list(allocation_map['MetadataRanges'])
+    for block_offset in allocation_map['BlockOffsets']:
+        if block_offset not in (vhdparser.BLOCK_NOT_PRESENT,
+                                vhdparser.BLOCK_ZERO):
+            file_ranges.append((block_offset * block_offset_unit -
+                                bitmap_size, bitmap_size + block_size))
+    for bitmap_offset in allocation_map['SectorBitmapOffsets'] or []:
+        if bitmap_offset != vhdparser.BLOCK_NOT_PRESENT:
+            file_ranges.append((bitmap_offset * block_offset_unit,
+                                units.Mi))
+
+    file_size = allocation_map['FileSize']
+    merged_ranges = []
+    for offset, length in sorted(file_ranges):
+        end = min(offset + length, file_size)
+        if merged_ranges and offset <= merged_ranges[-1][1]:
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], end)
+        elif offset < end:
+            merged_ranges.append([offset, end])
+    return [(start, end - start) for start, end in merged_ranges]
+
+
+def _is_zeroed(data):
+    if len(data) == ZERO_RANGE_SIZE:
+        return data == _ZERO_RANGE
+    return data.count(b'\x00') == len(data)
+
+
+def _write_non_zeroed_ranges(dest, offset, chunk):
+    bytes_written = 0
+    write_start = None
+    # The extra iteration flushes the data pending at the end of chunk.
+    for pos in range(0, len(chunk) + ZERO_RANGE_SIZE, ZERO_RANGE_SIZE):
+        data = chunk[pos:pos + ZERO_RANGE_SIZE]
+        if data and not _is_zeroed(data):
+            if write_start is None:
+                write_start = pos
+        elif write_start is not None:
+            dest.seek(offset + write_start)
+            dest.write(chunk[write_start:pos])
+            bytes_written += len(chunk[write_start:pos])
+            write_start = None
+    return bytes_written
+
+
+def _copy_file_ranges(src, dest, file_ranges):
+    bytes_written = 0
+    for offset, length in file_ranges:
+        src.seek(offset)
+        while length:
+            chunk = src.read(min(length, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise IOError(_("Unexpected end of file at offset %s.") %
+                              offset)
+
+            bytes_written += _write_non_zeroed_ranges(dest, offset, chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+    return bytes_written
+
+
+def _verify_copy(allocation_map, dest_path):
+    dest_allocation_map = vhdparser.get_vhd_allocation_map(dest_path)
+    for prop in _VERIFIED_PROPERTIES:
+        if allocation_map[prop] != dest_allocation_map[prop]:
+            raise vmutils.HyperVException(
+                _("The copied image %(dest_path)s does not match the "
+                  "source image %(src_path)s: %(prop)s differs.") %
+                {'dest_path': dest_path, 'src_path': allocation_map['Path'],
+                 'prop': prop})
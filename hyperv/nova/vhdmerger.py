@@ -0,0 +1,313 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Streaming merge of VHD / VHDX differencing chains.
+
+The allocation maps of the images in the chain are used to build the
+block allocation table of the merged image upfront, so the merged image
+is generated in a single sequential pass, each virtual disk range being
+read from the topmost image having data for it.
+"""
+from hyperv.i18n import _
+from hyperv.nova import vhdcopier
+from hyperv.nova import vhdparser
+from hyperv.nova import vhdwriter
+from hyperv.nova import vmutils
+
+# Differencing chains deeper than this are considered invalid, also
+# preventing loops.
+MAX_CHAIN_LENGTH = 128
+
+# Virtual disk range sources.
+_FROM_IMAGE = 0
+_FROM_PARENT = 1
+_ZEROED = 2
+
+
+class _ImageLayer(object):
+    """An image of a differencing chain, opened for reading."""
+
+    def __init__(self, allocation_map):
+        self.allocation_map = allocation_map
+        self.has_parent = bool(allocation_map['ParentPath'])
+        self._block_size = allocation_map['BlockSize']
+        self._file = open(allocation_map['Path'], 'rb')
+        self._cached_bitmap = (None, None)
+
+        if allocation_map['Format'] == vhdparser.VHD_FORMAT:
+            self._sector_size = vhdparser.VHD_SECTOR_SIZE
+        else:
+            self._sector_size = allocation_map['LogicalSectorSize']
+            self._chunk_ratio = vhdparser._get_vhdx_chunk_ratio(
+                allocation_map)
+
+    def close(self):
+        self._file.close()
+
+    def read(self, block_idx, offset, length):
+        """Reads a range of a block, the offset being block relative."""
+        self._file.seek(vhdparser.get_block_file_offset(
+            self.allocation_map, block_idx) + offset)
+        data = self._file.read(length)
+        if len(data) != length:
+            raise IOError(_("Unexpected end of file %s.") %
+                          self.allocation_map['Path'])
+        return data
+
+    def get_block_sources(self, block_idx, start, end):
+        """Yields the (start, end, source) subranges of a block range.
+
+        The offsets are block relative and sector aligned.
+        """
+        block_offset = self.allocation_map['BlockOffsets'][block_idx]
+        if block_offset == vhdparser.BLOCK_ZERO:
+            yield start, end, _ZEROED
+        elif block_offset == vhdparser.BLOCK_NOT_PRESENT:
+            yield start, end, (_FROM_PARENT if self.has_parent else _ZEROED)
+        elif not self._is_partial_block(block_idx):
+            yield start, end, _FROM_IMAGE
+        else:
+            for source_range in self._get_bitmap_sources(block_idx, start,
+                                                         end):
+                yield source_range
+
+    def _is_partial_block(self, block_idx):
+        if not self.has_parent:
+            return False
+        if self.allocation_map['Format'] == vhdparser.VHD_FORMAT:
+            # VHD differencing images always use the sector bitmaps.
+            return True
+        return block_idx in self.allocation_map['PartialBlocks']
+
+    def _get_bitmap_sources(self, block_idx, start, end):
+        bitmap, msb_first = self._get_sector_bitmap(block_idx)
+        start_sector = start // self._sector_size
+        end_sector = end // self._sector_size
+
+        # Fast path for ranges entirely present or missing.
+        if not (start_sector % 8 or end_sector % 8):
+            range_bitmap = bitmap[start_sector // 8:end_sector // 8]
+            for byte, source in ((b'\xff', _FROM_IMAGE),
+                                 (b'\x00', _FROM_PARENT)):
+                if range_bitmap.count(byte) == len(range_bitmap):
+                    yield start, end, source
+                    return
+
+        run_start = start_sector
+        run_source = None
+        sector = start_sector
+        while sector < end_sector:
+            byte = bitmap[sector // 8]
+            if byte in (0, 0xFF) and not sector % 8:
+                present = bool(byte)
+                sector_count = min(8, end_sector - sector)
+            else:
+                bit = 0x80 >> sector % 8 if msb_first else 1 << sector % 8
+                present = bool(byte & bit)
+                sector_count = 1
+            source = _FROM_IMAGE if present else _FROM_PARENT
+
+            if source != run_source:
+                if run_source is not None:
+                    yield (run_start * self._sector_size,
+                           sector * self._sector_size, run_source)
+                run_start = sector
+                run_source = source
+            sector += sector_count
+        if run_source is not None:
+            yield run_start * self._sector_size, end, run_source
+
+    def _get_sector_bitmap(self, block_idx):
+        # Returns the block sector bitmap along with its bit order.
+        if self._cached_bitmap[0] == block_idx:
+            return self._cached_bitmap[1]
+
+        if self.allocation_map['Format'] == vhdparser.VHD_FORMAT:
+            # The sector bitmap precedes the block data, the most
+            # significant bit standing for the first sector.
+            bitmap_size = vhdparser.get_vhd_sector_bitmap_size(
+                self._block_size)
+            bitmap_offset = vhdparser.get_block_file_offset(
+                self.allocation_map, block_idx) - bitmap_size
+            msb_first = True
+        else:
+            # Sector bitmap blocks cover a chunk of payload blocks.
+            bitmap_size = self._block_size // self._sector_size // 8
+            chunk_idx, chunk_block_idx = divmod(block_idx, self._chunk_ratio)
+            chunk_bitmap_offset = (
+                self.allocation_map['SectorBitmapOffsets'][chunk_idx])
+            if chunk_bitmap_offset == vhdparser.BLOCK_NOT_PRESENT:
+                raise vmutils.HyperVException(
+                    _("Missing sector bitmap block %(chunk_idx)s of "
+                      "image %(path)s.") %
+                    {'chunk_idx': chunk_idx,
+                     'path': self.allocation_map['Path']})
+            bitmap_offset = (chunk_bitmap_offset *
+                             self.allocation_map['BlockOffsetUnit'] +
+                             chunk_block_idx * bitmap_size)
+            msb_first = False
+
+        self._file.seek(bitmap_offset)
+        bitmap = bytearray(self._file.read(bitmap_size))
+        if len(bitmap) != bitmap_size:
+            raise IOError(_("Unexpected end of file %s.") %
+                          self.allocation_map['Path'])
+        self._cached_bitmap = (block_idx, (bitmap, msb_first))
+        return bitmap, msb_first
+
+
+def get_chain_allocation_maps(vhd_path):
+    """Returns the allocation maps of the images of a differencing chain.
+
+    The maps are ordered from the given image to the base image.
+    """
+    allocation_maps = []
+    path = vhd_path
+    while path:
+        if len(allocation_maps) == MAX_CHAIN_LENGTH:
+            raise vmutils.HyperVException(
+                _("The differencing chain of %s is too long.") % vhd_path)
+        allocation_map = vhdparser.get_vhd_allocation_map(path)
+        if (allocation_maps and
+                allocation_map['Format'] != allocation_maps[0]['Format']):
+            raise vmutils.HyperVException(
+                _("The images of the differencing chain of %s have "
+                  "different formats.") % vhd_path)
+        allocation_maps.append(allocation_map)
+        path = allocation_map['ParentPath']
+    return allocation_maps
+
+
+def _get_merged_allocated_blocks(allocation_maps, block_size):
+    # The merged image blocks overlapping blocks having data in any of
+    # the images are allocated, the other ones being read as zeros.
+    disk_size = allocation_maps[0]['MaxInternalSize']
+    allocated_blocks = set()
+    for allocation_map in allocation_maps:
+        for start, length in vhdparser.get_allocated_ranges(allocation_map):
+            end = min(start + length, disk_size)
+            allocated_blocks.update(range(start // block_size,
+                                          (end - 1) // block_size + 1))
+    return sorted(allocated_blocks)
+
+
+def _read_virtual_range(layers, offset, length):
+    # Reads a virtual disk range of the first layer, falling back to the
+    # parent layers for the sectors having no data in it.
+    if not layers:
+        return b'\x00' * length
+
+    layer = layers[0]
+    block_size = layer.allocation_map['BlockSize']
+    disk_size = layer.allocation_map['MaxInternalSize']
+
+    pieces = []
+    pos = offset
+    end = offset + length
+    while pos < end:
+        if pos >= disk_size:
+            pieces.append(b'\x00' * (end - pos))
+            break
+
+        block_idx, block_start = divmod(pos, block_size)
+        block_end = min(block_size, end - pos + block_start,
+                        disk_size - pos + block_start)
+        for start, stop, source in layer.get_block_sources(
+                block_idx, block_start, block_end):
+            if source == _FROM_IMAGE:
+                pieces.append(layer.read(block_idx, start, stop - start))
+            elif source == _ZEROED:
+                pieces.append(b'\x00' * (stop - start))
+            else:
+                pieces.append(_read_virtual_range(
+                    layers[1:], block_idx * block_size + start,
+                    stop - start))
+        pos += block_end - block_start
+    # Avoid copying the data when the range is read at once.
+    return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+
+def iter_merged_vhd(vhd_path):
+    """Returns an iterator over the chunks of the merged chain image.
+
+    The merged image is a dynamic image having the format of the chain,
+    no longer depending on the parent images. It is generated in a single
+    pass, so it can be written to streams.
+
+    The chain metadata is read by this call, so unsupported chains are
+    reported before any data is generated.
+
+    :raises vmutils.HyperVException: if the chain images could not be
+                                     read.
+    """
+    allocation_maps = get_chain_allocation_maps(vhd_path)
+    return _iter_merged_image(allocation_maps)
+
+
+def _iter_merged_image(allocation_maps):
+    top_map = allocation_maps[0]
+    base_map = allocation_maps[-1]
+    disk_size = top_map['MaxInternalSize']
+
+    if top_map['Format'] == vhdparser.VHD_FORMAT:
+        block_size = vhdwriter.VHD_DEFAULT_BLOCK_SIZE
+        iter_image = vhdwriter.iter_dynamic_vhd
+        image_args = {}
+    else:
+        # Keep the base image block size, as the merge performed by
+        # Hyper-V does.
+        block_size = base_map['BlockSize']
+        iter_image = vhdwriter.iter_dynamic_vhdx
+        image_args = {
+            'logical_sector_size': top_map['LogicalSectorSize'],
+            'physical_sector_size': top_map['PhysicalSectorSize']}
+
+    layers = []
+    try:
+        for allocation_map in allocation_maps:
+            layers.append(_ImageLayer(allocation_map))
+
+        def read_block(block_idx):
+            return _read_virtual_range(layers, block_idx * block_size,
+                                       block_size)
+
+        allocated_blocks = _get_merged_allocated_blocks(allocation_maps,
+                                                        block_size)
+        for chunk in iter_image(disk_size, allocated_blocks, read_block,
+                                block_size=block_size, **image_args):
+            yield chunk
+    finally:
+        for layer in layers:
+            layer.close()
+
+
+def merge_vhd(vhd_path, dest_path):
+    """Merges a differencing chain into a new, standalone image.
+
+    The images of the chain are not modified.
+
+    :returns: the number of bytes written.
+    :raises vmutils.HyperVException: if the chain images could not be
+                                     read.
+    """
+    try:
+        return vhdcopier.write_image(dest_path, iter_merged_vhd(vhd_path))
+    except (IOError, OSError) as ex:
+        raise vmutils.HyperVException(
+            _("Could not merge virtual disk %(path)s into %(dest_path)s: "
+              "%(ex)s") % {'path': vhd_path, 'dest_path': dest_path,
+                           'ex': ex})
+
@@ -0,0 +1,671 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process VHD and VHDX metadata reader.
+
+Reads the virtual disk properties directly from the image files, without
+involving WMI. The returned properties match the ones reported by the
+Msvm_VirtualHardDiskSettingData WMI class.
+
+Official VHD format specs can be retrieved at:
+http://technet.microsoft.com/en-us/library/bb676673.aspx
+
+Official VHDX format specs can be retrieved at:
+http://www.microsoft.com/en-us/download/details.aspx?id=34750
+"""
+import array
+import collections
+import os
+import struct
+import threading
+import uuid
+
+from oslo_utils import units
+
+from hyperv.i18n import _
+from hyperv.nova import constants
+from hyperv.nova import vmutils
+
+# Msvm_VirtualHardDiskSettingData Format values.
+VHD_FORMAT = 2
+VHDX_FORMAT = 3
+
+VHD_FOOTER = struct.Struct('>8sIIQI4sI4sQQIII16sB')
+VHD_FOOTER_SIZE = 512
+VHD_FOOTER_CHECKSUM_OFFSET = 64
+VHD_FOOTER_COOKIE = b'conectix'
+VHD_DYNAMIC_HEADER = struct.Struct('>8sQQIIII16sII512s')
+VHD_DYNAMIC_HEADER_SIZE = 1024
+VHD_DYNAMIC_HEADER_COOKIE = b'cxsparse'
+VHD_PARENT_LOCATOR = struct.Struct('>4sIIIQ')
+VHD_PARENT_LOCATOR_COUNT = 8
+VHD_PARENT_LOCATOR_OFFSET = 576
+VHD_SECTOR_SIZE = 512
+# Absolute and relative Windows paths, UTF-16 LE encoded.
+VHD_LOCATOR_ABSOLUTE = b'W2ku'
+VHD_LOCATOR_RELATIVE = b'W2ru'
+
+VHDX_FILE_SIGNATURE = b'vhdxfile'
+VHDX_HEADER = struct.Struct('<4sIQ16s16s16sHHIQ')
+VHDX_HEADER_SIGNATURE = b'head'
+VHDX_HEADER_OFFSETS = (64 * units.Ki, 128 * units.Ki)
+VHDX_HEADER_SIZE = 4 * units.Ki
+VHDX_HEADER_CHECKSUM_OFFSET = 4
+VHDX_REGION_TABLE_HEADER = struct.Struct('<4sIII')
+VHDX_REGION_TABLE_ENTRY = struct.Struct('<16sQII')
+VHDX_REGION_TABLE_SIGNATURE = b'regi'
+VHDX_REGION_TABLE_OFFSET = 192 * units.Ki
+VHDX_REGION_TABLE_MAX_ENTRIES = 2047
+VHDX_METADATA_TABLE_HEADER = struct.Struct('<8sHH20s')
+VHDX_METADATA_TABLE_ENTRY = struct.Struct('<16sIIII')
+VHDX_METADATA_TABLE_SIGNATURE = b'metadata'
+VHDX_METADATA_TABLE_MAX_ENTRIES = 2047
+VHDX_FILE_PARAMETERS = struct.Struct('<II')
+VHDX_FILE_PARAMETERS_LEAVE_BLOCKS_ALLOCATED = 0x1
+VHDX_FILE_PARAMETERS_HAS_PARENT = 0x2
+VHDX_PARENT_LOCATOR_HEADER = struct.Struct('<16sHH')
+VHDX_PARENT_LOCATOR_ENTRY = struct.Struct('<IIHH')
+
+VHDX_REGION_BAT = uuid.UUID('2dc27766-f623-4200-9d64-115e9bfd4a08')
+VHDX_REGION_METADATA = uuid.UUID('8b7ca206-4790-4b9a-b8fe-575f050f886e')
+
+VHDX_METADATA_FILE_PARAMETERS = uuid.UUID(
+    'caa16737-fa36-4d43-b3b6-33f0aa44e76b')
+VHDX_METADATA_VIRTUAL_DISK_SIZE = uuid.UUID(
+    '2fa54224-cd1b-4876-b211-5dbed83bf4b8')
+VHDX_METADATA_LOGICAL_SECTOR_SIZE = uuid.UUID(
+    '8141bf1d-a96f-4709-ba47-f233a8faab5f')
+VHDX_METADATA_PHYSICAL_SECTOR_SIZE = uuid.UUID(
+    'cda348c7-445d-4471-9cc9-e9885251c556')
+VHDX_METADATA_PARENT_LOCATOR = uuid.UUID(
+    'a8d35f2d-b30b-454d-abf7-d3d84834ab0c')
+VHDX_METADATA_PAGE83_DATA = uuid.UUID(
+    'beca12ab-b2e6-4523-93ef-c309e000c746')
+VHDX_METADATA_IS_VIRTUAL_DISK = 0x2
+VHDX_METADATA_IS_REQUIRED = 0x4
+VHDX_PARENT_LOCATOR_TYPE = uuid.UUID('b04aefb7-d19e-4a81-b789-25b8e9445913')
+
+# Parent locator keys, in the order in which they are used.
+VHDX_PARENT_LOCATOR_PATH_KEYS = ('relative_path', 'volume_path',
+                                  'absolute_win32_path')
+
+VHDX_BAT_ENTRY_SIZE = 8
+VHDX_BAT_STATE_MASK = 0x7
+VHDX_BAT_FILE_OFFSET_SHIFT = 20
+VHDX_BAT_PAYLOAD_BLOCK_UNDEFINED = 1
+VHDX_BAT_PAYLOAD_BLOCK_ZERO = 2
+VHDX_BAT_PAYLOAD_BLOCK_UNMAPPED = 3
+VHDX_BAT_PAYLOAD_BLOCK_FULLY_PRESENT = 6
+VHDX_BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT = 7
+VHDX_BAT_SECTOR_BITMAP_BLOCK_PRESENT = 6
+
+# Block allocation map values used for blocks having no data in the
+# image file. Blocks that are not present are read from the parent
+# image, if any, while zero blocks are always read as zeros.
+BLOCK_NOT_PRESENT = 0xFFFFFFFF
+BLOCK_ZERO = 0xFFFFFFFE
+# Fixed VHD images have no BAT, the block size being only used
+# when mapping them.
+VHD_FIXED_BLOCK_SIZE = 2 * units.Mi
+
+_VHD_UNUSED_BAT_ENTRY = 0xFFFFFFFF
+_VHD_INFO_CACHE_MAX_ENTRIES = 256
+
+_vhd_info_cache = collections.OrderedDict()
+_vhd_info_cache_lock = threading.Lock()
+
+
+def _build_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _bit in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _build_crc32c_table()
+
+
+def crc32c(data, crc=0):
+    """Computes the CRC-32C (Castagnoli) checksum used by VHDX."""
+    crc ^= 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def get_vhd_info(path):
+    """Returns the properties of the specified VHD or VHDX image.
+
+    The result is cached until the image file modification time or size
+    changes.
+
+    :raises vmutils.HyperVException: if the image could not be read or
+                                     is not a supported image.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as ex:
+        raise vmutils.HyperVException(
+            _("Could not read virtual disk %(path)s: %(ex)s") %
+            {'path': path, 'ex': ex})
+
+    cache_key = (st.st_mtime, st.st_size)
+    with _vhd_info_cache_lock:
+        cached = _vhd_info_cache.get(path)
+        if cached and cached[0] == cache_key:
+            # Move the entry to the end, keeping the most recently used
+            # entries when the cache is full.
+            del _vhd_info_cache[path]
+            _vhd_info_cache[path] = cached
+            return dict(cached[1])
+
+    vhd_info = _read_vhd_info(path, st.st_size)
+
+    with _vhd_info_cache_lock:
+        _vhd_info_cache.pop(path, None)
+        _vhd_info_cache[path] = (cache_key, vhd_info)
+        while len(_vhd_info_cache) > _VHD_INFO_CACHE_MAX_ENTRIES:
+            _vhd_info_cache.popitem(last=False)
+    return dict(vhd_info)
+
+
+def get_vhd_linkage_id(path):
+    """Returns the identifier used by child images to reference the image.
+
+    This is the footer unique id for VHD images and the data write GUID
+    for VHDX images, as raw bytes.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if _read_at(f, 0, 8) == VHDX_FILE_SIGNATURE:
+                # The data write GUID.
+                return _read_vhdx_header(f, path)[4]
+
+            # The footer unique id.
+            file_size = os.fstat(f.fileno()).st_size
+            return _read_vhd_footer(f, path, file_size)[13]
+    except (IOError, OSError, struct.error) as ex:
+        raise vmutils.HyperVException(
+            _("Could not read virtual disk %(path)s: %(ex)s") %
+            {'path': path, 'ex': ex})
+
+
+def get_vhd_allocation_map(path):
+    """Returns the image properties along with its block allocation map.
+
+    The 'BlockOffsets' array holds, for each virtual disk block, either
+    the file offset of the block data, expressed in 'BlockOffsetUnit'
+    bytes, BLOCK_NOT_PRESENT or BLOCK_ZERO. For differencing VHDX
+    images, 'SectorBitmapOffsets' holds the offsets of the sector bitmap
+    blocks, one per chunk of blocks, while 'PartialBlocks' holds the
+    indexes of the blocks having only some of their sectors present in
+    the image, as tracked by the sector bitmaps. 'MetadataRanges' lists
+    the (offset, length) file ranges holding the image metadata.
+
+    The map is not cached, as it changes whenever the image grows.
+    """
+    try:
+        with open(path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            if _read_at(f, 0, 8) == VHDX_FILE_SIGNATURE:
+                vhd_info = _read_vhdx_info(f, path)
+                vhd_info['BlockOffsetUnit'] = units.Mi
+                (block_offsets, sector_bitmap_offsets, partial_blocks,
+                 metadata_ranges) = _read_vhdx_allocation(f, path, vhd_info)
+            else:
+                vhd_info = _read_vhd_footer_info(f, path, file_size)
+                if vhd_info['Type'] == constants.VHD_TYPE_FIXED:
+                    vhd_info['BlockSize'] = VHD_FIXED_BLOCK_SIZE
+                vhd_info['BlockOffsetUnit'] = VHD_SECTOR_SIZE
+                block_offsets, metadata_ranges = _read_vhd_allocation(
+                    f, path, file_size, vhd_info)
+                sector_bitmap_offsets = None
+                partial_blocks = None
+    except (IOError, OSError, struct.error, UnicodeDecodeError) as ex:
+        raise vmutils.HyperVException(
+            _("Could not read virtual disk %(path)s: %(ex)s") %
+            {'path': path, 'ex': ex})
+
+    vhd_info['Path'] = path
+    vhd_info['FileSize'] = file_size
+    vhd_info['BlockOffsets'] = block_offsets
+    vhd_info['SectorBitmapOffsets'] = sector_bitmap_offsets
+    vhd_info['PartialBlocks'] = partial_blocks
+    vhd_info['MetadataRanges'] = sorted(metadata_ranges)
+    return vhd_info
+
+
+def get_block_file_offset(allocation_map, block_idx):
+    """Returns the file offset of a block, or None if it has no data."""
+    block_offset = allocation_map['BlockOffsets'][block_idx]
+    if block_offset in (BLOCK_NOT_PRESENT, BLOCK_ZERO):
+        return None
+    return block_offset * allocation_map['BlockOffsetUnit']
+
+
+def get_allocated_ranges(allocation_map):
+    """Returns the (offset, length) virtual disk ranges having data.
+
+    Adjacent blocks are merged into a single range.
+    """
+    block_size = allocation_map['BlockSize']
+    disk_size = allocation_map['MaxInternalSize']
+
+    ranges = []
+    for idx, block_offset in enumerate(allocation_map['BlockOffsets']):
+        if block_offset in (BLOCK_NOT_PRESENT, BLOCK_ZERO):
+            continue
+
+        offset = idx * block_size
+        length = min(block_size, disk_size - offset)
+        if ranges and sum(ranges[-1]) == offset:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + length)
+        else:
+            ranges.append((offset, length))
+    return ranges
+
+
+def _read_vhd_info(path, file_size):
+    try:
+        with open(path, 'rb') as f:
+            if _read_at(f, 0, 8) == VHDX_FILE_SIGNATURE:
+                vhd_info = _read_vhdx_info(f, path)
+            else:
+                vhd_info = _read_vhd_footer_info(f, path, file_size)
+    except (IOError, OSError, struct.error, UnicodeDecodeError) as ex:
+        raise vmutils.HyperVException(
+            _("Could not read virtual disk %(path)s: %(ex)s") %
+            {'path': path, 'ex': ex})
+
+    vhd_info['Path'] = path
+    vhd_info['FileSize'] = file_size
+    return vhd_info
+
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise IOError(_("Unexpected end of file at offset %s.") % offset)
+    return data
+
+
+def _invalid_disk(path, reason):
+    return vmutils.HyperVException(
+        _("Invalid virtual disk %(path)s: %(reason)s") %
+        {'path': path, 'reason': reason})
+
+
+def _decode_path(data, encoding):
+    return data.decode(encoding).rstrip(u'\x00') or None
+
+
+def _resolve_parent_path(path, candidate_paths):
+    # Returns the first parent path that exists, relative paths being
+    # resolved against the child image directory.
+    resolved_paths = []
+    for parent_path in candidate_paths:
+        if not os.path.isabs(parent_path):
+            parent_path = os.path.normpath(
+                os.path.join(os.path.dirname(path), parent_path))
+        if os.path.exists(parent_path):
+            return parent_path
+        resolved_paths.append(parent_path)
+    return resolved_paths[-1] if resolved_paths else None
+
+
+def vhd_footer_checksum(footer):
+    return ~(sum(bytearray(footer[:VHD_FOOTER_CHECKSUM_OFFSET])) +
+             sum(bytearray(footer[VHD_FOOTER_CHECKSUM_OFFSET + 4:]))
+             ) & 0xFFFFFFFF
+
+
+def _read_vhd_footer(f, path, file_size):
+    if file_size < VHD_FOOTER_SIZE:
+        raise _invalid_disk(path, _("file too small"))
+
+    # Dynamic images keep a copy of the footer at the beginning of the
+    # file, used if the footer at the end of the file is corrupted.
+    for offset in (file_size - VHD_FOOTER_SIZE, 0):
+        footer = _read_at(f, offset, VHD_FOOTER_SIZE)
+        fields = VHD_FOOTER.unpack_from(footer)
+        if (fields[0] == VHD_FOOTER_COOKIE and
+                fields[12] == vhd_footer_checksum(footer)):
+            return fields
+
+    raise _invalid_disk(path, _("missing or corrupted VHD footer"))
+
+
+def _read_vhd_footer_info(f, path, file_size):
+    (_cookie, _features, _version, data_offset, _timestamp, _creator_app,
+     _creator_version, _creator_host_os, _original_size, current_size,
+     _geometry, disk_type, _checksum, _unique_id,
+     _saved_state) = _read_vhd_footer(f, path, file_size)
+
+    vhd_info = {'Format': VHD_FORMAT,
+                'Type': disk_type,
+                'MaxInternalSize': current_size,
+                'BlockSize': 0,
+                'LogicalSectorSize': VHD_SECTOR_SIZE,
+                'PhysicalSectorSize': VHD_SECTOR_SIZE,
+                'ParentPath': None}
+
+    if disk_type == constants.VHD_TYPE_FIXED:
+        return vhd_info
+    if disk_type not in (constants.VHD_TYPE_DYNAMIC,
+                         constants.VHD_TYPE_DIFFERENCING):
+        raise _invalid_disk(path, _("unsupported VHD type %s") % disk_type)
+
+    header = _read_at(f, data_offset, VHD_DYNAMIC_HEADER_SIZE)
+    (cookie, _data_offset, _table_offset, _header_version,
+     _max_table_entries, block_size, _checksum, _parent_unique_id,
+     _parent_timestamp, _reserved,
+     _parent_name) = VHD_DYNAMIC_HEADER.unpack_from(header)
+    if cookie != VHD_DYNAMIC_HEADER_COOKIE:
+        raise _invalid_disk(path, _("missing VHD dynamic disk header"))
+
+    vhd_info['BlockSize'] = block_size
+    if disk_type == constants.VHD_TYPE_DIFFERENCING:
+        vhd_info['ParentPath'] = _read_vhd_parent_path(f, path, header)
+    return vhd_info
+
+
+def _read_vhd_parent_path(f, path, header):
+    locator_paths = {}
+    for idx in range(VHD_PARENT_LOCATOR_COUNT):
+        (platform_code, _data_space, data_length, _reserved,
+         data_offset) = VHD_PARENT_LOCATOR.unpack_from(
+            header, VHD_PARENT_LOCATOR_OFFSET +
+            idx * VHD_PARENT_LOCATOR.size)
+        if (platform_code in (VHD_LOCATOR_ABSOLUTE, VHD_LOCATOR_RELATIVE)
+                and data_length):
+            locator_paths[platform_code] = _decode_path(
+                _read_at(f, data_offset, data_length), 'utf-16-le')
+
+    candidate_paths = [locator_paths[platform_code]
+                       for platform_code in (VHD_LOCATOR_RELATIVE,
+                                             VHD_LOCATOR_ABSOLUTE)
+                       if locator_paths.get(platform_code)]
+    if not candidate_paths:
+        raise _invalid_disk(path, _("missing parent locator"))
+    return _resolve_parent_path(path, candidate_paths)
+
+
+def _read_vhdx_header(f, path):
+    # The valid header having the highest sequence number is used.
+    current_header = None
+    for offset in VHDX_HEADER_OFFSETS:
+        header = bytearray(_read_at(f, offset, VHDX_HEADER_SIZE))
+        fields = VHDX_HEADER.unpack_from(bytes(header))
+        if fields[0] != VHDX_HEADER_SIGNATURE:
+            continue
+
+        checksum = fields[1]
+        header[VHDX_HEADER_CHECKSUM_OFFSET:
+               VHDX_HEADER_CHECKSUM_OFFSET + 4] = b'\x00' * 4
+        if crc32c(header) != checksum:
+            continue
+
+        if not current_header or fields[2] > current_header[2]:
+            current_header = fields
+
+    if not current_header:
+        raise _invalid_disk(path, _("missing or corrupted VHDX headers"))
+    return current_header
+
+
+def _read_vhdx_regions(f, path):
+    table_header = _read_at(f, VHDX_REGION_TABLE_OFFSET,
+                            VHDX_REGION_TABLE_HEADER.size)
+    signature, _checksum, entry_count, _reserved = (
+        VHDX_REGION_TABLE_HEADER.unpack(table_header))
+    if (signature != VHDX_REGION_TABLE_SIGNATURE or
+            entry_count > VHDX_REGION_TABLE_MAX_ENTRIES):
+        raise _invalid_disk(path, _("invalid VHDX region table"))
+
+    entries = _read_at(f, VHDX_REGION_TABLE_OFFSET +
+                       VHDX_REGION_TABLE_HEADER.size,
+                       entry_count * VHDX_REGION_TABLE_ENTRY.size)
+    regions = {}
+    for idx in range(entry_count):
+        guid, file_offset, length, required = (
+            VHDX_REGION_TABLE_ENTRY.unpack_from(
+                entries, idx * VHDX_REGION_TABLE_ENTRY.size))
+        region_id = uuid.UUID(bytes_le=guid)
+        if (required & 1 and
+                region_id not in (VHDX_REGION_BAT, VHDX_REGION_METADATA)):
+            raise _invalid_disk(path, _("unknown required VHDX region %s") %
+                                region_id)
+        regions[region_id] = (file_offset, length)
+
+    if VHDX_REGION_METADATA not in regions:
+        raise _invalid_disk(path, _("missing VHDX metadata region"))
+    return regions
+
+
+def _read_vhdx_metadata_items(f, path, metadata_offset):
+    table_header = _read_at(f, metadata_offset,
+                            VHDX_METADATA_TABLE_HEADER.size)
+    signature, _reserved, entry_count, _reserved2 = (
+        VHDX_METADATA_TABLE_HEADER.unpack(table_header))
+    if (signature != VHDX_METADATA_TABLE_SIGNATURE or
+            entry_count > VHDX_METADATA_TABLE_MAX_ENTRIES):
+        raise _invalid_disk(path, _("invalid VHDX metadata table"))
+
+    entries = _read_at(f, metadata_offset + VHDX_METADATA_TABLE_HEADER.size,
+                       entry_count * VHDX_METADATA_TABLE_ENTRY.size)
+    items = {}
+    for idx in range(entry_count):
+        guid, item_offset, length, _flags, _reserved = (
+            VHDX_METADATA_TABLE_ENTRY.unpack_from(
+                entries, idx * VHDX_METADATA_TABLE_ENTRY.size))
+        items[uuid.UUID(bytes_le=guid)] = _read_at(
+            f, metadata_offset + item_offset, length)
+    return items
+
+
+def _read_vhdx_info(f, path):
+    header = _read_vhdx_header(f, path)
+    log_guid = header[5]
+    if log_guid != b'\x00' * 16:
+        # The metadata may be stale until the log is replayed.
+        raise _invalid_disk(path, _("the VHDX log must be replayed"))
+
+    regions = _read_vhdx_regions(f, path)
+    items = _read_vhdx_metadata_items(
+        f, path, regions[VHDX_REGION_METADATA][0])
+
+    required_items = (VHDX_METADATA_FILE_PARAMETERS,
+                      VHDX_METADATA_VIRTUAL_DISK_SIZE,
+                      VHDX_METADATA_LOGICAL_SECTOR_SIZE,
+                      VHDX_METADATA_PHYSICAL_SECTOR_SIZE)
+    if not all(item in items for item in required_items):
+        raise _invalid_disk(path, _("missing VHDX metadata items"))
+
+    block_size, flags = VHDX_FILE_PARAMETERS.unpack_from(
+        items[VHDX_METADATA_FILE_PARAMETERS])
+    if flags & VHDX_FILE_PARAMETERS_HAS_PARENT:
+        disk_type = constants.VHD_TYPE_DIFFERENCING
+    elif flags & VHDX_FILE_PARAMETERS_LEAVE_BLOCKS_ALLOCATED:
+        disk_type = constants.VHD_TYPE_FIXED
+    else:
+        disk_type = constants.VHD_TYPE_DYNAMIC
+
+    vhd_info = {
+        'Format': VHDX_FORMAT,
+        'Type': disk_type,
+        'MaxInternalSize': struct.unpack_from(
+            '<Q', items[VHDX_METADATA_VIRTUAL_DISK_SIZE])[0],
+        'BlockSize': block_size,
+        'LogicalSectorSize': struct.unpack_from(
+            '<I', items[VHDX_METADATA_LOGICAL_SECTOR_SIZE])[0],
+        'PhysicalSectorSize': struct.unpack_from(
+            '<I', items[VHDX_METADATA_PHYSICAL_SECTOR_SIZE])[0],
+        'ParentPath': None}
+
+    if disk_type == constants.VHD_TYPE_DIFFERENCING:
+        locator = items.get(VHDX_METADATA_PARENT_LOCATOR)
+        if not locator:
+            raise _invalid_disk(path, _("missing parent locator"))
+        vhd_info['ParentPath'] = _read_vhdx_parent_path(path, locator)
+    return vhd_info
+
+
+def _read_vhdx_parent_path(path, locator):
+    _locator_type, _reserved, key_value_count = (
+        VHDX_PARENT_LOCATOR_HEADER.unpack_from(locator))
+
+    locator_entries = {}
+    for idx in range(key_value_count):
+        key_offset, value_offset, key_length, value_length = (
+            VHDX_PARENT_LOCATOR_ENTRY.unpack_from(
+                locator, VHDX_PARENT_LOCATOR_HEADER.size +
+                idx * VHDX_PARENT_LOCATOR_ENTRY.size))
+        key = locator[key_offset:key_offset + key_length].decode(
+            'utf-16-le')
+        locator_entries[key] = locator[
+            value_offset:value_offset + value_length].decode('utf-16-le')
+
+    candidate_paths = [locator_entries[key]
+                       for key in VHDX_PARENT_LOCATOR_PATH_KEYS
+                       if locator_entries.get(key)]
+    if not candidate_paths:
+        raise _invalid_disk(path, _("missing parent locator"))
+    return _resolve_parent_path(path, candidate_paths)
+
+
+def _div_round_up(value, divisor):
+    return (value + divisor - 1) // divisor
+
+
+def get_vhd_sector_bitmap_size(block_size):
+    """Returns the size of the sector bitmap preceding each VHD block."""
+    bitmap_size = _div_round_up(block_size // VHD_SECTOR_SIZE, 8)
+    return _div_round_up(bitmap_size, VHD_SECTOR_SIZE) * VHD_SECTOR_SIZE
+
+
+def _read_vhd_allocation(f, path, file_size, vhd_info):
+    block_size = vhd_info['BlockSize']
+    block_count = _div_round_up(vhd_info['MaxInternalSize'], block_size)
+    if vhd_info['Type'] == constants.VHD_TYPE_FIXED:
+        block_sectors = block_size // VHD_SECTOR_SIZE
+        block_offsets = array.array('I', [idx * block_sectors
+                                          for idx in range(block_count)])
+        return block_offsets, [(file_size - VHD_FOOTER_SIZE,
+                                VHD_FOOTER_SIZE)]
+
+    data_offset = _read_vhd_footer(f, path, file_size)[3]
+    header = _read_at(f, data_offset, VHD_DYNAMIC_HEADER_SIZE)
+    (_cookie, _data_offset, table_offset, _header_version,
+     max_table_entries, _block_size, _checksum, _parent_unique_id,
+     _parent_timestamp, _reserved,
+     _parent_name) = VHD_DYNAMIC_HEADER.unpack_from(header)
+    if max_table_entries < block_count:
+        raise _invalid_disk(path, _("VHD BAT too small"))
+
+    # BAT entries are sector offsets, the block data following the
+    # sector bitmap.
+    bitmap_sectors = get_vhd_sector_bitmap_size(block_size) // VHD_SECTOR_SIZE
+    entries = struct.unpack('>%dI' % block_count,
+                            _read_at(f, table_offset, block_count * 4))
+    block_offsets = array.array('I', [
+        BLOCK_NOT_PRESENT if entry == _VHD_UNUSED_BAT_ENTRY
+        else entry + bitmap_sectors
+        for entry in entries])
+
+    metadata_ranges = [
+        (0, VHD_FOOTER_SIZE),
+        (data_offset, VHD_DYNAMIC_HEADER_SIZE),
+        (table_offset, _div_round_up(max_table_entries * 4,
+                                     VHD_SECTOR_SIZE) * VHD_SECTOR_SIZE),
+        (file_size - VHD_FOOTER_SIZE, VHD_FOOTER_SIZE)]
+    for idx in range(VHD_PARENT_LOCATOR_COUNT):
+        (platform_code, _data_space, data_length, _reserved,
+         locator_offset) = VHD_PARENT_LOCATOR.unpack_from(
+            header, VHD_PARENT_LOCATOR_OFFSET +
+            idx * VHD_PARENT_LOCATOR.size)
+        if platform_code.strip(b'\x00') and data_length:
+            metadata_ranges.append(
+                (locator_offset, _div_round_up(data_length, VHD_SECTOR_SIZE) *
+                 VHD_SECTOR_SIZE))
+    return block_offsets, metadata_ranges
+
+
+def _get_vhdx_chunk_ratio(vhd_info):
+    return ((1 << 23) * vhd_info['LogicalSectorSize'] //
+            vhd_info['BlockSize'])
+
+
+def _read_vhdx_allocation(f, path, vhd_info):
+    regions = _read_vhdx_regions(f, path)
+    if VHDX_REGION_BAT not in regions:
+        raise _invalid_disk(path, _("missing VHDX BAT region"))
+    bat_offset, bat_length = regions[VHDX_REGION_BAT]
+
+    # Payload block entries are interleaved with sector bitmap block
+    # entries, one of which follows each chunk of payload blocks.
+    chunk_ratio = _get_vhdx_chunk_ratio(vhd_info)
+    block_count = _div_round_up(vhd_info['MaxInternalSize'],
+                                vhd_info['BlockSize'])
+    has_parent = vhd_info['Type'] == constants.VHD_TYPE_DIFFERENCING
+    if has_parent:
+        chunk_count = _div_round_up(block_count, chunk_ratio)
+        entry_count = chunk_count * (chunk_ratio + 1)
+    else:
+        entry_count = block_count + (block_count - 1) // chunk_ratio
+    if entry_count * VHDX_BAT_ENTRY_SIZE > bat_length:
+        raise _invalid_disk(path, _("VHDX BAT too small"))
+    entries = struct.unpack(
+        '<%dQ' % entry_count,
+        _read_at(f, bat_offset, entry_count * VHDX_BAT_ENTRY_SIZE))
+
+    block_offsets = array.array('I', [BLOCK_NOT_PRESENT]) * block_count
+    partial_blocks = set() if has_parent else None
+    for idx in range(block_count):
+        entry = entries[idx + idx // chunk_ratio]
+        state = entry & VHDX_BAT_STATE_MASK
+        if state in (VHDX_BAT_PAYLOAD_BLOCK_FULLY_PRESENT,
+                     VHDX_BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT):
+            block_offsets[idx] = entry >> VHDX_BAT_FILE_OFFSET_SHIFT
+            if (has_parent and
+                    state == VHDX_BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT):
+                partial_blocks.add(idx)
+        elif state in (VHDX_BAT_PAYLOAD_BLOCK_ZERO,
+                       VHDX_BAT_PAYLOAD_BLOCK_UNMAPPED,
+                       VHDX_BAT_PAYLOAD_BLOCK_UNDEFINED):
+            block_offsets[idx] = BLOCK_ZERO
+
+    # The sector bitmaps tell which sectors of the partially present
+    # blocks of differencing images have data.
+    sector_bitmap_offsets = None
+    if has_parent:
+        sector_bitmap_offsets = array.array('I', [BLOCK_NOT_PRESENT])
+        sector_bitmap_offsets *= chunk_count
+        for idx in range(chunk_count):
+            entry = entries[idx * (chunk_ratio + 1) + chunk_ratio]
+            if (entry & VHDX_BAT_STATE_MASK ==
+                    VHDX_BAT_SECTOR_BITMAP_BLOCK_PRESENT):
+                sector_bitmap_offsets[idx] = (
+                    entry >> VHDX_BAT_FILE_OFFSET_SHIFT)
+
+    # The headers and region tables are placed in the first MB, while
+    # the log is skipped, being empty.
+    metadata_ranges = [(0, units.Mi)] + list(regions.values())
+    return (block_offsets, sector_bitmap_offsets, partial_blocks,
+            metadata_ranges)
@@ -25,16 +25,43 @@ http://www.microsoft.com/en-us/download/details.aspx?id=34750
 """
 import struct
 import sys
+import time
 
 if sys.platform == 'win32':
     import wmi
 
 from xml.etree import ElementTree
 
-from hyperv.i18n import _
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from hyperv.i18n import _, _LW
 from hyperv.nova import constants
+from hyperv.nova import ioutils
+from hyperv.nova import vhdmerger
+from hyperv.nova import vhdparser
+from hyperv.nova import vhdwriter
 from hyperv.nova import vmutils
 
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.BoolOpt('native_vhd_creation',
+                default=True,
+                help='Create the empty dynamic and differencing virtual '
+                     'disks in process, instead of using WMI. WMI is '
+                     'still used if the in process creation fails.'),
+    cfg.BoolOpt('native_vhd_merge',
+                default=True,
+                help='Merge differencing image chains in process, in a '
+                     'single pass, instead of copying the base image and '
+                     'merging the chain into it using WMI. WMI is still '
+                     'used if the in process merge fails.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
 
 VHD_HEADER_SIZE_FIX = 512
 VHD_BAT_ENTRY_SIZE = 4
@@ -72,11 +99,37 @@ class VHDUtils(object):
             raise vmutils.HyperVException(_("Unsupported disk format: %s") %
                                           format)
 
+        if self._create_vhd_natively(vhdwriter.create_dynamic_vhd, path,
+                                     max_internal_size, format):
+            return
+
         (job_path, ret_val) = self._image_man_svc.CreateDynamicVirtualHardDisk(
             Path=path, MaxInternalSize=max_internal_size)
         self._vmutils.check_ret_val(ret_val, job_path)
 
+    def _create_vhd_natively(self, create_vhd, path, *args):
+        """Creates the virtual disk in process, returning True on success."""
+        if not CONF.hyperv.native_vhd_creation:
+            return False
+
+        start_time = time.time()
+        try:
+            create_vhd(path, *args)
+        except Exception as ex:
+            LOG.warning(_LW("Failed to create virtual disk %(path)s in "
+                            "process, using WMI instead. Error: %(ex)s"),
+                        {'path': path, 'ex': ex})
+            return False
+
+        LOG.debug("Created virtual disk %(path)s in %(elapsed).3f seconds.",
+                  {'path': path, 'elapsed': time.time() - start_time})
+        return True
+
     def create_differencing_vhd(self, path, parent_path):
+        if self._create_vhd_natively(vhdwriter.create_differencing_vhd,
+                                     path, parent_path):
+            return
+
         (job_path,
          ret_val) = self._image_man_svc.CreateDifferencingVirtualHardDisk(
             Path=path, ParentPath=parent_path)
@@ -96,6 +149,44 @@ class VHDUtils(object):
             DestinationPath=dest_vhd_path)
         self._vmutils.check_ret_val(ret_val, job_path)
 
+    def merge_vhd_chain(self, vhd_path, dest_path):
+        """Writes the image resulting from merging a differencing chain.
+
+        The merged image is written in a single pass, without altering
+        the chain images. Returns False if the merge could not be
+        performed in process, in which case merge_vhd should be used.
+        """
+        if not CONF.hyperv.native_vhd_merge:
+            return False
+
+        start_time = time.time()
+        try:
+            # The merge is performed in a native thread, not blocking the
+            # other greenthreads.
+            bytes_written = ioutils.avoid_blocking_call(
+                vhdmerger.merge_vhd, vhd_path, dest_path)
+        except vmutils.HyperVException as ex:
+            LOG.warning(_LW("Failed to merge virtual disk %(path)s in "
+                            "process. Error: %(ex)s"),
+                        {'path': vhd_path, 'ex': ex})
+            return False
+
+        LOG.debug("Merged virtual disk %(path)s into %(dest_path)s, "
+                  "writing %(bytes)s bytes in %(elapsed).3f seconds.",
+                  {'path': vhd_path, 'dest_path': dest_path,
+                   'bytes': bytes_written,
+                   'elapsed': time.time() - start_time})
+        return True
+
+    def get_merged_vhd_chunks(self, vhd_path):
+        """Returns an iterator over the chunks of the merged chain image.
+
+        The differencing chain is flattened in a single pass while the
+        chunks are consumed, so the merged image may be streamed without
+        being written to disk.
+        """
+        return vhdmerger.iter_merged_vhd(vhd_path)
+
     def _get_resize_method(self):
         return self._image_man_svc.ExpandVirtualHardDisk
 
@@ -167,6 +258,20 @@ class VHDUtils(object):
         return self.get_vhd_info(vhd_path).get("ParentPath")
 
     def get_vhd_info(self, vhd_path):
+        """Returns the virtual disk properties.
+
+        The image metadata is read directly from the image file, WMI
+        being used only if this is not possible, for example if the
+        image is exclusively opened or if it has a pending VHDX log.
+        """
+        try:
+            return vhdparser.get_vhd_info(vhd_path)
+        except vmutils.HyperVException as ex:
+            LOG.debug("Could not read the virtual disk metadata in "
+                      "process, using WMI instead. %s", ex)
+            return self._get_vhd_info_wmi(vhd_path)
+
+    def _get_vhd_info_wmi(self, vhd_path):
         (vhd_info,
          job_path,
          ret_val) = self._image_man_svc.GetVirtualHardDiskInfo(vhd_path)
@@ -189,6 +294,28 @@ class VHDUtils(object):
 
         return vhd_info_dict
 
+    def get_vhd_allocation_info(self, vhd_path):
+        """Returns the space actually used by the virtual disk.
+
+        The image block allocation table is read directly from the image
+        file. 'AllocatedBytes' accounts only the virtual disk blocks
+        having data in this image, blocks of differencing images which
+        are read from the parent image not being included.
+        """
+        allocation_map = vhdparser.get_vhd_allocation_map(vhd_path)
+        allocated_ranges = vhdparser.get_allocated_ranges(allocation_map)
+
+        return {'Path': vhd_path,
+                'ParentPath': allocation_map['ParentPath'],
+                'Format': allocation_map['Format'],
+                'Type': allocation_map['Type'],
+                'MaxInternalSize': allocation_map['MaxInternalSize'],
+                'FileSize': allocation_map['FileSize'],
+                'BlockSize': allocation_map['BlockSize'],
+                'AllocatedRanges': allocated_ranges,
+                'AllocatedBytes': sum(length
+                                      for _offset, length in allocated_ranges)}
+
     def get_vhd_format(self, path):
         with open(path, 'rb') as f:
             # Read header
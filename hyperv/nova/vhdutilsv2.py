@@ -31,6 +31,7 @@ from oslo_utils import units
 from hyperv.i18n import _
 from hyperv.nova import constants
 from hyperv.nova import vhdutils
+from hyperv.nova import vhdwriter
 from hyperv.nova import vmutils
 from hyperv.nova import vmutilsv2
 
@@ -66,6 +67,10 @@ class VHDUtilsV2(vhdutils.VHDUtils):
             raise vmutils.HyperVException(_("Unsupported disk format: %s") %
                                           format)
 
+        if self._create_vhd_natively(vhdwriter.create_dynamic_vhd, path,
+                                     max_internal_size, format):
+            return
+
         self._create_vhd(self._VHD_TYPE_DYNAMIC, vhd_format, path,
                          max_internal_size=max_internal_size)
 
@@ -74,6 +79,10 @@ class VHDUtilsV2(vhdutils.VHDUtils):
         # images, avoid it as the underlying Win32 is currently not
         # resizing the disk properly. This can be reconsidered once the
         # Win32 issue is fixed.
+        if self._create_vhd_natively(vhdwriter.create_differencing_vhd,
+                                     path, parent_path):
+            return
+
         parent_vhd_info = self.get_vhd_info(parent_path)
         self._create_vhd(self._VHD_TYPE_DIFFERENCING,
                          parent_vhd_info["Format"],
@@ -219,7 +228,7 @@ class VHDUtilsV2(vhdutils.VHDUtils):
 
         return vhd_info_xml.encode('utf8', 'xmlcharrefreplace')
 
-    def get_vhd_info(self, vhd_path):
+    def _get_vhd_info_wmi(self, vhd_path):
         vhd_info_xml = self._get_vhd_info_xml(self._image_man_svc, vhd_path)
 
         vhd_info_dict = {}
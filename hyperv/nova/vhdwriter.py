@@ -0,0 +1,495 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-process creation of empty dynamic and differencing VHD / VHDX images.
+
+Creating such images only requires writing the image headers, an empty
+block allocation table and, for differencing images, the parent
+locators, so WMI is not needed.
+"""
+import calendar
+import datetime
+import ntpath
+import os
+import struct
+import time
+import uuid
+
+from oslo_utils import excutils
+from oslo_utils import units
+
+from hyperv.i18n import _
+from hyperv.nova import constants
+from hyperv.nova import vhdparser
+from hyperv.nova import vmutils
+
+VHD_DEFAULT_BLOCK_SIZE = 2 * units.Mi
+VHD_MAX_SIZE = 2040 * units.Gi
+VHDX_DEFAULT_BLOCK_SIZE = 32 * units.Mi
+VHDX_DEFAULT_DIFFERENCING_BLOCK_SIZE = 2 * units.Mi
+VHDX_DEFAULT_LOGICAL_SECTOR_SIZE = 512
+VHDX_DEFAULT_PHYSICAL_SECTOR_SIZE = 4 * units.Ki
+VHDX_MAX_SIZE = 64 * units.Ti
+
+_VHD_EPOCH = calendar.timegm(datetime.datetime(2000, 1, 1).timetuple())
+_VHD_FEATURES = 2
+_VHD_VERSION = 0x10000
+_VHD_CREATOR_APP = b'win '
+_VHD_CREATOR_VERSION = 0x60003
+_VHD_CREATOR_HOST_OS = b'Wi2k'
+_VHD_BAT_ENTRY_SIZE = 4
+_VHD_UNUSED_BAT_ENTRY = b'\xff' * _VHD_BAT_ENTRY_SIZE
+_VHD_NO_DATA_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+_VHDX_CREATOR = u'nova-hyperv'
+_VHDX_FILE_IDENTIFIER_SIZE = 64 * units.Ki
+_VHDX_LOG_OFFSET = units.Mi
+_VHDX_LOG_SIZE = units.Mi
+_VHDX_METADATA_REGION_OFFSET = 2 * units.Mi
+_VHDX_METADATA_REGION_SIZE = units.Mi
+_VHDX_METADATA_ITEMS_OFFSET = 64 * units.Ki
+_VHDX_BAT_OFFSET = 3 * units.Mi
+_VHDX_BAT_ENTRY_SIZE = 8
+_VHDX_REGION_TABLE_SIZE = 64 * units.Ki
+_VHDX_REGION_TABLE_OFFSETS = (192 * units.Ki, 256 * units.Ki)
+_VHDX_VERSION = 1
+_VHDX_REGION_REQUIRED = 1
+
+
+def create_dynamic_vhd(path, max_internal_size, vhd_format):
+    """Creates an empty dynamic VHD or VHDX image."""
+    if vhd_format == constants.DISK_FORMAT_VHD:
+        _create_image(path, _write_vhd, max_internal_size,
+                      constants.VHD_TYPE_DYNAMIC)
+    elif vhd_format == constants.DISK_FORMAT_VHDX:
+        _create_image(path, _write_vhdx, max_internal_size,
+                      VHDX_DEFAULT_BLOCK_SIZE,
+                      VHDX_DEFAULT_LOGICAL_SECTOR_SIZE,
+                      VHDX_DEFAULT_PHYSICAL_SECTOR_SIZE)
+    else:
+        raise vmutils.HyperVException(_("Unsupported disk format: %s") %
+                                      vhd_format)
+
+
+def create_differencing_vhd(path, parent_path):
+    """Creates a differencing image having the same format as its parent.
+
+    The parent locators reference the parent image both by its absolute
+    path and by its path relative to the child image.
+    """
+    parent_info = vhdparser.get_vhd_info(parent_path)
+    parent_linkage_id = vhdparser.get_vhd_linkage_id(parent_path)
+    parent_paths = {'absolute': parent_path,
+                    'relative': _get_relative_path(path, parent_path)}
+
+    if parent_info['Format'] == vhdparser.VHD_FORMAT:
+        parent_timestamp = int(os.path.getmtime(parent_path)) - _VHD_EPOCH
+        _create_image(path, _write_vhd, parent_info['MaxInternalSize'],
+                      constants.VHD_TYPE_DIFFERENCING,
+                      parent=(parent_linkage_id, parent_timestamp,
+                              parent_paths))
+    else:
+        _create_image(path, _write_vhdx, parent_info['MaxInternalSize'],
+                      VHDX_DEFAULT_DIFFERENCING_BLOCK_SIZE,
+                      parent_info['LogicalSectorSize'],
+                      parent_info['PhysicalSectorSize'],
+                      parent=(parent_linkage_id, parent_paths))
+
+
+def _create_image(path, write_image, *args, **kwargs):
+    # The image file must not already exist.
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY |
+                 getattr(os, 'O_BINARY', 0))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_image(f, *args, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception:
+        with excutils.save_and_reraise_exception():
+            os.remove(path)
+
+
+def _get_relative_path(path, parent_path):
+    try:
+        relative_path = ntpath.relpath(parent_path, ntpath.dirname(path))
+    except ValueError:
+        # The images are placed on different drives.
+        return
+    return ntpath.join('.', relative_path)
+
+
+def _round_up(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def _get_vhd_geometry(size):
+    # CHS geometry, as described by the VHD specs.
+    total_sectors = min(size // vhdparser.VHD_SECTOR_SIZE, 65535 * 16 * 255)
+    if total_sectors >= 65535 * 16 * 63:
+        sectors_per_track = 255
+        heads = 16
+        cylinder_times_heads = total_sectors // sectors_per_track
+    else:
+        sectors_per_track = 17
+        cylinder_times_heads = total_sectors // sectors_per_track
+        heads = max((cylinder_times_heads + 1023) // 1024, 4)
+        if cylinder_times_heads >= heads * 1024 or heads > 16:
+            sectors_per_track = 31
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+        if cylinder_times_heads >= heads * 1024:
+            sectors_per_track = 63
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+
+    cylinders = cylinder_times_heads // heads
+    return (cylinders << 16) | (heads << 8) | sectors_per_track
+
+
+def _build_vhd_footer(size, disk_type, data_offset, timestamp):
+    footer = bytearray(vhdparser.VHD_FOOTER_SIZE)
+    vhdparser.VHD_FOOTER.pack_into(
+        footer, 0, vhdparser.VHD_FOOTER_COOKIE, _VHD_FEATURES, _VHD_VERSION,
+        data_offset, timestamp, _VHD_CREATOR_APP, _VHD_CREATOR_VERSION,
+        _VHD_CREATOR_HOST_OS, size, size, _get_vhd_geometry(size),
+        disk_type, 0, uuid.uuid4().bytes, 0)
+    struct.pack_into('>I', footer, vhdparser.VHD_FOOTER_CHECKSUM_OFFSET,
+                     vhdparser.vhd_footer_checksum(footer))
+    return footer
+
+
+def append_fixed_vhd_footer(path):
+    """Converts a raw disk image into a fixed VHD image, in place.
+
+    Fixed VHD images consist of the raw disk data followed by the image
+    footer, so the disk data is not copied.
+    """
+    with open(path, 'r+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if not size or size % vhdparser.VHD_SECTOR_SIZE:
+            raise vmutils.HyperVException(
+                _("The size of the raw disk image %(path)s is not a "
+                  "multiple of the sector size: %(size)s") %
+                {'path': path, 'size': size})
+
+        timestamp = int(time.time()) - _VHD_EPOCH
+        f.write(_build_vhd_footer(size, constants.VHD_TYPE_FIXED,
+                                  _VHD_NO_DATA_OFFSET, timestamp))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_vhd(f, size, disk_type, block_size=VHD_DEFAULT_BLOCK_SIZE,
+               parent=None):
+    """Writes an empty dynamic or differencing VHD image."""
+    image_head, footer = _build_vhd_metadata(size, disk_type, block_size,
+                                             parent=parent)
+    f.write(image_head)
+    f.write(footer)
+
+
+def iter_dynamic_vhd(size, allocated_blocks, read_block,
+                     block_size=VHD_DEFAULT_BLOCK_SIZE):
+    """Yields the chunks of a dynamic VHD image holding the given blocks.
+
+    The image is generated sequentially, so it can be written to streams.
+
+    :param allocated_blocks: the sorted indexes of the blocks having data.
+    :param read_block: callable returning the data of a block, which must
+                       be block_size long. The blocks are read in order.
+    """
+    image_head, footer = _build_vhd_metadata(
+        size, constants.VHD_TYPE_DYNAMIC, block_size,
+        allocated_blocks=allocated_blocks)
+    yield bytes(image_head)
+
+    # All the block sectors have data.
+    sector_bitmap = b'\xff' * vhdparser.get_vhd_sector_bitmap_size(block_size)
+    for block_idx in allocated_blocks:
+        yield sector_bitmap
+        yield _check_block(read_block(block_idx), block_size)
+    yield bytes(footer)
+
+
+def _check_block(data, block_size):
+    if len(data) != block_size:
+        raise vmutils.HyperVException(
+            _("Invalid block length: %(length)s, expected: "
+              "%(block_size)s") % {'length': len(data),
+                                   'block_size': block_size})
+    return data
+
+
+def _build_vhd_metadata(size, disk_type, block_size, parent=None,
+                        allocated_blocks=()):
+    """Returns the VHD image data preceding the blocks and the footer.
+
+    Layout: footer copy, dynamic disk header, BAT, parent locators, the
+    allocated blocks, in order, and the footer.
+    """
+    if size > VHD_MAX_SIZE or size % vhdparser.VHD_SECTOR_SIZE:
+        raise vmutils.HyperVException(_("Invalid VHD size: %s") % size)
+
+    header_offset = vhdparser.VHD_FOOTER_SIZE
+    bat_offset = header_offset + vhdparser.VHD_DYNAMIC_HEADER_SIZE
+    max_table_entries = _round_up(size, block_size) // block_size
+    bat_size = _round_up(max_table_entries * _VHD_BAT_ENTRY_SIZE,
+                         vhdparser.VHD_SECTOR_SIZE)
+    data_offset = bat_offset + bat_size
+
+    timestamp = int(time.time()) - _VHD_EPOCH
+    footer = _build_vhd_footer(size, disk_type, header_offset, timestamp)
+
+    header = bytearray(vhdparser.VHD_DYNAMIC_HEADER_SIZE)
+    locators_data = b''
+    if parent:
+        parent_unique_id, parent_timestamp, parent_paths = parent
+        parent_name = ntpath.basename(parent_paths['absolute'])
+        locators = [(vhdparser.VHD_LOCATOR_RELATIVE,
+                     parent_paths['relative']),
+                    (vhdparser.VHD_LOCATOR_ABSOLUTE,
+                     parent_paths['absolute'])]
+        locator_idx = 0
+        for platform_code, parent_path in locators:
+            if not parent_path:
+                continue
+            locator = parent_path.encode('utf-16-le')
+            locator_space = _round_up(len(locator),
+                                      vhdparser.VHD_SECTOR_SIZE)
+            vhdparser.VHD_PARENT_LOCATOR.pack_into(
+                header, vhdparser.VHD_PARENT_LOCATOR_OFFSET +
+                locator_idx * vhdparser.VHD_PARENT_LOCATOR.size,
+                platform_code, locator_space, len(locator), 0,
+                data_offset + len(locators_data))
+            locators_data += locator.ljust(locator_space, b'\x00')
+            locator_idx += 1
+    else:
+        parent_unique_id = b'\x00' * 16
+        parent_timestamp = 0
+        parent_name = u''
+
+    vhdparser.VHD_DYNAMIC_HEADER.pack_into(
+        header, 0, vhdparser.VHD_DYNAMIC_HEADER_COOKIE, _VHD_NO_DATA_OFFSET,
+        bat_offset, _VHD_VERSION, max_table_entries, block_size, 0,
+        parent_unique_id, parent_timestamp, 0,
+        parent_name.encode('utf-16-be'))
+    struct.pack_into('>I', header, 36, (~sum(header)) & 0xFFFFFFFF)
+
+    # The BAT entries point to the block sector bitmaps, the blocks being
+    # placed right after the parent locators.
+    bat = bytearray(_VHD_UNUSED_BAT_ENTRY * (bat_size // _VHD_BAT_ENTRY_SIZE))
+    block_file_size = (vhdparser.get_vhd_sector_bitmap_size(block_size) +
+                       block_size)
+    blocks_offset = data_offset + len(locators_data)
+    for idx, block_idx in enumerate(allocated_blocks):
+        struct.pack_into('>I', bat, block_idx * _VHD_BAT_ENTRY_SIZE,
+                         (blocks_offset + idx * block_file_size) //
+                         vhdparser.VHD_SECTOR_SIZE)
+
+    return footer + header + bat + locators_data, footer
+
+
+def _get_vhdx_bat_entry_count(size, block_size, logical_sector_size,
+                              has_parent):
+    chunk_ratio = (1 << 23) * logical_sector_size // block_size
+    data_blocks = _round_up(size, block_size) // block_size
+    if has_parent:
+        sector_bitmap_blocks = _round_up(data_blocks,
+                                         chunk_ratio) // chunk_ratio
+        return sector_bitmap_blocks * (chunk_ratio + 1)
+    return data_blocks + (data_blocks - 1) // chunk_ratio
+
+
+def _build_vhdx_parent_locator(parent_linkage_id, parent_paths):
+    entries = [('parent_linkage',
+                u'{%s}' % uuid.UUID(bytes_le=parent_linkage_id)),
+               ('relative_path', parent_paths['relative']),
+               ('absolute_win32_path', parent_paths['absolute'])]
+    entries = [(key.encode('utf-16-le'), value.encode('utf-16-le'))
+               for key, value in entries if value]
+
+    data_offset = (vhdparser.VHDX_PARENT_LOCATOR_HEADER.size +
+                   len(entries) * vhdparser.VHDX_PARENT_LOCATOR_ENTRY.size)
+    locator = vhdparser.VHDX_PARENT_LOCATOR_HEADER.pack(
+        vhdparser.VHDX_PARENT_LOCATOR_TYPE.bytes_le, 0, len(entries))
+    data = b''
+    for key, value in entries:
+        locator += vhdparser.VHDX_PARENT_LOCATOR_ENTRY.pack(
+            data_offset + len(data), data_offset + len(data) + len(key),
+            len(key), len(value))
+        data += key + value
+    return locator + data
+
+
+def _build_vhdx_metadata_region(size, block_size, logical_sector_size,
+                                physical_sector_size, parent):
+    file_parameters_flags = 0
+    if parent:
+        file_parameters_flags |= vhdparser.VHDX_FILE_PARAMETERS_HAS_PARENT
+
+    virtual_disk_flags = (vhdparser.VHDX_METADATA_IS_VIRTUAL_DISK |
+                          vhdparser.VHDX_METADATA_IS_REQUIRED)
+    items = [
+        (vhdparser.VHDX_METADATA_FILE_PARAMETERS,
+         vhdparser.VHDX_FILE_PARAMETERS.pack(block_size,
+                                             file_parameters_flags),
+         vhdparser.VHDX_METADATA_IS_REQUIRED),
+        (vhdparser.VHDX_METADATA_VIRTUAL_DISK_SIZE,
+         struct.pack('<Q', size), virtual_disk_flags),
+        (vhdparser.VHDX_METADATA_PAGE83_DATA,
+         uuid.uuid4().bytes_le, virtual_disk_flags),
+        (vhdparser.VHDX_METADATA_LOGICAL_SECTOR_SIZE,
+         struct.pack('<I', logical_sector_size), virtual_disk_flags),
+        (vhdparser.VHDX_METADATA_PHYSICAL_SECTOR_SIZE,
+         struct.pack('<I', physical_sector_size), virtual_disk_flags)]
+    if parent:
+        items.append((vhdparser.VHDX_METADATA_PARENT_LOCATOR,
+                      _build_vhdx_parent_locator(*parent),
+                      vhdparser.VHDX_METADATA_IS_REQUIRED))
+
+    table = vhdparser.VHDX_METADATA_TABLE_HEADER.pack(
+        vhdparser.VHDX_METADATA_TABLE_SIGNATURE, 0, len(items), b'')
+    items_data = b''
+    for item_id, data, flags in items:
+        table += vhdparser.VHDX_METADATA_TABLE_ENTRY.pack(
+            item_id.bytes_le, _VHDX_METADATA_ITEMS_OFFSET + len(items_data),
+            len(data), flags, 0)
+        items_data += data
+    return (table.ljust(_VHDX_METADATA_ITEMS_OFFSET, b'\x00') +
+            items_data)
+
+
+def _build_vhdx_header(sequence_number, file_write_guid, data_write_guid):
+    header = bytearray(vhdparser.VHDX_HEADER_SIZE)
+    vhdparser.VHDX_HEADER.pack_into(
+        header, 0, vhdparser.VHDX_HEADER_SIGNATURE, 0, sequence_number,
+        file_write_guid, data_write_guid, b'\x00' * 16, 0, _VHDX_VERSION,
+        _VHDX_LOG_SIZE, _VHDX_LOG_OFFSET)
+    struct.pack_into('<I', header, vhdparser.VHDX_HEADER_CHECKSUM_OFFSET,
+                     vhdparser.crc32c(header))
+    return header
+
+
+def _build_vhdx_region_table(bat_size):
+    table = bytearray(_VHDX_REGION_TABLE_SIZE)
+    regions = [(vhdparser.VHDX_REGION_BAT, _VHDX_BAT_OFFSET, bat_size),
+               (vhdparser.VHDX_REGION_METADATA, _VHDX_METADATA_REGION_OFFSET,
+                _VHDX_METADATA_REGION_SIZE)]
+    vhdparser.VHDX_REGION_TABLE_HEADER.pack_into(
+        table, 0, vhdparser.VHDX_REGION_TABLE_SIGNATURE, 0, len(regions), 0)
+    for idx, (region_id, offset, length) in enumerate(regions):
+        vhdparser.VHDX_REGION_TABLE_ENTRY.pack_into(
+            table, vhdparser.VHDX_REGION_TABLE_HEADER.size +
+            idx * vhdparser.VHDX_REGION_TABLE_ENTRY.size,
+            region_id.bytes_le, offset, length, _VHDX_REGION_REQUIRED)
+    struct.pack_into('<I', table, 4, vhdparser.crc32c(table))
+    return table
+
+
+def _write_vhdx(f, size, block_size, logical_sector_size,
+                physical_sector_size, parent=None):
+    """Writes an empty dynamic or differencing VHDX image."""
+    image_ranges, _payload_offset = _build_vhdx_metadata(
+        size, block_size, logical_sector_size, physical_sector_size,
+        parent=parent)
+    # The gaps between the metadata ranges, such as the log, are left
+    # empty.
+    for offset, data in image_ranges:
+        f.seek(offset)
+        f.write(data)
+
+
+def iter_dynamic_vhdx(size, allocated_blocks, read_block,
+                      block_size=VHDX_DEFAULT_BLOCK_SIZE,
+                      logical_sector_size=VHDX_DEFAULT_LOGICAL_SECTOR_SIZE,
+                      physical_sector_size=VHDX_DEFAULT_PHYSICAL_SECTOR_SIZE):
+    """Yields the chunks of a dynamic VHDX image holding the given blocks.
+
+    The image is generated sequentially, so it can be written to streams.
+
+    :param allocated_blocks: the sorted indexes of the blocks having data.
+    :param read_block: callable returning the data of a block, which must
+                       be block_size long. The blocks are read in order.
+    """
+    image_ranges, payload_offset = _build_vhdx_metadata(
+        size, block_size, logical_sector_size, physical_sector_size,
+        allocated_blocks=allocated_blocks)
+
+    pos = 0
+    for offset, data in image_ranges:
+        if offset > pos:
+            yield b'\x00' * (offset - pos)
+        yield bytes(data)
+        pos = offset + len(data)
+
+    for block_idx in allocated_blocks:
+        yield _check_block(read_block(block_idx), block_size)
+
+
+def _build_vhdx_metadata(size, block_size, logical_sector_size,
+                         physical_sector_size, parent=None,
+                         allocated_blocks=()):
+    """Returns the VHDX metadata (offset, data) ranges and payload offset.
+
+    Layout: file identifier, headers and region tables (first MB), an
+    empty log (second MB), metadata region (third MB), BAT and the
+    allocated blocks, in order.
+    """
+    if (size > VHDX_MAX_SIZE or not size or size % logical_sector_size):
+        raise vmutils.HyperVException(_("Invalid VHDX size: %s") % size)
+
+    bat_entries = _get_vhdx_bat_entry_count(size, block_size,
+                                            logical_sector_size,
+                                            has_parent=bool(parent))
+    bat_size = _round_up(bat_entries * _VHDX_BAT_ENTRY_SIZE, units.Mi)
+
+    file_identifier = (vhdparser.VHDX_FILE_SIGNATURE +
+                       _VHDX_CREATOR.encode('utf-16-le'))
+    file_write_guid = uuid.uuid4().bytes_le
+    data_write_guid = uuid.uuid4().bytes_le
+
+    image_head = bytearray(file_identifier.ljust(
+        _VHDX_FILE_IDENTIFIER_SIZE, b'\x00'))
+    for sequence_number in (0, 1):
+        header = _build_vhdx_header(sequence_number, file_write_guid,
+                                    data_write_guid)
+        image_head += header.ljust(_VHDX_FILE_IDENTIFIER_SIZE, b'\x00')
+    region_table = _build_vhdx_region_table(bat_size)
+    for _offset in _VHDX_REGION_TABLE_OFFSETS:
+        image_head += region_table
+
+    # The log is left empty, the headers having no log GUID.
+    metadata = _build_vhdx_metadata_region(
+        size, block_size, logical_sector_size, physical_sector_size, parent)
+
+    # Unallocated blocks have zeroed BAT entries, the payload block
+    # entries being interleaved with the sector bitmap block entries.
+    bat = bytearray(bat_size)
+    chunk_ratio = (1 << 23) * logical_sector_size // block_size
+    payload_offset = _VHDX_BAT_OFFSET + bat_size
+    for idx, block_idx in enumerate(allocated_blocks):
+        block_offset = payload_offset + idx * block_size
+        struct.pack_into(
+            '<Q', bat,
+            (block_idx + block_idx // chunk_ratio) * _VHDX_BAT_ENTRY_SIZE,
+            block_offset | vhdparser.VHDX_BAT_PAYLOAD_BLOCK_FULLY_PRESENT)
+
+    image_ranges = [(0, image_head),
+                    (_VHDX_METADATA_REGION_OFFSET, metadata),
+                    (_VHDX_BAT_OFFSET, bat)]
+    return image_ranges, payload_offset
@@ -27,6 +27,7 @@ from nova.compute import vm_states
 from nova import exception
 from nova import objects
 from nova import utils
+from nova import version
 from nova.virt import configdrive
 from nova.virt import hardware
 from oslo_concurrency import processutils
@@ -42,10 +43,14 @@ import six
 from hyperv.i18n import _, _LI, _LE, _LW
 from hyperv.nova import block_device_manager
 from hyperv.nova import constants
+from hyperv.nova import ephemeraldiskpool
 from hyperv.nova import imagecache
+from hyperv.nova import isowriter
 from hyperv.nova import serialconsoleops
 from hyperv.nova import utilsfactory
+from hyperv.nova import vhdwriter
 from hyperv.nova import vif as vif_utils
+from hyperv.nova import vmshellpool
 from hyperv.nova import vmutils
 from hyperv.nova import volumeops
 
@@ -67,6 +72,14 @@ hyperv_opts = [
                 default=False,
                 help='Attaches the Config Drive image as a cdrom drive '
                      'instead of a disk drive'),
+    cfg.BoolOpt('native_config_drive',
+                default=True,
+                help='Builds the Config Drive ISO image in process, without '
+                     'running external tools. When the Config Drive is '
+                     'attached as a disk drive, the ISO image is turned '
+                     'into a fixed VHD image in place instead of being '
+                     'converted by qemu-img. The external tools are used if '
+                     'the Config Drive contents cannot be stored this way.'),
     cfg.BoolOpt('enable_instance_metrics_collection',
                 default=False,
                 help='Enables metrics collections for an instance by using '
@@ -97,6 +110,8 @@ CONF = cfg.CONF
 CONF.register_opts(hyperv_opts, 'hyperv')
 CONF.import_opt('use_cow_images', 'nova.virt.driver')
 
+CONFIG_DRIVE_LABEL = 'config-2'
+
 SHUTDOWN_TIME_INCREMENT = 5
 REBOOT_TYPE_SOFT = 'SOFT'
 REBOOT_TYPE_HARD = 'HARD'
@@ -133,6 +148,8 @@ class VMOps(object):
         self._serial_console_ops = serialconsoleops.SerialConsoleOps()
         self._volumeops = volumeops.VolumeOps()
         self._imagecache = imagecache.ImageCache()
+        self._ephemeral_disk_pool = ephemeraldiskpool.EphemeralDiskPool()
+        self._vm_shell_pool = vmshellpool.VMShellPool()
         self._vif_driver_cache = {}
         self._block_device_manager = (
             block_device_manager.BlockDeviceInfoManager())
@@ -148,7 +165,8 @@ class VMOps(object):
         return instance_uuids
 
     def list_instances(self):
-        return self._vmutils.list_instances()
+        return [vm_name for vm_name in self._vmutils.list_instances()
+                if not vmshellpool.is_vm_shell(vm_name)]
 
     def get_info(self, instance):
         """Get information about the VM."""
@@ -269,6 +287,11 @@ class VMOps(object):
             self._create_ephemeral_disk(instance.name, eph)
 
     def _create_ephemeral_disk(self, instance_name, eph_info):
+        if self._ephemeral_disk_pool.claim_disk(eph_info['size'],
+                                                eph_info['format'],
+                                                eph_info['path']):
+            return
+
         self._vhdutils.create_dynamic_vhd(eph_info['path'],
                                           eph_info['size'] * units.Gi,
                                           eph_info['format'])
@@ -372,19 +395,32 @@ class VMOps(object):
             dynamic_memory_ratio = CONF.hyperv.dynamic_memory_ratio
             vnuma_enabled = False
 
-        self._vmutils.create_vm(instance_name,
-                                vnuma_enabled,
-                                vm_gen,
-                                instance_path,
-                                [instance.uuid])
-
-        self._vmutils.update_vm(instance_name,
-                                instance.memory_mb,
-                                memory_per_numa_node,
-                                instance.vcpus,
-                                cpus_per_numa_node,
-                                CONF.hyperv.limit_cpu_features,
-                                dynamic_memory_ratio)
+        vm_shape = vmshellpool.VMShape(
+            vm_gen=vm_gen,
+            vnuma_enabled=vnuma_enabled,
+            memory_mb=instance.memory_mb,
+            memory_per_numa_node=memory_per_numa_node,
+            vcpus=instance.vcpus,
+            vcpus_per_numa_node=cpus_per_numa_node,
+            limit_cpu_features=CONF.hyperv.limit_cpu_features,
+            dynamic_memory_ratio=dynamic_memory_ratio)
+        if not self._vm_shell_pool.claim_vm(vm_shape, instance_name,
+                                            instance_path, [instance.uuid]):
+            self._vmutils.create_vm(instance_name,
+                                    vnuma_enabled,
+                                    vm_gen,
+                                    instance_path,
+                                    [instance.uuid])
+
+            self._vmutils.update_vm(instance_name,
+                                    instance.memory_mb,
+                                    memory_per_numa_node,
+                                    instance.vcpus,
+                                    cpus_per_numa_node,
+                                    CONF.hyperv.limit_cpu_features,
+                                    dynamic_memory_ratio)
+
+            self._vmutils.create_scsi_controller(instance_name)
 
         flavor_extra_specs = instance.flavor.extra_specs
         remote_fx_config = flavor_extra_specs.get(
@@ -398,8 +434,6 @@ class VMOps(object):
             else:
                 self._configure_remotefx(instance, remote_fx_config)
 
-        self._vmutils.create_scsi_controller(instance_name)
-
         self._attach_root_device(instance_name, root_device)
         self._attach_ephemerals(instance_name, block_device_info['ephemerals'])
         self._volumeops.attach_volumes(
@@ -492,6 +526,52 @@ class VMOps(object):
                                                      extra_md=extra_md,
                                                      network_info=network_info)
 
+        start_time = time.time()
+        configdrive_path = self._create_config_drive_natively(
+            instance, inst_md, rescue)
+        if not configdrive_path:
+            configdrive_path = self._create_config_drive_with_tools(
+                instance, inst_md, rescue)
+
+        LOG.debug("Created config drive %(path)s in %(elapsed).3f seconds.",
+                  {'path': configdrive_path,
+                   'elapsed': time.time() - start_time}, instance=instance)
+        return configdrive_path
+
+    def _create_config_drive_natively(self, instance, inst_md, rescue):
+        """Builds the config drive image in process, returning its path,
+        or None if the config drive cannot be built this way.
+        """
+        if not CONF.hyperv.native_config_drive:
+            return
+
+        disk_format = (constants.DVD_FORMAT if CONF.hyperv.config_drive_cdrom
+                       else constants.DISK_FORMAT_VHD)
+        configdrive_path = self._pathutils.get_configdrive_path(
+            instance.name, disk_format, rescue=rescue)
+        LOG.info(_LI('Creating config drive at %(path)s'),
+                 {'path': configdrive_path}, instance=instance)
+
+        try:
+            isowriter.write_iso(
+                configdrive_path, inst_md.metadata_for_config_drive(),
+                volume_id=CONFIG_DRIVE_LABEL,
+                publisher=u'OpenStack Compute %s' % (
+                    version.version_string_with_package()))
+            if disk_format == constants.DISK_FORMAT_VHD:
+                vhdwriter.append_fixed_vhd_footer(configdrive_path)
+        except vmutils.HyperVException as ex:
+            fileutils.delete_if_exists(configdrive_path)
+            LOG.warning(_LW('Cannot create the config drive in process, '
+                            'using the external tools instead. Error: %s'),
+                        ex, instance=instance)
+            return
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                fileutils.delete_if_exists(configdrive_path)
+        return configdrive_path
+
+    def _create_config_drive_with_tools(self, instance, inst_md, rescue):
         configdrive_path_iso = self._pathutils.get_configdrive_path(
             instance.name, constants.DVD_FORMAT, rescue=rescue)
         LOG.info(_LI('Creating config drive at %(path)s'),
@@ -615,6 +695,8 @@ class VMOps(object):
                 self._pathutils.remove(configdrive_path)
 
     def _delete_disk_files(self, instance_name):
+        # The console log files must be released first.
+        self._serial_console_ops.wait_for_console_handler_stop(instance_name)
         self._pathutils.get_instance_dir(instance_name,
                                          create_dir=False,
                                          remove_dir=True)
@@ -722,9 +804,9 @@ class VMOps(object):
         """Power off the specified instance."""
         LOG.debug("Power off instance", instance=instance)
 
-        # We must make sure that the console log workers are stopped,
-        # otherwise we won't be able to delete / move VM log files.
-        self._serial_console_ops.stop_console_handler(instance.name)
+        # The console handler is stopped in the background. Callers that
+        # delete or move the VM log files have to wait for it to complete.
+        self._serial_console_ops.stop_console_handler_async(instance.name)
 
         if retry_interval <= 0:
             retry_interval = SHUTDOWN_TIME_INCREMENT
@@ -990,6 +1072,82 @@ class VMOps(object):
                        if disk_path.find(instance_path) != -1]
         return local_disks
 
+    def _get_instance_local_vhds(self, instance_name):
+        return [disk_path
+                for disk_path in self._get_instance_local_disks(instance_name)
+                if os.path.splitext(disk_path)[1][1:].lower() in (
+                    constants.DISK_FORMAT_VHD.lower(),
+                    constants.DISK_FORMAT_VHDX.lower())]
+
+    def _get_vhd_size_info(self, disk_path):
+        # Does not require the block allocation table, which cannot be read
+        # while the image is exclusively opened, for example by a running
+        # instance. In that case, the image metadata is retrieved through
+        # WMI, which does not provide the file size. The allocated space is
+        # not known either, the file size being used instead.
+        vhd_info = self._vhdutils.get_vhd_info(disk_path)
+        disk_size = os.path.getsize(disk_path)
+        return {'MaxInternalSize': vhd_info['MaxInternalSize'],
+                'FileSize': disk_size,
+                'ParentPath': vhd_info.get('ParentPath'),
+                'AllocatedBytes': disk_size}
+
+    def get_instance_over_committed_disk_size(self, instance_name):
+        """Returns the space the instance local disks may still grow by.
+
+        Only the image metadata is read, which is cached until the image
+        changes, so this is cheaper than get_instance_disk_info. Disks
+        which cannot be read, for example if missing, are skipped.
+        """
+        over_committed_size = 0
+        for disk_path in self._get_instance_local_vhds(instance_name):
+            try:
+                size_info = self._get_vhd_size_info(disk_path)
+            except (vmutils.HyperVException, OSError) as ex:
+                LOG.debug("Could not get the info of disk %(disk_path)s: "
+                          "%(ex)s", {'disk_path': disk_path, 'ex': ex})
+                continue
+
+            over_committed_size += max(
+                size_info['MaxInternalSize'] - size_info['FileSize'], 0)
+        return over_committed_size
+
+    def get_instance_disk_info(self, instance_name):
+        """Returns the virtual and the actually used size of the local disks.
+
+        The disk details use the same keys as the libvirt driver.
+        """
+        disk_info = []
+        for disk_path in self._get_instance_local_vhds(instance_name):
+            format_ext = os.path.splitext(disk_path)[1][1:].lower()
+            try:
+                allocation_info = self._vhdutils.get_vhd_allocation_info(
+                    disk_path)
+            except vmutils.HyperVException as ex:
+                LOG.debug("Could not get the allocation info of disk "
+                          "%(disk_path)s: %(ex)s",
+                          {'disk_path': disk_path, 'ex': ex})
+                try:
+                    allocation_info = self._get_vhd_size_info(disk_path)
+                except (vmutils.HyperVException, OSError) as ex:
+                    LOG.debug("Could not get the info of disk "
+                              "%(disk_path)s: %(ex)s",
+                              {'disk_path': disk_path, 'ex': ex})
+                    continue
+
+            virt_disk_size = allocation_info['MaxInternalSize']
+            disk_size = allocation_info['FileSize']
+            disk_info.append(
+                {'type': format_ext,
+                 'path': disk_path,
+                 'virt_disk_size': virt_disk_size,
+                 'backing_file': allocation_info['ParentPath'] or '',
+                 'disk_size': disk_size,
+                 'allocated_size': allocation_info['AllocatedBytes'],
+                 'over_committed_disk_size': max(
+                     virt_disk_size - disk_size, 0)})
+        return disk_info
+
     def _get_storage_qos_specs(self, instance):
         extra_specs = instance.flavor.get('extra_specs') or {}
         storage_qos_specs = {}
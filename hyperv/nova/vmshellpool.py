@@ -0,0 +1,300 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Pool of pre-defined, powered off VMs, reused when spawning instances.
+"""
+import collections
+
+import eventlet
+from nova import utils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import excutils
+from oslo_utils import uuidutils
+
+from hyperv.i18n import _LW
+from hyperv.nova import utilsfactory
+from hyperv.nova import vmutils
+
+LOG = logging.getLogger(__name__)
+
+hyperv_opts = [
+    cfg.IntOpt('vm_shell_pool_size',
+               default=0,
+               min=0,
+               help='The number of powered off VMs defined in advance, in '
+                    'the background, for each of the recently requested '
+                    'instance shapes. The shape of an instance consists of '
+                    'its VM generation, vCPU count, memory and vNUMA '
+                    'topology. The instances having one of those shapes '
+                    'reuse such a VM instead of defining a new one when '
+                    'they are spawned. 0 disables the pool.'),
+    cfg.IntOpt('vm_shell_pool_max_shapes',
+               default=3,
+               min=1,
+               help='The number of most recently requested instance '
+                    'shapes for which VMs are kept in the pool.'),
+    cfg.IntOpt('vm_shell_pool_refill_interval',
+               default=30,
+               min=1,
+               help='The interval, in seconds, at which the VMs taken from '
+                    'the pool are replaced.'),
+    cfg.FloatOpt('vm_shell_pool_throttle_interval',
+                 default=1,
+                 min=0,
+                 help='The time, in seconds, to wait between the creation '
+                      'of the pooled VMs, limiting the impact on the '
+                      'running instances.'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(hyperv_opts, 'hyperv')
+
+# Pooled VMs are named <prefix><shell_id>, their notes containing the
+# serialized VM shape. The VMs are defined using temporary names, so that
+# they are not claimed before being complete.
+_SHELL_NAME_PREFIX = 'nova-vm-shell-'
+_TMP_SHELL_NAME_PREFIX = _SHELL_NAME_PREFIX + 'tmp-'
+
+_POOL_LOCK_NAME = 'hyperv-vm-shell-pool'
+
+VMShape = collections.namedtuple(
+    'VMShape', ['vm_gen', 'vnuma_enabled', 'memory_mb',
+                'memory_per_numa_node', 'vcpus', 'vcpus_per_numa_node',
+                'limit_cpu_features', 'dynamic_memory_ratio'])
+
+# Shared by all the VMShellPool instances, as the VMs are claimed by the
+# VMOps instances while the pool is refilled by the driver.
+_pool_stats = collections.Counter()
+# The requested VM shapes, the most recent one being the last.
+_requested_shapes = collections.OrderedDict()
+
+
+def is_vm_shell(vm_name):
+    """Returns whether the given VM belongs to the pool."""
+    return vm_name.startswith(_SHELL_NAME_PREFIX)
+
+
+def _serialize_shape(vm_shape):
+    return jsonutils.dumps(vm_shape._asdict(), sort_keys=True)
+
+
+def _deserialize_shape(notes):
+    try:
+        return VMShape(**jsonutils.loads(notes[0]))
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def _add_requested_shape(vm_shape):
+    _requested_shapes.pop(vm_shape, None)
+    _requested_shapes[vm_shape] = None
+    while len(_requested_shapes) > CONF.hyperv.vm_shell_pool_max_shapes:
+        _requested_shapes.popitem(last=False)
+
+
+class VMShellPool(object):
+    """Keeps powered off VMs ready to be used by new instances.
+
+    Defining a VM and setting its memory, vCPUs and SCSI controller take a
+    significant part of the instance spawn time. Pooled VMs having those
+    already set are claimed by renaming them, which is a single operation.
+    Claimed VMs are replaced periodically, one VM at a time, pausing in
+    between.
+    """
+
+    def __init__(self):
+        self._vmutils = utilsfactory.get_vmutils()
+        self._pathutils = utilsfactory.get_pathutils()
+        # Pooled VMs are claimed by renaming them, which is supported
+        # starting with Hyper-V Server 2012.
+        self._rename_supported = (
+            utilsfactory.get_hostutils().check_min_windows_version(6, 2))
+
+    def _is_enabled(self):
+        return bool(CONF.hyperv.vm_shell_pool_size and
+                    self._rename_supported)
+
+    def start(self):
+        if not self._is_enabled():
+            if CONF.hyperv.vm_shell_pool_size:
+                LOG.warning(_LW("The VM shell pool is not supported on "
+                                "this version of Hyper-V, being "
+                                "disabled."))
+            return
+
+        eventlet.spawn_n(self._refill_periodically)
+
+    def _refill_periodically(self):
+        try:
+            # Keep the VMs left by a previous run of the service.
+            for vm_shape in set(self._list_shells().values()):
+                if vm_shape:
+                    _add_requested_shape(vm_shape)
+        except Exception as ex:
+            LOG.warning(_LW("Could not list the pooled VMs. Error: %s"), ex)
+
+        while True:
+            try:
+                self.refill()
+            except Exception as ex:
+                LOG.warning(_LW("VM shell pool refill failed. Error: %s"),
+                            ex)
+            eventlet.sleep(CONF.hyperv.vm_shell_pool_refill_interval)
+
+    def _list_shells(self):
+        # Returns the shapes of the pooled VMs ready to be claimed, by VM
+        # name. Unusable pooled VMs have None shapes.
+        shells = {}
+        for vm_name, notes in self._vmutils.list_instance_notes():
+            if is_vm_shell(vm_name):
+                shells[vm_name] = (
+                    None if vm_name.startswith(_TMP_SHELL_NAME_PREFIX)
+                    else _deserialize_shape(notes))
+        return shells
+
+    def claim_vm(self, vm_shape, vm_name, instance_path, notes):
+        """Renames a pooled VM having the requested shape.
+
+        The notes and the data roots of the VM are updated as well. The
+        configuration data root of the pooled VMs cannot be changed, so
+        it remains the pool directory. The configuration files are not
+        part of the instance directory, being removed by Hyper-V along
+        with the VM and moved to the same path on the destination host
+        when the VM is live migrated.
+
+        Returns whether a pooled VM having the requested shape was
+        available.
+        """
+        if not self._is_enabled():
+            return False
+
+        @utils.synchronized(_POOL_LOCK_NAME)
+        def claim_shell():
+            _add_requested_shape(vm_shape)
+            shells = self._list_shells()
+            for shell_name in sorted(shells):
+                if shells[shell_name] != vm_shape:
+                    continue
+
+                try:
+                    self._vmutils.rename_vm(shell_name, vm_name,
+                                            instance_path, notes)
+                except vmutils.HyperVException as ex:
+                    LOG.warning(_LW("Could not claim pooled VM %(shell)s. "
+                                    "Error: %(ex)s"),
+                                {'shell': shell_name, 'ex': ex})
+                    self._destroy_shell(shell_name)
+                    continue
+
+                LOG.debug("Claimed pooled VM %(shell)s as %(vm_name)s",
+                          {'shell': shell_name, 'vm_name': vm_name})
+                return True
+            return False
+
+        if claim_shell():
+            _pool_stats['hits'] += 1
+            return True
+
+        _pool_stats['misses'] += 1
+        return False
+
+    def _throttle(self):
+        eventlet.sleep(CONF.hyperv.vm_shell_pool_throttle_interval)
+
+    def refill(self):
+        """Defines the missing pooled VMs.
+
+        The pooled VMs which are no longer needed, such as the ones having
+        shapes which were not recently requested, are removed.
+        """
+        vm_shapes = list(_requested_shapes)
+        pool_size = CONF.hyperv.vm_shell_pool_size
+
+        self._remove_stale_shells(vm_shapes, pool_size)
+        for vm_shape in vm_shapes:
+            while (list(self._list_shells().values()).count(vm_shape) <
+                    pool_size):
+                self._create_shell(vm_shape)
+                self._throttle()
+
+        LOG.debug("VM shell pool statistics: %s", self.get_pool_stats())
+
+    def _remove_stale_shells(self, vm_shapes, pool_size):
+        # Pooled VMs are destroyed while holding the lock, so that they
+        # cannot be claimed in the meantime.
+        @utils.synchronized(_POOL_LOCK_NAME)
+        def remove_stale_shells():
+            shell_counts = collections.Counter()
+            shells = self._list_shells()
+            for shell_name in sorted(shells):
+                vm_shape = shells[shell_name]
+                if (vm_shape in vm_shapes and
+                        shell_counts[vm_shape] < pool_size):
+                    shell_counts[vm_shape] += 1
+                    continue
+
+                LOG.debug("Removing stale pooled VM %s", shell_name)
+                self._destroy_shell(shell_name)
+
+        remove_stale_shells()
+
+    def _create_shell(self, vm_shape):
+        shell_id = uuidutils.generate_uuid()
+        tmp_name = _TMP_SHELL_NAME_PREFIX + shell_id
+        shell_name = _SHELL_NAME_PREFIX + shell_id
+        pool_dir = self._pathutils.get_vm_shell_pool_dir()
+
+        try:
+            self._vmutils.create_vm(tmp_name, vm_shape.vnuma_enabled,
+                                    vm_shape.vm_gen, pool_dir)
+            self._vmutils.update_vm(tmp_name, vm_shape.memory_mb,
+                                    vm_shape.memory_per_numa_node,
+                                    vm_shape.vcpus,
+                                    vm_shape.vcpus_per_numa_node,
+                                    vm_shape.limit_cpu_features,
+                                    vm_shape.dynamic_memory_ratio)
+            self._vmutils.create_scsi_controller(tmp_name)
+            self._vmutils.rename_vm(tmp_name, shell_name, pool_dir,
+                                    [_serialize_shape(vm_shape)])
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                if self._vmutils.vm_exists(tmp_name):
+                    self._destroy_shell(tmp_name)
+
+        LOG.debug("Created pooled VM %s", shell_name)
+
+    def _destroy_shell(self, shell_name):
+        try:
+            self._vmutils.destroy_vm(shell_name)
+        except Exception as ex:
+            LOG.warning(_LW("Could not destroy pooled VM %(shell)s. "
+                            "Error: %(ex)s"), {'shell': shell_name, 'ex': ex})
+
+    def get_pool_stats(self):
+        """Returns the pool hit and miss counters along with the pool size.
+
+        Only the instances spawned while the pool is enabled are accounted.
+        """
+        if not self._is_enabled():
+            return {}
+
+        shells = self._list_shells()
+        size = len([vm_shape for vm_shape in shells.values() if vm_shape])
+        return {'vm_shell_pool_hits': _pool_stats['hits'],
+                'vm_shell_pool_misses': _pool_stats['misses'],
+                'vm_shell_pool_size': size}
@@ -319,6 +319,10 @@ class VMUtils(object):
 
         return self._get_wmi_obj(vm_path)
 
+    def rename_vm(self, vm_name, new_vm_name, instance_path, notes):
+        raise NotImplementedError(_("Renaming VMs is not supported on "
+                                    "this version of Hyper-V"))
+
     @loopingcall.RetryDecorator(max_retry_count=5, max_sleep_time=1,
                                 exceptions=(HyperVException, ))
     def _modify_virtual_system(self, vm_path, vmsetting):
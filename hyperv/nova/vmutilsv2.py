@@ -422,6 +422,22 @@ class VMUtilsV2(vmutils.VMUtils):
         # VMUtilsV2._modify_virt_resource does not require the vm path.
         self._modify_virt_resource(disk_resource, None)
 
+    def rename_vm(self, vm_name, new_vm_name, instance_path, notes):
+        """Renames a VM, also updating its notes and data roots.
+
+        The configuration data root cannot be changed once the VM is
+        defined.
+        """
+        vmsettings = self._lookup_vm_check(vm_name)
+        vmsettings.ElementName = new_vm_name
+        vmsettings.Notes = notes
+        vmsettings.LogDataRoot = instance_path
+        vmsettings.SnapshotDataRoot = instance_path
+        vmsettings.SuspendDataRoot = instance_path
+        vmsettings.SwapFileDataRoot = instance_path
+
+        self._modify_virtual_system(None, vmsettings)
+
     def enable_secure_boot(self, vm_name, certificate_required):
         vmsettings = self._lookup_vm_check(vm_name)
         self._set_secure_boot(vmsettings, certificate_required)
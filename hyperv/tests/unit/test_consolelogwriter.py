@@ -0,0 +1,428 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import errno
+import os
+
+import mock
+from six.moves import builtins
+
+from hyperv.nova import consolelogwriter
+from hyperv.nova import pathutils
+from hyperv.tests.unit import test_base
+
+
+class ConsoleLogWriterTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_LOG_PATH = 'fake_log_path'
+
+    def setUp(self):
+        super(ConsoleLogWriterTestCase, self).setUp()
+
+        self._writer = consolelogwriter.ConsoleLogWriter()
+        self._writer._archiver = mock.Mock()
+        self._writer.open_log(self._FAKE_LOG_PATH)
+        self._log = self._writer._logs[self._FAKE_LOG_PATH]
+
+    def test_write(self):
+        self._writer._flush_requested = mock.Mock()
+        self.flags(console_log_flush_size=8, group='hyperv')
+
+        self._writer.write(self._FAKE_LOG_PATH, b'fake')
+        self.assertFalse(self._writer._flush_requested.set.called)
+
+        self._writer.write(self._FAKE_LOG_PATH, b'data')
+        self._writer._flush_requested.set.assert_called_once_with()
+
+        self.assertEqual([b'fake', b'data'], list(self._log.pending_data))
+        self.assertEqual(8, self._log.pending_size)
+        self.assertEqual(8, self._writer._pending_bytes)
+
+    @mock.patch.object(consolelogwriter, 'LOG')
+    def test_write_drop_oldest(self, mock_log):
+        self.flags(console_log_max_pending_size=8, group='hyperv')
+
+        self._writer.write(self._FAKE_LOG_PATH, b'fake')
+        self._writer.write(self._FAKE_LOG_PATH, b'_data')
+        self.assertEqual(1, mock_log.warning.call_count)
+
+        self._writer.write(self._FAKE_LOG_PATH, b'_new')
+        # Only the first drop is logged.
+        self.assertEqual(1, mock_log.warning.call_count)
+
+        self.assertEqual([b'data', b'_new'], list(self._log.pending_data))
+        self.assertEqual(8, self._log.pending_size)
+        self.assertEqual(5, self._log.bytes_dropped)
+        self.assertEqual(8, self._writer._pending_bytes)
+
+    def test_write_closed_log(self):
+        self._writer.write(mock.sentinel.other_log_path, b'fake_data')
+
+        self.assertEqual(0, self._writer._pending_bytes)
+
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter,
+                       '_close_log_file')
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter,
+                       '_write_pending_data')
+    def test_close_log(self, mock_write_pending_data, mock_close_log_file):
+        self._writer.close_log(self._FAKE_LOG_PATH)
+
+        mock_write_pending_data.assert_called_once_with(self._log)
+        mock_close_log_file.assert_called_once_with(self._log)
+        self.assertNotIn(self._FAKE_LOG_PATH, self._writer._logs)
+
+    @mock.patch.object(consolelogwriter, 'LOG')
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter,
+                       '_close_log_file')
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter,
+                       '_write_pending_data')
+    def test_close_log_dropped_data(self, mock_write_pending_data,
+                                    mock_close_log_file, mock_log):
+        self._log.bytes_dropped = 10
+
+        self._writer.close_log(self._FAKE_LOG_PATH)
+
+        self.assertEqual(10, mock_log.warning.call_args[0][1][
+            'bytes_dropped'])
+
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter,
+                       '_close_log_file')
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter,
+                       '_write_pending_data')
+    def test_flush_exception(self, mock_write_pending_data,
+                             mock_close_log_file):
+        mock_write_pending_data.side_effect = IOError
+
+        self._writer.flush()
+
+        mock_close_log_file.assert_called_once_with(self._log)
+
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter, '_rotate_log')
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter, '_open_log_file')
+    def _test_write_pending_data(self, mock_open_log_file, mock_rotate_log,
+                                 size_exceeded=False):
+        self._log.pending_data = collections.deque([b'fake', b'_data'])
+        self._log.pending_size = 9
+        self._writer._pending_bytes = 9
+        self.flags(console_log_max_file_size=20, group='hyperv')
+        self._log.size = 15 if size_exceeded else 0
+
+        def fake_open_log_file(log):
+            log.file_handle = mock.Mock()
+
+        mock_open_log_file.side_effect = fake_open_log_file
+
+        self._writer._write_pending_data(self._log)
+
+        mock_open_log_file.assert_called_once_with(self._log)
+        self._log.file_handle.write.assert_has_calls(
+            [mock.call(b'fake'), mock.call(b'_data')])
+        self._log.file_handle.flush.assert_called_once_with()
+        if size_exceeded:
+            mock_rotate_log.assert_called_once_with(self._log)
+        else:
+            self.assertFalse(mock_rotate_log.called)
+
+        self.assertFalse(self._log.pending_data)
+        self.assertEqual(0, self._log.pending_size)
+        self.assertEqual(0, self._writer._pending_bytes)
+
+    def test_write_pending_data(self):
+        self._test_write_pending_data()
+
+    def test_write_pending_data_size_exceeded(self):
+        self._test_write_pending_data(size_exceeded=True)
+
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter, '_open_log_file')
+    def test_rotate_log(self, mock_open_log_file):
+        fake_handle = mock.Mock()
+        self._log.file_handle = fake_handle
+
+        self._writer._rotate_log(self._log)
+
+        self._writer._archiver.can_rotate.assert_called_once_with(
+            self._FAKE_LOG_PATH)
+        fake_handle.flush.assert_called_once_with()
+        fake_handle.close.assert_called_once_with()
+        self._writer._archiver.rotate.assert_called_once_with(
+            self._FAKE_LOG_PATH)
+        mock_open_log_file.assert_called_once_with(self._log)
+
+    @mock.patch.object(consolelogwriter.ConsoleLogWriter, '_open_log_file')
+    def test_rotate_log_deferred(self, mock_open_log_file):
+        fake_handle = mock.Mock()
+        self._log.file_handle = fake_handle
+        self._writer._archiver.can_rotate.return_value = False
+
+        self._writer._rotate_log(self._log)
+
+        self.assertFalse(fake_handle.close.called)
+        self.assertFalse(self._writer._archiver.rotate.called)
+        self.assertFalse(mock_open_log_file.called)
+
+    @mock.patch.object(consolelogwriter, 'time')
+    def test_retry_if_file_in_use_exceeded_retries(self, mock_time):
+        class FakeWindowsException(Exception):
+            errno = errno.EACCES
+
+        raise_count = consolelogwriter._MAX_FILE_IN_USE_RETRIES + 1
+        mock_func_side_eff = [FakeWindowsException] * raise_count
+        mock_func = mock.Mock(side_effect=mock_func_side_eff)
+
+        with mock.patch.object(consolelogwriter, 'WindowsError',
+                               FakeWindowsException, create=True):
+            self.assertRaises(FakeWindowsException,
+                              consolelogwriter._retry_if_file_in_use,
+                              mock_func, mock.sentinel.arg)
+            mock_time.sleep.assert_has_calls(
+                [mock.call(1)] * consolelogwriter._MAX_FILE_IN_USE_RETRIES)
+
+
+@mock.patch.object(consolelogwriter, '_retry_if_file_in_use',
+                   lambda f, *args: f(*args))
+class ConsoleLogArchiverTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_LOG_PATH = 'fake_log_path'
+
+    def setUp(self):
+        super(ConsoleLogArchiverTestCase, self).setUp()
+
+        self.flags(console_log_archive_count=2, group='hyperv')
+        self._archiver = consolelogwriter.ConsoleLogArchiver()
+        self._archiver._pathutils = pathutils.PathUtils()
+
+    @mock.patch('os.path.exists')
+    def _test_can_rotate(self, mock_exists, existing_paths=(),
+                         compressing=False, pending=False, failed=False,
+                         expected_result=True):
+        mock_exists.side_effect = lambda path: path in existing_paths
+        pending_path = 'fake_log_path.1'
+        if compressing:
+            self._archiver._compressing_log = pending_path
+        if pending:
+            self._archiver._pending_logs.append(pending_path)
+        if failed:
+            self._archiver._failed_logs.add(pending_path)
+
+        result = self._archiver.can_rotate(self._FAKE_LOG_PATH)
+
+        self.assertEqual(expected_result, result)
+        if not (expected_result or compressing):
+            # The pending log is compressed in the background.
+            self.assertEqual([pending_path],
+                             list(self._archiver._pending_logs))
+
+    def test_can_rotate(self):
+        self._test_can_rotate()
+
+    def test_can_rotate_being_compressed(self):
+        self._test_can_rotate(existing_paths=['fake_log_path.1'],
+                              compressing=True, expected_result=False)
+
+    def test_can_rotate_pending_compression(self):
+        self._test_can_rotate(existing_paths=['fake_log_path.1'],
+                              pending=True, expected_result=False)
+
+    def test_can_rotate_left_behind(self):
+        self._test_can_rotate(existing_paths=['fake_log_path.1'],
+                              expected_result=False)
+        self.assertTrue(self._archiver._archive_requested.is_set())
+
+    @mock.patch('os.remove')
+    def test_can_rotate_already_compressed(self, mock_remove):
+        self._test_can_rotate(existing_paths=['fake_log_path.1',
+                                              'fake_log_path.1.gz'])
+        mock_remove.assert_called_once_with('fake_log_path.1')
+
+    def test_can_rotate_compress_failed(self):
+        self._test_can_rotate(existing_paths=['fake_log_path.1'],
+                              failed=True)
+
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_rotate(self, mock_os):
+        mock_os.path.exists.side_effect = lambda path: path != (
+            'fake_log_path.1')
+
+        self._archiver.rotate(self._FAKE_LOG_PATH)
+
+        mock_os.remove.assert_called_once_with('fake_log_path.2.gz')
+        mock_os.rename.assert_has_calls(
+            [mock.call('fake_log_path.1.gz', 'fake_log_path.2.gz'),
+             mock.call(self._FAKE_LOG_PATH, 'fake_log_path.1')])
+        self.assertEqual(['fake_log_path.1'],
+                         list(self._archiver._pending_logs))
+        self.assertTrue(self._archiver._archive_requested.is_set())
+
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_rotate_compress_failed(self, mock_os):
+        self._archiver._failed_logs.add('fake_log_path.1')
+        mock_os.path.exists.side_effect = [True, False, False]
+
+        self._archiver.rotate(self._FAKE_LOG_PATH)
+
+        mock_os.remove.assert_called_once_with('fake_log_path.1')
+        mock_os.rename.assert_called_once_with(self._FAKE_LOG_PATH,
+                                               'fake_log_path.1')
+        self.assertFalse(self._archiver._failed_logs)
+
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_rotate_no_archives(self, mock_os):
+        self.flags(console_log_archive_count=0, group='hyperv')
+        mock_os.path.exists.return_value = False
+
+        self._archiver.rotate(self._FAKE_LOG_PATH)
+
+        mock_os.remove.assert_called_once_with(self._FAKE_LOG_PATH)
+        self.assertFalse(mock_os.rename.called)
+        self.assertFalse(self._archiver._pending_logs)
+
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_rotate_other_log_being_compressed(self, mock_os):
+        self._archiver._compressing_log = 'other_log_path.1'
+        mock_os.path.exists.return_value = False
+
+        self._archiver.rotate(self._FAKE_LOG_PATH)
+
+        mock_os.rename.assert_called_once_with(self._FAKE_LOG_PATH,
+                                               'fake_log_path.1')
+
+    @mock.patch.object(consolelogwriter.ConsoleLogArchiver, '_replace_log')
+    @mock.patch.object(consolelogwriter.ConsoleLogArchiver,
+                       '_write_compressed_log')
+    @mock.patch('os.path.exists')
+    def test_archive_pending_logs(self, mock_exists,
+                                  mock_write_compressed_log,
+                                  mock_replace_log):
+        self._archiver._pending_logs.extend(['compressed_path.1',
+                                             'pending_path.1'])
+        existing_paths = ['pending_path.1']
+        mock_exists.side_effect = lambda path: path in existing_paths
+
+        def fake_write_compressed_log(log_path):
+            # The logs are compressed without holding the lock.
+            self.assertFalse(self._archiver._lock.locked())
+            self.assertEqual(log_path, self._archiver._compressing_log)
+            return mock.sentinel.tmp_path
+
+        mock_write_compressed_log.side_effect = fake_write_compressed_log
+
+        self._archiver._archive_pending_logs()
+
+        mock_write_compressed_log.assert_called_once_with('pending_path.1')
+        mock_replace_log.assert_called_once_with('pending_path.1',
+                                                 mock.sentinel.tmp_path)
+        self.assertIsNone(self._archiver._compressing_log)
+        self.assertFalse(self._archiver._pending_logs)
+
+    @mock.patch.object(consolelogwriter.ConsoleLogArchiver, '_replace_log')
+    @mock.patch.object(consolelogwriter.ConsoleLogArchiver,
+                       '_write_compressed_log')
+    @mock.patch('os.path.exists')
+    def test_archive_pending_logs_compress_failed(self, mock_exists,
+                                                  mock_write_compressed_log,
+                                                  mock_replace_log):
+        self._archiver._pending_logs.append('pending_path.1')
+        mock_exists.side_effect = lambda path: path == 'pending_path.1'
+        mock_write_compressed_log.side_effect = IOError
+
+        self._archiver._archive_pending_logs()
+
+        self.assertFalse(mock_replace_log.called)
+        self.assertIsNone(self._archiver._compressing_log)
+        self.assertEqual(set(['pending_path.1']), self._archiver._failed_logs)
+
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_remove_if_compressed(self, mock_os):
+        mock_os.path.exists.return_value = True
+
+        self.assertTrue(
+            self._archiver._remove_if_compressed(self._FAKE_LOG_PATH))
+
+        mock_os.path.exists.assert_called_once_with('fake_log_path.gz')
+        mock_os.remove.assert_called_once_with(self._FAKE_LOG_PATH)
+
+    @mock.patch.object(consolelogwriter, 'shutil')
+    @mock.patch.object(consolelogwriter, 'gzip')
+    @mock.patch.object(builtins, 'open')
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_compress_log(self, mock_os, mock_open, mock_gzip, mock_shutil):
+        mock_src = mock_open.return_value.__enter__.return_value
+        mock_dest = mock_gzip.open.return_value
+        mock_os.path.exists.return_value = False
+
+        tmp_path = self._archiver._write_compressed_log(self._FAKE_LOG_PATH)
+        self._archiver._replace_log(self._FAKE_LOG_PATH, tmp_path)
+
+        mock_open.assert_called_once_with(self._FAKE_LOG_PATH, 'rb')
+        mock_gzip.open.assert_called_once_with(
+            'fake_log_path.gz.tmp', 'wb',
+            self._archiver._COMPRESS_LEVEL)
+        mock_shutil.copyfileobj.assert_called_once_with(mock_src, mock_dest)
+        mock_dest.close.assert_called_once_with()
+        # The archive is moved in place before removing the log.
+        self.assertEqual(
+            [mock.call.rename('fake_log_path.gz.tmp', 'fake_log_path.gz'),
+             mock.call.remove(self._FAKE_LOG_PATH)],
+            [call for call in mock_os.mock_calls
+             if call[0] in ('rename', 'remove')])
+
+    @mock.patch.object(consolelogwriter, 'gzip')
+    @mock.patch.object(builtins, 'open')
+    @mock.patch.object(consolelogwriter, 'os')
+    def test_compress_log_exception(self, mock_os, mock_open, mock_gzip):
+        mock_gzip.open.side_effect = IOError
+        mock_os.path.exists.return_value = True
+
+        self.assertRaises(IOError, self._archiver._write_compressed_log,
+                          self._FAKE_LOG_PATH)
+
+        mock_os.remove.assert_called_once_with('fake_log_path.gz.tmp')
+        self.assertFalse(mock_os.rename.called)
+
+    @mock.patch('os.remove')
+    @mock.patch('os.stat')
+    @mock.patch('os.listdir')
+    def test_enforce_disk_budget(self, mock_listdir, mock_stat, mock_remove):
+        self.flags(console_log_max_total_size=20, group='hyperv')
+        self._archiver._pathutils.get_instances_dir = mock.Mock(
+            return_value='instances')
+        mock_listdir.return_value = ['inst1', 'inst2']
+
+        log1 = os.path.join('instances', 'inst1', 'console.log')
+        log2 = os.path.join('instances', 'inst2', 'console.log')
+        files = {log1: (10, 10),
+                 log1 + '.1.gz': (5, 6),
+                 log1 + '.2.gz': (1, 6),
+                 log2: (20, 3),
+                 log2 + '.1.gz': (3, 6)}
+
+        def fake_stat(path):
+            if path not in files:
+                raise OSError(errno.ENOENT, '')
+            mtime, size = files[path]
+            return mock.Mock(st_mtime=mtime, st_size=size)
+
+        mock_stat.side_effect = fake_stat
+
+        self._archiver._enforce_disk_budget()
+
+        mock_remove.assert_has_calls([mock.call(log1 + '.2.gz'),
+                                      mock.call(log2 + '.1.gz')])
+        self.assertEqual(2, mock_remove.call_count)
+
+    @mock.patch('os.listdir')
+    def test_enforce_disk_budget_unlimited(self, mock_listdir):
+        self._archiver._enforce_disk_budget()
+
+        self.assertFalse(mock_listdir.called)
@@ -46,6 +46,9 @@ class HyperVDriverTestCase(test_base.HyperVBaseTestCase):
         self.driver._rdpconsoleops = mock.MagicMock()
         self.driver._serialconsoleops = mock.MagicMock()
         self.driver._imagecache = mock.MagicMock()
+        self.driver._imageprefetcher = mock.MagicMock()
+        self.driver._ephemeral_disk_pool = mock.MagicMock()
+        self.driver._vm_shell_pool = mock.MagicMock()
 
     @mock.patch.object(driver.hostutils.HostUtils, 'check_min_windows_version')
     def test_check_minimum_windows_version(self, mock_check_min_win_version):
@@ -72,6 +75,9 @@ class HyperVDriverTestCase(test_base.HyperVBaseTestCase):
             state_change_callback=self.driver.emit_event)
         fake_event_handler = mock_InstanceEventHandler.return_value
         fake_event_handler.start_listener.assert_called_once_with()
+        self.driver._imageprefetcher.start.assert_called_once_with()
+        self.driver._ephemeral_disk_pool.start.assert_called_once_with()
+        self.driver._vm_shell_pool.start.assert_called_once_with()
 
     def test_list_instance_uuids(self):
         self.driver.list_instance_uuids()
@@ -119,6 +125,18 @@ class HyperVDriverTestCase(test_base.HyperVBaseTestCase):
         self.driver._vmops.get_info.assert_called_once_with(
             mock.sentinel.instance)
 
+    @mock.patch.object(driver.jsonutils, 'dumps')
+    def test_get_instance_disk_info(self, mock_dumps):
+        mock_instance = mock.MagicMock()
+
+        disk_info = self.driver.get_instance_disk_info(mock_instance)
+
+        self.assertEqual(mock_dumps.return_value, disk_info)
+        self.driver._vmops.get_instance_disk_info.assert_called_once_with(
+            mock_instance.name)
+        mock_dumps.assert_called_once_with(
+            self.driver._vmops.get_instance_disk_info.return_value)
+
     def test_attach_volume(self):
         mock_instance = mock.MagicMock()
         self.driver.attach_volume(
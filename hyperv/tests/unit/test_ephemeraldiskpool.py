@@ -0,0 +1,194 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import os
+
+import mock
+from oslo_utils import units
+
+from hyperv.nova import ephemeraldiskpool
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class EphemeralDiskPoolTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V EphemeralDiskPool class."""
+
+    _FAKE_POOL_DIR = 'C:\\Instances\\_ephemeral_pool'
+    _FAKE_DEST_PATH = 'C:\\Instances\\fake_instance\\eph0.vhdx'
+
+    def setUp(self):
+        super(EphemeralDiskPoolTestCase, self).setUp()
+        self.flags(ephemeral_disk_pool_sizes=['10', '20'], group='hyperv')
+
+        self._pool = ephemeraldiskpool.EphemeralDiskPool()
+        self._pool._pathutils = mock.MagicMock()
+        self._pool._vhdutils = mock.MagicMock()
+        self._pool._pathutils.get_ephemeral_disk_pool_dir.return_value = (
+            self._FAKE_POOL_DIR)
+        self._pool._vhdutils.get_best_supported_vhd_format.return_value = (
+            'VHDX')
+
+        self._pool_files = []
+        listdir_patcher = mock.patch('os.listdir',
+                                     side_effect=self._fake_listdir)
+        listdir_patcher.start()
+        self.addCleanup(listdir_patcher.stop)
+
+        stats_patcher = mock.patch.object(ephemeraldiskpool, '_pool_stats',
+                                          collections.Counter())
+        stats_patcher.start()
+        self.addCleanup(stats_patcher.stop)
+
+    def _fake_listdir(self, path):
+        self.assertEqual(self._FAKE_POOL_DIR, path)
+        return list(self._pool_files)
+
+    def _get_pool_path(self, file_name):
+        return os.path.join(self._FAKE_POOL_DIR, file_name)
+
+    @mock.patch.object(ephemeraldiskpool, 'eventlet')
+    def test_start(self, mock_eventlet):
+        self._pool.start()
+
+        mock_eventlet.spawn_n.assert_called_once_with(
+            self._pool._refill_periodically)
+
+    @mock.patch.object(ephemeraldiskpool, 'eventlet')
+    def test_start_disabled(self, mock_eventlet):
+        self.flags(ephemeral_disk_pool_sizes=[], group='hyperv')
+
+        self._pool.start()
+
+        self.assertFalse(mock_eventlet.spawn_n.called)
+
+    def test_get_pool_sizes(self):
+        self.flags(ephemeral_disk_pool_sizes=['20', '10', '0', 'x', '20'],
+                   group='hyperv')
+
+        self.assertEqual([10, 20], self._pool._get_pool_sizes())
+
+    def test_claim_disk(self):
+        self._pool_files = ['eph_10gb_a.vhdx', 'eph_1gb_b.vhdx',
+                            'eph_10gb_c.vhd', 'tmp_d.vhdx']
+        mock_rename = self._pool._pathutils.rename
+
+        claimed = self._pool.claim_disk(10, 'VHDX', self._FAKE_DEST_PATH)
+
+        self.assertTrue(claimed)
+        mock_rename.assert_called_once_with(
+            self._get_pool_path('eph_10gb_a.vhdx'), self._FAKE_DEST_PATH)
+        self.assertEqual({'hits': 1}, ephemeraldiskpool._pool_stats)
+
+    def test_claim_disk_concurrently_claimed(self):
+        self._pool_files = ['eph_10gb_a.vhdx', 'eph_10gb_b.vhdx']
+        mock_rename = self._pool._pathutils.rename
+        mock_rename.side_effect = [OSError, None]
+
+        claimed = self._pool.claim_disk(10, 'VHDX', self._FAKE_DEST_PATH)
+
+        self.assertTrue(claimed)
+        mock_rename.assert_has_calls([
+            mock.call(self._get_pool_path('eph_10gb_a.vhdx'),
+                      self._FAKE_DEST_PATH),
+            mock.call(self._get_pool_path('eph_10gb_b.vhdx'),
+                      self._FAKE_DEST_PATH)])
+
+    def test_claim_disk_pool_empty(self):
+        self._pool_files = ['eph_20gb_a.vhdx', 'tmp_b.vhdx']
+
+        claimed = self._pool.claim_disk(10, 'VHDX', self._FAKE_DEST_PATH)
+
+        self.assertFalse(claimed)
+        self.assertFalse(self._pool._pathutils.rename.called)
+        self.assertEqual({'misses': 1}, ephemeraldiskpool._pool_stats)
+
+    def test_claim_disk_size_not_pooled(self):
+        claimed = self._pool.claim_disk(30, 'VHDX', self._FAKE_DEST_PATH)
+
+        self.assertFalse(claimed)
+        self.assertFalse(
+            self._pool._pathutils.get_ephemeral_disk_pool_dir.called)
+        self.assertEqual({}, ephemeraldiskpool._pool_stats)
+
+    @mock.patch.object(ephemeraldiskpool.EphemeralDiskPool, '_throttle')
+    @mock.patch.object(ephemeraldiskpool.EphemeralDiskPool, '_create_disk')
+    def test_refill(self, mock_create_disk, mock_throttle):
+        self.flags(ephemeral_disk_pool_depth=2, group='hyperv')
+        self._pool_files = ['eph_10gb_a.vhdx', 'eph_10gb_b.vhdx',
+                            'eph_20gb_c.vhdx', 'eph_30gb_d.vhdx',
+                            'eph_20gb_e.vhd', 'tmp_f.vhdx']
+
+        def fake_create_disk(pool_dir, size_gb, vhd_format):
+            self._pool_files.append('eph_%sgb_new.%s' % (size_gb,
+                                                         vhd_format.lower()))
+
+        mock_create_disk.side_effect = fake_create_disk
+        self._pool._pathutils.remove.side_effect = (
+            lambda path: self._pool_files.remove(os.path.basename(path)))
+
+        self._pool.refill()
+
+        self._pool._pathutils.remove.assert_has_calls(
+            [mock.call(self._get_pool_path(file_name))
+             for file_name in ('eph_20gb_e.vhd', 'eph_30gb_d.vhdx',
+                               'tmp_f.vhdx')],
+            any_order=True)
+        mock_create_disk.assert_called_once_with(self._FAKE_POOL_DIR, 20,
+                                                 'VHDX')
+        mock_throttle.assert_called_once_with()
+
+    @mock.patch.object(ephemeraldiskpool, 'uuidutils')
+    def test_create_disk(self, mock_uuidutils):
+        mock_uuidutils.generate_uuid.return_value = 'fake_id'
+
+        self._pool._create_disk(self._FAKE_POOL_DIR, 10, 'VHDX')
+
+        tmp_path = self._get_pool_path('tmp_fake_id.vhdx')
+        self._pool._vhdutils.create_dynamic_vhd.assert_called_once_with(
+            tmp_path, 10 * units.Gi, 'VHDX')
+        self._pool._pathutils.rename.assert_called_once_with(
+            tmp_path, self._get_pool_path('eph_10gb_fake_id.vhdx'))
+
+    @mock.patch.object(ephemeraldiskpool, 'uuidutils')
+    def test_create_disk_failed(self, mock_uuidutils):
+        mock_uuidutils.generate_uuid.return_value = 'fake_id'
+        self._pool._vhdutils.create_dynamic_vhd.side_effect = (
+            vmutils.HyperVException)
+        self._pool._pathutils.exists.return_value = True
+
+        self.assertRaises(vmutils.HyperVException, self._pool._create_disk,
+                          self._FAKE_POOL_DIR, 10, 'VHDX')
+
+        tmp_path = self._get_pool_path('tmp_fake_id.vhdx')
+        self._pool._pathutils.remove.assert_called_once_with(tmp_path)
+        self.assertFalse(self._pool._pathutils.rename.called)
+
+    def test_get_pool_stats(self):
+        self._pool_files = ['eph_10gb_a.vhdx', 'eph_20gb_b.vhdx', 'tmp_c.vhdx']
+        ephemeraldiskpool._pool_stats.update(hits=3, misses=1)
+
+        expected_stats = {'ephemeral_disk_pool_hits': 3,
+                          'ephemeral_disk_pool_misses': 1,
+                          'ephemeral_disk_pool_depth': 2}
+        self.assertEqual(expected_stats, self._pool.get_pool_stats())
+
+    def test_get_pool_stats_disabled(self):
+        self.flags(ephemeral_disk_pool_sizes=[], group='hyperv')
+
+        self.assertEqual({}, self._pool.get_pool_stats())
+        self.assertFalse(
+            self._pool._pathutils.get_ephemeral_disk_pool_dir.called)
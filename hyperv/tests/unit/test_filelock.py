@@ -0,0 +1,227 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+
+import mock
+
+from hyperv.nova import filelock
+from hyperv.tests.unit import test_base
+
+
+class FileLockTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_LOCK_PATH = 'fake_lock_path'
+    _FAKE_LEASE_TIMEOUT = 30
+
+    def setUp(self):
+        super(FileLockTestCase, self).setUp()
+        self.flags(host='fake_host')
+
+        self._lock = filelock.FileLock(self._FAKE_LOCK_PATH,
+                                       self._FAKE_LEASE_TIMEOUT)
+
+    @mock.patch.object(filelock, 'eventlet')
+    @mock.patch.object(filelock, 'time')
+    @mock.patch.object(filelock.FileLock, '_break_if_stale')
+    @mock.patch.object(filelock.FileLock, '_try_acquire')
+    def test_acquire(self, mock_try_acquire, mock_break_if_stale, mock_time,
+                     mock_eventlet):
+        mock_try_acquire.side_effect = [False, True]
+
+        self._lock.acquire()
+
+        mock_break_if_stale.assert_called_once_with()
+        mock_time.sleep.assert_called_once_with(
+            filelock.FileLock._RETRY_INTERVAL)
+        mock_eventlet.spawn.assert_called_once_with(self._lock._renew_lease)
+        self.assertEqual(mock_eventlet.spawn.return_value,
+                         self._lock._lease_renewer)
+
+    @mock.patch.object(filelock, 'open', create=True)
+    @mock.patch('os.remove')
+    def _test_release(self, mock_remove, mock_open, owner=None):
+        mock_lease_renewer = mock.Mock()
+        self._lock._lease_renewer = mock_lease_renewer
+        mock_file = mock_open.return_value.__enter__.return_value
+        mock_file.read.return_value = (owner or
+                                       self._lock._owner).encode('utf-8')
+
+        self._lock.release()
+
+        mock_lease_renewer.kill.assert_called_once_with()
+        self.assertIsNone(self._lock._lease_renewer)
+        mock_open.assert_called_once_with(self._FAKE_LOCK_PATH, 'rb')
+        if owner:
+            self.assertFalse(mock_remove.called)
+        else:
+            mock_remove.assert_called_once_with(self._FAKE_LOCK_PATH)
+
+    def test_release(self):
+        self._test_release()
+
+    def test_release_broken_lock(self):
+        # The lock was broken as stale and acquired by another host.
+        self._test_release(owner='other_host:1:fake_id')
+
+    @mock.patch.object(filelock, 'open', create=True)
+    @mock.patch('os.remove')
+    def test_release_missing_lock_file(self, mock_remove, mock_open):
+        mock_open.side_effect = IOError(errno.ENOENT, '')
+
+        self._lock.release()
+
+        self.assertFalse(mock_remove.called)
+
+    def test_owner_unique(self):
+        other_lock = filelock.FileLock(self._FAKE_LOCK_PATH,
+                                       self._FAKE_LEASE_TIMEOUT)
+
+        self.assertTrue(self._lock._owner.startswith('fake_host:'))
+        self.assertNotEqual(self._lock._owner, other_lock._owner)
+
+    @mock.patch.object(filelock.FileLock, 'release')
+    @mock.patch.object(filelock.FileLock, 'acquire')
+    def test_context_manager(self, mock_acquire, mock_release):
+        with self._lock:
+            mock_acquire.assert_called_once_with()
+            self.assertFalse(mock_release.called)
+
+        mock_release.assert_called_once_with()
+
+    @mock.patch('os.close')
+    @mock.patch('os.write')
+    @mock.patch('os.open')
+    def test_try_acquire(self, mock_open, mock_write, mock_close):
+        self.assertTrue(self._lock._try_acquire())
+
+        mock_open.assert_called_once_with(self._FAKE_LOCK_PATH, mock.ANY)
+        mock_write.assert_called_once_with(
+            mock_open.return_value, self._lock._owner.encode('utf-8'))
+        mock_close.assert_called_once_with(mock_open.return_value)
+
+    @mock.patch('os.open')
+    def test_try_acquire_locked(self, mock_open):
+        mock_open.side_effect = OSError(errno.EEXIST, '')
+
+        self.assertFalse(self._lock._try_acquire())
+
+    @mock.patch('os.open')
+    def test_try_acquire_exception(self, mock_open):
+        mock_open.side_effect = OSError(errno.ENOENT, '')
+
+        self.assertRaises(OSError, self._lock._try_acquire)
+
+    @mock.patch('os.path.getmtime')
+    @mock.patch.object(filelock, 'time')
+    def test_get_lease_age(self, mock_time, mock_getmtime):
+        mock_time.time.return_value = 1000
+        mock_getmtime.return_value = 990
+
+        lease_age = self._lock._get_lease_age(mock.sentinel.path)
+
+        self.assertEqual(10, lease_age)
+        mock_getmtime.assert_called_once_with(mock.sentinel.path)
+
+    @mock.patch.object(filelock.FileLock, '_restore_lock_file')
+    @mock.patch.object(filelock.FileLock, '_get_lease_age')
+    @mock.patch.object(filelock, 'uuidutils')
+    @mock.patch('os.remove')
+    @mock.patch('os.rename')
+    def _test_break_if_stale(self, mock_rename, mock_remove, mock_uuidutils,
+                             mock_get_lease_age, mock_restore_lock_file,
+                             lease_ages, rename_side_effect=None):
+        mock_uuidutils.generate_uuid.return_value = 'fake_id'
+        mock_get_lease_age.side_effect = lease_ages
+        mock_rename.side_effect = rename_side_effect
+        stale_path = self._FAKE_LOCK_PATH + '.fake_id'
+
+        self._lock._break_if_stale()
+
+        mock_get_lease_age.assert_has_calls(
+            [mock.call(self._FAKE_LOCK_PATH), mock.call(stale_path)][
+                :len(lease_ages)])
+        lock_expired = lease_ages[0] > self._FAKE_LEASE_TIMEOUT
+        if lock_expired:
+            mock_rename.assert_called_once_with(self._FAKE_LOCK_PATH,
+                                                stale_path)
+        else:
+            self.assertFalse(mock_rename.called)
+
+        stale_lock_moved = lock_expired and not rename_side_effect
+        if stale_lock_moved and lease_ages[1] > self._FAKE_LEASE_TIMEOUT:
+            mock_remove.assert_called_once_with(stale_path)
+        else:
+            self.assertFalse(mock_remove.called)
+
+        if stale_lock_moved and lease_ages[1] <= self._FAKE_LEASE_TIMEOUT:
+            mock_restore_lock_file.assert_called_once_with(stale_path)
+        else:
+            self.assertFalse(mock_restore_lock_file.called)
+
+    def test_break_if_stale(self):
+        self._test_break_if_stale(
+            lease_ages=[self._FAKE_LEASE_TIMEOUT + 1] * 2)
+
+    def test_break_if_stale_valid_lease(self):
+        self._test_break_if_stale(lease_ages=[self._FAKE_LEASE_TIMEOUT - 1])
+
+    @mock.patch.object(filelock.FileLock, '_get_lease_age')
+    @mock.patch('os.rename')
+    def test_break_if_stale_released(self, mock_rename, mock_get_lease_age):
+        mock_get_lease_age.side_effect = OSError
+
+        self._lock._break_if_stale()
+
+        self.assertFalse(mock_rename.called)
+
+    def test_break_if_stale_broken_by_other_host(self):
+        self._test_break_if_stale(lease_ages=[self._FAKE_LEASE_TIMEOUT + 1],
+                                  rename_side_effect=OSError)
+
+    def test_break_if_stale_reacquired(self):
+        # The lock was acquired again by another host after its lease was
+        # checked, the lock file being restored.
+        self._test_break_if_stale(
+            lease_ages=[self._FAKE_LEASE_TIMEOUT + 1,
+                        self._FAKE_LEASE_TIMEOUT - 1])
+
+    @mock.patch('os.rename')
+    def test_restore_lock_file(self, mock_rename):
+        self._lock._restore_lock_file(mock.sentinel.stale_path)
+
+        mock_rename.assert_called_once_with(mock.sentinel.stale_path,
+                                            self._FAKE_LOCK_PATH)
+
+    @mock.patch.object(filelock, 'LOG')
+    @mock.patch('os.rename')
+    def test_restore_lock_file_failed(self, mock_rename, mock_log):
+        mock_rename.side_effect = OSError
+
+        self._lock._restore_lock_file(mock.sentinel.stale_path)
+
+        self.assertTrue(mock_log.error.called)
+
+    @mock.patch('os.utime')
+    @mock.patch.object(filelock, 'time')
+    def test_renew_lease(self, mock_time, mock_utime):
+        mock_time.sleep.side_effect = [None, None, StopIteration]
+        mock_utime.side_effect = [OSError, None]
+
+        self.assertRaises(StopIteration, self._lock._renew_lease)
+
+        mock_time.sleep.assert_has_calls(
+            [mock.call(self._FAKE_LEASE_TIMEOUT / 3.0)] * 3)
+        mock_utime.assert_has_calls(
+            [mock.call(self._FAKE_LOCK_PATH, None)] * 2)
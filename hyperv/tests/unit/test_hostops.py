@@ -26,6 +26,7 @@ import six
 
 from hyperv.nova import constants
 from hyperv.nova import hostops
+from hyperv.nova import vmutils
 from hyperv.tests.unit import test_base
 
 CONF = cfg.CONF
@@ -47,6 +48,9 @@ class HostOpsTestCase(test_base.HyperVBaseTestCase):
         self._hostops = hostops.HostOps()
         self._hostops._api = mock.MagicMock()
         self._hostops._vmops = mock.MagicMock()
+        self._hostops._imagecache = mock.MagicMock()
+        self._hostops._ephemeral_disk_pool = mock.MagicMock()
+        self._hostops._vm_shell_pool = mock.MagicMock()
 
     def test_get_cpu_info(self):
         mock_processors = mock.MagicMock()
@@ -93,6 +97,39 @@ class HostOpsTestCase(test_base.HyperVBaseTestCase):
         self._hostops._hostutils.get_memory_info.assert_called_once_with()
         self.assertEqual((2, 1, 1), response)
 
+    def test_get_disk_over_committed_size_gb(self):
+        mock_vmops = self._hostops._vmops
+        mock_vmops.list_instances.return_value = [
+            mock.sentinel.instance1, mock.sentinel.instance2,
+            mock.sentinel.instance3, mock.sentinel.instance4]
+        mock_get_over_committed_size = (
+            mock_vmops.get_instance_over_committed_disk_size)
+        # The disks of the second and third instances cannot be listed,
+        # as the instances were removed meanwhile.
+        mock_get_over_committed_size.side_effect = [
+            3 * units.Gi, exception.InstanceNotFound(instance_id='fake'),
+            vmutils.HyperVException, units.Gi + 1]
+
+        over_committed_size_gb = (
+            self._hostops._get_disk_over_committed_size_gb())
+
+        self.assertEqual(4, over_committed_size_gb)
+        self.assertFalse(mock_vmops.get_instance_disk_info.called)
+        mock_get_over_committed_size.assert_has_calls(
+            [mock.call(mock.sentinel.instance1),
+             mock.call(mock.sentinel.instance2),
+             mock.call(mock.sentinel.instance3),
+             mock.call(mock.sentinel.instance4)])
+
+    def test_get_disk_over_committed_size_gb_unexpected_error(self):
+        mock_vmops = self._hostops._vmops
+        mock_vmops.list_instances.return_value = [mock.sentinel.instance]
+        mock_vmops.get_instance_over_committed_disk_size.side_effect = (
+            KeyError)
+
+        self.assertRaises(KeyError,
+                          self._hostops._get_disk_over_committed_size_gb)
+
     def test_get_local_hdd_info_gb(self):
         self._hostops._pathutils.get_instances_dir.return_value = ''
         self._hostops._hostutils.get_volume_info.return_value = (2 * units.Gi,
@@ -135,16 +172,19 @@ class HostOpsTestCase(test_base.HyperVBaseTestCase):
     @mock.patch.object(hostops.HostOps, '_get_cpu_info')
     @mock.patch.object(hostops.HostOps, '_get_memory_info')
     @mock.patch.object(hostops.HostOps, '_get_hypervisor_version')
+    @mock.patch.object(hostops.HostOps, '_get_disk_over_committed_size_gb')
     @mock.patch.object(hostops.HostOps, '_get_local_hdd_info_gb')
     @mock.patch('platform.node')
     def test_get_available_resource(self, mock_node,
                                     mock_get_local_hdd_info_gb,
+                                    mock_get_over_committed_size_gb,
                                     mock_get_hypervisor_version,
                                     mock_get_memory_info, mock_get_cpu_info,
                                     mock_get_gpu_info, mock_get_numa_topology):
         mock_get_local_hdd_info_gb.return_value = (mock.sentinel.LOCAL_GB,
-                                                   mock.sentinel.LOCAL_GB_FREE,
+                                                   10,
                                                    mock.sentinel.LOCAL_GB_USED)
+        mock_get_over_committed_size_gb.return_value = 4
         mock_get_memory_info.return_value = (mock.sentinel.MEMORY_MB,
                                              mock.sentinel.MEMORY_MB_FREE,
                                              mock.sentinel.MEMORY_MB_USED)
@@ -160,6 +200,13 @@ class HostOpsTestCase(test_base.HyperVBaseTestCase):
         self._hostops._hostutils.get_supported_vm_types.return_value = [
             constants.IMAGE_PROP_VM_GEN_1]
 
+        self._hostops._imagecache.get_cache_stats.return_value = {
+            'image_cache_hits': mock.sentinel.image_cache_hits}
+        self._hostops._ephemeral_disk_pool.get_pool_stats.return_value = {
+            'ephemeral_disk_pool_hits': mock.sentinel.pool_hits}
+        self._hostops._vm_shell_pool.get_pool_stats.return_value = {
+            'vm_shell_pool_hits': mock.sentinel.vm_shell_pool_hits}
+
         response = self._hostops.get_available_resource()
 
         mock_get_memory_info.assert_called_once_with()
@@ -174,13 +221,22 @@ class HostOpsTestCase(test_base.HyperVBaseTestCase):
                     'memory_mb_used': mock.sentinel.MEMORY_MB_USED,
                     'local_gb': mock.sentinel.LOCAL_GB,
                     'local_gb_used': mock.sentinel.LOCAL_GB_USED,
+                    'disk_available_least': 6,
                     'vcpus': self.FAKE_NUM_CPUS,
                     'vcpus_used': 0,
                     'hypervisor_type': 'hyperv',
                     'numa_topology': mock.sentinel.numa_topology_json,
                     'remotefx_available_video_ram': 2048,
                     'remotefx_gpu_info': mock.sentinel.FAKE_GPU_INFO,
-                    'remotefx_total_video_ram': 4096
+                    'remotefx_total_video_ram': 4096,
+                    'stats': {
+                        'image_cache_size_bytes': (
+                            self._hostops._imagecache.get_cache_size
+                            .return_value),
+                        'image_cache_hits': mock.sentinel.image_cache_hits,
+                        'ephemeral_disk_pool_hits': mock.sentinel.pool_hits,
+                        'vm_shell_pool_hits': (
+                            mock.sentinel.vm_shell_pool_hits)},
                     }
         self.assertEqual(expected, response)
 
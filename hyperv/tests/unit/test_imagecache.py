@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
 import os
 
 import mock
@@ -24,6 +25,7 @@ from oslo_utils import units
 
 from hyperv.nova import constants
 from hyperv.nova import imagecache
+from hyperv.nova import vmutils
 from hyperv.tests import fake_instance
 from hyperv.tests.unit import test_base
 
@@ -46,7 +48,136 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
 
         self.imagecache = imagecache.ImageCache()
         self.imagecache._pathutils = mock.MagicMock()
+        self.imagecache._pathutils.is_base_vhd_dir_shared.return_value = False
         self.imagecache._vhdutils = mock.MagicMock()
+        self.imagecache._fetcher = mock.MagicMock()
+        self._mock_index = mock.MagicMock()
+        self.imagecache._get_index = mock.Mock(return_value=self._mock_index)
+
+    @mock.patch.object(imagecache.imagecacheindex, 'get_image_cache_index')
+    def _test_get_index(self, mock_get_image_cache_index, shared=False):
+        self.flags(host='fake_host')
+        imgcache = imagecache.ImageCache()
+        imgcache._pathutils = mock.MagicMock()
+        imgcache._pathutils.is_base_vhd_dir_shared.return_value = shared
+
+        index = imgcache._get_index()
+
+        self.assertEqual(mock_get_image_cache_index.return_value, index)
+        expected_index_file_name = (
+            'imagecache-fake_host.idx' if shared
+            else imagecache.imagecacheindex.INDEX_FILE_NAME)
+        mock_get_image_cache_index.assert_called_once_with(
+            imgcache._pathutils.get_base_vhd_dir.return_value,
+            expected_index_file_name)
+
+    def test_get_index(self):
+        self._test_get_index()
+
+    def test_get_index_shared(self):
+        self._test_get_index(shared=True)
+
+    @mock.patch.object(imagecache.filelock, 'FileLock')
+    @mock.patch.object(imagecache.utils, 'synchronized')
+    def _test_synchronized(self, mock_synchronized, mock_file_lock,
+                           shared=False):
+        mock_synchronized.return_value = lambda f: f
+        self.imagecache._pathutils.is_base_vhd_dir_shared.return_value = (
+            shared)
+        mock_func = mock.Mock()
+
+        ret = self.imagecache._synchronized(mock.sentinel.path)(mock_func)(
+            mock.sentinel.arg)
+
+        self.assertEqual(mock_func.return_value, ret)
+        mock_func.assert_called_once_with(mock.sentinel.arg)
+        mock_synchronized.assert_called_once_with(mock.sentinel.path)
+        return mock_file_lock
+
+    def test_synchronized(self):
+        mock_file_lock = self._test_synchronized()
+        self.assertFalse(mock_file_lock.called)
+
+    @mock.patch.object(imagecache, 'filelock')
+    def test_synchronized_shared(self, mock_filelock):
+        self.flags(shared_image_cache_lock_timeout=60, group='hyperv')
+        mock_filelock.LOCK_FILE_EXT = '.lock'
+        self.imagecache._pathutils.is_base_vhd_dir_shared.return_value = True
+        mock_func = mock.Mock()
+
+        ret = self.imagecache._synchronized('fake_path')(mock_func)()
+
+        self.assertEqual(mock_func.return_value, ret)
+        mock_filelock.FileLock.assert_called_once_with('fake_path.lock', 60)
+        mock_lock = mock_filelock.FileLock.return_value
+        mock_lock.__enter__.assert_called_once_with()
+        mock_lock.__exit__.assert_called_once_with(None, None, None)
+
+    def test_get_image_id(self):
+        self.assertEqual(
+            'fake-image-id',
+            self.imagecache._get_image_id(
+                os.path.join(self.FAKE_BASE_DIR, 'fake-image-id_5.vhdx')))
+
+    @mock.patch('os.utime')
+    @mock.patch.object(imagecache, 'open', create=True)
+    def test_renew_image_leases(self, mock_open, mock_utime):
+        self.flags(host='fake_host')
+        self.imagecache._pathutils.get_base_vhd_dir.return_value = (
+            self.FAKE_BASE_DIR)
+        self.imagecache._pathutils.exists.return_value = False
+        mock_utime.side_effect = [OSError, None]
+
+        self.imagecache._renew_image_leases(['img1', 'img2'])
+
+        lease_dirs = [os.path.join(self.FAKE_BASE_DIR, '.leases', img)
+                      for img in ('img1', 'img2')]
+        lease_paths = [os.path.join(lease_dir, 'fake_host')
+                       for lease_dir in lease_dirs]
+        self.imagecache._pathutils.makedirs.assert_has_calls(
+            [mock.call(lease_dir) for lease_dir in lease_dirs])
+        mock_open.assert_has_calls(
+            [mock.call(lease_path, 'a') for lease_path in lease_paths],
+            any_order=True)
+        mock_utime.assert_has_calls(
+            [mock.call(lease_path, None) for lease_path in lease_paths])
+
+    @mock.patch.object(imagecache, 'time')
+    @mock.patch('os.path.getmtime')
+    @mock.patch('os.listdir')
+    def _test_is_image_leased_by_peers(self, mock_listdir, mock_getmtime,
+                                       mock_time, shared=True,
+                                       peer_lease_age=0):
+        self.flags(host='fake_host')
+        self.flags(remove_unused_original_minimum_age_seconds=3000)
+        self.imagecache._pathutils.is_base_vhd_dir_shared.return_value = (
+            shared)
+        self.imagecache._pathutils.get_base_vhd_dir.return_value = (
+            self.FAKE_BASE_DIR)
+        mock_listdir.return_value = ['fake_host', 'missing_host',
+                                     'peer_host']
+        mock_time.time.return_value = 10000
+        mock_getmtime.side_effect = [OSError, 10000 - peer_lease_age]
+
+        ret = self.imagecache._is_image_leased_by_peers('fake_image')
+
+        if shared:
+            mock_listdir.assert_called_once_with(
+                os.path.join(self.FAKE_BASE_DIR, '.leases', 'fake_image'))
+        else:
+            self.assertFalse(mock_listdir.called)
+        return ret
+
+    def test_is_image_leased_by_peers(self):
+        self.assertTrue(
+            self._test_is_image_leased_by_peers(peer_lease_age=100))
+
+    def test_is_image_leased_by_peers_expired(self):
+        self.assertFalse(
+            self._test_is_image_leased_by_peers(peer_lease_age=3600))
+
+    def test_is_image_leased_by_peers_not_shared(self):
+        self.assertFalse(self._test_is_image_leased_by_peers(shared=False))
 
     @mock.patch.object(imagecache.ImageCache, '_get_root_vhd_size_gb')
     def test_resize_and_cache_vhd_smaller(self, mock_get_vhd_size_gb):
@@ -69,6 +200,80 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
         mock_internal_vhd_size.assert_called_once_with(
             mock.sentinel.vhd_path, self.FAKE_VHD_SIZE_GB * units.Gi)
 
+    @mock.patch('os.path.getsize')
+    @mock.patch.object(imagecache.ImageCache, '_get_root_vhd_size_gb')
+    def test_resize_and_cache_vhd(self, mock_get_vhd_size_gb, mock_getsize):
+        fake_vhd_path = os.path.join(self.FAKE_BASE_DIR, 'fake_image.vhd')
+        expected_resized_path = os.path.join(self.FAKE_BASE_DIR,
+                                             'fake_image_2.vhd')
+        self.imagecache._vhdutils.get_vhd_info.return_value = {
+            'MaxInternalSize': self.FAKE_VHD_SIZE_GB * units.Gi}
+        mock_get_vhd_size_gb.return_value = 2
+        mock_internal_vhd_size = (
+            self.imagecache._vhdutils.get_internal_vhd_size_by_file_size)
+        mock_internal_vhd_size.return_value = 2 * units.Gi
+        self.imagecache._pathutils.exists.return_value = False
+
+        resized_path = self.imagecache._resize_and_cache_vhd(
+            mock.sentinel.instance, fake_vhd_path)
+
+        self.assertEqual(expected_resized_path, resized_path)
+        self.imagecache._pathutils.copyfile.assert_called_once_with(
+            fake_vhd_path, expected_resized_path)
+        self.imagecache._vhdutils.resize_vhd.assert_called_once_with(
+            expected_resized_path, 2 * units.Gi, is_file_max_size=False)
+        mock_getsize.assert_called_once_with(expected_resized_path)
+        self._mock_index.add_resized_image.assert_called_once_with(
+            'fake_image', 2, mock_getsize.return_value)
+
+    @mock.patch.object(imagecache.ImageCache, '_record_cache_access')
+    @mock.patch.object(imagecache.ImageCache, 'cache_resized_vhd')
+    @mock.patch.object(imagecache.ImageCache, '_get_root_vhd_size_gb')
+    def test_resize_and_cache_vhd_cached(self, mock_get_vhd_size_gb,
+                                         mock_cache_resized_vhd,
+                                         mock_record_cache_access):
+        mock_cache_resized_vhd.return_value = (mock.sentinel.resized_path,
+                                               True)
+
+        resized_path = self.imagecache._resize_and_cache_vhd(
+            mock.sentinel.instance, mock.sentinel.vhd_path)
+
+        self.assertEqual(mock.sentinel.resized_path, resized_path)
+        mock_get_vhd_size_gb.assert_called_once_with(mock.sentinel.instance)
+        mock_cache_resized_vhd.assert_called_once_with(
+            mock.sentinel.vhd_path, mock_get_vhd_size_gb.return_value)
+        mock_record_cache_access.assert_called_once_with('resize', True)
+
+    def test_cache_resized_vhd_existing(self):
+        fake_vhd_path = os.path.join(self.FAKE_BASE_DIR, 'fake_image.vhd')
+        self.imagecache._vhdutils.get_vhd_info.return_value = {
+            'MaxInternalSize': self.FAKE_VHD_SIZE_GB * units.Gi}
+        mock_internal_vhd_size = (
+            self.imagecache._vhdutils.get_internal_vhd_size_by_file_size)
+        mock_internal_vhd_size.return_value = 2 * units.Gi
+        self.imagecache._pathutils.exists.return_value = True
+
+        resized_path, cached = self.imagecache.cache_resized_vhd(
+            fake_vhd_path, 2)
+
+        self.assertEqual(os.path.join(self.FAKE_BASE_DIR, 'fake_image_2.vhd'),
+                         resized_path)
+        self.assertTrue(cached)
+        self.assertFalse(self.imagecache._pathutils.copyfile.called)
+
+    def test_cache_resized_vhd_same_size(self):
+        self.imagecache._vhdutils.get_vhd_info.return_value = {
+            'MaxInternalSize': self.FAKE_VHD_SIZE_GB * units.Gi}
+        mock_internal_vhd_size = (
+            self.imagecache._vhdutils.get_internal_vhd_size_by_file_size)
+        mock_internal_vhd_size.return_value = self.FAKE_VHD_SIZE_GB * units.Gi
+
+        resized_path, cached = self.imagecache.cache_resized_vhd(
+            mock.sentinel.vhd_path, self.FAKE_VHD_SIZE_GB)
+
+        self.assertIsNone(resized_path)
+        self.assertTrue(cached)
+
     def _test_get_root_vhd_size_gb(self, old_flavor=True):
         if old_flavor:
             mock_flavor = objects.Flavor(**test_flavor.fake_flavor)
@@ -93,8 +298,10 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
         self.imagecache._pathutils.get_base_vhd_dir.return_value = (
             self.FAKE_BASE_DIR)
         self.imagecache._pathutils.exists.return_value = path_exists
-        self.imagecache._vhdutils.get_vhd_format.return_value = (
+        self.imagecache._fetcher.fetch.return_value = (
             constants.DISK_FORMAT_VHD)
+        self.imagecache._fetcher.get_image_meta.return_value = {
+            'properties': {}}
 
         CONF.set_override('use_cow_images', use_cow)
 
@@ -103,35 +310,40 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
                                      image_file_name)
         expected_vhd_path = "%s.%s" % (expected_path,
                                        constants.DISK_FORMAT_VHD.lower())
+        self._mock_index.get_image_path.return_value = (
+            expected_vhd_path if path_exists else None)
         return (expected_path, expected_vhd_path)
 
-    @mock.patch.object(imagecache.images, 'fetch')
-    def test_get_cached_image_with_fetch(self, mock_fetch):
+    @mock.patch('os.path.getsize')
+    def test_get_cached_image_with_fetch(self, mock_getsize):
         (expected_path,
          expected_image_path) = self._prepare_get_cached_image(False, False)
 
         result = self.imagecache.get_cached_image(self.context, self.instance)
         self.assertEqual(expected_image_path, result)
 
-        mock_fetch.assert_called_once_with(self.context, self.FAKE_IMAGE_REF,
-                                           expected_path,
-                                           self.instance['user_id'],
-                                           self.instance['project_id'])
-        self.imagecache._vhdutils.get_vhd_format.assert_called_once_with(
-            expected_path)
+        self._mock_index.get_image_path.assert_called_once_with(
+            self.FAKE_IMAGE_REF)
+        self.assertFalse(self.imagecache._pathutils.exists.called)
+        mock_getsize.assert_called_once_with(expected_image_path)
+        self._mock_index.add_image.assert_called_once_with(
+            self.FAKE_IMAGE_REF, constants.DISK_FORMAT_VHD,
+            mock_getsize.return_value)
+
+        self.imagecache._fetcher.fetch.assert_called_once_with(
+            self.context, self.FAKE_IMAGE_REF, expected_path,
+            image_meta=self.imagecache._fetcher.get_image_meta.return_value)
         self.imagecache._pathutils.rename.assert_called_once_with(
             expected_path, expected_image_path)
 
-    @mock.patch.object(imagecache.images, 'fetch')
-    def test_get_cached_image_with_fetch_exception(self, mock_fetch):
+    def test_get_cached_image_with_fetch_exception(self):
         (expected_path,
          expected_image_path) = self._prepare_get_cached_image(False, False)
 
-        # path doesn't exist until fetched.
-        self.imagecache._pathutils.exists.side_effect = [False, False, False,
-            True]
-        mock_fetch.side_effect = exception.InvalidImageRef(
-            image_href=self.FAKE_IMAGE_REF)
+        # The partially fetched image is removed.
+        self.imagecache._pathutils.exists.return_value = True
+        self.imagecache._fetcher.fetch.side_effect = (
+            exception.InvalidImageRef(image_href=self.FAKE_IMAGE_REF))
 
         self.assertRaises(exception.InvalidImageRef,
                           self.imagecache.get_cached_image,
@@ -140,6 +352,20 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
         self.imagecache._pathutils.remove.assert_called_once_with(
             expected_path)
 
+    def test_get_cached_image_unsupported_format(self):
+        (expected_path,
+         expected_image_path) = self._prepare_get_cached_image(False, False)
+        self.imagecache._fetcher.fetch.return_value = None
+        self.imagecache._pathutils.exists.return_value = True
+
+        self.assertRaises(vmutils.HyperVException,
+                          self.imagecache.get_cached_image,
+                          self.context, self.instance)
+
+        self.imagecache._pathutils.remove.assert_called_once_with(
+            expected_path)
+        self.assertFalse(self._mock_index.add_image.called)
+
     @mock.patch.object(imagecache.ImageCache, '_resize_and_cache_vhd')
     @mock.patch.object(imagecache.ImageCache, '_update_image_timestamp')
     def test_get_cached_image_use_cow(self, mock_update_img_timestamp,
@@ -156,9 +382,193 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
         mock_resize.assert_called_once_with(self.instance, expected_image_path)
         mock_update_img_timestamp.assert_called_once_with(
             self.instance.image_ref)
+        self.imagecache._pathutils.exists.assert_called_once_with(
+            expected_image_path)
+
+    @mock.patch('os.path.getsize')
+    @mock.patch.object(imagecache.filelock, 'FileLock', mock.MagicMock())
+    @mock.patch.object(imagecache.ImageCache, '_renew_image_leases')
+    def test_get_cached_image_shared(self, mock_renew_image_leases,
+                                     mock_getsize):
+        (expected_path,
+         expected_image_path) = self._prepare_get_cached_image(False, False)
+        self.imagecache._pathutils.is_base_vhd_dir_shared.return_value = True
+        mock_lookup = self.imagecache._pathutils.lookup_image_basepath
+        mock_lookup.return_value = expected_image_path
 
-    @mock.patch.object(imagecache.images, 'fetch')
-    def test_cache_rescue_image_bigger_than_flavor(self, mock_fetch):
+        result = self.imagecache.get_cached_image(self.context, self.instance)
+
+        self.assertEqual(expected_image_path, result)
+        mock_lookup.assert_called_once_with(self.FAKE_IMAGE_REF)
+        mock_getsize.assert_called_once_with(expected_image_path)
+        self._mock_index.add_image.assert_called_once_with(
+            self.FAKE_IMAGE_REF, constants.DISK_FORMAT_VHD.lower(),
+            mock_getsize.return_value)
+        mock_renew_image_leases.assert_called_once_with(
+            [self.FAKE_IMAGE_REF])
+        self.assertFalse(self.imagecache._fetcher.fetch.called)
+
+    @mock.patch('os.path.getsize')
+    def test_cache_image_detected_iso(self, mock_getsize):
+        (expected_path,
+         expected_image_path) = self._prepare_get_cached_image(False, False)
+        self.imagecache._fetcher.fetch.return_value = constants.DVD_FORMAT
+
+        image_path, cached = self.imagecache.cache_image(
+            self.context, self.FAKE_IMAGE_REF)
+
+        self.assertEqual(expected_path + '.iso', image_path)
+        self.assertFalse(cached)
+        self._mock_index.add_image.assert_called_once_with(
+            self.FAKE_IMAGE_REF, 'iso', mock_getsize.return_value)
+
+    @mock.patch('os.path.getsize')
+    @mock.patch.object(imagecache.ImageCache, '_rebuild_incremental_image')
+    def test_cache_image_incremental(self, mock_rebuild, mock_getsize):
+        (expected_path,
+         expected_image_path) = self._prepare_get_cached_image(False, False)
+        image_props = {
+            constants.IMAGE_PROP_PARENT_IMAGE_ID: mock.sentinel.parent_id}
+        self.imagecache._fetcher.get_image_meta.return_value = {
+            'properties': image_props}
+
+        image_path, cached = self.imagecache.cache_image(
+            self.context, self.FAKE_IMAGE_REF)
+
+        self.assertEqual(expected_image_path, image_path)
+        self.assertFalse(cached)
+        mock_rebuild.assert_called_once_with(
+            self.context, self.FAKE_IMAGE_REF, image_props, expected_path,
+            expected_image_path)
+        self.assertFalse(self.imagecache._pathutils.rename.called)
+        self._mock_index.add_image.assert_called_once_with(
+            self.FAKE_IMAGE_REF, constants.DISK_FORMAT_VHD,
+            mock_getsize.return_value)
+
+    @mock.patch.object(imagecache.ImageCache, 'cache_resized_vhd')
+    @mock.patch.object(imagecache.ImageCache, 'cache_image')
+    def _test_rebuild_incremental_image(self, mock_cache_image,
+                                        mock_cache_resized_vhd,
+                                        native_merge=True, root_gb=None,
+                                        merge_exc=None):
+        fake_diff_path = os.path.join(self.FAKE_BASE_DIR, 'fake_snapshot')
+        fake_image_path = fake_diff_path + '.vhd'
+        expected_diff_vhd_path = fake_diff_path + '.diff.vhd'
+        fake_parent_path = os.path.join(self.FAKE_BASE_DIR, 'fake_id.vhd')
+        mock_cache_image.return_value = (fake_parent_path, True)
+        mock_cache_resized_vhd.return_value = (mock.sentinel.resized_path,
+                                               False)
+        image_props = {constants.IMAGE_PROP_PARENT_IMAGE_ID: 'fake_id'}
+        if root_gb:
+            image_props[constants.IMAGE_PROP_PARENT_ROOT_GB] = root_gb
+        expected_parent_path = (mock.sentinel.resized_path if root_gb
+                                else fake_parent_path)
+        mock_vhdutils = self.imagecache._vhdutils
+        mock_vhdutils.merge_vhd_chain.return_value = native_merge
+        mock_vhdutils.merge_vhd_chain.side_effect = merge_exc
+        self.imagecache._pathutils.exists.return_value = True
+
+        if merge_exc:
+            self.assertRaises(merge_exc,
+                              self.imagecache._rebuild_incremental_image,
+                              self.context, mock.sentinel.image_id,
+                              image_props, fake_diff_path, fake_image_path)
+            self.imagecache._pathutils.remove.assert_has_calls(
+                [mock.call(fake_image_path),
+                 mock.call(expected_diff_vhd_path)])
+            return
+
+        self.imagecache._rebuild_incremental_image(
+            self.context, mock.sentinel.image_id, image_props,
+            fake_diff_path, fake_image_path)
+
+        mock_cache_image.assert_called_once_with(self.context, 'fake_id')
+        if root_gb:
+            mock_cache_resized_vhd.assert_called_once_with(
+                fake_parent_path, int(root_gb))
+        else:
+            self.assertFalse(mock_cache_resized_vhd.called)
+        self.imagecache._pathutils.rename.assert_called_once_with(
+            fake_diff_path, expected_diff_vhd_path)
+        mock_vhdutils.merge_vhd_chain.assert_called_once_with(
+            expected_diff_vhd_path, fake_image_path)
+
+        expected_reconnect_calls = [
+            mock.call(expected_diff_vhd_path, expected_parent_path)]
+        if native_merge:
+            self.assertFalse(self.imagecache._pathutils.copyfile.called)
+            self.assertFalse(mock_vhdutils.merge_vhd.called)
+        else:
+            self.imagecache._pathutils.copyfile.assert_called_once_with(
+                expected_parent_path, fake_image_path)
+            expected_reconnect_calls.append(
+                mock.call(expected_diff_vhd_path, fake_image_path))
+            mock_vhdutils.merge_vhd.assert_called_once_with(
+                expected_diff_vhd_path, fake_image_path)
+        mock_vhdutils.reconnect_parent_vhd.assert_has_calls(
+            expected_reconnect_calls)
+        self.imagecache._pathutils.remove.assert_called_once_with(
+            expected_diff_vhd_path)
+
+    def test_rebuild_incremental_image(self):
+        self._test_rebuild_incremental_image()
+
+    def test_rebuild_incremental_image_resized_parent(self):
+        self._test_rebuild_incremental_image(root_gb='10')
+
+    def test_rebuild_incremental_image_wmi_merge(self):
+        self._test_rebuild_incremental_image(native_merge=False)
+
+    def test_rebuild_incremental_image_failed(self):
+        self._test_rebuild_incremental_image(
+            merge_exc=vmutils.HyperVException)
+
+    @mock.patch.object(imagecache, '_cache_stats', collections.Counter())
+    def test_get_cache_stats(self):
+        self.imagecache._record_cache_access('image', True)
+        self.imagecache._record_cache_access('image', False)
+        self.imagecache._record_cache_access('image', True)
+        self.imagecache._record_cache_access('resize', False)
+
+        expected_stats = {'image_cache_hits': 2,
+                          'image_cache_misses': 1,
+                          'image_cache_resize_hits': 0,
+                          'image_cache_resize_misses': 1}
+        self.assertEqual(expected_stats, self.imagecache.get_cache_stats())
+
+    def test_list_recently_used_images(self):
+        images = {'old': {'format': 'vhd', 'last_used': 1},
+                  'recent': {'format': 'vhd', 'last_used': 3},
+                  'resized_only': {'format': None, 'last_used': 4},
+                  'older': {'format': 'vhdx', 'last_used': 0},
+                  'removed': None}
+        self._mock_index.list_images.return_value = list(images)
+        self._mock_index.get_image.side_effect = images.get
+
+        ret = self.imagecache.list_recently_used_images(2)
+
+        self.assertEqual(['recent', 'old'], ret)
+
+    @mock.patch('os.path.getsize')
+    def test_get_cached_image_removed(self, mock_getsize):
+        (expected_path,
+         expected_image_path) = self._prepare_get_cached_image(True, False)
+        self.imagecache._pathutils.exists.return_value = False
+
+        result = self.imagecache.get_cached_image(self.context, self.instance)
+
+        self.assertEqual(expected_image_path, result)
+        self._mock_index.remove_image_file.assert_called_once_with(
+            expected_image_path)
+        self.imagecache._fetcher.fetch.assert_called_once_with(
+            self.context, self.FAKE_IMAGE_REF, expected_path,
+            image_meta=self.imagecache._fetcher.get_image_meta.return_value)
+        self._mock_index.add_image.assert_called_once_with(
+            self.FAKE_IMAGE_REF, constants.DISK_FORMAT_VHD,
+            mock_getsize.return_value)
+
+    @mock.patch('os.path.getsize', mock.Mock())
+    def test_cache_rescue_image_bigger_than_flavor(self):
         fake_rescue_image_id = 'fake_rescue_image_id'
 
         self.imagecache._vhdutils.get_vhd_info.return_value = {
@@ -172,11 +582,8 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
                           self.context, self.instance,
                           fake_rescue_image_id)
 
-        mock_fetch.assert_called_once_with(self.context,
-                                           fake_rescue_image_id,
-                                           expected_path,
-                                           self.instance.user_id,
-                                           self.instance.project_id)
+        self.imagecache._fetcher.fetch.assert_called_once_with(
+            self.context, fake_rescue_image_id, expected_path)
         self.imagecache._vhdutils.get_vhd_info.assert_called_once_with(
             expected_vhd_path)
 
@@ -199,82 +606,166 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
         mock_rem_if_old_img.assert_called_once_with(
             mock.sentinel.FAKE_IMG2)
 
-    @mock.patch.object(imagecache.ImageCache, '_get_image_backing_files')
-    @mock.patch.object(os, 'utime')
-    def test_update_image_timestamp(self, mock_utime,
-                                    mock_get_img_backing_file):
-        fake_backing_files = [mock.sentinel.IMG_PATH1, mock.sentinel.IMG_PATH2,
-                              mock.sentinel.IMG_PATH3]
-        mock_get_img_backing_file.return_value = fake_backing_files
-
+    def test_update_image_timestamp(self):
         self.imagecache._update_image_timestamp(mock.sentinel.IMG)
 
-        mock_get_img_backing_file.assert_called_once_with(mock.sentinel.IMG)
-        mock_utime.assert_has_calls([mock.call(mock.sentinel.IMG_PATH1, None),
-                                     mock.call(mock.sentinel.IMG_PATH2, None),
-                                     mock.call(mock.sentinel.IMG_PATH3, None)])
+        self._mock_index.mark_used.assert_called_once_with(mock.sentinel.IMG)
 
     def test_get_image_backing_files(self):
-        mock_lookup_img_basepath = (
-            self.imagecache._pathutils.lookup_image_basepath)
-        fake_image_name = 'fake_image_name'
-        resized_image1 = '%s_1' % fake_image_name
-        resized_image5 = '%s_5' % fake_image_name
-        self.imagecache.unexplained_images = [resized_image1,
-                                              resized_image5]
-        fake_backing_files = [mock.sentinel.BACKING_FILE,
-                              mock.sentinel.RESIZED_FILE1,
-                              mock.sentinel.RESIZED_FILE2]
-        mock_lookup_img_basepath.side_effect = fake_backing_files
+        self._mock_index.get_image_files.return_value = [
+            (mock.sentinel.BACKING_FILE, mock.sentinel.size),
+            (mock.sentinel.RESIZED_FILE, mock.sentinel.resized_size)]
 
-        ret = self.imagecache._get_image_backing_files(fake_image_name)
+        ret = self.imagecache._get_image_backing_files(mock.sentinel.IMG)
 
-        self.assertEqual(ret, fake_backing_files)
+        self.assertEqual([mock.sentinel.BACKING_FILE,
+                          mock.sentinel.RESIZED_FILE], ret)
+        self._mock_index.get_image_files.assert_called_once_with(
+            mock.sentinel.IMG)
 
+    @mock.patch.object(imagecache, 'time')
     @mock.patch.object(imagecache.ImageCache, '_get_image_backing_files')
     @mock.patch.object(imagecache.ImageCache, 'remove_old_image')
-    def test_remove_if_old_image(self, mock_remove_old_image,
-                                  mock_get_img_backing_file):
+    def _test_remove_if_old_image(self, mock_remove_old_image,
+                                  mock_get_img_backing_file, mock_time,
+                                  last_used=0):
         self.flags(remove_unused_original_minimum_age_seconds=3000)
         fake_backing_files = [mock.sentinel.BACKING_FILE,
-                              mock.sentinel.RESIZED_FILE1,
-                              mock.sentinel.RESIZED_FILE2]
+                              mock.sentinel.RESIZED_FILE]
         mock_get_img_backing_file.return_value = fake_backing_files
-        self.imagecache._pathutils.get_age_of_file.side_effect = [3600, 2400,
-                                                                  3600]
+        self._mock_index.get_image.return_value = {'last_used': last_used}
+        mock_time.time.return_value = 3600
+
+        self.imagecache._remove_if_old_image(mock.sentinel.FAKE_IMAGE)
+
+        self._mock_index.get_image.assert_called_once_with(
+            mock.sentinel.FAKE_IMAGE)
+        if last_used:
+            self.assertFalse(mock_remove_old_image.called)
+        else:
+            mock_remove_old_image.assert_has_calls([
+                mock.call(mock.sentinel.BACKING_FILE),
+                mock.call(mock.sentinel.RESIZED_FILE)])
+
+    def test_remove_if_old_image(self):
+        self._test_remove_if_old_image()
+
+    def test_remove_if_old_image_recently_used(self):
+        self._test_remove_if_old_image(last_used=1200)
+
+    @mock.patch.object(imagecache.ImageCache, '_is_image_leased_by_peers')
+    def test_remove_old_images(self, mock_is_image_leased_by_peers):
+        img_file = os.path.join(self.FAKE_BASE_DIR, 'fake-image.vhd')
+        mock_is_image_leased_by_peers.return_value = False
+
+        self.assertTrue(self.imagecache.remove_old_image(img_file))
+
+        mock_is_image_leased_by_peers.assert_called_once_with('fake-image')
+        self.imagecache._pathutils.remove.assert_called_once_with(img_file)
+        self._mock_index.remove_image_file.assert_called_once_with(img_file)
+
+    @mock.patch.object(imagecache.ImageCache, '_is_image_leased_by_peers')
+    def test_remove_old_images_leased_by_peers(
+            self, mock_is_image_leased_by_peers):
+        img_file = os.path.join(self.FAKE_BASE_DIR, 'fake-image.vhd')
+        mock_is_image_leased_by_peers.return_value = True
+
+        self.assertFalse(self.imagecache.remove_old_image(img_file))
+
+        self.assertFalse(self.imagecache._pathutils.remove.called)
+        self.assertFalse(self._mock_index.remove_image_file.called)
+
+    def test_get_cache_size(self):
+        cache_size = self.imagecache.get_cache_size()
+
+        self.assertEqual(self._mock_index.get_cache_size.return_value,
+                         cache_size)
+
+    def test_get_cached_images_disk_info(self):
+        self._mock_index.list_images.return_value = ['img1', 'img2']
+        self._mock_index.get_image_files.side_effect = [
+            [('img1.vhd', 10), ('img1_5.vhd', 20)],
+            [('img2.iso', 30)]]
+        mock_get_allocation_info = (
+            self.imagecache._vhdutils.get_vhd_allocation_info)
+        mock_get_allocation_info.side_effect = [
+            {'FileSize': 11, 'MaxInternalSize': 100, 'AllocatedBytes': 8},
+            vmutils.HyperVException]
+
+        disk_info = self.imagecache.get_cached_images_disk_info()
+
+        expected_disk_info = [
+            {'image_id': 'img1', 'path': 'img1.vhd', 'disk_size': 11,
+             'virt_disk_size': 100, 'allocated_size': 8},
+            {'image_id': 'img1', 'path': 'img1_5.vhd', 'disk_size': 20},
+            {'image_id': 'img2', 'path': 'img2.iso', 'disk_size': 30}]
+        self.assertEqual(expected_disk_info, disk_info)
+        mock_get_allocation_info.assert_has_calls(
+            [mock.call('img1.vhd'), mock.call('img1_5.vhd')])
+
+    @mock.patch.object(imagecache.ImageCache, 'remove_old_image')
+    def test_evict_least_recently_used_images(self, mock_remove_old_image):
+        self.flags(image_cache_max_size=50, group='hyperv')
+        self._mock_index.get_cache_size.return_value = 65
+        images = {'used': ({'last_used': 1}, [('used.vhd', 20)]),
+                  'old': ({'last_used': 3}, [('old.vhd', 10),
+                                             ('old_5.vhd', 15)]),
+                  'recent': ({'last_used': 5}, [('recent.vhd', 10)]),
+                  'older': ({'last_used': 4}, [('older.vhd', 10)]),
+                  'removed': (None, [])}
+        self._mock_index.get_image.side_effect = (
+            lambda img: images[img][0])
+        self._mock_index.get_image_files.side_effect = (
+            lambda img: images[img][1])
+        mock_remove_old_image.side_effect = [True, OSError, False, True]
+        self.imagecache.originals = ['used', 'old', 'recent', 'older',
+                                     'removed']
+        self.imagecache.used_images = ['used']
+
+        self.imagecache._evict_least_recently_used_images(
+            mock.sentinel.base_dir)
+
+        # The removal of the resized image fails and the next image is
+        # used by other hosts, so one more image has to be evicted.
+        mock_remove_old_image.assert_has_calls(
+            [mock.call('old.vhd'), mock.call('old_5.vhd'),
+             mock.call('older.vhd'), mock.call('recent.vhd')])
+        self.assertEqual(4, mock_remove_old_image.call_count)
 
-        self.imagecache._remove_if_old_image(mock.sentinel.FAKE_IMAGE_FILE)
+    @mock.patch.object(imagecache.ImageCache, 'remove_old_image')
+    def test_evict_least_recently_used_images_within_budget(
+            self, mock_remove_old_image):
+        self.flags(image_cache_max_size=50, group='hyperv')
+        self._mock_index.get_cache_size.return_value = 50
 
-        calls = [mock.call(mock.sentinel.BACKING_FILE),
-                 mock.call(mock.sentinel.RESIZED_FILE1),
-                 mock.call(mock.sentinel.RESIZED_FILE2)]
-        self.imagecache._pathutils.get_age_of_file.assert_has_calls(calls)
-        mock_remove_old_image.assert_has_calls([
-            mock.call(mock.sentinel.BACKING_FILE),
-            mock.call(mock.sentinel.RESIZED_FILE2)])
+        self.imagecache._evict_least_recently_used_images(
+            mock.sentinel.base_dir)
 
-    def test_remove_old_images(self):
-        self.imagecache.remove_old_image(mock.sentinel.img_file)
+        self.assertFalse(mock_remove_old_image.called)
 
-        self.imagecache._pathutils.remove.assert_called_once_with(
-            mock.sentinel.img_file)
+    def test_evict_least_recently_used_images_unlimited(self):
+        self.imagecache._evict_least_recently_used_images(
+            mock.sentinel.base_dir)
+
+        self.assertFalse(self.imagecache._get_index.called)
 
+    @mock.patch.object(imagecache.ImageCache, '_renew_image_leases')
     @mock.patch.object(imagecache.ImageCache, '_list_running_instances')
-    @mock.patch.object(imagecache.ImageCache, 'list_base_images')
     @mock.patch.object(imagecache.ImageCache, '_age_and_verify_cached_images')
-    def test_update(self, mock_age_and_verify_cached_images,
-                    mock_list_base_images, mock_list_running_instances):
+    @mock.patch.object(imagecache.ImageCache,
+                       '_evict_least_recently_used_images')
+    def _test_update(self, mock_evict_lru_images,
+                     mock_age_and_verify_cached_images,
+                     mock_list_running_instances, mock_renew_image_leases,
+                     shared=False):
+        self.imagecache._pathutils.is_base_vhd_dir_shared.return_value = (
+            shared)
         mock_get_base_vhd_dir = self.imagecache._pathutils.get_base_vhd_dir
         mock_get_base_vhd_dir.return_value = mock.sentinel.base_vhd_dir
 
-        fake_used_images = mock.MagicMock()
-        fake_used_images.keys.return_value = mock.sentinel.used_images
+        fake_used_images = {mock.sentinel.img: (1, 2, mock.sentinel.names)}
         fake_running = {'used_images': fake_used_images}
-        fake_all_files = {'originals': mock.sentinel.originals,
-                          'unexplained_images': mock.sentinel.unexplained
-                         }
         mock_list_running_instances.return_value = fake_running
-        mock_list_base_images.return_value = fake_all_files
 
         self.imagecache.update(mock.sentinel.FAKE_CONTEXT,
                                mock.sentinel.all_instances)
@@ -282,23 +773,37 @@ class ImageCacheTestCase(test_base.HyperVBaseTestCase):
         mock_get_base_vhd_dir.assert_called_once_with()
         mock_list_running_instances.assert_called_once_with(
             mock.sentinel.FAKE_CONTEXT, mock.sentinel.all_instances)
-        mock_list_base_images.assert_called_once_with(
-            mock.sentinel.base_vhd_dir)
+        self._mock_index.update_refcounts.assert_called_once_with(
+            {mock.sentinel.img: 3})
         mock_age_and_verify_cached_images.assert_called_once_with(
             mock.sentinel.FAKE_CONTEXT, mock.sentinel.all_instances,
             mock.sentinel.base_vhd_dir)
-        self.assertEqual(mock.sentinel.used_images,
-                         self.imagecache.used_images)
-        self.assertEqual(mock.sentinel.originals, self.imagecache.originals)
-        self.assertEqual(mock.sentinel.unexplained,
-                         self.imagecache.unexplained_images)
+        mock_evict_lru_images.assert_called_once_with(
+            mock.sentinel.base_vhd_dir)
+        self.assertEqual([mock.sentinel.img],
+                         list(self.imagecache.used_images))
+        self.assertEqual(self._mock_index.list_images.return_value,
+                         self.imagecache.originals)
+        if shared:
+            mock_renew_image_leases.assert_called_once_with(
+                self.imagecache.used_images)
+        else:
+            self.assertFalse(mock_renew_image_leases.called)
+
+    def test_update(self):
+        self._test_update()
+
+    def test_update_shared(self):
+        self._test_update(shared=True)
 
     @mock.patch.object(os, 'listdir')
     def test_list_base_images(self, mock_list_dir):
         fake_file1 = 'fake_file'
         fake_file2 = '5a51f1c5-fbc2-4e26-906c-759d45168ecb'
         fake_file3 = '5a51f1c5-fbc2-4e26-906c-759d45168ecb_5'
-        mock_list_dir.return_value = [fake_file1, fake_file2, fake_file3]
+        index_file = imagecache.imagecacheindex.INDEX_FILE_NAME
+        mock_list_dir.return_value = [fake_file1, fake_file2, fake_file3,
+                                      index_file]
 
         ret = self.imagecache.list_base_images(mock.sentinel.base_vhd_dir)
 
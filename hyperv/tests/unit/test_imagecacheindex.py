@@ -0,0 +1,306 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+
+import mock
+from six.moves import builtins
+
+from hyperv.nova import imagecacheindex
+from hyperv.tests.unit import test_base
+
+
+class ImageCacheIndexTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_BASE_DIR = 'fake_base_dir'
+    _FAKE_IMAGE_ID = '5a51f1c5-fbc2-4e26-906c-759d45168ecb'
+    _FAKE_OTHER_IMAGE_ID = '0c0fa3b1-0c52-4f32-bd4e-8a1d38d1e0c5'
+
+    def setUp(self):
+        super(ImageCacheIndexTestCase, self).setUp()
+
+        self._index = imagecacheindex.ImageCacheIndex(self._FAKE_BASE_DIR)
+        self._journal_path = os.path.join(self._FAKE_BASE_DIR,
+                                          imagecacheindex.INDEX_FILE_NAME)
+
+    def _get_path(self, file_name):
+        return os.path.join(self._FAKE_BASE_DIR, file_name)
+
+    def _get_record(self, image_format='vhd', size=10, resized=None,
+                    refcount=0, last_used=1):
+        return {'format': image_format,
+                'size': size,
+                'resized': resized or {},
+                'refcount': refcount,
+                'last_used': last_used}
+
+    @mock.patch.object(imagecacheindex, 'ImageCacheIndex')
+    def test_get_image_cache_index(self, mock_index_cls):
+        self.addCleanup(imagecacheindex._indexes.clear)
+
+        index = imagecacheindex.get_image_cache_index(mock.sentinel.base_dir)
+        same_index = imagecacheindex.get_image_cache_index(
+            mock.sentinel.base_dir)
+
+        self.assertEqual(mock_index_cls.return_value, index)
+        self.assertEqual(index, same_index)
+        mock_index_cls.assert_called_once_with(
+            mock.sentinel.base_dir, imagecacheindex.INDEX_FILE_NAME)
+        index.load.assert_called_once_with()
+
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_compact_journal')
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_reconcile')
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_replay_journal')
+    @mock.patch('os.path.isdir')
+    @mock.patch('os.path.exists')
+    def _test_load(self, mock_exists, mock_isdir, mock_replay_journal,
+                   mock_reconcile, mock_compact_journal,
+                   journal_exists=True, base_dir_exists=True):
+        mock_exists.side_effect = [journal_exists, True]
+        mock_isdir.return_value = base_dir_exists
+
+        self._index.load()
+
+        expected_journal_path = (self._journal_path if journal_exists
+                                 else self._journal_path + '.tmp')
+        mock_replay_journal.assert_called_once_with(expected_journal_path)
+        mock_reconcile.assert_called_once_with()
+        self.assertEqual(base_dir_exists, mock_compact_journal.called)
+
+    def test_load(self):
+        self._test_load()
+
+    def test_load_interrupted_compaction(self):
+        self._test_load(journal_exists=False)
+
+    def test_load_missing_base_dir(self):
+        self._test_load(base_dir_exists=False)
+
+    @mock.patch.object(builtins, 'open')
+    def test_replay_journal(self, mock_open):
+        other_record = self._get_record()
+        mock_open.return_value.__enter__.return_value = [
+            json.dumps([self._FAKE_IMAGE_ID, self._get_record()]),
+            json.dumps([self._FAKE_OTHER_IMAGE_ID, other_record]),
+            json.dumps([self._FAKE_IMAGE_ID, None]),
+            '["incomplete']
+
+        self._index._replay_journal(mock.sentinel.journal_path)
+
+        mock_open.assert_called_once_with(mock.sentinel.journal_path, 'r')
+        self.assertEqual({self._FAKE_OTHER_IMAGE_ID: other_record},
+                         self._index._images)
+
+    @mock.patch('os.stat')
+    @mock.patch('os.listdir')
+    @mock.patch('os.path.isdir')
+    def test_reconcile(self, mock_isdir, mock_listdir, mock_stat):
+        removed_image_id = '9f5b2d5c-2d3e-4c8b-8c1e-4b7c5ee0b6e6'
+        self._index._images = {
+            self._FAKE_IMAGE_ID: self._get_record(
+                resized={'5': 20, '10': 30}, last_used=3),
+            removed_image_id: self._get_record()}
+        mock_isdir.return_value = True
+        mock_listdir.return_value = [
+            imagecacheindex.INDEX_FILE_NAME,
+            'unexplained_file',
+            '%s.vhd' % self._FAKE_IMAGE_ID,
+            '%s_5.vhd' % self._FAKE_IMAGE_ID,
+            '%s_20.vhd' % self._FAKE_IMAGE_ID,
+            '%s.VHDX' % self._FAKE_OTHER_IMAGE_ID]
+        stats = {
+            self._get_path('%s_20.vhd' % self._FAKE_IMAGE_ID): (40, 2),
+            self._get_path('%s.vhdx' % self._FAKE_OTHER_IMAGE_ID): (50, 4)}
+        mock_stat.side_effect = lambda path: mock.Mock(
+            st_size=stats[path][0], st_mtime=stats[path][1])
+
+        self._index._reconcile()
+
+        expected_images = {
+            self._FAKE_IMAGE_ID: self._get_record(
+                resized={'5': 20, '20': 40}, last_used=3),
+            self._FAKE_OTHER_IMAGE_ID: self._get_record(
+                image_format='vhdx', size=50, last_used=4)}
+        self.assertEqual(expected_images, self._index._images)
+        mock_listdir.assert_called_once_with(self._FAKE_BASE_DIR)
+
+    @mock.patch('os.rename')
+    @mock.patch('os.remove')
+    @mock.patch('os.path.exists')
+    @mock.patch.object(builtins, 'open')
+    def test_compact_journal(self, mock_open, mock_exists, mock_remove,
+                             mock_rename):
+        record = self._get_record()
+        self._index._images = {self._FAKE_IMAGE_ID: record}
+        mock_exists.return_value = True
+        mock_journal = mock_open.return_value.__enter__.return_value
+
+        self._index._compact_journal()
+
+        tmp_journal_path = self._journal_path + '.tmp'
+        mock_open.assert_called_once_with(tmp_journal_path, 'w')
+        mock_journal.write.assert_called_once_with(
+            json.dumps([self._FAKE_IMAGE_ID, record]) + '\n')
+        mock_remove.assert_called_once_with(self._journal_path)
+        mock_rename.assert_called_once_with(tmp_journal_path,
+                                            self._journal_path)
+        self.assertEqual(1, self._index._journal_entries)
+
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_compact_journal')
+    @mock.patch.object(builtins, 'open')
+    def _test_save_image(self, mock_open, mock_compact_journal,
+                         record=None, journal_entries=0):
+        if record:
+            self._index._images[self._FAKE_IMAGE_ID] = record
+        self._index._journal_entries = journal_entries
+        mock_journal = mock_open.return_value.__enter__.return_value
+
+        self._index._save_image(self._FAKE_IMAGE_ID)
+
+        expected_record = (
+            record if record and (record['format'] or record['resized'])
+            else None)
+        mock_open.assert_called_once_with(self._journal_path, 'a')
+        mock_journal.write.assert_called_once_with(
+            json.dumps([self._FAKE_IMAGE_ID, expected_record]) + '\n')
+        if not expected_record:
+            self.assertNotIn(self._FAKE_IMAGE_ID, self._index._images)
+
+        max_entries = imagecacheindex.ImageCacheIndex._JOURNAL_MIN_ENTRIES
+        self.assertEqual(journal_entries >= max_entries,
+                         mock_compact_journal.called)
+
+    def test_save_image(self):
+        self._test_save_image(record=self._get_record())
+
+    def test_save_removed_image(self):
+        self._test_save_image(record=self._get_record(image_format=None))
+
+    def test_save_image_compact_journal(self):
+        self._test_save_image(
+            record=self._get_record(),
+            journal_entries=imagecacheindex.ImageCacheIndex.
+            _JOURNAL_MIN_ENTRIES)
+
+    @mock.patch.object(builtins, 'open')
+    def test_save_image_write_failed(self, mock_open):
+        mock_open.side_effect = IOError
+        self._index._images[self._FAKE_IMAGE_ID] = self._get_record()
+
+        self._index._save_image(self._FAKE_IMAGE_ID)
+
+        self.assertEqual(0, self._index._journal_entries)
+
+    def test_get_image_path(self):
+        self._index._images = {
+            self._FAKE_IMAGE_ID: self._get_record(),
+            self._FAKE_OTHER_IMAGE_ID: self._get_record(
+                image_format=None, resized={'5': 10})}
+
+        self.assertEqual(self._get_path('%s.vhd' % self._FAKE_IMAGE_ID),
+                         self._index.get_image_path(self._FAKE_IMAGE_ID))
+        self.assertIsNone(
+            self._index.get_image_path(self._FAKE_OTHER_IMAGE_ID))
+        self.assertIsNone(self._index.get_image_path('missing_image'))
+
+    def test_get_image_files(self):
+        self._index._images = {
+            self._FAKE_IMAGE_ID: self._get_record(
+                size=10, resized={'5': 20, '10': 30})}
+
+        image_files = self._index.get_image_files(self._FAKE_IMAGE_ID)
+
+        expected_image_files = [
+            (self._get_path('%s.vhd' % self._FAKE_IMAGE_ID), 10),
+            (self._get_path('%s_10.vhd' % self._FAKE_IMAGE_ID), 30),
+            (self._get_path('%s_5.vhd' % self._FAKE_IMAGE_ID), 20)]
+        self.assertEqual(expected_image_files, image_files)
+        self.assertEqual([], self._index.get_image_files('missing_image'))
+
+    def test_get_cache_size(self):
+        self._index._images = {
+            self._FAKE_IMAGE_ID: self._get_record(
+                size=10, resized={'5': 20}),
+            self._FAKE_OTHER_IMAGE_ID: self._get_record(size=5)}
+
+        self.assertEqual(35, self._index.get_cache_size())
+
+    @mock.patch.object(imagecacheindex, 'time')
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_save_image')
+    def test_add_image(self, mock_save_image, mock_time):
+        self._index.add_image(self._FAKE_IMAGE_ID, 'VHDX', 10)
+
+        expected_record = self._get_record(
+            image_format='vhdx', size=10,
+            last_used=mock_time.time.return_value)
+        self.assertEqual(expected_record,
+                         self._index.get_image(self._FAKE_IMAGE_ID))
+        mock_save_image.assert_called_once_with(self._FAKE_IMAGE_ID)
+
+    @mock.patch.object(imagecacheindex, 'time')
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_save_image')
+    def test_add_resized_image(self, mock_save_image, mock_time):
+        self._index._images[self._FAKE_IMAGE_ID] = self._get_record()
+
+        self._index.add_resized_image(self._FAKE_IMAGE_ID, 5, 20)
+
+        expected_record = self._get_record(
+            resized={'5': 20}, last_used=mock_time.time.return_value)
+        self.assertEqual(expected_record,
+                         self._index.get_image(self._FAKE_IMAGE_ID))
+        mock_save_image.assert_called_once_with(self._FAKE_IMAGE_ID)
+
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_save_image')
+    def test_remove_image_file(self, mock_save_image):
+        self._index._images[self._FAKE_IMAGE_ID] = self._get_record(
+            resized={'5': 20, '10': 30})
+
+        self._index.remove_image_file(
+            self._get_path('%s_5.vhd' % self._FAKE_IMAGE_ID))
+        self._index.remove_image_file(
+            self._get_path('%s.vhd' % self._FAKE_IMAGE_ID))
+        self._index.remove_image_file(self._get_path('unexplained_file'))
+
+        expected_record = self._get_record(image_format=None, size=0,
+                                           resized={'10': 30})
+        self.assertEqual(expected_record,
+                         self._index.get_image(self._FAKE_IMAGE_ID))
+        mock_save_image.assert_has_calls([mock.call(self._FAKE_IMAGE_ID)] * 2)
+        self.assertEqual(2, mock_save_image.call_count)
+
+    @mock.patch.object(imagecacheindex, 'time')
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_save_image')
+    def test_mark_used(self, mock_save_image, mock_time):
+        self._index._images[self._FAKE_IMAGE_ID] = self._get_record()
+
+        self._index.mark_used(self._FAKE_IMAGE_ID)
+        self._index.mark_used('missing_image')
+
+        self.assertEqual(mock_time.time.return_value,
+                         self._index._images[self._FAKE_IMAGE_ID][
+                             'last_used'])
+        mock_save_image.assert_called_once_with(self._FAKE_IMAGE_ID)
+
+    @mock.patch.object(imagecacheindex.ImageCacheIndex, '_save_image')
+    def test_update_refcounts(self, mock_save_image):
+        self._index._images = {
+            self._FAKE_IMAGE_ID: self._get_record(refcount=1),
+            self._FAKE_OTHER_IMAGE_ID: self._get_record(refcount=2)}
+
+        self._index.update_refcounts({self._FAKE_IMAGE_ID: 1})
+
+        self.assertEqual(
+            0, self._index._images[self._FAKE_OTHER_IMAGE_ID]['refcount'])
+        mock_save_image.assert_called_once_with(self._FAKE_OTHER_IMAGE_ID)
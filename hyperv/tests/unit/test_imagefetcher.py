@@ -0,0 +1,328 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+
+import mock
+from nova import exception
+from oslo_utils import units
+from six.moves import builtins
+
+from hyperv.nova import constants
+from hyperv.nova import imagefetcher
+from hyperv.nova import vhdutils
+from hyperv.tests.unit import test_base
+
+
+class ImageFormatDetectorTestCase(test_base.HyperVBaseTestCase):
+    def _test_get_format(self, chunks, expected_format):
+        detector = imagefetcher._ImageFormatDetector()
+        for chunk in chunks:
+            detector.update(chunk)
+
+        self.assertEqual(expected_format, detector.get_format())
+        self.assertEqual(sum(len(chunk) for chunk in chunks), detector.size)
+
+    def test_get_format_vhdx(self):
+        self._test_get_format([vhdutils.VHDX_SIGNATURE, b'\0' * 1024],
+                              constants.DISK_FORMAT_VHDX)
+
+    def test_get_format_vhd(self):
+        footer = vhdutils.VHD_SIGNATURE + b'\0' * 504
+        self._test_get_format([b'\0' * 1000, footer[:10], footer[10:]],
+                              constants.DISK_FORMAT_VHD)
+
+    def test_get_format_iso(self):
+        header = b'\0' * imagefetcher._ISO_SIGNATURE_OFFSET
+        self._test_get_format([header, imagefetcher._ISO_SIGNATURE,
+                               b'\0' * 2048],
+                              constants.DVD_FORMAT)
+
+    def test_get_format_unknown(self):
+        self._test_get_format([b'\0' * 100], None)
+
+
+class ImageFetcherTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_PATH = 'fake_path'
+    _FAKE_PARTIAL_PATH = 'fake_path.part'
+
+    def setUp(self):
+        super(ImageFetcherTestCase, self).setUp()
+
+        self._fetcher = imagefetcher.ImageFetcher()
+        self._fetcher._image_api = mock.Mock()
+        self._mock_image_api = self._fetcher._image_api
+
+    @mock.patch('os.remove')
+    @mock.patch('os.path.exists')
+    @mock.patch('os.rename')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_download_from_glance')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_copy_from_peers')
+    def _test_fetch(self, mock_copy_from_peers, mock_download_from_glance,
+                    mock_rename, mock_exists, mock_remove, copied=False,
+                    image_meta=None):
+        mock_copy_from_peers.return_value = (
+            copied, mock.sentinel.peer_image_format)
+        mock_download_from_glance.return_value = (
+            mock.sentinel.glance_image_format)
+
+        image_format = self._fetcher.fetch(mock.sentinel.context,
+                                           mock.sentinel.image_id,
+                                           self._FAKE_PATH,
+                                           image_meta=image_meta)
+
+        if image_meta:
+            mock_image_meta = image_meta
+            self.assertFalse(self._mock_image_api.get.called)
+        else:
+            mock_image_meta = self._mock_image_api.get.return_value
+            self._mock_image_api.get.assert_called_once_with(
+                mock.sentinel.context, mock.sentinel.image_id)
+        mock_copy_from_peers.assert_called_once_with(
+            mock.sentinel.image_id, mock_image_meta, self._FAKE_PARTIAL_PATH)
+        if copied:
+            self.assertEqual(mock.sentinel.peer_image_format, image_format)
+            self.assertFalse(mock_download_from_glance.called)
+        else:
+            self.assertEqual(mock.sentinel.glance_image_format, image_format)
+            mock_download_from_glance.assert_called_once_with(
+                mock.sentinel.context, mock.sentinel.image_id,
+                mock_image_meta, self._FAKE_PARTIAL_PATH)
+        mock_rename.assert_called_once_with(self._FAKE_PARTIAL_PATH,
+                                            self._FAKE_PATH)
+        self.assertFalse(mock_remove.called)
+
+    def test_fetch_from_glance(self):
+        self._test_fetch()
+
+    def test_fetch_from_peer(self):
+        self._test_fetch(copied=True)
+
+    def test_fetch_with_image_meta(self):
+        self._test_fetch(image_meta=mock.sentinel.image_meta)
+
+    @mock.patch('os.remove')
+    @mock.patch('os.path.exists')
+    @mock.patch('os.rename')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_download_from_glance')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_copy_from_peers')
+    def test_fetch_failed(self, mock_copy_from_peers,
+                          mock_download_from_glance, mock_rename,
+                          mock_exists, mock_remove):
+        mock_copy_from_peers.return_value = (False, None)
+        mock_download_from_glance.side_effect = IOError
+        mock_exists.return_value = True
+
+        self.assertRaises(IOError, self._fetcher.fetch,
+                          mock.sentinel.context, mock.sentinel.image_id,
+                          self._FAKE_PATH)
+
+        self.assertFalse(mock_rename.called)
+        mock_remove.assert_called_once_with(self._FAKE_PARTIAL_PATH)
+
+    @mock.patch('os.path.exists')
+    def test_get_peer_image_paths(self, mock_exists):
+        self.flags(image_cache_peer_dirs=['peer1', 'peer2', 'peer3'],
+                   group='hyperv')
+        peer_image_paths = [os.path.join('peer1', 'fake_image.vhdx'),
+                            os.path.join('peer3', 'fake_image.vhd')]
+        mock_exists.side_effect = lambda path: path in peer_image_paths
+
+        ret = list(self._fetcher._get_peer_image_paths('fake_image'))
+
+        self.assertEqual(peer_image_paths, ret)
+
+    @mock.patch('os.remove')
+    @mock.patch('os.path.exists')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_copy_from_peer')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_get_peer_image_paths')
+    def test_copy_from_peers(self, mock_get_peer_image_paths,
+                             mock_copy_from_peer, mock_exists, mock_remove):
+        image_meta = {'checksum': mock.sentinel.checksum}
+        mock_get_peer_image_paths.return_value = [
+            mock.sentinel.peer_image_path1, mock.sentinel.peer_image_path2]
+        mock_copy_from_peer.side_effect = [exception.ImageUnacceptable(
+            image_id=mock.sentinel.image_id, reason=''),
+            mock.sentinel.image_format]
+        mock_exists.return_value = True
+
+        ret = self._fetcher._copy_from_peers(mock.sentinel.image_id,
+                                             image_meta,
+                                             self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual((True, mock.sentinel.image_format), ret)
+        mock_copy_from_peer.assert_has_calls(
+            [mock.call(mock.sentinel.image_id, image_meta,
+                       mock.sentinel.peer_image_path1,
+                       self._FAKE_PARTIAL_PATH),
+             mock.call(mock.sentinel.image_id, image_meta,
+                       mock.sentinel.peer_image_path2,
+                       self._FAKE_PARTIAL_PATH)])
+        mock_remove.assert_called_once_with(self._FAKE_PARTIAL_PATH)
+
+    @mock.patch.object(imagefetcher.ImageFetcher, '_get_peer_image_paths')
+    def test_copy_from_peers_not_found(self, mock_get_peer_image_paths):
+        mock_get_peer_image_paths.return_value = []
+
+        ret = self._fetcher._copy_from_peers(
+            mock.sentinel.image_id, {'checksum': mock.sentinel.checksum},
+            self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual((False, None), ret)
+
+    @mock.patch.object(imagefetcher.ImageFetcher, '_get_peer_image_paths')
+    def test_copy_from_peers_missing_checksum(self,
+                                              mock_get_peer_image_paths):
+        ret = self._fetcher._copy_from_peers(
+            mock.sentinel.image_id, {}, self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual((False, None), ret)
+        self.assertFalse(mock_get_peer_image_paths.called)
+
+    @mock.patch.object(imagefetcher.ImageFetcher, '_write_image')
+    @mock.patch.object(builtins, 'open')
+    def test_copy_from_peer(self, mock_open, mock_write_image):
+        self.flags(image_fetch_buffer_size=units.Mi, group='hyperv')
+        mock_peer_image = mock_open.return_value.__enter__.return_value
+        mock_peer_image.read.side_effect = [b'fake', b'data', b'']
+        mock_write_image.side_effect = (
+            lambda image_id, image_meta, image_chunks, partial_path:
+                list(image_chunks))
+
+        ret = self._fetcher._copy_from_peer(
+            mock.sentinel.image_id, mock.sentinel.image_meta,
+            mock.sentinel.peer_image_path, self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual([b'fake', b'data'], ret)
+        mock_open.assert_called_once_with(mock.sentinel.peer_image_path,
+                                          'rb')
+        mock_peer_image.read.assert_has_calls([mock.call(units.Mi)] * 3)
+
+    @mock.patch.object(imagefetcher.ImageFetcher, '_write_image')
+    def test_download_from_glance(self, mock_write_image):
+        self.flags(image_fetch_retries=1, group='hyperv')
+        mock_write_image.side_effect = [IOError, mock.sentinel.image_format]
+
+        image_format = self._fetcher._download_from_glance(
+            mock.sentinel.context, mock.sentinel.image_id,
+            mock.sentinel.image_meta, self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual(mock.sentinel.image_format, image_format)
+        mock_image_chunks = self._mock_image_api.download.return_value
+        mock_write_image.assert_has_calls(
+            [mock.call(mock.sentinel.image_id, mock.sentinel.image_meta,
+                       mock_image_chunks, self._FAKE_PARTIAL_PATH)] * 2)
+
+    @mock.patch.object(imagefetcher.ImageFetcher, '_write_image')
+    def _test_download_from_glance_failed(self, mock_write_image,
+                                          write_exc=IOError,
+                                          expected_write_count=2):
+        self.flags(image_fetch_retries=1, group='hyperv')
+        mock_write_image.side_effect = write_exc
+
+        self.assertRaises(write_exc, self._fetcher._download_from_glance,
+                          mock.sentinel.context, mock.sentinel.image_id,
+                          mock.sentinel.image_meta, self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual(expected_write_count, mock_write_image.call_count)
+
+    def test_download_from_glance_retries_exceeded(self):
+        self._test_download_from_glance_failed()
+
+    def test_download_from_glance_image_unacceptable(self):
+        self._test_download_from_glance_failed(
+            write_exc=exception.ImageUnacceptable, expected_write_count=1)
+
+    @mock.patch('os.path.getsize')
+    @mock.patch('os.path.exists')
+    def _test_get_resume_offset(self, mock_exists, mock_getsize,
+                                partial_exists=True):
+        mock_exists.return_value = partial_exists
+        mock_getsize.return_value = self._fetcher._WRITE_ALIGNMENT * 2 + 10
+
+        offset = self._fetcher._get_resume_offset(self._FAKE_PARTIAL_PATH)
+
+        expected_offset = (self._fetcher._WRITE_ALIGNMENT * 2
+                           if partial_exists else 0)
+        self.assertEqual(expected_offset, offset)
+
+    def test_get_resume_offset(self):
+        self._test_get_resume_offset()
+
+    def test_get_resume_offset_no_partial_file(self):
+        self._test_get_resume_offset(partial_exists=False)
+
+    @mock.patch.object(imagefetcher, 'CONF')
+    @mock.patch('os.fsync')
+    @mock.patch.object(builtins, 'open')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_verify_image')
+    @mock.patch.object(imagefetcher.ImageFetcher, '_get_resume_offset')
+    def _test_write_image(self, mock_get_resume_offset, mock_verify_image,
+                          mock_open, mock_fsync, mock_conf, resume_offset=0):
+        mock_conf.hyperv.image_fetch_buffer_size = 8
+        self._fetcher._WRITE_ALIGNMENT = 4
+        mock_get_resume_offset.return_value = resume_offset
+        chunks = [vhdutils.VHDX_SIGNATURE[:3], vhdutils.VHDX_SIGNATURE[3:],
+                  b'0123456789', b'abc']
+        mock_file = mock_open.return_value.__enter__.return_value
+
+        image_format = self._fetcher._write_image(
+            mock.sentinel.image_id, mock.sentinel.image_meta, iter(chunks),
+            self._FAKE_PARTIAL_PATH)
+
+        self.assertEqual(constants.DISK_FORMAT_VHDX, image_format)
+        expected_mode = 'r+b' if resume_offset else 'wb'
+        mock_open.assert_called_once_with(self._FAKE_PARTIAL_PATH,
+                                          expected_mode)
+        mock_file.seek.assert_called_once_with(resume_offset)
+        mock_file.truncate.assert_called_once_with()
+        written_data = b''.join(
+            call[0][0] for call in mock_file.write.call_args_list)
+        self.assertEqual(b''.join(chunks)[resume_offset:], written_data)
+        mock_fsync.assert_called_once_with(mock_file.fileno.return_value)
+
+        data = b''.join(chunks)
+        mock_verify_image.assert_called_once_with(
+            mock.sentinel.image_id, mock.sentinel.image_meta, len(data),
+            hashlib.md5(data).hexdigest())
+        return mock_file
+
+    def test_write_image(self):
+        mock_file = self._test_write_image()
+
+        # The buffered data is written in aligned chunks.
+        write_sizes = [len(call[0][0])
+                       for call in mock_file.write.call_args_list]
+        self.assertEqual([8, 8, 5], write_sizes)
+
+    def test_write_image_resume(self):
+        self._test_write_image(resume_offset=12)
+
+    def _test_verify_image(self, size=10, checksum='fake_checksum'):
+        image_meta = {'size': 10, 'checksum': 'fake_checksum'}
+        self._fetcher._verify_image(mock.sentinel.image_id, image_meta,
+                                    size, checksum)
+
+    def test_verify_image(self):
+        self._test_verify_image()
+
+    def test_verify_image_size_mismatch(self):
+        self.assertRaises(exception.ImageUnacceptable,
+                          self._test_verify_image, size=5)
+
+    def test_verify_image_checksum_mismatch(self):
+        self.assertRaises(exception.ImageUnacceptable,
+                          self._test_verify_image, checksum='other_checksum')
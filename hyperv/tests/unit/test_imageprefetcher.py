@@ -0,0 +1,137 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+from nova import exception
+
+from hyperv.nova import imageprefetcher
+from hyperv.tests.unit import test_base
+
+
+class ImagePrefetcherTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V ImagePrefetcher class."""
+
+    def setUp(self):
+        super(ImagePrefetcherTestCase, self).setUp()
+
+        self._prefetcher = imageprefetcher.ImagePrefetcher()
+        self._prefetcher._imagecache = mock.MagicMock()
+        self._imagecache = self._prefetcher._imagecache
+
+    @mock.patch.object(imageprefetcher, 'eventlet')
+    def test_start(self, mock_eventlet):
+        self.flags(image_prefetch_interval=60, group='hyperv')
+
+        self._prefetcher.start()
+
+        mock_eventlet.spawn_n.assert_called_once_with(
+            self._prefetcher._prefetch_images_periodically)
+
+    @mock.patch.object(imageprefetcher, 'eventlet')
+    def test_start_disabled(self, mock_eventlet):
+        self._prefetcher.start()
+
+        self.assertFalse(mock_eventlet.spawn_n.called)
+
+    @mock.patch.object(imageprefetcher, 'eventlet')
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, 'prefetch_images')
+    def test_prefetch_images_periodically(self, mock_prefetch_images,
+                                          mock_eventlet):
+        self.flags(image_prefetch_interval=60, group='hyperv')
+        mock_prefetch_images.side_effect = [Exception, None]
+        mock_eventlet.sleep.side_effect = [None, StopIteration]
+
+        self.assertRaises(StopIteration,
+                          self._prefetcher._prefetch_images_periodically)
+
+        self.assertEqual(2, mock_prefetch_images.call_count)
+        mock_eventlet.sleep.assert_has_calls([mock.call(60)] * 2)
+
+    def test_get_root_gb_sizes(self):
+        self.flags(use_cow_images=True)
+        self.flags(image_prefetch_root_gb=['40', 'invalid', '20', '40'],
+                   group='hyperv')
+
+        self.assertEqual([20, 40], self._prefetcher._get_root_gb_sizes())
+
+    def test_get_root_gb_sizes_no_cow(self):
+        self.flags(use_cow_images=False)
+        self.flags(image_prefetch_root_gb=['20'], group='hyperv')
+
+        self.assertEqual([], self._prefetcher._get_root_gb_sizes())
+
+    def test_is_cache_full(self):
+        self.flags(image_cache_max_size=100, group='hyperv')
+        self._imagecache.get_cache_size.return_value = 100
+
+        self.assertTrue(self._prefetcher._is_cache_full())
+
+    def test_is_cache_full_unlimited(self):
+        self.assertFalse(self._prefetcher._is_cache_full())
+        self.assertFalse(self._imagecache.get_cache_size.called)
+
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, '_prefetch_image')
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, '_is_cache_full')
+    @mock.patch.object(imageprefetcher.nova_context, 'get_admin_context')
+    def test_prefetch_images(self, mock_get_admin_context,
+                             mock_is_cache_full, mock_prefetch_image):
+        self.flags(image_prefetch_images=['img1', 'img2'], group='hyperv')
+        self.flags(image_prefetch_recent_images=3, group='hyperv')
+        self._imagecache.list_recently_used_images.return_value = [
+            'img2', 'img3', 'img4']
+        mock_is_cache_full.side_effect = [False, False, False, True]
+        mock_prefetch_image.side_effect = [Exception, None, None]
+
+        self._prefetcher.prefetch_images()
+
+        self._imagecache.list_recently_used_images.assert_called_once_with(3)
+        context = mock_get_admin_context.return_value
+        mock_prefetch_image.assert_has_calls(
+            [mock.call(context, 'img1'), mock.call(context, 'img2'),
+             mock.call(context, 'img3')])
+        self.assertEqual(3, mock_prefetch_image.call_count)
+
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, '_throttle')
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, '_get_root_gb_sizes')
+    def test_prefetch_image(self, mock_get_root_gb_sizes, mock_throttle):
+        mock_get_root_gb_sizes.return_value = [10, 20, 40]
+        self._imagecache.cache_image.return_value = ('fake_image.vhd', False)
+        self._imagecache.cache_resized_vhd.side_effect = [
+            exception.FlavorDiskSmallerThanImage(flavor_size=10,
+                                                 image_size=20),
+            ('fake_image_20.vhd', True),
+            ('fake_image_40.vhd', False)]
+
+        self._prefetcher._prefetch_image(mock.sentinel.context,
+                                         mock.sentinel.image_id)
+
+        self._imagecache.cache_image.assert_called_once_with(
+            mock.sentinel.context, mock.sentinel.image_id)
+        self._imagecache.cache_resized_vhd.assert_has_calls(
+            [mock.call('fake_image.vhd', root_gb) for root_gb in (10, 20, 40)])
+        self.assertEqual(2, mock_throttle.call_count)
+
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, '_throttle')
+    @mock.patch.object(imageprefetcher.ImagePrefetcher, '_get_root_gb_sizes')
+    def test_prefetch_image_vhdx(self, mock_get_root_gb_sizes,
+                                 mock_throttle):
+        self._imagecache.cache_image.return_value = ('fake_image.vhdx', True)
+
+        self._prefetcher._prefetch_image(mock.sentinel.context,
+                                         mock.sentinel.image_id)
+
+        self.assertFalse(mock_get_root_gb_sizes.called)
+        self.assertFalse(self._imagecache.cache_resized_vhd.called)
+        self.assertFalse(mock_throttle.called)
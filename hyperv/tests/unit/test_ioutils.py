@@ -68,6 +68,19 @@ class IOUtilsTestCase(test_base.HyperVBaseTestCase):
             expected_flags, None, last_error_code, 0,
             mock_ctypes.byref(fake_message_buffer), 0, None)
 
+    @mock.patch.object(ioutils, 'avoid_blocking_call')
+    @mock.patch.object(ioutils, 'ctypes')
+    def test_wait_named_pipe(self, mock_ctypes, mock_avoid_blocking_call):
+        self._ioutils.wait_named_pipe(mock.sentinel.pipe_name, timeout=5)
+
+        mock_ctypes.c_wchar_p.assert_called_once_with(
+            mock.sentinel.pipe_name)
+        mock_avoid_blocking_call.assert_called_once_with(
+            self._ioutils._run_and_check_output,
+            self._fake_kernel32.WaitNamedPipeW,
+            mock_ctypes.c_wchar_p.return_value,
+            5000)
+
     def test_get_write_buffer_data(self):
         fake_data = 'fake data'
         fake_buffer = (ctypes.c_ubyte * len(fake_data))()
@@ -78,6 +91,34 @@ class IOUtilsTestCase(test_base.HyperVBaseTestCase):
         self.assertEqual(six.b(fake_data), buff_data)
 
 
+@mock.patch.object(ioutils, 'tpool')
+@mock.patch.object(ioutils.patcher, 'is_monkey_patched')
+class AvoidBlockingCallTestCase(test_base.HyperVBaseTestCase):
+    def _test_avoid_blocking_call(self, mock_is_monkey_patched, mock_tpool,
+                                  monkey_patched=True):
+        mock_is_monkey_patched.return_value = monkey_patched
+        mock_func = mock.Mock()
+
+        ret_val = ioutils.avoid_blocking_call(mock_func, mock.sentinel.arg,
+                                              kwarg=mock.sentinel.kwarg)
+
+        mock_is_monkey_patched.assert_called_once_with('thread')
+        if monkey_patched:
+            mock_tpool.execute.assert_called_once_with(
+                mock_func, mock.sentinel.arg, kwarg=mock.sentinel.kwarg)
+            self.assertEqual(mock_tpool.execute.return_value, ret_val)
+        else:
+            mock_func.assert_called_once_with(mock.sentinel.arg,
+                                              kwarg=mock.sentinel.kwarg)
+            self.assertEqual(mock_func.return_value, ret_val)
+
+    def test_avoid_blocking_call_monkey_patched(self, *mocks):
+        self._test_avoid_blocking_call(*mocks)
+
+    def test_avoid_blocking_call(self, *mocks):
+        self._test_avoid_blocking_call(*mocks, monkey_patched=False)
+
+
 class IOQueueTestCase(test_base.HyperVBaseTestCase):
     def setUp(self):
         super(IOQueueTestCase, self).setUp()
@@ -136,7 +177,7 @@ class IOQueueTestCase(test_base.HyperVBaseTestCase):
     @mock.patch.object(ioutils.IOQueue, 'get')
     def _test_get_burst(self, mock_get,
                         exceeded_max_size=False):
-        fake_data = 'fake_data'
+        fake_data = b'fake_data'
 
         mock_get.side_effect = [fake_data, fake_data, None]
 
@@ -167,3 +208,124 @@ class IOQueueTestCase(test_base.HyperVBaseTestCase):
 
     def test_get_burst_exceeded_size(self):
         self._test_get_burst(exceeded_max_size=True)
+
+    def test_put_nowait(self):
+        mock_callback = mock.Mock()
+        self._ioqueue.set_put_callback(mock_callback)
+
+        self._ioqueue.put_nowait(mock.sentinel.item)
+
+        self._mock_queue.put.assert_called_once_with(
+            self._ioqueue, mock.sentinel.item, block=False)
+        mock_callback.assert_called_once_with()
+
+    def test_get_burst_nowait(self):
+        self._mock_queue.get.side_effect = [b'fake', b'_data',
+                                            ioutils.Queue.Empty]
+
+        ret_val = self._ioqueue.get_burst_nowait()
+
+        self._mock_queue.get.assert_has_calls(
+            [mock.call(self._ioqueue, block=False)] * 3)
+        self.assertEqual(b'fake_data', ret_val)
+
+
+class BoundedIOQueueTestCase(test_base.HyperVBaseTestCase):
+    _FAKE_QUEUE_SIZE = 8
+
+    def setUp(self):
+        super(BoundedIOQueueTestCase, self).setUp()
+
+        self._mock_client_connected = mock.Mock()
+        self._mock_client_connected.isSet.return_value = True
+
+    def _get_queue(self, overflow_policy=ioutils.IO_QUEUE_OVERFLOW_BLOCK):
+        return ioutils.IOQueue(self._mock_client_connected,
+                               max_size_bytes=self._FAKE_QUEUE_SIZE,
+                               overflow_policy=overflow_policy)
+
+    def test_put_nowait_full(self):
+        ioqueue = self._get_queue()
+        ioqueue.put_nowait(b'fake')
+        ioqueue.put_nowait(b'fake_data')
+
+        self.assertRaises(ioutils.Queue.Full,
+                          ioqueue.put_nowait, b'x')
+        self.assertEqual(b'fakefake_data', ioqueue.get_burst_nowait(
+            max_size=self._FAKE_QUEUE_SIZE * 2))
+        self.assertEqual(13, ioqueue.bytes_queued)
+        self.assertEqual(0, ioqueue.bytes_dropped)
+
+    def test_put_drop_oldest(self):
+        ioqueue = self._get_queue(
+            overflow_policy=ioutils.IO_QUEUE_OVERFLOW_DROP_OLDEST)
+
+        for chunk in (b'abc', b'def', b'ghi'):
+            ioqueue.put(chunk)
+
+        self.assertEqual(b'bcdefghi', ioqueue.get_burst_nowait())
+        self.assertEqual(9, ioqueue.bytes_queued)
+        self.assertEqual(1, ioqueue.bytes_dropped)
+
+    def test_put_drop_oldest_drop_callback(self):
+        ioqueue = self._get_queue(
+            overflow_policy=ioutils.IO_QUEUE_OVERFLOW_DROP_OLDEST)
+        mock_callback = mock.Mock()
+        ioqueue.set_drop_callback(mock_callback)
+
+        for chunk in (b'abc', b'def', b'ghi', b'jk'):
+            ioqueue.put(chunk)
+
+        mock_callback.assert_has_calls([mock.call(1), mock.call(2)])
+        self.assertEqual(2, mock_callback.call_count)
+
+    def test_put_drop_oldest_exceeding_capacity(self):
+        ioqueue = self._get_queue(
+            overflow_policy=ioutils.IO_QUEUE_OVERFLOW_DROP_OLDEST)
+
+        ioqueue.put(b'abc')
+        ioqueue.put(b'0123456789')
+
+        self.assertEqual(b'23456789', ioqueue.get_burst_nowait())
+        self.assertEqual(5, ioqueue.bytes_dropped)
+
+    def test_get_burst_nowait_max_size(self):
+        ioqueue = self._get_queue()
+        ioqueue.put(b'abc')
+        ioqueue.put(b'def')
+
+        self.assertEqual(b'abc', ioqueue.get_burst_nowait(max_size=2))
+        self.assertEqual(b'def', ioqueue.get_burst_nowait(max_size=2))
+
+
+class RingBufferTestCase(test_base.HyperVBaseTestCase):
+    def test_read_partially_filled(self):
+        ring_buffer = ioutils.RingBuffer(8)
+        ring_buffer.write(b'abc')
+
+        self.assertEqual(b'abc', ring_buffer.read())
+        self.assertEqual(b'bc', ring_buffer.read(2))
+        self.assertEqual(b'abc', ring_buffer.read(5))
+
+    def test_read_wrapped(self):
+        ring_buffer = ioutils.RingBuffer(8)
+        ring_buffer.write(b'abcdef')
+        ring_buffer.write(b'ghijk')
+
+        self.assertEqual(b'defghijk', ring_buffer.read())
+        self.assertEqual(b'ijk', ring_buffer.read(3))
+        self.assertEqual(11, ring_buffer.bytes_written)
+        self.assertEqual(8, ring_buffer.bytes_available)
+
+    def test_write_exceeding_size(self):
+        ring_buffer = ioutils.RingBuffer(4)
+        ring_buffer.write(b'ab')
+        ring_buffer.write(b'cdefghi')
+
+        self.assertEqual(b'fghi', ring_buffer.read())
+
+    def test_disabled(self):
+        ring_buffer = ioutils.RingBuffer(0)
+        ring_buffer.write(b'abc')
+
+        self.assertEqual(b'', ring_buffer.read())
@@ -0,0 +1,189 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+import struct
+
+import mock
+
+from hyperv.nova import isowriter
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class ISOWriterTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the in-process ISO 9660 image creation."""
+
+    _FAKE_FILES = [
+        ('openstack/latest/meta_data.json', u'{"uuid": "fake_uuid"}'),
+        ('openstack/latest/user_data', b'\x01' * 5000),
+        ('openstack/content/0000', b''),
+        ('ec2/2009-04-04/meta-data.json', b'fake_ec2_data')]
+
+    def _write_image(self, files):
+        image = isowriter._ISOImage(u'config-2', u'fake_publisher')
+        for path, data in files:
+            image.add_file(path, data)
+
+        f = io.BytesIO()
+        image_size = image.write(f)
+        self.assertEqual(image_size, len(f.getvalue()))
+        return f.getvalue()
+
+    @staticmethod
+    def _get_sector(image, sector):
+        offset = sector * isowriter.SECTOR_SIZE
+        return image[offset:offset + isowriter.SECTOR_SIZE]
+
+    def _read_dir_record(self, record):
+        extent, size = struct.unpack_from('<I4xI', record, 2)
+        identifier_length = struct.unpack_from('<B', record, 32)[0]
+        return record[33:33 + identifier_length], extent, size
+
+    def _list_dir(self, image, extent, size):
+        records = {}
+        data = image[extent * isowriter.SECTOR_SIZE:
+                     extent * isowriter.SECTOR_SIZE + size]
+        offset = 0
+        while offset < len(data):
+            length = struct.unpack_from('<B', data, offset)[0]
+            if not length:
+                # Records do not span sectors.
+                offset += (isowriter.SECTOR_SIZE -
+                           offset % isowriter.SECTOR_SIZE)
+                continue
+            identifier, child_extent, child_size = self._read_dir_record(
+                data[offset:offset + length])
+            records[identifier] = (child_extent, child_size)
+            offset += length
+        return records
+
+    def _read_file(self, image, descriptor_sector, path, encoding):
+        descriptor = self._get_sector(image, descriptor_sector)
+        identifier, extent, size = self._read_dir_record(
+            descriptor[156:190])
+        for name in path.split('/'):
+            extent, size = self._list_dir(image, extent, size)[
+                name.encode(encoding)]
+        offset = extent * isowriter.SECTOR_SIZE
+        return image[offset:offset + size]
+
+    def test_write_volume_descriptors(self):
+        image = self._write_image(self._FAKE_FILES)
+
+        primary_descriptor = self._get_sector(image, 16)
+        self.assertEqual(b'\x01CD001\x01', primary_descriptor[:7])
+        self.assertEqual(b'config-2'.ljust(32), primary_descriptor[40:72])
+        sector_count = struct.unpack_from('<I', primary_descriptor, 80)[0]
+        self.assertEqual(len(image), sector_count * isowriter.SECTOR_SIZE)
+
+        joliet_descriptor = self._get_sector(image, 17)
+        self.assertEqual(b'\x02CD001\x01', joliet_descriptor[:7])
+        self.assertEqual(b'%/E', joliet_descriptor[88:91])
+        self.assertEqual(u'config-2'.encode('utf-16-be'),
+                         joliet_descriptor[40:56])
+        self.assertEqual(b'\xffCD001\x01', self._get_sector(image, 18)[:7])
+
+    def test_write_primary_tree(self):
+        image = self._write_image(self._FAKE_FILES)
+
+        self.assertEqual(
+            b'{"uuid": "fake_uuid"}',
+            self._read_file(image, 16, 'OPENSTACK/LATEST/META_DATA.JSON;1',
+                            'ascii'))
+        self.assertEqual(
+            b'fake_ec2_data',
+            self._read_file(image, 16, 'EC2/2009_04_04/META_DATA.JSON;1',
+                            'ascii'))
+
+    def test_write_joliet_tree(self):
+        image = self._write_image(self._FAKE_FILES)
+
+        for path, data in self._FAKE_FILES:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self.assertEqual(
+                data, self._read_file(image, 17, path + ';1', 'utf-16-be'))
+
+    def test_write_large_directory(self):
+        # The directory records span multiple sectors.
+        files = [('content/file_with_a_long_name_%03d' % idx,
+                  b'%d' % idx) for idx in range(100)]
+
+        image = self._write_image(files)
+
+        for path, data in files:
+            self.assertEqual(
+                data, self._read_file(image, 17, path + ';1', 'utf-16-be'))
+
+    def test_get_iso_name(self):
+        self.assertEqual('META_DATA.JSON;1',
+                         isowriter._get_iso_name('meta_data.json', False))
+        self.assertEqual('A_B.C;1', isowriter._get_iso_name('a.b.c', False))
+        self.assertEqual('0000.;1', isowriter._get_iso_name('0000', False))
+        self.assertEqual('2012_08_10',
+                         isowriter._get_iso_name('2012-08-10', True))
+        self.assertEqual('A' * 26 + '.JSON;1',
+                         isowriter._get_iso_name('a' * 40 + '.json', False))
+
+    def test_add_file_invalid_name(self):
+        image = isowriter._ISOImage(u'config-2', u'')
+
+        for path in ('a/../b', 'a:b', 'a' * 63, ''):
+            self.assertRaises(vmutils.HyperVException, image.add_file,
+                              path, b'')
+
+    def test_add_file_duplicate_path(self):
+        image = isowriter._ISOImage(u'config-2', u'')
+        image.add_file('a/b', b'')
+
+        self.assertRaises(vmutils.HyperVException, image.add_file,
+                          'a/b', b'')
+        self.assertRaises(vmutils.HyperVException, image.add_file,
+                          'a/b/c', b'')
+
+    def test_write_conflicting_iso_names(self):
+        files = [('a-b', b''), ('a_b', b'')]
+
+        self.assertRaises(vmutils.HyperVException, self._write_image, files)
+
+    @mock.patch('os.fsync')
+    @mock.patch.object(isowriter, 'open', create=True)
+    @mock.patch.object(isowriter._ISOImage, 'write')
+    @mock.patch.object(isowriter._ISOImage, 'add_file')
+    def test_write_iso(self, mock_add_file, mock_write, mock_open,
+                       mock_fsync):
+        mock_file = mock_open.return_value.__enter__.return_value
+
+        image_size = isowriter.write_iso(
+            mock.sentinel.path, [(mock.sentinel.file_path, b'data')],
+            u'config-2')
+
+        self.assertEqual(mock_write.return_value, image_size)
+        mock_add_file.assert_called_once_with(mock.sentinel.file_path,
+                                              b'data')
+        mock_open.assert_called_once_with(mock.sentinel.path, 'wb')
+        mock_write.assert_called_once_with(mock_file)
+        mock_fsync.assert_called_once_with(mock_file.fileno.return_value)
+
+    @mock.patch('oslo_utils.fileutils.delete_if_exists')
+    @mock.patch.object(isowriter, 'open', create=True)
+    @mock.patch.object(isowriter._ISOImage, 'write')
+    def test_write_iso_failed(self, mock_write, mock_open, mock_delete):
+        mock_write.side_effect = IOError
+
+        self.assertRaises(IOError, isowriter.write_iso, mock.sentinel.path,
+                          [], u'config-2')
+        mock_delete.assert_called_once_with(mock.sentinel.path)
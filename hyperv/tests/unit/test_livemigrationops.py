@@ -34,7 +34,7 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
         self._livemigrops._block_dev_man = mock.MagicMock()
 
     @mock.patch('hyperv.nova.serialconsoleops.SerialConsoleOps.'
-                'stop_console_handler')
+                'stop_console_handler_async')
     @mock.patch('hyperv.nova.vmops.VMOps.copy_vm_dvd_disks')
     def _test_live_migration(self, mock_get_vm_dvd_paths,
                              mock_stop_console_handler, side_effect):
@@ -60,6 +60,8 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
 
             mock_stop_console_handler.assert_called_once_with(
                 mock_instance.name)
+            mock_stop_event = mock_stop_console_handler.return_value
+            mock_stop_event.wait.assert_called_once_with()
             mock_copy_logs = self._livemigrops._pathutils.copy_vm_console_logs
             mock_copy_logs.assert_called_once_with(mock_instance.name,
                                                    fake_dest)
@@ -103,6 +105,8 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
         check_config = (
             self._livemigrops._livemigrutils.check_live_migration_config)
         check_config.assert_called_once_with()
+        mock_get_pool_dir = self._livemigrops._pathutils.get_vm_shell_pool_dir
+        mock_get_pool_dir.assert_called_once_with()
         mock_is_boot_from_vol.assert_called_once_with(
             mock.sentinel.BLOCK_INFO)
         mock_get_cached_image.assert_called_once_with(self.context,
@@ -119,3 +123,7 @@ class LiveMigrationOpsTestCase(test_base.HyperVBaseTestCase):
             mock.sentinel.block_device_info)
         self._livemigrops._pathutils.get_instance_dir.assert_called_once_with(
             mock.sentinel.instance.name, create_dir=False, remove_dir=True)
+        # The configuration files of the VMs taken from the VM shell pool
+        # are moved by Hyper-V, the pool directory being left in place.
+        self.assertFalse(
+            self._livemigrops._pathutils.get_vm_shell_pool_dir.called)
@@ -46,6 +46,7 @@ class MigrationOpsTestCase(test_base.HyperVBaseTestCase):
         self._migrationops._volumeops = mock.MagicMock()
         self._migrationops._imagecache = mock.MagicMock()
         self._migrationops._block_dev_manager = mock.MagicMock()
+        self._migrationops._serial_console_ops = mock.MagicMock()
 
     def _check_migrate_disk_files(self, host):
         instance_path = 'fake/instance/path'
@@ -199,6 +200,10 @@ class MigrationOpsTestCase(test_base.HyperVBaseTestCase):
                                                   mock.sentinel.fake_bdi)
         self._migrationops._vmops.power_off.assert_called_once_with(
             instance, self._FAKE_TIMEOUT, self._FAKE_RETRY_INTERVAL)
+        mock_wait_for_handler_stop = (
+            self._migrationops._serial_console_ops
+            .wait_for_console_handler_stop)
+        mock_wait_for_handler_stop.assert_called_once_with(instance.name)
         mock_get_vm_st_path.assert_called_once_with(instance.name)
         mock_migrate_disk_files.assert_called_once_with(
             instance.name, disk_files, mock.sentinel.FAKE_DEST)
@@ -305,10 +310,14 @@ class MigrationOpsTestCase(test_base.HyperVBaseTestCase):
         base_vhd_copy_path = os.path.join(
             os.path.dirname(fake_diff_vhd_path),
             os.path.basename(fake_base_vhd_path))
+        mock_merge_vhd_chain = self._migrationops._vhdutils.merge_vhd_chain
+        mock_merge_vhd_chain.return_value = False
 
         self._migrationops._merge_base_vhd(diff_vhd_path=fake_diff_vhd_path,
                                            base_vhd_path=fake_base_vhd_path)
 
+        mock_merge_vhd_chain.assert_called_once_with(fake_diff_vhd_path,
+                                                     base_vhd_copy_path)
         self._migrationops._pathutils.copyfile.assert_called_once_with(
             fake_base_vhd_path, base_vhd_copy_path)
         recon_parent_vhd = self._migrationops._vhdutils.reconnect_parent_vhd
@@ -319,12 +328,32 @@ class MigrationOpsTestCase(test_base.HyperVBaseTestCase):
         self._migrationops._pathutils.rename.assert_called_once_with(
             base_vhd_copy_path, fake_diff_vhd_path)
 
+    def test_merge_base_vhd_native(self):
+        fake_diff_vhd_path = 'fake/diff/path'
+        fake_base_vhd_path = 'fake/base/path'
+        merged_vhd_path = os.path.join(
+            os.path.dirname(fake_diff_vhd_path),
+            os.path.basename(fake_base_vhd_path))
+        mock_merge_vhd_chain = self._migrationops._vhdutils.merge_vhd_chain
+        mock_merge_vhd_chain.return_value = True
+
+        self._migrationops._merge_base_vhd(diff_vhd_path=fake_diff_vhd_path,
+                                           base_vhd_path=fake_base_vhd_path)
+
+        mock_merge_vhd_chain.assert_called_once_with(fake_diff_vhd_path,
+                                                     merged_vhd_path)
+        self.assertFalse(self._migrationops._pathutils.copyfile.called)
+        self.assertFalse(self._migrationops._vhdutils.merge_vhd.called)
+        self._migrationops._pathutils.rename.assert_called_once_with(
+            merged_vhd_path, fake_diff_vhd_path)
+
     def test_merge_base_vhd_exception(self):
         fake_diff_vhd_path = 'fake/diff/path'
         fake_base_vhd_path = 'fake/base/path'
         base_vhd_copy_path = os.path.join(
             os.path.dirname(fake_diff_vhd_path),
             os.path.basename(fake_base_vhd_path))
+        self._migrationops._vhdutils.merge_vhd_chain.return_value = False
 
         self._migrationops._vhdutils.reconnect_parent_vhd.side_effect = (
             vmutils.HyperVException)
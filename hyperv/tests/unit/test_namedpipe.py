@@ -13,11 +13,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import errno
 import mock
-from six.moves import builtins
 
-from hyperv.nova import constants
+from hyperv.nova import consolelogwriter
 from hyperv.nova import namedpipe
 from hyperv.nova import vmutils
 from hyperv.tests.unit import test_base
@@ -33,6 +31,7 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
         self._mock_input_queue = mock.Mock()
         self._mock_output_queue = mock.Mock()
         self._mock_client_connected = mock.Mock()
+        self._mock_log_tail_buffer = mock.Mock()
 
         threading_patcher = mock.patch.object(namedpipe, 'threading')
         threading_patcher.start()
@@ -43,11 +42,12 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
             self._mock_input_queue,
             self._mock_output_queue,
             self._mock_client_connected,
-            self._FAKE_LOG_PATH)
+            self._FAKE_LOG_PATH,
+            self._mock_log_tail_buffer)
         self._handler._ioutils = mock.Mock()
 
     def _mock_setup_pipe_handler(self):
-        self._handler._log_file_handle = mock.Mock()
+        self._handler._log_writer = mock.Mock()
         self._handler._pipe_handle = mock.sentinel.pipe_handle
         self._handler._workers = [mock.Mock(), mock.Mock()]
         self._handler._r_buffer = mock.Mock()
@@ -57,15 +57,17 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
         self._handler._r_completion_routine = mock.Mock()
         self._handler._w_completion_routine = mock.Mock()
 
-    @mock.patch.object(builtins, 'open')
+    @mock.patch.object(consolelogwriter, 'get_log_writer')
     @mock.patch.object(namedpipe.NamedPipeHandler, '_open_pipe')
-    def test_start_pipe_handler(self, mock_open_pipe, mock_open):
+    def test_start_pipe_handler(self, mock_open_pipe, mock_get_log_writer):
+        mock_log_writer = mock_get_log_writer.return_value
+
         self._handler.start()
 
         mock_open_pipe.assert_called_once_with()
-        mock_open.assert_called_once_with(self._FAKE_LOG_PATH, 'ab', 1)
-        self.assertEqual(mock_open.return_value,
-                         self._handler._log_file_handle)
+        mock_log_writer.open_log.assert_called_once_with(
+            self._FAKE_LOG_PATH)
+        self.assertEqual(mock_log_writer, self._handler._log_writer)
 
         thread = namedpipe.threading.Thread
         thread.assert_has_calls(
@@ -95,7 +97,8 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
 
         self._handler._stopped.set.assert_called_once_with()
         mock_close_pipe.assert_called_once_with()
-        self._handler._log_file_handle.close.assert_called_once_with()
+        self._handler._log_writer.close_log.assert_called_once_with(
+            self._FAKE_LOG_PATH)
 
         self._handler._ioutils.set_event.assert_has_calls(
             [mock.call(self._handler._r_overlapped.hEvent),
@@ -167,69 +170,21 @@ class NamedPipeTestCase(test_base.HyperVBaseTestCase):
             self._handler._w_buffer, fake_data)
         self.assertEqual(len(fake_data), num_bytes)
 
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_rotate_logs')
-    def _test_write_to_log(self, mock_rotate_logs, size_exceeded=False):
+    def test_write_to_log(self):
         self._mock_setup_pipe_handler()
         self._handler._stopped.isSet.return_value = False
-        fake_handle = self._handler._log_file_handle
-        fake_handle.tell.return_value = (constants.MAX_CONSOLE_LOG_FILE_SIZE
-                                         if size_exceeded else 0)
-        fake_data = 'fake_data'
-
-        self._handler._write_to_log(fake_data)
-
-        if size_exceeded:
-            mock_rotate_logs.assert_called_once_with()
 
-        self._handler._log_file_handle.write.assert_called_once_with(
-            fake_data)
+        self._handler._write_to_log(mock.sentinel.data)
 
-    def test_write_to_log(self):
-        self._test_write_to_log()
-
-    def test_write_to_log_size_exceeded(self):
-        self._test_write_to_log(size_exceeded=True)
-
-    @mock.patch.object(namedpipe.NamedPipeHandler, '_retry_if_file_in_use')
-    @mock.patch.object(builtins, 'open')
-    @mock.patch.object(namedpipe, 'os')
-    def test_rotate_logs(self, mock_os, mock_open, mock_exec_retry):
-        fake_archived_log_path = self._FAKE_LOG_PATH + '.1'
-        mock_os.path.exists.return_value = True
+        self._mock_log_tail_buffer.write.assert_called_once_with(
+            mock.sentinel.data)
+        self._handler._log_writer.write.assert_called_once_with(
+            self._FAKE_LOG_PATH, mock.sentinel.data)
 
+    def test_write_to_log_stopped(self):
         self._mock_setup_pipe_handler()
-        fake_handle = self._handler._log_file_handle
-
-        self._handler._rotate_logs()
+        self._handler._stopped.isSet.return_value = True
 
-        fake_handle.flush.assert_called_once_with()
-        fake_handle.close.assert_called_once_with()
-        mock_os.path.exists.assert_called_once_with(
-            fake_archived_log_path)
+        self._handler._write_to_log(mock.sentinel.data)
 
-        mock_exec_retry.assert_has_calls([mock.call(mock_os.remove,
-                                                    fake_archived_log_path),
-                                          mock.call(mock_os.rename,
-                                                    self._FAKE_LOG_PATH,
-                                                    fake_archived_log_path)])
-
-        mock_open.assert_called_once_with(self._FAKE_LOG_PATH, 'ab', 1)
-        self.assertEqual(mock_open.return_value,
-                         self._handler._log_file_handle)
-
-    @mock.patch.object(namedpipe, 'time')
-    def test_retry_if_file_in_use_exceeded_retries(self, mock_time):
-        class FakeWindowsException(Exception):
-            errno = errno.EACCES
-
-        raise_count = self._handler._MAX_LOG_ROTATE_RETRIES + 1
-        mock_func_side_eff = [FakeWindowsException] * raise_count
-        mock_func = mock.Mock(side_effect=mock_func_side_eff)
-
-        with mock.patch.object(namedpipe, 'WindowsError',
-                               FakeWindowsException, create=True):
-            self.assertRaises(FakeWindowsException,
-                              self._handler._retry_if_file_in_use,
-                              mock_func, mock.sentinel.arg)
-            mock_time.sleep.assert_has_calls(
-                [mock.call(1)] * self._handler._MAX_LOG_ROTATE_RETRIES)
+        self.assertFalse(self._handler._log_writer.write.called)
@@ -172,6 +172,21 @@ class PathUtilsTestCase(test_base.HyperVBaseTestCase):
     def test_force_unmount_smb_share(self):
         self._test_unmount_smb_share(force=True)
 
+    @mock.patch.object(os.path, 'getsize')
+    @mock.patch.object(os, 'walk')
+    def test_get_dir_size(self, mock_walk, mock_getsize):
+        mock_walk.return_value = [('dir', ['subdir'], ['file1']),
+                                  (os.path.join('dir', 'subdir'), [],
+                                   ['file2'])]
+        mock_getsize.side_effect = [1, 2]
+
+        dir_size = self._pathutils.get_dir_size('dir')
+
+        self.assertEqual(3, dir_size)
+        mock_getsize.assert_has_calls(
+            [mock.call(os.path.join('dir', 'file1')),
+             mock.call(os.path.join('dir', 'subdir', 'file2'))])
+
     @mock.patch('shutil.rmtree')
     def test_rmtree(self, mock_rmtree):
         class WindowsError(Exception):
@@ -205,6 +220,128 @@ class PathUtilsTestCase(test_base.HyperVBaseTestCase):
                               self._pathutils._get_instances_sub_dir,
                               fake_dir_name)
 
+    @mock.patch.object(pathutils.PathUtils, 'get_instance_dir')
+    def test_get_vm_console_log_paths(self, mock_get_instance_dir):
+        self.flags(console_log_archive_count=2, group='hyperv')
+        mock_get_instance_dir.return_value = self.fake_instance_dir
+        fake_log_path = os.path.join(self.fake_instance_dir, 'console.log')
+
+        log_paths = self._pathutils.get_vm_console_log_paths(
+            self.fake_instance_name, mock.sentinel.remote_server)
+
+        mock_get_instance_dir.assert_called_once_with(
+            self.fake_instance_name, mock.sentinel.remote_server)
+        expected_paths = [fake_log_path,
+                          fake_log_path + '.1',
+                          fake_log_path + '.1.gz',
+                          fake_log_path + '.2.gz']
+        self.assertEqual(expected_paths, log_paths)
+
+    @mock.patch.object(pathutils, 'gzip')
+    @mock.patch.object(builtins, 'open')
+    def _test_open_console_log(self, mock_open, mock_gzip, compressed):
+        log_path = 'console.log.1.gz' if compressed else 'console.log'
+
+        ret_val = self._pathutils.open_console_log(log_path)
+
+        mock_opener = mock_gzip.open if compressed else mock_open
+        mock_opener.assert_called_once_with(log_path, 'rb')
+        self.assertEqual(mock_opener.return_value, ret_val)
+
+    def test_open_console_log(self):
+        self._test_open_console_log(compressed=False)
+
+    def test_open_compressed_console_log(self):
+        self._test_open_console_log(compressed=True)
+
+    @mock.patch.object(builtins, 'open')
+    def test_get_console_log_size_compressed(self, mock_open):
+        mock_file = mock_open.return_value.__enter__.return_value
+        mock_file.read.return_value = b'\x00\x02\x01\x00'
+
+        size = self._pathutils.get_console_log_size('console.log.1.gz')
+
+        mock_file.seek.assert_called_once_with(-4, os.SEEK_END)
+        self.assertEqual(66048, size)
+
+    @mock.patch('os.path.getsize')
+    def test_get_console_log_size(self, mock_getsize):
+        size = self._pathutils.get_console_log_size('console.log')
+
+        mock_getsize.assert_called_once_with('console.log')
+        self.assertEqual(mock_getsize.return_value, size)
+
+    @mock.patch.object(pathutils, 'utils')
+    @mock.patch.object(pathutils.PathUtils, '_copy_vhd')
+    def test_copy(self, mock_copy_vhd, mock_utils):
+        mock_copy_vhd.return_value = False
+        mock_utils.execute.return_value = (mock.sentinel.output, 0)
+
+        self._pathutils.copy(mock.sentinel.src, mock.sentinel.dest)
+
+        mock_copy_vhd.assert_called_once_with(mock.sentinel.src,
+                                              mock.sentinel.dest)
+        mock_utils.execute.assert_called_once_with(
+            'cmd.exe', '/C', 'copy', '/Y', mock.sentinel.src,
+            mock.sentinel.dest)
+
+    @mock.patch.object(pathutils, 'utils')
+    @mock.patch.object(pathutils.PathUtils, '_copy_vhd')
+    def test_copy_vhd_image(self, mock_copy_vhd, mock_utils):
+        mock_copy_vhd.return_value = True
+
+        self._pathutils.copy(mock.sentinel.src, mock.sentinel.dest)
+
+        self.assertFalse(mock_utils.execute.called)
+
+    @mock.patch('os.path.isdir')
+    @mock.patch.object(pathutils.ioutils, 'avoid_blocking_call')
+    def _test_copy_vhd(self, mock_avoid_blocking_call, mock_isdir,
+                       dest_is_dir=False, copy_exc=None):
+        self.flags(sparse_vhd_copy=True, group='hyperv')
+        mock_isdir.return_value = dest_is_dir
+        mock_avoid_blocking_call.side_effect = copy_exc
+        src = os.path.join(self.fake_instance_dir, 'src.VHDX')
+        dest = os.path.join('C:', 'dest_dir')
+        if not dest_is_dir:
+            dest = os.path.join(dest, 'dest.vhdx')
+
+        ret_val = self._pathutils._copy_vhd(src, dest)
+
+        expected_dest = os.path.join(dest, 'src.VHDX') if dest_is_dir else dest
+        mock_avoid_blocking_call.assert_called_once_with(
+            pathutils.vhdcopier.copy_vhd, src, expected_dest)
+        self.assertEqual(not copy_exc, ret_val)
+
+    def test_copy_vhd(self):
+        self._test_copy_vhd()
+
+    def test_copy_vhd_to_dir(self):
+        self._test_copy_vhd(dest_is_dir=True)
+
+    def test_copy_vhd_unsupported_image(self):
+        self._test_copy_vhd(copy_exc=vmutils.HyperVException)
+
+    @mock.patch.object(pathutils.vhdcopier, 'copy_vhd')
+    def test_copy_vhd_not_an_image(self, mock_copy_vhd):
+        self.flags(sparse_vhd_copy=True, group='hyperv')
+
+        ret_val = self._pathutils._copy_vhd('console.log',
+                                            mock.sentinel.dest)
+
+        self.assertFalse(ret_val)
+        self.assertFalse(mock_copy_vhd.called)
+
+    @mock.patch.object(pathutils.vhdcopier, 'copy_vhd')
+    def test_copy_vhd_disabled(self, mock_copy_vhd):
+        self.flags(sparse_vhd_copy=False, group='hyperv')
+
+        ret_val = self._pathutils._copy_vhd('src.vhd',
+                                            mock.sentinel.dest)
+
+        self.assertFalse(ret_val)
+        self.assertFalse(mock_copy_vhd.called)
+
     def test_copy_vm_console_logs(self):
         fake_local_logs = [mock.sentinel.log_path,
                            mock.sentinel.archived_log_path]
@@ -229,6 +366,40 @@ class PathUtilsTestCase(test_base.HyperVBaseTestCase):
             mock.call(mock.sentinel.archived_log_path,
                       mock.sentinel.remote_archived_log_path)])
 
+    @mock.patch.object(pathutils.PathUtils, '_get_instances_sub_dir')
+    def test_get_base_vhd_dir(self, mock_get_instances_sub_dir):
+        base_vhd_dir = self._pathutils.get_base_vhd_dir()
+
+        self.assertEqual(mock_get_instances_sub_dir.return_value,
+                         base_vhd_dir)
+        mock_get_instances_sub_dir.assert_called_once_with('_base')
+        self.assertFalse(self._pathutils.is_base_vhd_dir_shared())
+
+    @mock.patch.object(pathutils.PathUtils, '_get_instances_sub_dir')
+    def test_get_ephemeral_disk_pool_dir(self, mock_get_instances_sub_dir):
+        pool_dir = self._pathutils.get_ephemeral_disk_pool_dir()
+
+        self.assertEqual(mock_get_instances_sub_dir.return_value, pool_dir)
+        mock_get_instances_sub_dir.assert_called_once_with('_ephemeral_pool')
+
+    @mock.patch.object(pathutils.PathUtils, '_get_instances_sub_dir')
+    def test_get_vm_shell_pool_dir(self, mock_get_instances_sub_dir):
+        pool_dir = self._pathutils.get_vm_shell_pool_dir()
+
+        self.assertEqual(mock_get_instances_sub_dir.return_value, pool_dir)
+        mock_get_instances_sub_dir.assert_called_once_with('_vm_shells')
+
+    @mock.patch.object(pathutils.PathUtils, '_get_instances_sub_dir')
+    def test_get_shared_base_vhd_dir(self, mock_get_instances_sub_dir):
+        self.flags(shared_base_vhd_dir=r'\\fake_server\fake_share',
+                   group='hyperv')
+
+        base_vhd_dir = self._pathutils.get_base_vhd_dir()
+
+        self.assertEqual(r'\\fake_server\fake_share', base_vhd_dir)
+        self.assertFalse(mock_get_instances_sub_dir.called)
+        self.assertTrue(self._pathutils.is_base_vhd_dir_shared())
+
     @mock.patch.object(pathutils.PathUtils, 'get_base_vhd_dir')
     @mock.patch.object(pathutils.PathUtils, 'exists')
     def _test_lookup_image_basepath(self, mock_exists,
@@ -14,8 +14,8 @@
 #    under the License.
 
 import mock
-
 from nova import exception
+from oslo_config import cfg
 
 from hyperv.nova import constants
 from hyperv.nova import ioutils
@@ -25,6 +25,8 @@ from hyperv.nova import serialproxy
 from hyperv.nova import utilsfactory
 from hyperv.tests.unit import test_base
 
+CONF = cfg.CONF
+
 
 class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
     @mock.patch.object(utilsfactory, 'get_pathutils')
@@ -66,17 +68,32 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
         for worker in mock_workers:
             worker.stop.assert_called_once_with()
 
+    @mock.patch.object(serialconsolehandler, 'LOG')
+    def test_stop_handler_output_queue_stats(self, mock_log):
+        mock_output_queue = mock.Mock(bytes_queued=10, bytes_dropped=2)
+        self._consolehandler._output_queue = mock_output_queue
+
+        self._consolehandler.stop()
+
+        log_args = mock_log.info.call_args[0][1]
+        self.assertEqual(10, log_args['bytes_queued'])
+        self.assertEqual(2, log_args['bytes_dropped'])
+
+    @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
+                       '_setup_log_tail_buffer')
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
                        '_setup_named_pipe_handlers')
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
                        '_setup_serial_proxy_handler')
     def _test_setup_handlers(self, mock_setup_proxy, mock_setup_pipe_handlers,
+                             mock_setup_tail_buffer,
                              serial_console_enabled=True):
         self.flags(enabled=serial_console_enabled, group='serial_console')
 
         self._consolehandler._setup_handlers()
 
         self.assertEqual(serial_console_enabled, mock_setup_proxy.called)
+        mock_setup_tail_buffer.assert_called_once_with()
         mock_setup_pipe_handlers.assert_called_once_with()
 
     def test_setup_handlers(self):
@@ -93,7 +110,7 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
                                         mock_acquire_port,
                                         mock_serial_proxy_class):
         mock_input_queue = mock.sentinel.input_queue
-        mock_output_queue = mock.sentinel.output_queue
+        mock_output_queue = mock.Mock()
         mock_client_connected = mock_event.return_value
         mock_io_queue.side_effect = [mock_input_queue, mock_output_queue]
         mock_serial_proxy = mock_serial_proxy_class.return_value
@@ -111,8 +128,25 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
             mock_output_queue,
             mock_client_connected)
 
+        mock_io_queue.assert_has_calls([
+            mock.call(client_connected=mock_client_connected,
+                      max_size_bytes=CONF.hyperv.serial_console_queue_size),
+            mock.call(client_connected=mock_client_connected,
+                      max_size_bytes=CONF.hyperv.serial_console_queue_size,
+                      overflow_policy=(
+                          CONF.hyperv.serial_console_output_overflow_policy))])
+        mock_output_queue.set_drop_callback.assert_called_once_with(
+            self._consolehandler._on_output_dropped)
         self.assertIn(mock_serial_proxy, self._consolehandler._workers)
 
+    @mock.patch.object(serialconsolehandler, 'LOG')
+    def test_on_output_dropped(self, mock_log):
+        self._consolehandler._on_output_dropped(mock.sentinel.bytes_dropped)
+        self._consolehandler._on_output_dropped(mock.sentinel.bytes_dropped)
+
+        self.assertTrue(self._consolehandler._output_dropped)
+        self.assertEqual(1, mock_log.warning.call_count)
+
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
                        '_get_named_pipe_handler')
     @mock.patch.object(serialconsolehandler.SerialConsoleHandler,
@@ -177,7 +211,9 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
                 'connect_event': mock.sentinel.connect_event})
 
         if enable_logging:
+            self._consolehandler._log_tail_buffer = mock.sentinel.tail_buffer
             expected_args['log_file'] = mock.sentinel.log_path
+            expected_args['log_tail_buffer'] = mock.sentinel.tail_buffer
 
         ret_val = self._consolehandler._get_named_pipe_handler(
             mock.sentinel.pipe_path, pipe_type, enable_logging)
@@ -197,6 +233,70 @@ class SerialConsoleHandlerTestCase(test_base.HyperVBaseTestCase):
             pipe_type=constants.SERIAL_PORT_TYPE_RW,
             enable_logging=False)
 
+    @mock.patch('os.path.exists')
+    @mock.patch.object(ioutils, 'RingBuffer')
+    def test_setup_log_tail_buffer(self, mock_ring_buffer_class,
+                                   mock_exists):
+        self.flags(console_log_tail_buffer_size=10, group='hyperv')
+        mock_pathutils = mock.MagicMock()
+        self._consolehandler._pathutils = mock_pathutils
+        mock_pathutils.get_vm_console_log_paths.return_value = [
+            mock.sentinel.log_path, mock.sentinel.pending_archive_path,
+            mock.sentinel.archived_log_path, mock.sentinel.old_log_path]
+        mock_exists.side_effect = [True, False, True]
+        mock_pathutils.get_console_log_size.side_effect = [4, 15]
+        mock_file = (
+            mock_pathutils.open_console_log.return_value.__enter__
+            .return_value)
+        mock_file.read.side_effect = [b'live', b'rotated']
+
+        self._consolehandler._setup_log_tail_buffer()
+
+        mock_ring_buffer = mock_ring_buffer_class.return_value
+        mock_ring_buffer_class.assert_called_once_with(10)
+        mock_pathutils.open_console_log.assert_has_calls(
+            [mock.call(mock.sentinel.log_path),
+             mock.call(mock.sentinel.archived_log_path)],
+            any_order=True)
+        mock_file.seek.assert_has_calls([mock.call(0), mock.call(9)])
+        mock_ring_buffer.write.assert_has_calls(
+            [mock.call(b'rotated'), mock.call(b'live')])
+        self.assertEqual(mock_ring_buffer,
+                         self._consolehandler._log_tail_buffer)
+
+    @mock.patch('os.path.exists')
+    def test_setup_log_tail_buffer_exception(self, mock_exists):
+        mock_exists.return_value = True
+        mock_pathutils = self._consolehandler._pathutils
+        mock_pathutils.get_vm_console_log_paths.return_value = [
+            mock.sentinel.log_path]
+        mock_pathutils.open_console_log.side_effect = IOError
+
+        self._consolehandler._setup_log_tail_buffer()
+
+        self.assertIsNone(self._consolehandler._log_tail_buffer)
+
+    def test_setup_log_tail_buffer_disabled(self):
+        self.flags(console_log_tail_buffer_size=0, group='hyperv')
+
+        self._consolehandler._setup_log_tail_buffer()
+
+        self.assertIsNone(self._consolehandler._log_tail_buffer)
+
+    def test_get_console_log_tail(self):
+        mock_tail_buffer = mock.Mock(size=10)
+        self._consolehandler._log_tail_buffer = mock_tail_buffer
+
+        ret_val = self._consolehandler.get_console_log_tail(5)
+
+        mock_tail_buffer.read.assert_called_once_with(5)
+        self.assertEqual(mock_tail_buffer.read.return_value, ret_val)
+
+    def test_get_console_log_tail_exceeding_size(self):
+        self._consolehandler._log_tail_buffer = mock.Mock(size=10)
+
+        self.assertIsNone(self._consolehandler.get_console_log_tail(20))
+
     def _mock_get_port_connections(self, port_connections):
         get_port_connections = (
             self._consolehandler._vmutils.get_vm_serial_port_connections)
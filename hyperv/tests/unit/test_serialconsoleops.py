@@ -13,20 +13,25 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
+
 import mock
-from six.moves import builtins
 
 from nova import exception
+from oslo_config import cfg
 
+from hyperv.nova import consolelogwriter
 from hyperv.nova import serialconsolehandler
 from hyperv.nova import serialconsoleops
 from hyperv.tests.unit import test_base
 
+CONF = cfg.CONF
 
 class SerialConsoleOpsTestCase(test_base.HyperVBaseTestCase):
     def setUp(self):
         super(SerialConsoleOpsTestCase, self).setUp()
         serialconsoleops._console_handlers = {}
+        serialconsoleops._pending_handler_stops = {}
         self._serialops = serialconsoleops.SerialConsoleOps()
 
     def _setup_console_handler_mock(self):
@@ -75,6 +80,64 @@ class SerialConsoleOpsTestCase(test_base.HyperVBaseTestCase):
                 mock.sentinel.instance_name)
         self.assertIsNone(handler)
 
+    @mock.patch.object(serialconsoleops, 'eventlet')
+    def test_stop_console_handler_async(self, mock_eventlet):
+        mock_console_handler = self._setup_console_handler_mock()
+
+        stop_event = self._serialops.stop_console_handler_async(
+            mock.sentinel.instance_name)
+
+        mock_eventlet.spawn_n.assert_called_once_with(
+            self._serialops._stop_handler, mock.sentinel.instance_name,
+            mock_console_handler, stop_event)
+        self.assertFalse(stop_event.ready())
+        self.assertNotIn(mock.sentinel.instance_name,
+                         serialconsoleops._console_handlers)
+        self.assertEqual(
+            stop_event,
+            serialconsoleops._pending_handler_stops[
+                mock.sentinel.instance_name])
+
+    def test_stop_console_handler_async_pending(self):
+        serialconsoleops._pending_handler_stops[
+            mock.sentinel.instance_name] = mock.sentinel.stop_event
+
+        stop_event = self._serialops.stop_console_handler_async(
+            mock.sentinel.instance_name)
+
+        self.assertEqual(mock.sentinel.stop_event, stop_event)
+
+    def test_stop_console_handler_async_not_running(self):
+        stop_event = self._serialops.stop_console_handler_async(
+            mock.sentinel.instance_name)
+
+        self.assertTrue(stop_event.ready())
+
+    def test_stop_handler_exception(self):
+        mock_handler = mock.Mock()
+        mock_handler.stop.side_effect = Exception
+        mock_stop_event = mock.Mock()
+        serialconsoleops._pending_handler_stops[
+            mock.sentinel.instance_name] = mock_stop_event
+
+        self._serialops._stop_handler(mock.sentinel.instance_name,
+                                      mock_handler, mock_stop_event)
+
+        mock_handler.stop.assert_called_once_with()
+        mock_stop_event.send.assert_called_once_with()
+        self.assertNotIn(mock.sentinel.instance_name,
+                         serialconsoleops._pending_handler_stops)
+
+    def test_wait_for_console_handler_stop(self):
+        mock_stop_event = mock.Mock()
+        serialconsoleops._pending_handler_stops[
+            mock.sentinel.instance_name] = mock_stop_event
+
+        self._serialops.wait_for_console_handler_stop(
+            mock.sentinel.instance_name)
+
+        mock_stop_event.wait.assert_called_once_with()
+
     def test_get_serial_console(self):
         mock_console_handler = self._setup_console_handler_mock()
 
@@ -89,28 +152,300 @@ class SerialConsoleOpsTestCase(test_base.HyperVBaseTestCase):
                           self._serialops.get_serial_console,
                           mock.sentinel.instance_name)
 
-    @mock.patch.object(builtins, 'open')
-    @mock.patch("os.path.exists")
-    def test_get_console_output_exception(self, fake_path_exists, fake_open):
-        self._serialops._pathutils.get_vm_console_log_paths.return_value = [
-            mock.sentinel.log_path]
-        fake_open.side_effect = IOError
-        fake_path_exists.return_value = True
+    @mock.patch.object(consolelogwriter, 'get_log_writer')
+    def test_get_console_log_segments(self, mock_get_log_writer):
+        mock_pathutils = self._serialops._pathutils
+        mock_pathutils.get_vm_console_log_paths.return_value = [
+            'console.log', 'console.log.1', 'console.log.1.gz',
+            'console.log.2.gz']
+        # The most recently rotated log was compressed but not removed yet.
+        mock_pathutils.exists.side_effect = (
+            lambda path: path == 'console.log.1.gz')
+        mock_pathutils.get_console_log_size.side_effect = [
+            6, 10, OSError(errno.ENOENT, '')]
+
+        segments = self._serialops._get_console_log_segments(
+            mock.sentinel.instance_name)
+
+        mock_get_log_writer.return_value.flush_log.assert_called_once_with(
+            'console.log')
+        mock_pathutils.get_console_log_size.assert_has_calls(
+            [mock.call('console.log'), mock.call('console.log.1.gz'),
+             mock.call('console.log.2.gz')])
+        self.assertEqual([('console.log.1.gz', 10), ('console.log', 6)],
+                         segments)
+
+    @mock.patch.object(consolelogwriter, 'get_log_writer')
+    def test_get_console_log_segments_max_bytes(self, mock_get_log_writer):
+        mock_pathutils = self._serialops._pathutils
+        mock_pathutils.get_vm_console_log_paths.return_value = [
+            'console.log', 'console.log.1', 'console.log.1.gz',
+            'console.log.2.gz']
+        mock_pathutils.exists.return_value = False
+        mock_pathutils.get_console_log_size.side_effect = [6, 10]
+
+        segments = self._serialops._get_console_log_segments(
+            mock.sentinel.instance_name, max_bytes=12)
+
+        # The older archives are not needed.
+        self.assertEqual([('console.log.1', 10), ('console.log', 6)],
+                         segments)
+        self.assertEqual(2, mock_pathutils.get_console_log_size.call_count)
+
+    @mock.patch.object(consolelogwriter, 'get_log_writer')
+    def test_get_console_log_segments_exception(self, mock_get_log_writer):
+        mock_pathutils = self._serialops._pathutils
+        mock_pathutils.get_vm_console_log_paths.return_value = [
+            'console.log']
+        mock_pathutils.exists.return_value = False
+        mock_pathutils.get_console_log_size.side_effect = IOError(
+            errno.EACCES, '')
 
         self.assertRaises(exception.ConsoleLogOutputException,
-                          self._serialops.get_console_output,
+                          self._serialops._get_console_log_segments,
                           mock.sentinel.instance_name)
-        fake_open.assert_called_once_with(mock.sentinel.log_path, 'rb')
+
+    def test_read_console_log_chunk(self):
+        mock_open = self._serialops._pathutils.open_console_log
+        mock_file = mock_open.return_value.__enter__.return_value
+
+        data = self._serialops._read_console_log_chunk(
+            mock.sentinel.instance_name, mock.sentinel.log_path,
+            mock.sentinel.pos, mock.sentinel.size)
+
+        mock_open.assert_called_once_with(mock.sentinel.log_path)
+        mock_file.seek.assert_called_once_with(mock.sentinel.pos)
+        mock_file.read.assert_called_once_with(mock.sentinel.size)
+        self.assertEqual(mock_file.read.return_value, data)
+
+    def test_read_console_log_chunk_rotated(self):
+        self._serialops._pathutils.open_console_log.side_effect = IOError(
+            errno.ENOENT, '')
+
+        data = self._serialops._read_console_log_chunk(
+            mock.sentinel.instance_name, mock.sentinel.log_path, 0, 1)
+
+        self.assertEqual(b'', data)
+
+    def test_read_console_log_chunk_exception(self):
+        self._serialops._pathutils.open_console_log.side_effect = IOError
+
+        self.assertRaises(exception.ConsoleLogOutputException,
+                          self._serialops._read_console_log_chunk,
+                          mock.sentinel.instance_name,
+                          mock.sentinel.log_path, 0, 1)
+
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       '_read_console_log_chunk')
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       '_get_console_log_segments')
+    def _test_get_console_output(self, mock_get_segments, mock_read_chunk,
+                                 offset=None, length=None, max_bytes=None,
+                                 chunk_size=None, expected_reads=None):
+        logs = {mock.sentinel.archived_log_path: b'0123456789',
+                mock.sentinel.log_path: b'abcdef'}
+        mock_get_segments.return_value = [
+            (mock.sentinel.archived_log_path, 10),
+            (mock.sentinel.log_path, 6)]
+
+        def fake_read_chunk(instance_name, log_path, pos, size):
+            return logs[log_path][pos:pos + size]
+
+        mock_read_chunk.side_effect = fake_read_chunk
+        if max_bytes is not None:
+            self.flags(console_output_max_bytes=max_bytes, group='hyperv')
+
+        if chunk_size:
+            output = b''.join(self._serialops.iter_console_output(
+                mock.sentinel.instance_name, offset=offset or 0,
+                length=length, chunk_size=chunk_size))
+        else:
+            output = self._serialops.get_console_output(
+                mock.sentinel.instance_name, offset=offset, length=length)
+
+        expected_max_bytes = None
+        if offset is not None and offset < 0:
+            expected_max_bytes = -offset
+        elif offset is None and length is None and chunk_size is None:
+            expected_max_bytes = CONF.hyperv.console_output_max_bytes or None
+        mock_get_segments.assert_called_once_with(
+            mock.sentinel.instance_name, max_bytes=expected_max_bytes)
+
+        expected_output = (b'0123456789abcdef'[offset:] if offset
+                           else b'0123456789abcdef')
+        if max_bytes:
+            expected_output = expected_output[-max_bytes:]
+        if length is not None:
+            expected_output = expected_output[:length]
+        self.assertEqual(expected_output, output)
+
+        if expected_reads is not None:
+            mock_read_chunk.assert_has_calls(
+                [mock.call(mock.sentinel.instance_name, log_path, pos, size)
+                 for log_path, pos, size in expected_reads])
+            self.assertEqual(len(expected_reads), mock_read_chunk.call_count)
+
+    def test_get_console_output(self):
+        self._test_get_console_output(
+            expected_reads=[(mock.sentinel.archived_log_path, 0, 10),
+                            (mock.sentinel.log_path, 0, 6)])
+
+    def test_get_console_output_unlimited(self):
+        self._test_get_console_output(
+            max_bytes=0,
+            expected_reads=[(mock.sentinel.archived_log_path, 0, 10),
+                            (mock.sentinel.log_path, 0, 6)])
+
+    def test_get_console_output_max_bytes(self):
+        self._test_get_console_output(
+            max_bytes=4, expected_reads=[(mock.sentinel.log_path, 2, 4)])
+
+    def test_get_console_output_range(self):
+        self._test_get_console_output(
+            offset=8, length=4,
+            expected_reads=[(mock.sentinel.archived_log_path, 8, 2),
+                            (mock.sentinel.log_path, 0, 2)])
+
+    def test_get_console_output_tail(self):
+        self._test_get_console_output(offset=-12, max_bytes=100)
+
+    def test_get_console_output_default_from_memory(self):
+        # By default, the console output is served from the in-memory
+        # buffer, the console logs not being read.
+        mock_handler = mock.Mock()
+        serialconsoleops._console_handlers[mock.sentinel.instance_name] = (
+            mock_handler)
+        self.addCleanup(serialconsoleops._console_handlers.clear)
+
+        output = self._serialops.get_console_output(
+            mock.sentinel.instance_name)
+
+        self.assertEqual(mock_handler.get_console_log_tail.return_value,
+                         output)
+        mock_handler.get_console_log_tail.assert_called_once_with(
+            CONF.hyperv.console_output_max_bytes)
+        self.assertLessEqual(CONF.hyperv.console_output_max_bytes,
+                             CONF.hyperv.console_log_tail_buffer_size)
+
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       'iter_console_output')
+    def _test_get_console_output_from_memory(self, mock_iter_output,
+                                             output_available=True):
+        mock_handler = mock.Mock()
+        mock_handler.get_console_log_tail.return_value = (
+            mock.sentinel.output if output_available else None)
+        mock_iter_output.return_value = [b'fake_output']
+        serialconsoleops._console_handlers[mock.sentinel.instance_name] = (
+            mock_handler)
+        self.addCleanup(serialconsoleops._console_handlers.clear)
+        self.flags(console_output_max_bytes=10, group='hyperv')
+
+        output = self._serialops.get_console_output(
+            mock.sentinel.instance_name)
+
+        mock_handler.get_console_log_tail.assert_called_once_with(10)
+        if output_available:
+            self.assertEqual(mock.sentinel.output, output)
+            self.assertFalse(mock_iter_output.called)
+        else:
+            self.assertEqual(b'fake_output', output)
+            mock_iter_output.assert_called_once_with(
+                mock.sentinel.instance_name, offset=-10, length=None)
+
+    def test_get_console_output_from_memory(self):
+        self._test_get_console_output_from_memory()
+
+    def test_get_console_output_from_memory_unavailable(self):
+        self._test_get_console_output_from_memory(output_available=False)
+
+    def test_iter_console_output_chunks(self):
+        self._test_get_console_output(
+            offset=6, chunk_size=3,
+            expected_reads=[(mock.sentinel.archived_log_path, 6, 3),
+                            (mock.sentinel.archived_log_path, 9, 1),
+                            (mock.sentinel.log_path, 0, 3),
+                            (mock.sentinel.log_path, 3, 3)])
+
+    @mock.patch.object(serialconsoleops, 'eventlet')
+    def test_start_console_handlers(self, mock_eventlet):
+        self._serialops.start_console_handlers()
+
+        mock_eventlet.spawn_n.assert_called_once_with(
+            self._serialops._start_console_handlers)
+
+    @mock.patch.object(serialconsoleops.SerialConsoleOps,
+                       '_start_console_handler_on_startup')
+    def test_start_console_handlers_in_background(self, mock_start_handler):
+        self.flags(console_handler_startup_workers=2, group='hyperv')
+        instances = ['instance0', 'instance1', 'instance2', 'instance3']
+        self._serialops._vmutils.get_active_instances.return_value = (
+            instances)
+        mock_start_handler.side_effect = [True, False, None, True]
+
+        with mock.patch.object(serialconsoleops, 'LOG') as mock_log:
+            self._serialops._start_console_handlers()
+
+        mock_start_handler.assert_has_calls(
+            [mock.call(instance_name) for instance_name in instances],
+            any_order=True)
+        mock_log.warning.assert_called_once_with(
+            mock.ANY, {'instances': 'instance1'})
+        log_args = mock_log.info.call_args[0][1]
+        self.assertEqual(2, log_args['started_count'])
+        self.assertEqual(1, log_args['failed_count'])
 
     @mock.patch('os.path.exists')
     @mock.patch.object(serialconsoleops.SerialConsoleOps,
                        'start_console_handler')
-    def test_start_console_handlers(self, mock_get_instance_dir, mock_exists):
-        self._serialops._pathutils.get_instance_dir.return_value = [
-            mock.sentinel.nova_instance_name,
-            mock.sentinel.other_instance_name]
-        mock_exists.side_effect = [True, False]
+    def _test_start_console_handler_on_startup(self, mock_start_handler,
+                                               mock_exists,
+                                               nova_instance=True,
+                                               started=True,
+                                               running=False,
+                                               exc=None):
+        mock_exists.return_value = nova_instance
+        mock_start_handler.side_effect = exc
+        if running:
+            serialconsoleops._console_handlers[
+                mock.sentinel.instance_name] = mock.sentinel.handler
 
-        self._serialops.start_console_handlers()
+        def fake_start_handler(instance_name):
+            if started:
+                serialconsoleops._console_handlers[instance_name] = (
+                    mock.sentinel.handler)
+
+        if not exc:
+            mock_start_handler.side_effect = fake_start_handler
+
+        ret_val = self._serialops._start_console_handler_on_startup(
+            mock.sentinel.instance_name)
+
+        mock_exists.assert_called_once_with(
+            self._serialops._pathutils.get_instance_dir.return_value)
+        if nova_instance and not running:
+            mock_start_handler.assert_called_once_with(
+                mock.sentinel.instance_name)
+        else:
+            self.assertFalse(mock_start_handler.called)
+
+        if not nova_instance:
+            expected_ret_val = None
+        else:
+            expected_ret_val = (started or running) and not exc
+        self.assertEqual(expected_ret_val, ret_val)
+
+    def test_start_console_handler_on_startup(self):
+        self._test_start_console_handler_on_startup()
+
+    def test_start_console_handler_on_startup_failed(self):
+        self._test_start_console_handler_on_startup(started=False)
+
+    def test_start_console_handler_on_startup_exception(self):
+        self._test_start_console_handler_on_startup(started=False,
+                                                    exc=Exception)
+
+    def test_start_console_handler_on_startup_running(self):
+        self._test_start_console_handler_on_startup(running=True)
 
-        self._serialops._vmutils.get_active_instances.assert_called_once_with()
+    def test_start_console_handler_on_startup_other_instance(self):
+        self._test_start_console_handler_on_startup(nova_instance=False)
@@ -13,10 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
+
 import mock
 from nova import exception
 import socket
 
+from hyperv.nova import ioutils
 from hyperv.nova import serialproxy
 from hyperv.tests.unit import test_base
 
@@ -58,17 +61,67 @@ class SerialProxyTestCase(test_base.HyperVBaseTestCase):
         fake_socket.bind.assert_called_once_with((mock.sentinel.host,
                                                   mock.sentinel.port))
 
+    @mock.patch.object(serialproxy, 'get_proxy_service')
+    @mock.patch.object(serialproxy.SerialProxy, '_setup_socket')
+    def test_start_serial_proxy(self, mock_setup_socket,
+                                mock_get_proxy_service):
+        mock_service = mock_get_proxy_service.return_value
+
+        self._proxy.start()
+
+        mock_setup_socket.assert_called_once_with()
+        self._mock_output_queue.set_put_callback.assert_called_once_with(
+            mock.ANY)
+        mock_service.notify.assert_called_once_with(self._proxy)
+
     def test_stop_serial_proxy(self):
-        self._proxy._conn = mock.Mock()
+        mock_conn = mock.Mock()
+        self._proxy._conn = mock_conn
         self._proxy._sock = mock.Mock()
+        self._proxy._proxy_service = mock.Mock()
 
         self._proxy.stop()
 
         self._proxy._stopped.set.assert_called_once_with()
         self._proxy._client_connected.clear.assert_called_once_with()
-        self._proxy._conn.shutdown.assert_called_once_with(socket.SHUT_RDWR)
-        self._proxy._conn.close.assert_called_once_with()
+        mock_conn.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+        mock_conn.close.assert_called_once_with()
         self._proxy._sock.close.assert_called_once_with()
+        self._mock_output_queue.set_put_callback.assert_called_once_with(
+            None)
+        self._proxy._proxy_service.notify.assert_called_once_with(
+            self._proxy)
+
+    def test_get_io_events_not_connected(self):
+        self._proxy._sock = mock.sentinel.sock
+
+        sock, events = self._proxy.get_io_events()
+
+        self.assertEqual(mock.sentinel.sock, sock)
+        self.assertEqual(serialproxy.EVENT_READ, events)
+
+    def _test_get_io_events(self, send_buffer=b'', pending_input=None,
+                            expected_events=0):
+        self._proxy._conn = mock.sentinel.conn
+        self._proxy._send_buffer = send_buffer
+        self._proxy._pending_input = pending_input
+
+        sock, events = self._proxy.get_io_events()
+
+        self.assertEqual(mock.sentinel.conn, sock)
+        self.assertEqual(expected_events, events)
+
+    def test_get_io_events_idle(self):
+        self._test_get_io_events(expected_events=serialproxy.EVENT_READ)
+
+    def test_get_io_events_pending_output(self):
+        self._test_get_io_events(
+            send_buffer=mock.sentinel.data,
+            expected_events=(serialproxy.EVENT_READ |
+                             serialproxy.EVENT_WRITE))
+
+    def test_get_io_events_input_blocked(self):
+        self._test_get_io_events(pending_input=mock.sentinel.data)
 
     def test_accept_connection(self):
         mock_conn = mock.Mock()
@@ -76,43 +129,183 @@ class SerialProxyTestCase(test_base.HyperVBaseTestCase):
         self._proxy._sock.accept.return_value = [
             mock_conn, (mock.sentinel.client_addr, mock.sentinel.client_port)]
 
-        self._proxy._accept_conn()
+        self._proxy.handle_io_events(serialproxy.EVENT_READ)
 
+        mock_conn.setblocking.assert_called_once_with(False)
         self._proxy._client_connected.set.assert_called_once_with()
-        mock_conn.close.assert_called_once_with()
-        self.assertIsNone(self._proxy._conn)
-
-        thread = serialproxy.threading.Thread
-        for job in [self._proxy._get_data,
-                    self._proxy._send_data]:
-            thread.assert_any_call(target=job)
+        self.assertEqual(mock_conn, self._proxy._conn)
 
     def test_get_data(self):
-        self._mock_client_connected.isSet.return_value = True
         self._proxy._conn = mock.Mock()
-        self._proxy._conn.recv.side_effect = [mock.sentinel.data, None]
+        self._proxy._conn.recv.return_value = mock.sentinel.data
+
+        self._proxy._get_data()
+
+        self._mock_input_queue.put_nowait.assert_called_once_with(
+            mock.sentinel.data)
+        self.assertFalse(self._proxy.input_blocked)
+
+    def test_get_data_input_queue_full(self):
+        self._proxy._conn = mock.Mock()
+        self._proxy._conn.recv.return_value = mock.sentinel.data
+        self._mock_input_queue.put_nowait.side_effect = ioutils.Queue.Full
+
+        self._proxy._get_data()
+
+        self.assertTrue(self._proxy.input_blocked)
+        self.assertEqual(mock.sentinel.data, self._proxy._pending_input)
+
+    def test_get_data_client_disconnected(self):
+        mock_conn = mock.Mock()
+        mock_conn.recv.return_value = b''
+        self._proxy._conn = mock_conn
 
         self._proxy._get_data()
 
         self._mock_client_connected.clear.assert_called_once_with()
-        self._mock_input_queue.put.assert_called_once_with(mock.sentinel.data)
+        mock_conn.close.assert_called_once_with()
+        self.assertIsNone(self._proxy._conn)
 
     def _test_send_data(self, exception=None):
-        self._mock_client_connected.isSet.side_effect = [True, False]
-        self._mock_output_queue.get_burst.return_value = mock.sentinel.data
-        self._proxy._conn = mock.Mock()
-        self._proxy._conn.sendall.side_effect = exception
+        mock_conn = mock.Mock()
+        mock_conn.send.side_effect = exception or [3]
+        self._proxy._conn = mock_conn
+        self._proxy._send_buffer = b'fake_data'
 
         self._proxy._send_data()
 
-        self._proxy._conn.sendall.assert_called_once_with(
-            mock.sentinel.data)
+        mock_conn.send.assert_called_once_with(b'fake_data')
 
         if exception:
             self._proxy._client_connected.clear.assert_called_once_with()
+            self.assertIsNone(self._proxy._conn)
+        else:
+            self.assertEqual(b'e_data', self._proxy._send_buffer)
 
     def test_send_data(self):
         self._test_send_data()
 
     def test_send_data_exception(self):
         self._test_send_data(exception=socket.error)
+
+    def test_send_data_would_block(self):
+        mock_conn = mock.Mock()
+        mock_conn.send.side_effect = socket.error(errno.EWOULDBLOCK, '')
+        self._proxy._conn = mock_conn
+
+        self._proxy._send_data()
+
+        self.assertFalse(self._mock_client_connected.clear.called)
+        self.assertEqual(mock_conn, self._proxy._conn)
+
+    def test_fill_send_buffer(self):
+        self._proxy._conn = mock.sentinel.conn
+        self._mock_output_queue.get_burst_nowait.return_value = (
+            mock.sentinel.data)
+
+        self._proxy.fill_send_buffer()
+
+        self.assertEqual(mock.sentinel.data, self._proxy._send_buffer)
+
+
+class SerialProxyServiceTestCase(test_base.HyperVBaseTestCase):
+    @mock.patch.object(serialproxy, '_socketpair')
+    @mock.patch.object(serialproxy, '_get_selector')
+    def setUp(self, mock_get_selector, mock_socketpair):
+        super(SerialProxyServiceTestCase, self).setUp()
+
+        self._mock_wakeup_reader = mock.Mock()
+        self._mock_wakeup_writer = mock.Mock()
+        mock_socketpair.return_value = (self._mock_wakeup_reader,
+                                        self._mock_wakeup_writer)
+
+        self._service = serialproxy.SerialProxyService()
+        self._mock_selector = mock_get_selector.return_value
+        self._mock_selector.register.assert_called_once_with(
+            self._mock_wakeup_reader, serialproxy.EVENT_READ)
+        self._mock_selector.reset_mock()
+
+    def test_notify(self):
+        self._service.notify(mock.sentinel.proxy)
+
+        self.assertIn(mock.sentinel.proxy, self._service._pending_proxies)
+        self._mock_wakeup_writer.send.assert_called_once_with(b'\0')
+
+    def _get_mock_proxy(self, stopped=False, events=serialproxy.EVENT_READ,
+                        input_blocked=False):
+        mock_proxy = mock.Mock(stopped=stopped, input_blocked=input_blocked)
+        mock_proxy.get_io_events.return_value = (mock.sentinel.sock, events)
+        return mock_proxy
+
+    def test_update_proxy_register(self):
+        mock_proxy = self._get_mock_proxy()
+
+        self._service._update_proxy(mock_proxy)
+
+        mock_proxy.fill_send_buffer.assert_called_once_with()
+        self._mock_selector.register.assert_called_once_with(
+            mock.sentinel.sock, serialproxy.EVENT_READ, mock_proxy)
+        self.assertEqual(
+            (mock.sentinel.sock, serialproxy.EVENT_READ),
+            self._service._registered_proxies[mock_proxy])
+
+    def test_update_proxy_modify(self):
+        events = serialproxy.EVENT_READ | serialproxy.EVENT_WRITE
+        mock_proxy = self._get_mock_proxy(events=events)
+        self._service._registered_proxies[mock_proxy] = (
+            mock.sentinel.sock, serialproxy.EVENT_READ)
+
+        self._service._update_proxy(mock_proxy)
+
+        self._mock_selector.modify.assert_called_once_with(
+            mock.sentinel.sock, events, mock_proxy)
+
+    def test_update_proxy_input_blocked(self):
+        mock_proxy = self._get_mock_proxy(events=0, input_blocked=True)
+        self._service._registered_proxies[mock_proxy] = (
+            mock.sentinel.sock, serialproxy.EVENT_READ)
+
+        self._service._update_proxy(mock_proxy)
+
+        self._mock_selector.unregister.assert_called_once_with(
+            mock.sentinel.sock)
+        self.assertIn(mock_proxy, self._service._blocked_proxies)
+        self.assertNotIn(mock_proxy, self._service._registered_proxies)
+
+    def test_update_stopped_proxy(self):
+        mock_proxy = self._get_mock_proxy(stopped=True)
+        self._service._registered_proxies[mock_proxy] = (
+            mock.sentinel.sock, serialproxy.EVENT_READ)
+        self._service._blocked_proxies.add(mock_proxy)
+
+        self._service._update_proxy(mock_proxy)
+
+        self.assertFalse(mock_proxy.fill_send_buffer.called)
+        self._mock_selector.unregister.assert_called_once_with(
+            mock.sentinel.sock)
+        self.assertNotIn(mock_proxy, self._service._blocked_proxies)
+
+    @mock.patch.object(serialproxy.SerialProxyService, '_update_proxy')
+    def test_run_once(self, mock_update_proxy):
+        mock_proxy = self._get_mock_proxy()
+        mock_blocked_proxy = self._get_mock_proxy()
+        mock_blocked_proxy.flush_pending_input.return_value = False
+        self._service._pending_proxies.add(mock_proxy)
+        self._service._blocked_proxies.add(mock_blocked_proxy)
+
+        wakeup_key = mock.Mock(data=None)
+        proxy_key = mock.Mock(data=mock_proxy)
+        self._mock_selector.select.return_value = [
+            (wakeup_key, serialproxy.EVENT_READ),
+            (proxy_key, serialproxy.EVENT_WRITE)]
+        self._mock_wakeup_reader.recv.side_effect = socket.error
+
+        self._service._run_once()
+
+        self._mock_selector.select.assert_called_once_with(
+            serialproxy.BLOCKED_INPUT_RETRY_INTERVAL)
+        self._mock_wakeup_reader.recv.assert_called_once_with(mock.ANY)
+        mock_proxy.handle_io_events.assert_called_once_with(
+            serialproxy.EVENT_WRITE)
+        mock_update_proxy.assert_has_calls([mock.call(mock_proxy)] * 2)
+        self.assertEqual(set(), self._service._pending_proxies)
@@ -17,8 +17,12 @@ import os
 
 import mock
 from nova.compute import task_states
+from nova import exception
 
+from hyperv.nova import constants
+from hyperv.nova import ioutils
 from hyperv.nova import snapshotops
+from hyperv.nova import vmutils
 from hyperv.tests import fake_instance
 from hyperv.tests.unit import test_base
 
@@ -26,6 +30,8 @@ from hyperv.tests.unit import test_base
 class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
     """Unit tests for the Hyper-V SnapshotOps class."""
 
+    _FAKE_IMAGE_ID = '5d8be4c6-2ae8-4a5c-8e26-0b0ab0a4b5b1'
+
     def setUp(self):
         super(SnapshotOpsTestCase, self).setUp()
 
@@ -56,7 +62,9 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
             self._snapshotops._pathutils.open().__enter__())
 
     @mock.patch('hyperv.nova.snapshotops.SnapshotOps._save_glance_image')
-    def _test_snapshot(self, mock_save_glance_image, base_disk_path):
+    def _test_snapshot(self, mock_save_glance_image, base_disk_path,
+                       native_merge=False):
+        self.flags(stream_snapshots=False, group='hyperv')
         mock_instance = fake_instance.fake_instance_obj(self.context)
         mock_update = mock.MagicMock()
         fake_src_path = os.path.join('fake', 'path')
@@ -66,6 +74,8 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
         self._snapshotops._pathutils.get_export_dir.return_value = fake_exp_dir
         self._snapshotops._vhdutils.get_vhd_parent_path.return_value = (
             base_disk_path)
+        mock_merge_vhd_chain = self._snapshotops._vhdutils.merge_vhd_chain
+        mock_merge_vhd_chain.return_value = native_merge
         fake_snapshot_path = (
             self._snapshotops._vmutils.take_vm_snapshot.return_value)
 
@@ -88,7 +98,14 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
                                            os.path.basename(fake_src_path)))]
         dest_vhd_path = os.path.join(fake_exp_dir,
                                      os.path.basename(fake_src_path))
-        if base_disk_path:
+        if base_disk_path and native_merge:
+            mock_merge_vhd_chain.assert_called_once_with(fake_src_path,
+                                                         dest_vhd_path)
+            self.assertFalse(self._snapshotops._pathutils.copyfile.called)
+            self.assertFalse(self._snapshotops._vhdutils.merge_vhd.called)
+            mock_save_glance_image.assert_called_once_with(
+                self.context, mock.sentinel.IMAGE_ID, dest_vhd_path)
+        elif base_disk_path:
             basename = os.path.basename(base_disk_path)
             base_dest_disk_path = os.path.join(fake_exp_dir, basename)
             expected.append(mock.call(base_disk_path, base_dest_disk_path))
@@ -100,14 +117,16 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
             mock_save_glance_image.assert_called_once_with(
                 self.context, mock.sentinel.IMAGE_ID, base_dest_disk_path)
         else:
+            self.assertFalse(mock_merge_vhd_chain.called)
             mock_save_glance_image.assert_called_once_with(
                 self.context, mock.sentinel.IMAGE_ID, dest_vhd_path)
-        self._snapshotops._pathutils.copyfile.has_calls(expected)
+        if not native_merge:
+            self._snapshotops._pathutils.copyfile.assert_has_calls(expected)
         expected_update = [
             mock.call(task_state=task_states.IMAGE_PENDING_UPLOAD),
             mock.call(task_state=task_states.IMAGE_UPLOADING,
                       expected_state=task_states.IMAGE_PENDING_UPLOAD)]
-        mock_update.has_calls(expected_update)
+        mock_update.assert_has_calls(expected_update)
         self._snapshotops._vmutils.remove_vm_snapshot.assert_called_once_with(
             fake_snapshot_path)
         self._snapshotops._pathutils.rmtree.assert_called_once_with(
@@ -117,5 +136,289 @@ class SnapshotOpsTestCase(test_base.HyperVBaseTestCase):
         base_disk_path = os.path.join('fake', 'disk')
         self._test_snapshot(base_disk_path=base_disk_path)
 
+    def test_snapshot_native_merge(self):
+        base_disk_path = os.path.join('fake', 'disk')
+        self._test_snapshot(base_disk_path=base_disk_path, native_merge=True)
+
     def test_snapshot_no_base_disk(self):
         self._test_snapshot(base_disk_path=None)
+
+    @mock.patch.object(snapshotops.SnapshotOps, '_upload_glance_image')
+    @mock.patch.object(snapshotops.SnapshotOps, '_get_image_stream')
+    def test_snapshot_streamed(self, mock_get_image_stream,
+                               mock_upload_glance_image):
+        mock_instance = fake_instance.fake_instance_obj(self.context)
+        mock_update = mock.MagicMock()
+        mock_image_stream = mock_get_image_stream.return_value
+        mock_image_stream.bytes_read = 10
+        fake_src_path = (
+            self._snapshotops._pathutils.lookup_root_vhd_path.return_value)
+        fake_snapshot_path = (
+            self._snapshotops._vmutils.take_vm_snapshot.return_value)
+
+        def fake_upload(context, image_id, data):
+            # The VM snapshot is released once the disk chain is read.
+            on_complete = mock_get_image_stream.call_args[0][1]
+            on_complete()
+            (self._snapshotops._vmutils.remove_vm_snapshot.
+                assert_called_once_with(fake_snapshot_path))
+
+        mock_upload_glance_image.side_effect = fake_upload
+
+        self._snapshotops.snapshot(context=self.context,
+                                   instance=mock_instance,
+                                   image_id=mock.sentinel.IMAGE_ID,
+                                   update_task_state=mock_update)
+
+        mock_get_image_stream.assert_called_once_with(fake_src_path,
+                                                      mock.ANY)
+        mock_upload_glance_image.assert_called_once_with(
+            self.context, mock.sentinel.IMAGE_ID, mock_image_stream)
+        mock_image_stream.close.assert_called_once_with()
+        self._snapshotops._vmutils.remove_vm_snapshot.assert_called_once_with(
+            fake_snapshot_path)
+        self.assertFalse(self._snapshotops._pathutils.get_export_dir.called)
+        self.assertFalse(self._snapshotops._pathutils.copyfile.called)
+        self.assertFalse(self._snapshotops._pathutils.rmtree.called)
+        mock_update.assert_has_calls([
+            mock.call(task_state=task_states.IMAGE_PENDING_UPLOAD),
+            mock.call(task_state=task_states.IMAGE_UPLOADING,
+                      expected_state=task_states.IMAGE_PENDING_UPLOAD)])
+
+    @mock.patch.object(snapshotops.SnapshotOps, '_upload_glance_image')
+    @mock.patch.object(snapshotops.SnapshotOps, '_get_image_stream')
+    def test_snapshot_streamed_upload_failed(self, mock_get_image_stream,
+                                             mock_upload_glance_image):
+        mock_instance = fake_instance.fake_instance_obj(self.context)
+        mock_upload_glance_image.side_effect = IOError
+
+        self.assertRaises(IOError, self._snapshotops.snapshot,
+                          self.context, mock_instance,
+                          mock.sentinel.IMAGE_ID, mock.MagicMock())
+
+        mock_get_image_stream.return_value.close.assert_called_once_with()
+        self._snapshotops._vmutils.remove_vm_snapshot.assert_called_once_with(
+            self._snapshotops._vmutils.take_vm_snapshot.return_value)
+
+    @mock.patch('nova.image.glance.get_remote_image_service')
+    def test_upload_glance_image(self, mock_get_remote_image_service):
+        glance_image_service = mock.MagicMock()
+        mock_get_remote_image_service.return_value = (glance_image_service,
+                                                      mock.sentinel.IMAGE_ID)
+
+        self._snapshotops._upload_glance_image(
+            self.context, mock.sentinel.IMAGE_ID, mock.sentinel.data)
+
+        glance_image_service.update.assert_called_once_with(
+            self.context, mock.sentinel.IMAGE_ID, mock.ANY,
+            mock.sentinel.data)
+
+    def test_get_image_stream(self):
+        mock_get_chunks = self._snapshotops._vhdutils.get_merged_vhd_chunks
+        mock_get_chunks.return_value = [b'data']
+        mock_on_complete = mock.Mock()
+
+        image_stream = self._snapshotops._get_image_stream(
+            mock.sentinel.path, mock_on_complete)
+
+        mock_get_chunks.assert_called_once_with(mock.sentinel.path)
+        self.assertEqual(b'data', image_stream.read())
+        mock_on_complete.assert_called_once_with()
+
+    def test_get_image_stream_unsupported_chain(self):
+        mock_get_chunks = self._snapshotops._vhdutils.get_merged_vhd_chunks
+        mock_get_chunks.side_effect = vmutils.HyperVException
+
+        image_stream = self._snapshotops._get_image_stream(
+            mock.sentinel.path, mock.sentinel.on_complete)
+
+        self.assertIsNone(image_stream)
+
+    def test_get_image_stream_disabled(self):
+        self.flags(stream_snapshots=False, group='hyperv')
+
+        image_stream = self._snapshotops._get_image_stream(
+            mock.sentinel.path, mock.sentinel.on_complete)
+
+        self.assertIsNone(image_stream)
+        mock_get_chunks = self._snapshotops._vhdutils.get_merged_vhd_chunks
+        self.assertFalse(mock_get_chunks.called)
+
+    @mock.patch('os.path.getsize')
+    @mock.patch.object(snapshotops.SnapshotOps, '_save_glance_image')
+    @mock.patch.object(snapshotops.SnapshotOps, '_get_image_stream')
+    @mock.patch.object(snapshotops.SnapshotOps,
+                       '_get_incremental_image_properties')
+    def test_snapshot_incremental(self, mock_get_image_properties,
+                                  mock_get_image_stream,
+                                  mock_save_glance_image, mock_getsize):
+        mock_instance = fake_instance.fake_instance_obj(self.context)
+        mock_update = mock.MagicMock()
+        image_properties = {
+            constants.IMAGE_PROP_PARENT_IMAGE_ID: mock.sentinel.parent_id}
+        mock_get_image_properties.return_value = image_properties
+        fake_src_path = (
+            self._snapshotops._pathutils.lookup_root_vhd_path.return_value)
+
+        self._snapshotops.snapshot(context=self.context,
+                                   instance=mock_instance,
+                                   image_id=mock.sentinel.IMAGE_ID,
+                                   update_task_state=mock_update)
+
+        mock_get_image_properties.assert_called_once_with(self.context,
+                                                          fake_src_path)
+        mock_save_glance_image.assert_called_once_with(
+            self.context, mock.sentinel.IMAGE_ID, fake_src_path,
+            image_properties)
+        mock_getsize.assert_called_once_with(fake_src_path)
+        self.assertFalse(mock_get_image_stream.called)
+        self.assertFalse(self._snapshotops._pathutils.get_export_dir.called)
+        self._snapshotops._vmutils.remove_vm_snapshot.assert_called_once_with(
+            self._snapshotops._vmutils.take_vm_snapshot.return_value)
+        mock_update.assert_has_calls([
+            mock.call(task_state=task_states.IMAGE_PENDING_UPLOAD),
+            mock.call(task_state=task_states.IMAGE_UPLOADING,
+                      expected_state=task_states.IMAGE_PENDING_UPLOAD)])
+
+    @mock.patch.object(snapshotops.SnapshotOps, '_is_glance_image_available')
+    def _test_get_incremental_image_properties(self, mock_is_available,
+                                               parent_name='fake_image.vhd',
+                                               parent_dir=None,
+                                               available=True):
+        self.flags(incremental_snapshots=True, group='hyperv')
+        base_dir = os.path.join('fake', '_base')
+        self._snapshotops._pathutils.get_base_vhd_dir.return_value = base_dir
+        mock_get_parent_path = self._snapshotops._vhdutils.get_vhd_parent_path
+        mock_get_parent_path.return_value = (
+            os.path.join(parent_dir or base_dir, parent_name)
+            if parent_name else None)
+        mock_is_available.return_value = available
+
+        image_properties = (
+            self._snapshotops._get_incremental_image_properties(
+                self.context, mock.sentinel.src_path))
+
+        mock_get_parent_path.assert_called_once_with(mock.sentinel.src_path)
+        return image_properties, mock_is_available
+
+    def test_get_incremental_image_properties(self):
+        image_properties, mock_is_available = (
+            self._test_get_incremental_image_properties(
+                parent_name=self._FAKE_IMAGE_ID + '.vhd'))
+
+        self.assertEqual(
+            {constants.IMAGE_PROP_PARENT_IMAGE_ID: self._FAKE_IMAGE_ID},
+            image_properties)
+        mock_is_available.assert_called_once_with(self.context,
+                                                  self._FAKE_IMAGE_ID)
+
+    def test_get_incremental_image_properties_resized_parent(self):
+        image_properties = self._test_get_incremental_image_properties(
+            parent_name=self._FAKE_IMAGE_ID + '_10.vhd')[0]
+
+        self.assertEqual(
+            {constants.IMAGE_PROP_PARENT_IMAGE_ID: self._FAKE_IMAGE_ID,
+             constants.IMAGE_PROP_PARENT_ROOT_GB: '10'},
+            image_properties)
+
+    def test_get_incremental_image_properties_not_cached_parent(self):
+        image_properties = self._test_get_incremental_image_properties(
+            parent_name=self._FAKE_IMAGE_ID + '.vhd',
+            parent_dir=os.path.join('fake', 'other_dir'))[0]
+
+        self.assertIsNone(image_properties)
+
+    def test_get_incremental_image_properties_no_parent(self):
+        image_properties = self._test_get_incremental_image_properties(
+            parent_name=None)[0]
+
+        self.assertIsNone(image_properties)
+
+    def test_get_incremental_image_properties_parent_unavailable(self):
+        image_properties = self._test_get_incremental_image_properties(
+            parent_name=self._FAKE_IMAGE_ID + '.vhd', available=False)[0]
+
+        self.assertIsNone(image_properties)
+
+    def test_get_incremental_image_properties_disabled(self):
+        image_properties = (
+            self._snapshotops._get_incremental_image_properties(
+                self.context, mock.sentinel.src_path))
+
+        self.assertIsNone(image_properties)
+        mock_get_parent_path = self._snapshotops._vhdutils.get_vhd_parent_path
+        self.assertFalse(mock_get_parent_path.called)
+
+    @mock.patch('nova.image.glance.get_remote_image_service')
+    def _test_is_glance_image_available(self, mock_get_remote_image_service,
+                                        show_side_effect=None):
+        glance_image_service = mock.MagicMock()
+        glance_image_service.show.return_value = {'status': 'active'}
+        glance_image_service.show.side_effect = show_side_effect
+        mock_get_remote_image_service.return_value = (glance_image_service,
+                                                      mock.sentinel.IMAGE_ID)
+
+        available = self._snapshotops._is_glance_image_available(
+            self.context, mock.sentinel.IMAGE_ID)
+
+        glance_image_service.show.assert_called_once_with(
+            self.context, mock.sentinel.IMAGE_ID)
+        return available
+
+    def test_is_glance_image_available(self):
+        self.assertTrue(self._test_is_glance_image_available())
+
+    def test_is_glance_image_available_not_found(self):
+        self.assertFalse(self._test_is_glance_image_available(
+            show_side_effect=exception.ImageNotFound(
+                image_id=mock.sentinel.IMAGE_ID)))
+
+
+class ImageStreamTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the snapshot image stream."""
+
+    def setUp(self):
+        super(ImageStreamTestCase, self).setUp()
+
+        patcher = mock.patch.object(ioutils, 'avoid_blocking_call',
+                                    side_effect=lambda f, *args: f(*args))
+        self._mock_avoid_blocking_call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self._mock_on_complete = mock.Mock()
+        self._image_stream = snapshotops._ImageStream(
+            iter([b'abc', b'', b'defg']), self._mock_on_complete)
+
+    def test_read(self):
+        self.assertEqual(b'ab', self._image_stream.read(2))
+        self.assertEqual(b'cde', self._image_stream.read(3))
+        self.assertFalse(self._mock_on_complete.called)
+        self.assertEqual(b'fg', self._image_stream.read(10))
+        self.assertEqual(b'', self._image_stream.read(10))
+
+        self._mock_on_complete.assert_called_once_with()
+        self.assertEqual(7, self._image_stream.bytes_read)
+        self.assertTrue(self._mock_avoid_blocking_call.called)
+
+    def test_read_all(self):
+        self.assertEqual(b'abcdefg', self._image_stream.read())
+        self._mock_on_complete.assert_called_once_with()
+
+    def test_iter(self):
+        self.assertEqual(b'abcdefg', b''.join(self._image_stream))
+
+    def test_close(self):
+        def fake_chunks():
+            try:
+                yield b'abc'
+            finally:
+                chunks_closed.append(True)
+
+        chunks_closed = []
+        image_stream = snapshotops._ImageStream(fake_chunks(),
+                                                self._mock_on_complete)
+        image_stream.read(1)
+
+        image_stream.close()
+
+        self.assertEqual([True], chunks_closed)
@@ -0,0 +1,221 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+
+import mock
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import vhdcopier
+from hyperv.nova import vhdparser
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class VHDCopierTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the allocation aware VHD / VHDX image copy."""
+
+    _FAKE_SRC_PATH = 'C:\\Instances\\_base\\fake_image.vhd'
+
+    def _get_allocation_map(self, **kwargs):
+        allocation_map = {
+            'Path': self._FAKE_SRC_PATH,
+            'Format': vhdparser.VHD_FORMAT,
+            'Type': constants.VHD_TYPE_DYNAMIC,
+            'MaxInternalSize': 8 * units.Mi,
+            'BlockSize': 2 * units.Mi,
+            'BlockOffsetUnit': 512,
+            'FileSize': 6 * units.Mi,
+            'BlockOffsets': [],
+            'SectorBitmapOffsets': None,
+            'MetadataRanges': [(0, 512), (512, 1024), (1536, 512)]}
+        allocation_map.update(kwargs)
+        return allocation_map
+
+    @mock.patch('os.fsync')
+    @mock.patch.object(vhdcopier, 'open', create=True)
+    @mock.patch.object(vhdcopier, '_write_non_zeroed_ranges')
+    def test_write_image(self, mock_write_non_zeroed_ranges, mock_open,
+                         mock_fsync):
+        mock_write_non_zeroed_ranges.return_value = 1
+        mock_dest = mock_open.return_value.__enter__.return_value
+
+        bytes_written = vhdcopier.write_image(mock.sentinel.dest_path,
+                                              [b'abc', b'de'])
+
+        self.assertEqual(2, bytes_written)
+        mock_open.assert_called_once_with(mock.sentinel.dest_path, 'wb')
+        mock_write_non_zeroed_ranges.assert_has_calls(
+            [mock.call(mock_dest, 0, b'abc'), mock.call(mock_dest, 3, b'de')])
+        mock_dest.truncate.assert_called_once_with(5)
+        mock_fsync.assert_called_once_with(mock_dest.fileno.return_value)
+
+    @mock.patch('oslo_utils.fileutils.delete_if_exists')
+    @mock.patch.object(vhdcopier, 'open', create=True)
+    def test_write_image_failed(self, mock_open, mock_delete):
+        def fake_chunks():
+            yield b'abc'
+            raise IOError
+
+        self.assertRaises(IOError, vhdcopier.write_image,
+                          mock.sentinel.dest_path, fake_chunks())
+        mock_delete.assert_called_once_with(mock.sentinel.dest_path)
+
+    def test_get_used_file_ranges_vhd(self):
+        allocation_map = self._get_allocation_map(
+            BlockOffsets=[4, vhdparser.BLOCK_NOT_PRESENT, 8197],
+            MetadataRanges=[(0, 2048), (6 * units.Mi - 512, 512)])
+
+        file_ranges = vhdcopier.get_used_file_ranges(allocation_map)
+
+        # The block sector bitmap precedes the block data, the first block
+        # being adjacent to the image metadata.
+        self.assertEqual([(0, 2048 + 2 * units.Mi),
+                          (8197 * 512 - 512, 6 * units.Mi - 8196 * 512)],
+                         file_ranges)
+
+    def test_get_used_file_ranges_fixed_vhd(self):
+        allocation_map = self._get_allocation_map(
+            Type=constants.VHD_TYPE_FIXED,
+            BlockOffsets=[0, vhdparser.BLOCK_ZERO],
+            FileSize=4 * units.Mi + 512,
+            MetadataRanges=[(4 * units.Mi, 512)])
+
+        file_ranges = vhdcopier.get_used_file_ranges(allocation_map)
+
+        self.assertEqual([(0, 2 * units.Mi), (4 * units.Mi, 512)],
+                         file_ranges)
+
+    def test_get_used_file_ranges_vhdx(self):
+        allocation_map = self._get_allocation_map(
+            Format=vhdparser.VHDX_FORMAT,
+            Type=constants.VHD_TYPE_DIFFERENCING,
+            BlockOffsetUnit=units.Mi,
+            FileSize=8 * units.Mi,
+            BlockOffsets=[4, vhdparser.BLOCK_NOT_PRESENT],
+            SectorBitmapOffsets=[7],
+            MetadataRanges=[(0, units.Mi), (units.Mi, units.Mi)])
+
+        file_ranges = vhdcopier.get_used_file_ranges(allocation_map)
+
+        self.assertEqual([(0, 2 * units.Mi),
+                          (4 * units.Mi, 2 * units.Mi),
+                          (7 * units.Mi, units.Mi)],
+                         file_ranges)
+
+    def test_write_non_zeroed_ranges(self):
+        zero_range = b'\x00' * vhdcopier.ZERO_RANGE_SIZE
+        data_range = b'\x01' * vhdcopier.ZERO_RANGE_SIZE
+        chunk = data_range + zero_range + data_range + data_range + b'\x01'
+        dest = io.BytesIO()
+
+        bytes_written = vhdcopier._write_non_zeroed_ranges(dest, 10, chunk)
+
+        self.assertEqual(len(chunk) - len(zero_range), bytes_written)
+        self.assertEqual(b'\x00' * 10 + chunk, dest.getvalue())
+
+    def test_write_non_zeroed_ranges_zeroed_chunk(self):
+        dest = io.BytesIO()
+
+        bytes_written = vhdcopier._write_non_zeroed_ranges(
+            dest, 0, b'\x00' * (vhdcopier.ZERO_RANGE_SIZE + 1))
+
+        self.assertEqual(0, bytes_written)
+        self.assertEqual(b'', dest.getvalue())
+
+    def test_copy_file_ranges(self):
+        src = io.BytesIO(b'\x01' * 4096)
+        dest = io.BytesIO()
+
+        bytes_written = vhdcopier._copy_file_ranges(
+            src, dest, [(0, 512), (1024, 1024)])
+
+        self.assertEqual(1536, bytes_written)
+        self.assertEqual(b'\x01' * 512 + b'\x00' * 512 + b'\x01' * 1024,
+                         dest.getvalue())
+
+    def test_copy_file_ranges_unexpected_eof(self):
+        src = io.BytesIO(b'\x01' * 512)
+
+        self.assertRaises(IOError, vhdcopier._copy_file_ranges,
+                          src, io.BytesIO(), [(0, 1024)])
+
+    @mock.patch.object(vhdparser, 'get_vhd_allocation_map')
+    def test_verify_copy(self, mock_get_allocation_map):
+        allocation_map = self._get_allocation_map()
+        mock_get_allocation_map.return_value = self._get_allocation_map(
+            Path=mock.sentinel.dest_path)
+
+        vhdcopier._verify_copy(allocation_map, mock.sentinel.dest_path)
+
+        mock_get_allocation_map.assert_called_once_with(
+            mock.sentinel.dest_path)
+
+    @mock.patch.object(vhdparser, 'get_vhd_allocation_map')
+    def test_verify_copy_mismatch(self, mock_get_allocation_map):
+        allocation_map = self._get_allocation_map()
+        mock_get_allocation_map.return_value = self._get_allocation_map(
+            BlockOffsets=[4])
+
+        self.assertRaises(vmutils.HyperVException, vhdcopier._verify_copy,
+                          allocation_map, mock.sentinel.dest_path)
+
+    @mock.patch('os.fsync')
+    @mock.patch.object(vhdcopier, 'open', create=True)
+    @mock.patch.object(vhdcopier, '_verify_copy')
+    @mock.patch.object(vhdcopier, '_copy_file_ranges')
+    @mock.patch.object(vhdcopier, 'get_used_file_ranges')
+    @mock.patch.object(vhdparser, 'get_vhd_allocation_map')
+    def _test_copy_vhd(self, mock_get_allocation_map,
+                       mock_get_used_file_ranges,
+                       mock_copy_file_ranges, mock_verify_copy, mock_open,
+                       mock_fsync, verify_exc=None):
+        allocation_map = self._get_allocation_map()
+        mock_get_allocation_map.return_value = allocation_map
+        mock_verify_copy.side_effect = verify_exc
+        mock_src = mock.Mock()
+        mock_dest = mock.Mock()
+        mock_open.return_value.__enter__.side_effect = [mock_src, mock_dest]
+
+        with mock.patch('oslo_utils.fileutils.delete_if_exists') as (
+                mock_delete):
+            if verify_exc:
+                self.assertRaises(verify_exc, vhdcopier.copy_vhd,
+                                  self._FAKE_SRC_PATH,
+                                  mock.sentinel.dest_path)
+                mock_delete.assert_called_once_with(mock.sentinel.dest_path)
+                return
+
+            bytes_written = vhdcopier.copy_vhd(self._FAKE_SRC_PATH,
+                                               mock.sentinel.dest_path)
+            self.assertFalse(mock_delete.called)
+
+        self.assertEqual(mock_copy_file_ranges.return_value, bytes_written)
+        mock_open.assert_has_calls([
+            mock.call(self._FAKE_SRC_PATH, 'rb'),
+            mock.call(mock.sentinel.dest_path, 'wb')], any_order=True)
+        mock_copy_file_ranges.assert_called_once_with(
+            mock_src, mock_dest, mock_get_used_file_ranges.return_value)
+        mock_dest.truncate.assert_called_once_with(allocation_map['FileSize'])
+        mock_fsync.assert_called_once_with(mock_dest.fileno.return_value)
+        mock_verify_copy.assert_called_once_with(allocation_map,
+                                                 mock.sentinel.dest_path)
+
+    def test_copy_vhd(self):
+        self._test_copy_vhd()
+
+    def test_copy_vhd_verification_failed(self):
+        self._test_copy_vhd(verify_exc=vmutils.HyperVException)
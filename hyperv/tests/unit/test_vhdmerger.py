@@ -0,0 +1,236 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+
+import mock
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import vhdcopier
+from hyperv.nova import vhdmerger
+from hyperv.nova import vhdparser
+from hyperv.nova import vhdwriter
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class VHDMergerTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the streaming merge of differencing chains."""
+
+    _FAKE_CHILD_PATH = 'C:\\Instances\\fake_instance\\root.vhd'
+    _FAKE_PARENT_PATH = 'C:\\Instances\\_base\\fake_image.vhd'
+    _BLOCK_SIZE = 4096
+
+    def setUp(self):
+        super(VHDMergerTestCase, self).setUp()
+
+        self._image_files = {}
+        patcher = mock.patch.object(vhdmerger, 'open', create=True,
+                                    side_effect=self._open_image)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _open_image(self, path, mode):
+        return io.BytesIO(self._image_files[path])
+
+    def _get_vhd_map(self, path, block_offsets, image, parent_path=None):
+        self._image_files[path] = image
+        return {'Path': path,
+                'ParentPath': parent_path,
+                'Format': vhdparser.VHD_FORMAT,
+                'Type': (constants.VHD_TYPE_DIFFERENCING if parent_path
+                         else constants.VHD_TYPE_DYNAMIC),
+                'MaxInternalSize': len(block_offsets) * self._BLOCK_SIZE,
+                'BlockSize': self._BLOCK_SIZE,
+                'BlockOffsetUnit': vhdparser.VHD_SECTOR_SIZE,
+                'BlockOffsets': block_offsets,
+                'SectorBitmapOffsets': None,
+                'PartialBlocks': None}
+
+    def _get_layers(self):
+        # The parent image has data in its first block, while the child
+        # image has data in its second block and in the second sector of
+        # the first block, as tracked by the block sector bitmaps which
+        # precede the block data.
+        parent_map = self._get_vhd_map(
+            self._FAKE_PARENT_PATH, [0, vhdparser.BLOCK_NOT_PRESENT],
+            b'P' * self._BLOCK_SIZE)
+        child_image = (b'\x40'.ljust(512, b'\x00') + b'C' * self._BLOCK_SIZE +
+                       b'\xff' * 512 + b'D' * self._BLOCK_SIZE)
+        child_map = self._get_vhd_map(
+            self._FAKE_CHILD_PATH, [1, 10], child_image,
+            parent_path=self._FAKE_PARENT_PATH)
+        return [vhdmerger._ImageLayer(child_map),
+                vhdmerger._ImageLayer(parent_map)]
+
+    def test_get_block_sources(self):
+        child_layer, parent_layer = self._get_layers()
+
+        self.assertEqual(
+            [(0, 512, vhdmerger._FROM_PARENT),
+             (512, 1024, vhdmerger._FROM_IMAGE),
+             (1024, self._BLOCK_SIZE, vhdmerger._FROM_PARENT)],
+            list(child_layer.get_block_sources(0, 0, self._BLOCK_SIZE)))
+        self.assertEqual(
+            [(0, self._BLOCK_SIZE, vhdmerger._FROM_IMAGE)],
+            list(child_layer.get_block_sources(1, 0, self._BLOCK_SIZE)))
+        self.assertEqual(
+            [(0, self._BLOCK_SIZE, vhdmerger._ZEROED)],
+            list(parent_layer.get_block_sources(1, 0, self._BLOCK_SIZE)))
+
+    def test_get_block_sources_vhdx_partial_block(self):
+        block_size = units.Mi
+        bitmap = bytearray(units.Mi)
+        # The bitmap of the second block of the chunk, the least
+        # significant bit standing for the first sector.
+        bitmap[block_size // 512 // 8] = 0x2
+        self._image_files[self._FAKE_CHILD_PATH] = bytes(bitmap)
+        child_layer = vhdmerger._ImageLayer({
+            'Path': self._FAKE_CHILD_PATH,
+            'ParentPath': self._FAKE_PARENT_PATH,
+            'Format': vhdparser.VHDX_FORMAT,
+            'BlockSize': block_size,
+            'LogicalSectorSize': 512,
+            'BlockOffsetUnit': units.Mi,
+            'BlockOffsets': [vhdparser.BLOCK_ZERO, 2],
+            'SectorBitmapOffsets': [0],
+            'PartialBlocks': set([1])})
+
+        self.assertEqual(
+            [(0, 512, vhdmerger._FROM_PARENT),
+             (512, 1024, vhdmerger._FROM_IMAGE),
+             (1024, 4096, vhdmerger._FROM_PARENT)],
+            list(child_layer.get_block_sources(1, 0, 4096)))
+        self.assertEqual(
+            [(0, 4096, vhdmerger._ZEROED)],
+            list(child_layer.get_block_sources(0, 0, 4096)))
+
+    def test_get_block_sources_missing_sector_bitmap(self):
+        self._image_files[self._FAKE_CHILD_PATH] = b''
+        child_layer = vhdmerger._ImageLayer({
+            'Path': self._FAKE_CHILD_PATH,
+            'ParentPath': self._FAKE_PARENT_PATH,
+            'Format': vhdparser.VHDX_FORMAT,
+            'BlockSize': units.Mi,
+            'LogicalSectorSize': 512,
+            'BlockOffsetUnit': units.Mi,
+            'BlockOffsets': [2],
+            'SectorBitmapOffsets': [vhdparser.BLOCK_NOT_PRESENT],
+            'PartialBlocks': set([0])})
+
+        self.assertRaises(vmutils.HyperVException, list,
+                          child_layer.get_block_sources(0, 0, 4096))
+
+    def test_read_virtual_range(self):
+        layers = self._get_layers()
+
+        data = vhdmerger._read_virtual_range(layers, 0,
+                                             3 * self._BLOCK_SIZE)
+
+        expected_data = (b'P' * 512 + b'C' * 512 +
+                         b'P' * (self._BLOCK_SIZE - 1024) +
+                         b'D' * self._BLOCK_SIZE +
+                         b'\x00' * self._BLOCK_SIZE)
+        self.assertEqual(expected_data, data)
+
+    def test_get_merged_allocated_blocks(self):
+        allocation_maps = [layer.allocation_map
+                           for layer in self._get_layers()]
+
+        allocated_blocks = vhdmerger._get_merged_allocated_blocks(
+            allocation_maps, self._BLOCK_SIZE // 2)
+
+        self.assertEqual([0, 1, 2, 3], allocated_blocks)
+
+    @mock.patch.object(vhdparser, 'get_vhd_allocation_map')
+    def test_get_chain_allocation_maps(self, mock_get_allocation_map):
+        child_map = {'Format': vhdparser.VHD_FORMAT,
+                     'ParentPath': self._FAKE_PARENT_PATH}
+        parent_map = {'Format': vhdparser.VHD_FORMAT, 'ParentPath': None}
+        mock_get_allocation_map.side_effect = [child_map, parent_map]
+
+        allocation_maps = vhdmerger.get_chain_allocation_maps(
+            self._FAKE_CHILD_PATH)
+
+        self.assertEqual([child_map, parent_map], allocation_maps)
+        mock_get_allocation_map.assert_has_calls(
+            [mock.call(self._FAKE_CHILD_PATH),
+             mock.call(self._FAKE_PARENT_PATH)])
+
+    @mock.patch.object(vhdparser, 'get_vhd_allocation_map')
+    def test_get_chain_allocation_maps_format_mismatch(
+            self, mock_get_allocation_map):
+        mock_get_allocation_map.side_effect = [
+            {'Format': vhdparser.VHDX_FORMAT,
+             'ParentPath': self._FAKE_PARENT_PATH},
+            {'Format': vhdparser.VHD_FORMAT, 'ParentPath': None}]
+
+        self.assertRaises(vmutils.HyperVException,
+                          vhdmerger.get_chain_allocation_maps,
+                          self._FAKE_CHILD_PATH)
+
+    @mock.patch.object(vhdmerger, 'MAX_CHAIN_LENGTH', 2)
+    @mock.patch.object(vhdparser, 'get_vhd_allocation_map')
+    def test_get_chain_allocation_maps_loop(self, mock_get_allocation_map):
+        mock_get_allocation_map.return_value = {
+            'Format': vhdparser.VHD_FORMAT,
+            'ParentPath': self._FAKE_CHILD_PATH}
+
+        self.assertRaises(vmutils.HyperVException,
+                          vhdmerger.get_chain_allocation_maps,
+                          self._FAKE_CHILD_PATH)
+
+    @mock.patch.object(vhdwriter, 'iter_dynamic_vhd')
+    @mock.patch.object(vhdmerger, 'get_chain_allocation_maps')
+    def test_iter_merged_vhd(self, mock_get_chain_allocation_maps,
+                             mock_iter_dynamic_vhd):
+        layers = self._get_layers()
+        mock_get_chain_allocation_maps.return_value = [
+            layer.allocation_map for layer in layers]
+
+        def fake_iter_dynamic_vhd(size, allocated_blocks, read_block,
+                                  block_size):
+            for block_idx in allocated_blocks:
+                yield read_block(block_idx)
+
+        mock_iter_dynamic_vhd.side_effect = fake_iter_dynamic_vhd
+
+        chunks = list(vhdmerger.iter_merged_vhd(self._FAKE_CHILD_PATH))
+
+        self.assertEqual(vhdmerger._read_virtual_range(
+            layers, 0, vhdwriter.VHD_DEFAULT_BLOCK_SIZE), chunks[0])
+        mock_iter_dynamic_vhd.assert_called_once_with(
+            2 * self._BLOCK_SIZE, [0], mock.ANY,
+            block_size=vhdwriter.VHD_DEFAULT_BLOCK_SIZE)
+
+    @mock.patch.object(vhdcopier, 'write_image')
+    @mock.patch.object(vhdmerger, 'iter_merged_vhd')
+    def test_merge_vhd(self, mock_iter_merged_vhd, mock_write_image):
+        bytes_written = vhdmerger.merge_vhd(mock.sentinel.path,
+                                            mock.sentinel.dest_path)
+
+        self.assertEqual(mock_write_image.return_value, bytes_written)
+        mock_iter_merged_vhd.assert_called_once_with(mock.sentinel.path)
+        mock_write_image.assert_called_once_with(
+            mock.sentinel.dest_path, mock_iter_merged_vhd.return_value)
+
+    @mock.patch.object(vhdcopier, 'write_image')
+    @mock.patch.object(vhdmerger, 'iter_merged_vhd', mock.Mock())
+    def test_merge_vhd_io_error(self, mock_write_image):
+        mock_write_image.side_effect = IOError
+
+        self.assertRaises(vmutils.HyperVException, vhdmerger.merge_vhd,
+                          mock.sentinel.path, mock.sentinel.dest_path)
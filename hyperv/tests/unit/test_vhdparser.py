@@ -0,0 +1,501 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import io
+import os
+import struct
+
+import mock
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import vhdparser
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+def build_vhd_footer(disk_type, size, data_offset=0xFFFFFFFFFFFFFFFF):
+    footer = bytearray(vhdparser.VHD_FOOTER_SIZE)
+    vhdparser.VHD_FOOTER.pack_into(
+        footer, 0, vhdparser.VHD_FOOTER_COOKIE, 2, 0x10000, data_offset,
+        0, b'win ', 0x60001, b'Wi2k', size, size, 0, disk_type, 0,
+        b'\x00' * 16, 0)
+    struct.pack_into('>I', footer, vhdparser.VHD_FOOTER_CHECKSUM_OFFSET,
+                     vhdparser.vhd_footer_checksum(bytes(footer)))
+    return bytes(footer)
+
+
+def build_vhd(disk_type, size, block_size=2 * units.Mi, parent_paths=None):
+    """Builds an empty VHD image, returning its content."""
+    if disk_type == constants.VHD_TYPE_FIXED:
+        return b'\x00' * size + build_vhd_footer(disk_type, size)
+
+    header_offset = vhdparser.VHD_FOOTER_SIZE
+    footer = build_vhd_footer(disk_type, size, data_offset=header_offset)
+    max_table_entries = size // block_size
+    table_offset = header_offset + vhdparser.VHD_DYNAMIC_HEADER_SIZE
+    locators_offset = table_offset + max_table_entries * 4
+
+    header = bytearray(vhdparser.VHD_DYNAMIC_HEADER_SIZE)
+    vhdparser.VHD_DYNAMIC_HEADER.pack_into(
+        header, 0, vhdparser.VHD_DYNAMIC_HEADER_COOKIE,
+        0xFFFFFFFFFFFFFFFF, table_offset, 0x10000, max_table_entries,
+        block_size, 0, b'\x00' * 16, 0, 0, b'')
+
+    locators_data = b''
+    for idx, (platform_code, parent_path) in enumerate(
+            sorted((parent_paths or {}).items())):
+        data = parent_path.encode('utf-16-le')
+        vhdparser.VHD_PARENT_LOCATOR.pack_into(
+            header, vhdparser.VHD_PARENT_LOCATOR_OFFSET +
+            idx * vhdparser.VHD_PARENT_LOCATOR.size,
+            platform_code, 512, len(data), 0,
+            locators_offset + len(locators_data))
+        locators_data += data.ljust(512, b'\x00')
+
+    return (footer + bytes(header) + b'\xff' * (max_table_entries * 4) +
+            locators_data + footer)
+
+
+def build_vhdx(size, block_size=32 * units.Mi, logical_sector_size=512,
+               physical_sector_size=4096, flags=0, locator_entries=None,
+               log_guid=b'\x00' * 16, header_sequence_numbers=(1, 2)):
+    """Builds the VHDX image headers, returning the image content."""
+    image = bytearray(units.Mi + 64 * units.Ki)
+    image[0:8] = vhdparser.VHDX_FILE_SIGNATURE
+
+    for offset, sequence_number in zip(vhdparser.VHDX_HEADER_OFFSETS,
+                                       header_sequence_numbers):
+        header = bytearray(vhdparser.VHDX_HEADER_SIZE)
+        vhdparser.VHDX_HEADER.pack_into(
+            header, 0, vhdparser.VHDX_HEADER_SIGNATURE, 0,
+            sequence_number, b'\x01' * 16, b'\x02' * 16, log_guid, 0, 1,
+            units.Mi, units.Mi)
+        struct.pack_into('<I', header, 4, vhdparser.crc32c(header))
+        image[offset:offset + len(header)] = header
+
+    metadata_offset = units.Mi
+    vhdparser.VHDX_REGION_TABLE_HEADER.pack_into(
+        image, vhdparser.VHDX_REGION_TABLE_OFFSET,
+        vhdparser.VHDX_REGION_TABLE_SIGNATURE, 0, 2, 0)
+    for idx, (region_id, region_offset) in enumerate(
+            [(vhdparser.VHDX_REGION_BAT, 2 * units.Mi),
+             (vhdparser.VHDX_REGION_METADATA, metadata_offset)]):
+        vhdparser.VHDX_REGION_TABLE_ENTRY.pack_into(
+            image, vhdparser.VHDX_REGION_TABLE_OFFSET +
+            vhdparser.VHDX_REGION_TABLE_HEADER.size +
+            idx * vhdparser.VHDX_REGION_TABLE_ENTRY.size,
+            region_id.bytes_le, region_offset, units.Mi, 1)
+
+    items = [
+        (vhdparser.VHDX_METADATA_FILE_PARAMETERS,
+         struct.pack('<II', block_size, flags)),
+        (vhdparser.VHDX_METADATA_VIRTUAL_DISK_SIZE, struct.pack('<Q', size)),
+        (vhdparser.VHDX_METADATA_LOGICAL_SECTOR_SIZE,
+         struct.pack('<I', logical_sector_size)),
+        (vhdparser.VHDX_METADATA_PHYSICAL_SECTOR_SIZE,
+         struct.pack('<I', physical_sector_size))]
+    if locator_entries is not None:
+        items.append((vhdparser.VHDX_METADATA_PARENT_LOCATOR,
+                      _build_vhdx_parent_locator(locator_entries)))
+
+    vhdparser.VHDX_METADATA_TABLE_HEADER.pack_into(
+        image, metadata_offset, vhdparser.VHDX_METADATA_TABLE_SIGNATURE,
+        0, len(items), b'')
+    item_offset = 64 * units.Ki
+    for idx, (item_id, data) in enumerate(items):
+        vhdparser.VHDX_METADATA_TABLE_ENTRY.pack_into(
+            image, metadata_offset +
+            vhdparser.VHDX_METADATA_TABLE_HEADER.size +
+            idx * vhdparser.VHDX_METADATA_TABLE_ENTRY.size,
+            item_id.bytes_le, item_offset, len(data), 0, 0)
+        image[metadata_offset + item_offset:
+              metadata_offset + item_offset + len(data)] = data
+        item_offset += len(data)
+    return bytes(image)
+
+
+def _build_vhdx_parent_locator(locator_entries):
+    locator_entries = sorted(locator_entries.items())
+    data_offset = (vhdparser.VHDX_PARENT_LOCATOR_HEADER.size +
+                   len(locator_entries) *
+                   vhdparser.VHDX_PARENT_LOCATOR_ENTRY.size)
+    locator = vhdparser.VHDX_PARENT_LOCATOR_HEADER.pack(
+        b'\x00' * 16, 0, len(locator_entries))
+    data = b''
+    for key, value in locator_entries:
+        key = key.encode('utf-16-le')
+        value = value.encode('utf-16-le')
+        locator += vhdparser.VHDX_PARENT_LOCATOR_ENTRY.pack(
+            data_offset + len(data), data_offset + len(data) + len(key),
+            len(key), len(value))
+        data += key + value
+    return locator + data
+
+
+class VHDParserTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the in-process VHD / VHDX metadata reader."""
+
+    _FAKE_DIR = os.path.join('C:', os.sep, 'fake_dir')
+    _FAKE_PATH = os.path.join(_FAKE_DIR, 'fake_image.vhd')
+    _FAKE_PARENT_PATH = os.path.join(_FAKE_DIR, 'fake_parent.vhd')
+    _FAKE_SIZE = 16 * units.Mi
+
+    def setUp(self):
+        super(VHDParserTestCase, self).setUp()
+
+        cache_patcher = mock.patch.object(vhdparser, '_vhd_info_cache',
+                                          collections.OrderedDict())
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def test_crc32c(self):
+        self.assertEqual(0xE3069283, vhdparser.crc32c(b'123456789'))
+
+    def _read_vhd_footer_info(self, image):
+        return vhdparser._read_vhd_footer_info(io.BytesIO(image),
+                                               self._FAKE_PATH, len(image))
+
+    def test_read_vhd_info_fixed(self):
+        vhd_info = self._read_vhd_footer_info(
+            build_vhd(constants.VHD_TYPE_FIXED, self._FAKE_SIZE))
+
+        expected_info = {'Format': vhdparser.VHD_FORMAT,
+                         'Type': constants.VHD_TYPE_FIXED,
+                         'MaxInternalSize': self._FAKE_SIZE,
+                         'BlockSize': 0,
+                         'LogicalSectorSize': 512,
+                         'PhysicalSectorSize': 512,
+                         'ParentPath': None}
+        self.assertEqual(expected_info, vhd_info)
+
+    def test_read_vhd_info_dynamic(self):
+        vhd_info = self._read_vhd_footer_info(
+            build_vhd(constants.VHD_TYPE_DYNAMIC, self._FAKE_SIZE))
+
+        self.assertEqual(constants.VHD_TYPE_DYNAMIC, vhd_info['Type'])
+        self.assertEqual(self._FAKE_SIZE, vhd_info['MaxInternalSize'])
+        self.assertEqual(2 * units.Mi, vhd_info['BlockSize'])
+        self.assertIsNone(vhd_info['ParentPath'])
+
+    def test_read_vhd_info_corrupted_footer(self):
+        # The footer copy placed at the beginning of the file is used.
+        image = build_vhd(constants.VHD_TYPE_DYNAMIC, self._FAKE_SIZE)
+        image = image[:-vhdparser.VHD_FOOTER_SIZE] + b'\x00' * 512
+
+        vhd_info = self._read_vhd_footer_info(image)
+
+        self.assertEqual(self._FAKE_SIZE, vhd_info['MaxInternalSize'])
+
+    def test_read_vhd_info_invalid(self):
+        self.assertRaises(vmutils.HyperVException,
+                          self._read_vhd_footer_info, b'\x00' * 1024)
+
+    def test_read_vhd_info_too_small(self):
+        self.assertRaises(vmutils.HyperVException,
+                          self._read_vhd_footer_info, b'\x00' * 511)
+
+    @mock.patch('os.path.exists')
+    def test_read_vhd_info_differencing(self, mock_exists):
+        mock_exists.side_effect = lambda path: path == self._FAKE_PARENT_PATH
+        parent_paths = {
+            vhdparser.VHD_LOCATOR_RELATIVE: os.path.join(
+                '.', 'missing_parent.vhd'),
+            vhdparser.VHD_LOCATOR_ABSOLUTE: self._FAKE_PARENT_PATH}
+
+        vhd_info = self._read_vhd_footer_info(
+            build_vhd(constants.VHD_TYPE_DIFFERENCING, self._FAKE_SIZE,
+                      parent_paths=parent_paths))
+
+        self.assertEqual(constants.VHD_TYPE_DIFFERENCING, vhd_info['Type'])
+        self.assertEqual(self._FAKE_PARENT_PATH, vhd_info['ParentPath'])
+
+    @mock.patch('os.path.exists')
+    def test_read_vhd_info_differencing_relative_path(self, mock_exists):
+        mock_exists.return_value = True
+        parent_paths = {
+            vhdparser.VHD_LOCATOR_RELATIVE: os.path.join(
+                '.', 'fake_parent.vhd')}
+
+        vhd_info = self._read_vhd_footer_info(
+            build_vhd(constants.VHD_TYPE_DIFFERENCING, self._FAKE_SIZE,
+                      parent_paths=parent_paths))
+
+        self.assertEqual(self._FAKE_PARENT_PATH, vhd_info['ParentPath'])
+
+    def test_read_vhd_info_differencing_missing_locator(self):
+        self.assertRaises(
+            vmutils.HyperVException, self._read_vhd_footer_info,
+            build_vhd(constants.VHD_TYPE_DIFFERENCING, self._FAKE_SIZE))
+
+    def _read_vhdx_info(self, image):
+        return vhdparser._read_vhdx_info(io.BytesIO(image), self._FAKE_PATH)
+
+    def test_read_vhdx_info_dynamic(self):
+        vhd_info = self._read_vhdx_info(build_vhdx(self._FAKE_SIZE))
+
+        expected_info = {'Format': vhdparser.VHDX_FORMAT,
+                         'Type': constants.VHD_TYPE_DYNAMIC,
+                         'MaxInternalSize': self._FAKE_SIZE,
+                         'BlockSize': 32 * units.Mi,
+                         'LogicalSectorSize': 512,
+                         'PhysicalSectorSize': 4096,
+                         'ParentPath': None}
+        self.assertEqual(expected_info, vhd_info)
+
+    def test_read_vhdx_info_fixed(self):
+        vhd_info = self._read_vhdx_info(build_vhdx(
+            self._FAKE_SIZE,
+            flags=vhdparser.VHDX_FILE_PARAMETERS_LEAVE_BLOCKS_ALLOCATED))
+
+        self.assertEqual(constants.VHD_TYPE_FIXED, vhd_info['Type'])
+
+    @mock.patch('os.path.exists')
+    def test_read_vhdx_info_differencing(self, mock_exists):
+        mock_exists.side_effect = lambda path: path == self._FAKE_PARENT_PATH
+        locator_entries = {
+            'relative_path': os.path.join('.', 'missing_parent.vhdx'),
+            'absolute_win32_path': self._FAKE_PARENT_PATH}
+
+        vhd_info = self._read_vhdx_info(build_vhdx(
+            self._FAKE_SIZE,
+            flags=vhdparser.VHDX_FILE_PARAMETERS_HAS_PARENT,
+            locator_entries=locator_entries))
+
+        self.assertEqual(constants.VHD_TYPE_DIFFERENCING, vhd_info['Type'])
+        self.assertEqual(self._FAKE_PARENT_PATH, vhd_info['ParentPath'])
+
+    def test_read_vhdx_info_differencing_missing_locator(self):
+        self.assertRaises(
+            vmutils.HyperVException, self._read_vhdx_info,
+            build_vhdx(self._FAKE_SIZE,
+                       flags=vhdparser.VHDX_FILE_PARAMETERS_HAS_PARENT))
+
+    def test_read_vhdx_info_current_header(self):
+        # The first header has a higher sequence number but an invalid
+        # checksum, so the second header, having no pending log, is used.
+        image = bytearray(build_vhdx(self._FAKE_SIZE,
+                                     header_sequence_numbers=(2, 1),
+                                     log_guid=b'\x03' * 16))
+        image[vhdparser.VHDX_HEADER_OFFSETS[1] + 48:
+              vhdparser.VHDX_HEADER_OFFSETS[1] + 64] = b'\x00' * 16
+        header_offset = vhdparser.VHDX_HEADER_OFFSETS[1]
+        header = image[header_offset:
+                       header_offset + vhdparser.VHDX_HEADER_SIZE]
+        header[4:8] = b'\x00' * 4
+        struct.pack_into('<I', image, header_offset + 4,
+                         vhdparser.crc32c(header))
+        image[vhdparser.VHDX_HEADER_OFFSETS[0] + 8] = 0xFF
+
+        vhd_info = self._read_vhdx_info(bytes(image))
+
+        self.assertEqual(self._FAKE_SIZE, vhd_info['MaxInternalSize'])
+
+    def test_read_vhdx_info_pending_log(self):
+        self.assertRaises(
+            vmutils.HyperVException, self._read_vhdx_info,
+            build_vhdx(self._FAKE_SIZE, log_guid=b'\x03' * 16))
+
+    def test_read_vhdx_info_corrupted_headers(self):
+        image = bytearray(build_vhdx(self._FAKE_SIZE))
+        for offset in vhdparser.VHDX_HEADER_OFFSETS:
+            image[offset + 8] ^= 0xFF
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._read_vhdx_info, bytes(image))
+
+    @mock.patch.object(vhdparser, '_read_vhdx_info')
+    @mock.patch.object(vhdparser, '_read_vhd_footer_info')
+    def _test_read_vhd_info(self, mock_read_vhd_footer_info,
+                            mock_read_vhdx_info, header=b''):
+        image = header.ljust(1024, b'\x00')
+        with mock.patch.object(vhdparser, 'open',
+                               mock.Mock(return_value=io.BytesIO(image)),
+                               create=True):
+            vhd_info = vhdparser._read_vhd_info(self._FAKE_PATH, len(image))
+
+        if header == vhdparser.VHDX_FILE_SIGNATURE:
+            mock_read_info = mock_read_vhdx_info
+        else:
+            mock_read_info = mock_read_vhd_footer_info
+        self.assertEqual(mock_read_info.return_value, vhd_info)
+        vhd_info.__setitem__.assert_has_calls(
+            [mock.call('Path', self._FAKE_PATH),
+             mock.call('FileSize', len(image))])
+
+    def test_read_vhd_info_vhd_image(self):
+        self._test_read_vhd_info()
+
+    def test_read_vhd_info_vhdx_image(self):
+        self._test_read_vhd_info(header=vhdparser.VHDX_FILE_SIGNATURE)
+
+    def test_read_vhd_info_io_error(self):
+        with mock.patch.object(vhdparser, 'open',
+                               mock.Mock(side_effect=IOError), create=True):
+            self.assertRaises(vmutils.HyperVException,
+                              vhdparser._read_vhd_info,
+                              self._FAKE_PATH, 0)
+
+    @mock.patch.object(vhdparser, '_read_vhd_info')
+    @mock.patch('os.stat')
+    def test_get_vhd_info_cached(self, mock_stat, mock_read_vhd_info):
+        mock_stat.return_value = mock.Mock(st_mtime=1, st_size=1024)
+        mock_read_vhd_info.side_effect = lambda path, size: {'Size': size}
+
+        first_info = vhdparser.get_vhd_info(self._FAKE_PATH)
+        first_info['Size'] = None
+        second_info = vhdparser.get_vhd_info(self._FAKE_PATH)
+
+        # The cached info is not altered by the callers.
+        self.assertEqual({'Size': 1024}, second_info)
+        mock_read_vhd_info.assert_called_once_with(self._FAKE_PATH, 1024)
+
+    @mock.patch.object(vhdparser, '_read_vhd_info')
+    @mock.patch('os.stat')
+    def test_get_vhd_info_modified(self, mock_stat, mock_read_vhd_info):
+        mock_stat.side_effect = [mock.Mock(st_mtime=1, st_size=1024),
+                                 mock.Mock(st_mtime=2, st_size=1024)]
+
+        vhdparser.get_vhd_info(self._FAKE_PATH)
+        vhdparser.get_vhd_info(self._FAKE_PATH)
+
+        self.assertEqual(2, mock_read_vhd_info.call_count)
+
+    @mock.patch.object(vhdparser, '_VHD_INFO_CACHE_MAX_ENTRIES', 2)
+    @mock.patch.object(vhdparser, '_read_vhd_info',
+                       mock.Mock(return_value={}))
+    @mock.patch('os.stat')
+    def test_get_vhd_info_cache_full(self, mock_stat):
+        mock_stat.return_value = mock.Mock(st_mtime=1, st_size=1024)
+
+        for path in ('path1', 'path2', 'path1', 'path3'):
+            vhdparser.get_vhd_info(path)
+
+        self.assertEqual(['path1', 'path3'],
+                         list(vhdparser._vhd_info_cache.keys()))
+
+    @mock.patch('os.stat')
+    def test_get_vhd_info_missing_file(self, mock_stat):
+        mock_stat.side_effect = OSError
+
+        self.assertRaises(vmutils.HyperVException,
+                          vhdparser.get_vhd_info, self._FAKE_PATH)
+
+    def _get_allocation_map(self, image, path=None):
+        class FakeImageFile(io.BytesIO):
+            def fileno(self):
+                return mock.sentinel.fileno
+
+        with mock.patch.object(vhdparser, 'open', create=True,
+                               return_value=FakeImageFile(image)), \
+                mock.patch('os.fstat') as mock_fstat:
+            mock_fstat.return_value = mock.Mock(st_size=len(image))
+            return vhdparser.get_vhd_allocation_map(path or self._FAKE_PATH)
+
+    def test_get_vhd_allocation_map_fixed(self):
+        allocation_map = self._get_allocation_map(
+            build_vhd(constants.VHD_TYPE_FIXED, 3 * units.Mi))
+
+        self.assertEqual(vhdparser.VHD_FIXED_BLOCK_SIZE,
+                         allocation_map['BlockSize'])
+        self.assertEqual([0, 2 * units.Mi],
+                         [vhdparser.get_block_file_offset(allocation_map, idx)
+                          for idx in range(2)])
+        self.assertEqual([(0, 3 * units.Mi)],
+                         vhdparser.get_allocated_ranges(allocation_map))
+        self.assertEqual([(3 * units.Mi, 512)],
+                         allocation_map['MetadataRanges'])
+
+    def test_get_vhd_allocation_map_dynamic(self):
+        image = bytearray(build_vhd(constants.VHD_TYPE_DYNAMIC,
+                                    self._FAKE_SIZE))
+        # The second and third blocks are allocated.
+        bat_offset = (vhdparser.VHD_FOOTER_SIZE +
+                      vhdparser.VHD_DYNAMIC_HEADER_SIZE)
+        struct.pack_into('>II', image, bat_offset + 4, 100, 5000)
+
+        allocation_map = self._get_allocation_map(bytes(image))
+
+        self.assertEqual(self._FAKE_PATH, allocation_map['Path'])
+        self.assertEqual(len(image), allocation_map['FileSize'])
+        self.assertEqual(8, len(allocation_map['BlockOffsets']))
+        self.assertEqual(vhdparser.BLOCK_NOT_PRESENT,
+                         allocation_map['BlockOffsets'][0])
+        # The block data follows the 512 bytes sector bitmap.
+        self.assertEqual(100 * 512 + 512, vhdparser.get_block_file_offset(
+            allocation_map, 1))
+        self.assertEqual([(2 * units.Mi, 4 * units.Mi)],
+                         vhdparser.get_allocated_ranges(allocation_map))
+        # Footer copy, dynamic header, BAT and footer.
+        self.assertEqual([(0, 512), (512, 1024), (1536, 512),
+                          (len(image) - 512, 512)],
+                         allocation_map['MetadataRanges'])
+        self.assertIsNone(allocation_map['SectorBitmapOffsets'])
+
+    def test_get_vhdx_allocation_map(self):
+        block_size = units.Mi
+        # The chunk ratio being 4096, a sector bitmap entry follows the
+        # first 4096 payload block entries.
+        block_count = 4100
+        image = bytearray(build_vhdx(block_count * block_size,
+                                     block_size=block_size))
+        image += b'\x00' * (3 * units.Mi - len(image))
+
+        entries = {0: (vhdparser.VHDX_BAT_PAYLOAD_BLOCK_FULLY_PRESENT, 10),
+                   1: (vhdparser.VHDX_BAT_PAYLOAD_BLOCK_ZERO, 0),
+                   4095: (vhdparser.VHDX_BAT_PAYLOAD_BLOCK_PARTIALLY_PRESENT,
+                          11),
+                   4097: (vhdparser.VHDX_BAT_PAYLOAD_BLOCK_FULLY_PRESENT,
+                          12)}
+        for entry_idx, (state, offset_mb) in entries.items():
+            struct.pack_into('<Q', image, 2 * units.Mi + entry_idx * 8,
+                             offset_mb << 20 | state)
+
+        allocation_map = self._get_allocation_map(bytes(image))
+
+        self.assertEqual(block_count, len(allocation_map['BlockOffsets']))
+        self.assertEqual(10 * units.Mi, vhdparser.get_block_file_offset(
+            allocation_map, 0))
+        self.assertEqual(vhdparser.BLOCK_ZERO,
+                         allocation_map['BlockOffsets'][1])
+        self.assertEqual(12 * units.Mi, vhdparser.get_block_file_offset(
+            allocation_map, 4096))
+        self.assertEqual([(0, units.Mi), (4095 * units.Mi, 2 * units.Mi)],
+                         vhdparser.get_allocated_ranges(allocation_map))
+
+    def test_get_vhdx_allocation_map_missing_bat(self):
+        image = bytearray(build_vhdx(self._FAKE_SIZE))
+        # Drop the BAT region from the region table.
+        struct.pack_into('<I', image, vhdparser.VHDX_REGION_TABLE_OFFSET + 8,
+                         1)
+        struct.pack_into(
+            '<16s', image, vhdparser.VHDX_REGION_TABLE_OFFSET +
+            vhdparser.VHDX_REGION_TABLE_HEADER.size,
+            vhdparser.VHDX_REGION_METADATA.bytes_le)
+        struct.pack_into(
+            '<Q', image, vhdparser.VHDX_REGION_TABLE_OFFSET +
+            vhdparser.VHDX_REGION_TABLE_HEADER.size + 16, units.Mi)
+
+        self.assertRaises(vmutils.HyperVException,
+                          self._get_allocation_map, bytes(image))
+
+    def test_get_allocated_ranges_partial_last_block(self):
+        allocation_map = {'BlockSize': 2 * units.Mi,
+                          'MaxInternalSize': 3 * units.Mi,
+                          'BlockOffsets': [1, 2]}
+
+        self.assertEqual([(0, 3 * units.Mi)],
+                         vhdparser.get_allocated_ranges(allocation_map))
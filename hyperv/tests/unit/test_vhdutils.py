@@ -110,17 +110,68 @@ class VHDUtilsTestCase(VHDUtilsBaseTestCase):
         mock_img_svc.ValidateVirtualHardDisk.assert_called_once_with(
             Path=self._FAKE_VHD_PATH)
 
-    def test_get_vhd_info(self):
+    @mock.patch.object(vhdutils.vhdparser, 'get_vhd_info')
+    def test_get_vhd_info(self, mock_get_vhd_info):
+        vhd_info = self._vhdutils.get_vhd_info(self._FAKE_VHD_PATH)
+
+        self.assertEqual(mock_get_vhd_info.return_value, vhd_info)
+        mock_get_vhd_info.assert_called_once_with(self._FAKE_VHD_PATH)
+        self.assertFalse(
+            self._vhdutils._image_man_svc.GetVirtualHardDiskInfo.called)
+
+    @mock.patch.object(vhdutils.vhdparser, 'get_vhd_info')
+    def test_get_vhd_info_wmi_fallback(self, mock_get_vhd_info):
+        mock_get_vhd_info.side_effect = vmutils.HyperVException
         self._mock_get_vhd_info()
+
         vhd_info = self._vhdutils.get_vhd_info(self._FAKE_VHD_PATH)
+
         self.assertEqual(self._fake_vhd_info, vhd_info)
 
+    def test_get_vhd_info_wmi(self):
+        self._mock_get_vhd_info()
+        vhd_info = self._vhdutils._get_vhd_info_wmi(self._FAKE_VHD_PATH)
+        self.assertEqual(self._fake_vhd_info, vhd_info)
+
+    @mock.patch.object(vhdutils.vhdparser, 'get_allocated_ranges')
+    @mock.patch.object(vhdutils.vhdparser, 'get_vhd_allocation_map')
+    def test_get_vhd_allocation_info(self, mock_get_allocation_map,
+                                     mock_get_allocated_ranges):
+        mock_get_allocation_map.return_value = {
+            'ParentPath': self._FAKE_PARENT_PATH,
+            'Format': self._FAKE_FORMAT,
+            'Type': self._FAKE_TYPE,
+            'MaxInternalSize': self._FAKE_MAX_INTERNAL_SIZE,
+            'FileSize': mock.sentinel.file_size,
+            'BlockSize': self._FAKE_DYNAMIC_BLK_SIZE,
+            'BlockOffsets': mock.sentinel.block_offsets}
+        allocated_ranges = [(0, units.Mi), (4 * units.Mi, 2 * units.Mi)]
+        mock_get_allocated_ranges.return_value = allocated_ranges
+
+        allocation_info = self._vhdutils.get_vhd_allocation_info(
+            self._FAKE_VHD_PATH)
+
+        expected_info = {'Path': self._FAKE_VHD_PATH,
+                         'ParentPath': self._FAKE_PARENT_PATH,
+                         'Format': self._FAKE_FORMAT,
+                         'Type': self._FAKE_TYPE,
+                         'MaxInternalSize': self._FAKE_MAX_INTERNAL_SIZE,
+                         'FileSize': mock.sentinel.file_size,
+                         'BlockSize': self._FAKE_DYNAMIC_BLK_SIZE,
+                         'AllocatedRanges': allocated_ranges,
+                         'AllocatedBytes': 3 * units.Mi}
+        self.assertEqual(expected_info, allocation_info)
+        mock_get_allocation_map.assert_called_once_with(self._FAKE_VHD_PATH)
+        mock_get_allocated_ranges.assert_called_once_with(
+            mock_get_allocation_map.return_value)
+
     def _mock_get_vhd_info(self):
         mock_img_svc = self._vhdutils._image_man_svc
         mock_img_svc.GetVirtualHardDiskInfo.return_value = (
             self._FAKE_VHD_INFO_XML, self._FAKE_JOB_PATH, self._FAKE_RET_VAL)
 
     def test_create_dynamic_vhd(self):
+        self.flags(native_vhd_creation=False, group='hyperv')
         self._vhdutils.get_vhd_info = mock.MagicMock(
             return_value={'Format': self._FAKE_FORMAT})
 
@@ -193,7 +244,86 @@ class VHDUtilsTestCase(VHDUtilsBaseTestCase):
             return self._vhdutils.get_internal_vhd_size_by_file_size(
                 None, root_vhd_size)
 
+    @mock.patch.object(vhdutils.VHDUtils, '_create_vhd_natively')
+    def test_create_dynamic_vhd_natively(self, mock_create_vhd_natively):
+        mock_create_vhd_natively.return_value = True
+
+        self._vhdutils.create_dynamic_vhd(self._FAKE_VHD_PATH,
+                                          self._FAKE_MAX_INTERNAL_SIZE,
+                                          constants.DISK_FORMAT_VHD)
+
+        mock_create_vhd_natively.assert_called_once_with(
+            vhdutils.vhdwriter.create_dynamic_vhd, self._FAKE_VHD_PATH,
+            self._FAKE_MAX_INTERNAL_SIZE, constants.DISK_FORMAT_VHD)
+        mock_img_svc = self._vhdutils._image_man_svc
+        self.assertFalse(mock_img_svc.CreateDynamicVirtualHardDisk.called)
+
+    def test_create_vhd_natively(self):
+        mock_create_vhd = mock.Mock()
+
+        ret_val = self._vhdutils._create_vhd_natively(
+            mock_create_vhd, mock.sentinel.path, mock.sentinel.arg)
+
+        self.assertTrue(ret_val)
+        mock_create_vhd.assert_called_once_with(mock.sentinel.path,
+                                                mock.sentinel.arg)
+
+    def test_create_vhd_natively_failed(self):
+        mock_create_vhd = mock.Mock(side_effect=vmutils.HyperVException)
+
+        ret_val = self._vhdutils._create_vhd_natively(
+            mock_create_vhd, mock.sentinel.path)
+
+        self.assertFalse(ret_val)
+
+    def test_create_vhd_natively_disabled(self):
+        self.flags(native_vhd_creation=False, group='hyperv')
+        mock_create_vhd = mock.Mock()
+
+        ret_val = self._vhdutils._create_vhd_natively(
+            mock_create_vhd, mock.sentinel.path)
+
+        self.assertFalse(ret_val)
+        self.assertFalse(mock_create_vhd.called)
+
+    @mock.patch.object(vhdutils.ioutils, 'avoid_blocking_call')
+    def test_merge_vhd_chain(self, mock_avoid_blocking_call):
+        ret_val = self._vhdutils.merge_vhd_chain(mock.sentinel.path,
+                                                 mock.sentinel.dest_path)
+
+        self.assertTrue(ret_val)
+        mock_avoid_blocking_call.assert_called_once_with(
+            vhdutils.vhdmerger.merge_vhd, mock.sentinel.path,
+            mock.sentinel.dest_path)
+
+    @mock.patch.object(vhdutils.vhdmerger, 'iter_merged_vhd')
+    def test_get_merged_vhd_chunks(self, mock_iter_merged_vhd):
+        chunks = self._vhdutils.get_merged_vhd_chunks(mock.sentinel.path)
+
+        self.assertEqual(mock_iter_merged_vhd.return_value, chunks)
+        mock_iter_merged_vhd.assert_called_once_with(mock.sentinel.path)
+
+    @mock.patch.object(vhdutils.ioutils, 'avoid_blocking_call')
+    def test_merge_vhd_chain_failed(self, mock_avoid_blocking_call):
+        mock_avoid_blocking_call.side_effect = vmutils.HyperVException
+
+        ret_val = self._vhdutils.merge_vhd_chain(mock.sentinel.path,
+                                                 mock.sentinel.dest_path)
+
+        self.assertFalse(ret_val)
+
+    @mock.patch.object(vhdutils.ioutils, 'avoid_blocking_call')
+    def test_merge_vhd_chain_disabled(self, mock_avoid_blocking_call):
+        self.flags(native_vhd_merge=False, group='hyperv')
+
+        ret_val = self._vhdutils.merge_vhd_chain(mock.sentinel.path,
+                                                 mock.sentinel.dest_path)
+
+        self.assertFalse(ret_val)
+        self.assertFalse(mock_avoid_blocking_call.called)
+
     def test_create_differencing_vhd(self):
+        self.flags(native_vhd_creation=False, group='hyperv')
         mock_img_svc = self._vhdutils._image_man_svc
         mock_img_svc.CreateDifferencingVirtualHardDisk.return_value = (
             self._FAKE_JOB_PATH, self._FAKE_RET_VAL)
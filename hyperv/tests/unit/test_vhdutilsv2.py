@@ -54,9 +54,9 @@ class VHDUtilsV2TestCase(test_vhdutils.VHDUtilsBaseTestCase):
             self._FAKE_JOB_PATH, self._FAKE_RET_VAL,
             self._FAKE_VHD_INFO_XML)
 
-    def test_get_vhd_info(self):
+    def test_get_vhd_info_wmi(self):
         self._mock_get_vhd_info()
-        vhd_info = self._vhdutils.get_vhd_info(self._FAKE_VHD_PATH)
+        vhd_info = self._vhdutils._get_vhd_info_wmi(self._FAKE_VHD_PATH)
 
         self.assertEqual(self._FAKE_VHD_PATH, vhd_info['Path'])
         self.assertEqual(self._FAKE_PARENT_PATH, vhd_info['ParentPath'])
@@ -65,7 +65,7 @@ class VHDUtilsV2TestCase(test_vhdutils.VHDUtilsBaseTestCase):
                          vhd_info['MaxInternalSize'])
         self.assertEqual(self._FAKE_TYPE, vhd_info['Type'])
 
-    def test_get_vhd_info_no_parent(self):
+    def test_get_vhd_info_wmi_no_parent(self):
         fake_vhd_xml_no_parent = self._FAKE_VHD_INFO_XML.replace(
             self._FAKE_PARENT_PATH, "")
 
@@ -73,7 +73,7 @@ class VHDUtilsV2TestCase(test_vhdutils.VHDUtilsBaseTestCase):
         mock_img_svc.GetVirtualHardDiskSettingData.return_value = (
             self._FAKE_JOB_PATH, self._FAKE_RET_VAL, fake_vhd_xml_no_parent)
 
-        vhd_info = self._vhdutils.get_vhd_info(self._FAKE_VHD_PATH)
+        vhd_info = self._vhdutils._get_vhd_info_wmi(self._FAKE_VHD_PATH)
 
         self.assertEqual(self._FAKE_VHD_PATH, vhd_info['Path'])
         self.assertIsNone(vhd_info['ParentPath'])
@@ -83,6 +83,7 @@ class VHDUtilsV2TestCase(test_vhdutils.VHDUtilsBaseTestCase):
         self.assertEqual(self._FAKE_TYPE, vhd_info['Type'])
 
     def test_create_dynamic_vhd(self):
+        self.flags(native_vhd_creation=False, group='hyperv')
         self._vhdutils.get_vhd_info = mock.MagicMock(
             return_value={'Format': self._FAKE_FORMAT})
 
@@ -96,7 +97,22 @@ class VHDUtilsV2TestCase(test_vhdutils.VHDUtilsBaseTestCase):
 
         self.assertTrue(mock_img_svc.CreateVirtualHardDisk.called)
 
+    @mock.patch.object(vhdutilsv2.VHDUtilsV2, '_create_vhd_natively')
+    @mock.patch.object(vhdutilsv2.VHDUtilsV2, '_create_vhd')
+    def test_create_differencing_vhd_natively(self, mock_create_vhd,
+                                              mock_create_vhd_natively):
+        mock_create_vhd_natively.return_value = True
+
+        self._vhdutils.create_differencing_vhd(self._FAKE_VHD_PATH,
+                                               self._FAKE_PARENT_PATH)
+
+        mock_create_vhd_natively.assert_called_once_with(
+            vhdutilsv2.vhdwriter.create_differencing_vhd,
+            self._FAKE_VHD_PATH, self._FAKE_PARENT_PATH)
+        self.assertFalse(mock_create_vhd.called)
+
     def test_create_differencing_vhd(self):
+        self.flags(native_vhd_creation=False, group='hyperv')
         self._vhdutils.get_vhd_info = mock.MagicMock(
             return_value={'ParentPath': self._FAKE_PARENT_PATH,
                           'Format': self._FAKE_FORMAT})
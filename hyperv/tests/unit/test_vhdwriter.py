@@ -0,0 +1,328 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import io
+import uuid
+
+import mock
+from oslo_utils import units
+
+from hyperv.nova import constants
+from hyperv.nova import vhdparser
+from hyperv.nova import vhdwriter
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class VHDWriterTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the in-process VHD / VHDX image creation."""
+
+    _FAKE_PATH = 'C:\\Instances\\fake_instance\\root.vhd'
+    _FAKE_PARENT_PATH = 'C:\\Instances\\_base\\fake_image.vhd'
+    _FAKE_PARENT_LINKAGE_ID = uuid.UUID(int=1).bytes_le
+    _FAKE_SIZE = units.Gi
+
+    def setUp(self):
+        super(VHDWriterTestCase, self).setUp()
+
+        patcher = mock.patch.object(vhdparser, '_resolve_parent_path')
+        self._mock_resolve_parent_path = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _get_parent_paths(self):
+        return {'absolute': self._FAKE_PARENT_PATH,
+                'relative': '.\\..\\_base\\fake_image.vhd'}
+
+    @mock.patch.object(vhdwriter, '_create_image')
+    def test_create_dynamic_vhd(self, mock_create_image):
+        vhdwriter.create_dynamic_vhd(mock.sentinel.path,
+                                     mock.sentinel.size,
+                                     constants.DISK_FORMAT_VHD)
+
+        mock_create_image.assert_called_once_with(
+            mock.sentinel.path, vhdwriter._write_vhd, mock.sentinel.size,
+            constants.VHD_TYPE_DYNAMIC)
+
+    @mock.patch.object(vhdwriter, '_create_image')
+    def test_create_dynamic_vhdx(self, mock_create_image):
+        vhdwriter.create_dynamic_vhd(mock.sentinel.path,
+                                     mock.sentinel.size,
+                                     constants.DISK_FORMAT_VHDX)
+
+        mock_create_image.assert_called_once_with(
+            mock.sentinel.path, vhdwriter._write_vhdx, mock.sentinel.size,
+            vhdwriter.VHDX_DEFAULT_BLOCK_SIZE,
+            vhdwriter.VHDX_DEFAULT_LOGICAL_SECTOR_SIZE,
+            vhdwriter.VHDX_DEFAULT_PHYSICAL_SECTOR_SIZE)
+
+    def test_create_dynamic_vhd_unsupported_format(self):
+        self.assertRaises(vmutils.HyperVException,
+                          vhdwriter.create_dynamic_vhd,
+                          mock.sentinel.path, mock.sentinel.size,
+                          mock.sentinel.format)
+
+    @mock.patch('os.path.getmtime')
+    @mock.patch.object(vhdwriter, '_create_image')
+    @mock.patch.object(vhdparser, 'get_vhd_linkage_id')
+    @mock.patch.object(vhdparser, 'get_vhd_info')
+    def test_create_differencing_vhd(self, mock_get_vhd_info,
+                                     mock_get_vhd_linkage_id,
+                                     mock_create_image, mock_getmtime):
+        mock_get_vhd_info.return_value = {
+            'Format': vhdparser.VHD_FORMAT,
+            'MaxInternalSize': self._FAKE_SIZE}
+        mock_getmtime.return_value = vhdwriter._VHD_EPOCH + 10
+
+        vhdwriter.create_differencing_vhd(self._FAKE_PATH,
+                                          self._FAKE_PARENT_PATH)
+
+        mock_create_image.assert_called_once_with(
+            self._FAKE_PATH, vhdwriter._write_vhd, self._FAKE_SIZE,
+            constants.VHD_TYPE_DIFFERENCING,
+            parent=(mock_get_vhd_linkage_id.return_value, 10,
+                    self._get_parent_paths()))
+
+    @mock.patch.object(vhdwriter, '_create_image')
+    @mock.patch.object(vhdparser, 'get_vhd_linkage_id')
+    @mock.patch.object(vhdparser, 'get_vhd_info')
+    def test_create_differencing_vhdx(self, mock_get_vhd_info,
+                                      mock_get_vhd_linkage_id,
+                                      mock_create_image):
+        mock_get_vhd_info.return_value = {
+            'Format': vhdparser.VHDX_FORMAT,
+            'MaxInternalSize': self._FAKE_SIZE,
+            'LogicalSectorSize': mock.sentinel.logical_sector_size,
+            'PhysicalSectorSize': mock.sentinel.physical_sector_size}
+
+        vhdwriter.create_differencing_vhd(self._FAKE_PATH,
+                                          self._FAKE_PARENT_PATH)
+
+        mock_create_image.assert_called_once_with(
+            self._FAKE_PATH, vhdwriter._write_vhdx, self._FAKE_SIZE,
+            vhdwriter.VHDX_DEFAULT_DIFFERENCING_BLOCK_SIZE,
+            mock.sentinel.logical_sector_size,
+            mock.sentinel.physical_sector_size,
+            parent=(mock_get_vhd_linkage_id.return_value,
+                    self._get_parent_paths()))
+
+    @mock.patch('os.fsync')
+    @mock.patch('os.fdopen')
+    @mock.patch('os.open')
+    def test_create_image(self, mock_open, mock_fdopen, mock_fsync):
+        mock_write_image = mock.Mock()
+        mock_file = mock_fdopen.return_value.__enter__.return_value
+
+        vhdwriter._create_image(mock.sentinel.path, mock_write_image,
+                                mock.sentinel.size, parent=None)
+
+        mock_fdopen.assert_called_once_with(mock_open.return_value, 'wb')
+        mock_write_image.assert_called_once_with(
+            mock_file, mock.sentinel.size, parent=None)
+        mock_fsync.assert_called_once_with(mock_file.fileno.return_value)
+
+    @mock.patch('os.remove')
+    @mock.patch('os.fdopen')
+    @mock.patch('os.open')
+    def test_create_image_failed(self, mock_open, mock_fdopen, mock_remove):
+        mock_write_image = mock.Mock(side_effect=IOError)
+
+        self.assertRaises(IOError, vhdwriter._create_image,
+                          mock.sentinel.path, mock_write_image)
+
+        mock_remove.assert_called_once_with(mock.sentinel.path)
+
+    def test_get_relative_path(self):
+        relative_path = vhdwriter._get_relative_path(
+            'C:\\Instances\\fake_instance\\root.vhd',
+            'C:\\Instances\\fake_instance\\parent.vhd')
+        self.assertEqual('.\\parent.vhd', relative_path)
+
+    def test_get_relative_path_different_drives(self):
+        relative_path = vhdwriter._get_relative_path(
+            'C:\\Instances\\root.vhd', 'D:\\_base\\parent.vhd')
+        self.assertIsNone(relative_path)
+
+    def test_get_vhd_geometry(self):
+        geometry = vhdwriter._get_vhd_geometry(units.Gi)
+        # 2080 cylinders, 16 heads, 63 sectors per track.
+        self.assertEqual((2080 << 16) | (16 << 8) | 63, geometry)
+
+    def _write_and_read_vhd(self, size, disk_type, parent=None):
+        f = io.BytesIO()
+        vhdwriter._write_vhd(f, size, disk_type, parent=parent)
+        return vhdparser._read_vhd_footer_info(f, mock.sentinel.path,
+                                               len(f.getvalue()))
+
+    def test_write_vhd_dynamic(self):
+        vhd_info = self._write_and_read_vhd(self._FAKE_SIZE,
+                                            constants.VHD_TYPE_DYNAMIC)
+
+        self.assertEqual(vhdparser.VHD_FORMAT, vhd_info['Format'])
+        self.assertEqual(constants.VHD_TYPE_DYNAMIC, vhd_info['Type'])
+        self.assertEqual(self._FAKE_SIZE, vhd_info['MaxInternalSize'])
+        self.assertEqual(vhdwriter.VHD_DEFAULT_BLOCK_SIZE,
+                         vhd_info['BlockSize'])
+        self.assertIsNone(vhd_info['ParentPath'])
+
+    def test_write_vhd_differencing(self):
+        parent = (self._FAKE_PARENT_LINKAGE_ID, 10,
+                  self._get_parent_paths())
+
+        vhd_info = self._write_and_read_vhd(
+            self._FAKE_SIZE, constants.VHD_TYPE_DIFFERENCING, parent)
+
+        self.assertEqual(constants.VHD_TYPE_DIFFERENCING, vhd_info['Type'])
+        self.assertEqual(self._mock_resolve_parent_path.return_value,
+                         vhd_info['ParentPath'])
+        self._mock_resolve_parent_path.assert_called_once_with(
+            mock.sentinel.path,
+            [self._get_parent_paths()['relative'], self._FAKE_PARENT_PATH])
+
+    def test_write_vhd_invalid_size(self):
+        self.assertRaises(vmutils.HyperVException,
+                          self._write_and_read_vhd, self._FAKE_SIZE + 1,
+                          constants.VHD_TYPE_DYNAMIC)
+
+    def _write_and_read_vhdx(self, size, block_size, parent=None):
+        f = io.BytesIO()
+        vhdwriter._write_vhdx(f, size, block_size, 512, 4096,
+                              parent=parent)
+        return vhdparser._read_vhdx_info(f, mock.sentinel.path)
+
+    def test_write_vhdx_dynamic(self):
+        vhd_info = self._write_and_read_vhdx(
+            self._FAKE_SIZE, vhdwriter.VHDX_DEFAULT_BLOCK_SIZE)
+
+        self.assertEqual(vhdparser.VHDX_FORMAT, vhd_info['Format'])
+        self.assertEqual(constants.VHD_TYPE_DYNAMIC, vhd_info['Type'])
+        self.assertEqual(self._FAKE_SIZE, vhd_info['MaxInternalSize'])
+        self.assertEqual(vhdwriter.VHDX_DEFAULT_BLOCK_SIZE,
+                         vhd_info['BlockSize'])
+        self.assertEqual(512, vhd_info['LogicalSectorSize'])
+        self.assertEqual(4096, vhd_info['PhysicalSectorSize'])
+        self.assertIsNone(vhd_info['ParentPath'])
+
+    def test_write_vhdx_differencing(self):
+        parent_paths = self._get_parent_paths()
+        parent = (self._FAKE_PARENT_LINKAGE_ID, parent_paths)
+
+        vhd_info = self._write_and_read_vhdx(
+            self._FAKE_SIZE, vhdwriter.VHDX_DEFAULT_DIFFERENCING_BLOCK_SIZE,
+            parent)
+
+        self.assertEqual(constants.VHD_TYPE_DIFFERENCING, vhd_info['Type'])
+        self.assertEqual(self._mock_resolve_parent_path.return_value,
+                         vhd_info['ParentPath'])
+        self._mock_resolve_parent_path.assert_called_once_with(
+            mock.sentinel.path,
+            [parent_paths['relative'], parent_paths['absolute']])
+
+    @mock.patch('os.fsync')
+    def _test_append_fixed_vhd_footer(self, mock_fsync, raw_size):
+        class FakeImageFile(io.BytesIO):
+            def fileno(self):
+                return mock.sentinel.fileno
+
+            def close(self):
+                # Keep the image data available.
+                pass
+
+        f = FakeImageFile(b'\x01' * raw_size)
+        with mock.patch.object(vhdwriter, 'open', create=True,
+                               return_value=f) as mock_open:
+            vhdwriter.append_fixed_vhd_footer(mock.sentinel.path)
+
+        mock_open.assert_called_once_with(mock.sentinel.path, 'r+b')
+        mock_fsync.assert_called_once_with(mock.sentinel.fileno)
+        return f
+
+    def test_append_fixed_vhd_footer(self):
+        f = self._test_append_fixed_vhd_footer(raw_size=4096)
+
+        image = f.getvalue()
+        self.assertEqual(4096 + vhdparser.VHD_FOOTER_SIZE, len(image))
+        self.assertEqual(b'\x01' * 4096, image[:4096])
+        vhd_info = vhdparser._read_vhd_footer_info(f, mock.sentinel.path,
+                                                   len(image))
+        self.assertEqual(vhdparser.VHD_FORMAT, vhd_info['Format'])
+        self.assertEqual(constants.VHD_TYPE_FIXED, vhd_info['Type'])
+        self.assertEqual(4096, vhd_info['MaxInternalSize'])
+
+    def test_append_fixed_vhd_footer_unaligned_size(self):
+        self.assertRaises(vmutils.HyperVException,
+                          self._test_append_fixed_vhd_footer, raw_size=1000)
+
+    def test_get_vhdx_bat_entry_count(self):
+        # 1 TB disk, 32 MB blocks: 32768 payload blocks, interleaved with
+        # a sector bitmap entry every 128 (chunk ratio) payload entries.
+        self.assertEqual(32768 + 255, vhdwriter._get_vhdx_bat_entry_count(
+            units.Ti, 32 * units.Mi, 512, has_parent=False))
+        self.assertEqual(32768 + 256, vhdwriter._get_vhdx_bat_entry_count(
+            units.Ti, 32 * units.Mi, 512, has_parent=True))
+
+    def _read_image_map(self, chunks):
+        class FakeImageFile(io.BytesIO):
+            def fileno(self):
+                return mock.sentinel.fileno
+
+        image = b''.join(chunks)
+        with mock.patch.object(vhdparser, 'open', create=True,
+                               return_value=FakeImageFile(image)), \
+                mock.patch('os.fstat') as mock_fstat:
+            mock_fstat.return_value = mock.Mock(st_size=len(image))
+            allocation_map = vhdparser.get_vhd_allocation_map(
+                mock.sentinel.path)
+        return image, allocation_map
+
+    def test_iter_dynamic_vhd(self):
+        blocks = {1: b'\x01' * units.Mi, 3: b'\x03' * units.Mi}
+
+        image, allocation_map = self._read_image_map(
+            vhdwriter.iter_dynamic_vhd(4 * units.Mi, [1, 3], blocks.get,
+                                       block_size=units.Mi))
+
+        self.assertEqual(constants.VHD_TYPE_DYNAMIC, allocation_map['Type'])
+        self.assertEqual(4 * units.Mi, allocation_map['MaxInternalSize'])
+        for block_idx in range(4):
+            offset = vhdparser.get_block_file_offset(allocation_map,
+                                                     block_idx)
+            if block_idx in blocks:
+                self.assertEqual(blocks[block_idx],
+                                 image[offset:offset + units.Mi])
+            else:
+                self.assertIsNone(offset)
+
+    def test_iter_dynamic_vhdx(self):
+        blocks = {0: b'\x01' * units.Mi, 2: b'\x03' * units.Mi}
+
+        image, allocation_map = self._read_image_map(
+            vhdwriter.iter_dynamic_vhdx(3 * units.Mi, [0, 2], blocks.get,
+                                        block_size=units.Mi))
+
+        self.assertEqual(vhdparser.VHDX_FORMAT, allocation_map['Format'])
+        self.assertEqual(constants.VHD_TYPE_DYNAMIC, allocation_map['Type'])
+        self.assertEqual(vhdparser.BLOCK_NOT_PRESENT,
+                         allocation_map['BlockOffsets'][1])
+        for block_idx, data in blocks.items():
+            offset = vhdparser.get_block_file_offset(allocation_map,
+                                                     block_idx)
+            self.assertEqual(data, image[offset:offset + units.Mi])
+
+    def test_iter_dynamic_vhd_invalid_block(self):
+        chunks = vhdwriter.iter_dynamic_vhd(units.Mi, [0],
+                                            lambda block_idx: b'\x01',
+                                            block_size=units.Mi)
+
+        self.assertRaises(vmutils.HyperVException, list, chunks)
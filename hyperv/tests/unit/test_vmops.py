@@ -31,6 +31,7 @@ import six
 from hyperv.nova import block_device_manager
 from hyperv.nova import constants
 from hyperv.nova import vmops
+from hyperv.nova import vmshellpool
 from hyperv.nova import vmutils
 from hyperv.nova import volumeops
 from hyperv.tests import fake_instance
@@ -66,6 +67,8 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
         self._vmops._pathutils = mock.MagicMock()
         self._vmops._hostutils = mock.MagicMock()
         self._vmops._serial_console_ops = mock.MagicMock()
+        self._vmops._ephemeral_disk_pool = mock.MagicMock()
+        self._vmops._vm_shell_pool = mock.MagicMock()
 
     def test_get_vif_driver_cached(self):
         self._vmops._vif_driver_cache = mock.MagicMock()
@@ -85,11 +88,11 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
                 self._vmops._vif_driver_cache[mock.sentinel.VIF_TYPE])
 
     def test_list_instances(self):
-        mock_instance = mock.MagicMock()
-        self._vmops._vmutils.list_instances.return_value = [mock_instance]
+        self._vmops._vmutils.list_instances.return_value = [
+            'instance-00000001', vmshellpool._SHELL_NAME_PREFIX + 'x']
         response = self._vmops.list_instances()
         self._vmops._vmutils.list_instances.assert_called_once_with()
-        self.assertEqual(response, [mock_instance])
+        self.assertEqual(response, ['instance-00000001'])
 
     def _test_get_info(self, vm_exists):
         mock_instance = fake_instance.fake_instance_obj(self.context)
@@ -335,20 +338,32 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
             [mock.call(mock_instance.name, fake_ephemerals[0]),
              mock.call(mock_instance.name, fake_ephemerals[1])])
 
-    def test_create_ephemeral_disk(self):
+    def _test_create_ephemeral_disk(self, pooled_disk_available=False):
         mock_instance = fake_instance.fake_instance_obj(self.context)
 
         mock_ephemeral_info = {'path': 'fake_eph_path',
                                'format': 'vhd',
                                'size': 10}
 
+        mock_claim_disk = self._vmops._ephemeral_disk_pool.claim_disk
+        mock_claim_disk.return_value = pooled_disk_available
         mock_create_dynamic_vhd = self._vmops._vhdutils.create_dynamic_vhd
 
         self._vmops._create_ephemeral_disk(mock_instance.name,
                                            mock_ephemeral_info)
 
-        mock_create_dynamic_vhd.assert_called_once_with('fake_eph_path',
-                                                        10 * units.Gi, 'vhd')
+        mock_claim_disk.assert_called_once_with(10, 'vhd', 'fake_eph_path')
+        if pooled_disk_available:
+            self.assertFalse(mock_create_dynamic_vhd.called)
+        else:
+            mock_create_dynamic_vhd.assert_called_once_with(
+                'fake_eph_path', 10 * units.Gi, 'vhd')
+
+    def test_create_ephemeral_disk(self):
+        self._test_create_ephemeral_disk()
+
+    def test_create_ephemeral_disk_from_pool(self):
+        self._test_create_ephemeral_disk(pooled_disk_available=True)
 
     @mock.patch.object(block_device_manager.BlockDeviceInfoManager,
                        'get_boot_order')
@@ -502,8 +517,11 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
                               mock_requires_secure_boot,
                               enable_instance_metrics,
                               vm_gen=constants.VM_GEN_1, vnuma_enabled=False,
-                              requires_sec_boot=True, remotefx=False):
+                              requires_sec_boot=True, remotefx=False,
+                              pooled_vm_available=False):
         mock_vif_driver = mock_get_vif_driver()
+        mock_claim_vm = self._vmops._vm_shell_pool.claim_vm
+        mock_claim_vm.return_value = pooled_vm_available
         self.flags(dynamic_memory_ratio=2.0, group='hyperv')
         self.flags(enable_instance_metrics_collection=enable_instance_metrics,
                    group='hyperv')
@@ -553,16 +571,35 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
                     mock_instance,
                     flavor.extra_specs['hyperv:remotefx'])
 
-            self._vmops._vmutils.create_vm.assert_called_once_with(
-                mock_instance.name, vnuma_enabled, vm_gen,
-                instance_path, [mock_instance.uuid])
-            self._vmops._vmutils.update_vm.assert_called_once_with(
-                mock_instance.name, mock_instance.memory_mb, mem_per_numa,
-                mock_instance.vcpus, cpus_per_numa,
-                CONF.hyperv.limit_cpu_features, dynamic_memory_ratio)
-
+            expected_vm_shape = vmshellpool.VMShape(
+                vm_gen=vm_gen, vnuma_enabled=vnuma_enabled,
+                memory_mb=mock_instance.memory_mb,
+                memory_per_numa_node=mem_per_numa,
+                vcpus=mock_instance.vcpus,
+                vcpus_per_numa_node=cpus_per_numa,
+                limit_cpu_features=CONF.hyperv.limit_cpu_features,
+                dynamic_memory_ratio=dynamic_memory_ratio)
+            mock_claim_vm.assert_called_once_with(
+                expected_vm_shape, mock_instance.name, instance_path,
+                [mock_instance.uuid])
+
+            mock_create_vm = self._vmops._vmutils.create_vm
+            mock_update_vm = self._vmops._vmutils.update_vm
             mock_create_scsi_ctrl = self._vmops._vmutils.create_scsi_controller
-            mock_create_scsi_ctrl.assert_called_once_with(mock_instance.name)
+            if pooled_vm_available:
+                self.assertFalse(mock_create_vm.called)
+                self.assertFalse(mock_update_vm.called)
+                self.assertFalse(mock_create_scsi_ctrl.called)
+            else:
+                mock_create_vm.assert_called_once_with(
+                    mock_instance.name, vnuma_enabled, vm_gen,
+                    instance_path, [mock_instance.uuid])
+                mock_update_vm.assert_called_once_with(
+                    mock_instance.name, mock_instance.memory_mb,
+                    mem_per_numa, mock_instance.vcpus, cpus_per_numa,
+                    CONF.hyperv.limit_cpu_features, dynamic_memory_ratio)
+                mock_create_scsi_ctrl.assert_called_once_with(
+                    mock_instance.name)
 
             mock_attach_root_device.assert_called_once_with(mock_instance.name,
                 root_device_info)
@@ -595,6 +632,10 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
     def test_create_instance(self):
         self._test_create_instance(enable_instance_metrics=True)
 
+    def test_create_instance_pooled_vm(self):
+        self._test_create_instance(enable_instance_metrics=False,
+                                   pooled_vm_available=True)
+
     def test_create_instance_exception(self):
         # Secure Boot requires Generation 2 VMs. If boot is required while the
         # vm_gen is 1, exception is raised.
@@ -748,6 +789,7 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
         self.flags(config_drive_format=config_drive_format)
         self.flags(config_drive_cdrom=config_drive_cdrom, group='hyperv')
         self.flags(config_drive_inject_password=True, group='hyperv')
+        self.flags(native_config_drive=False, group='hyperv')
         mock_ConfigDriveBuilder().__enter__().make_drive.side_effect = [
             side_effect]
 
@@ -840,6 +882,84 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
             config_drive_cdrom=False,
             side_effect=processutils.ProcessExecutionError)
 
+    @mock.patch('nova.api.metadata.base.InstanceMetadata')
+    @mock.patch.object(vmops.VMOps, '_create_config_drive_with_tools')
+    @mock.patch.object(vmops.VMOps, '_create_config_drive_natively')
+    def test_create_config_drive_natively_built(
+            self, mock_create_natively, mock_create_with_tools,
+            mock_InstanceMetadata):
+        mock_instance = fake_instance.fake_instance_obj(self.context)
+        self.flags(config_drive_format=self.ISO9660)
+
+        path = self._vmops._create_config_drive(
+            mock_instance, [mock.sentinel.FILE], mock.sentinel.PASSWORD,
+            mock.sentinel.NET_INFO, mock.sentinel.rescue)
+
+        self.assertEqual(mock_create_natively.return_value, path)
+        mock_create_natively.assert_called_once_with(
+            mock_instance, mock_InstanceMetadata.return_value,
+            mock.sentinel.rescue)
+        self.assertFalse(mock_create_with_tools.called)
+
+    @mock.patch.object(vmops.vhdwriter, 'append_fixed_vhd_footer')
+    @mock.patch.object(vmops.isowriter, 'write_iso')
+    def _test_create_config_drive_natively(self, mock_write_iso,
+                                           mock_append_fixed_vhd_footer,
+                                           config_drive_cdrom=False,
+                                           write_exc=None):
+        self.flags(config_drive_cdrom=config_drive_cdrom, group='hyperv')
+        mock_instance = fake_instance.fake_instance_obj(self.context)
+        mock_inst_md = mock.Mock()
+        mock_write_iso.side_effect = write_exc
+        mock_get_configdrive_path = self._vmops._pathutils.get_configdrive_path
+
+        with mock.patch('oslo_utils.fileutils.delete_if_exists') as (
+                mock_delete):
+            path = self._vmops._create_config_drive_natively(
+                mock_instance, mock_inst_md, mock.sentinel.rescue)
+
+        expected_format = (constants.DVD_FORMAT if config_drive_cdrom
+                           else constants.DISK_FORMAT_VHD)
+        mock_get_configdrive_path.assert_called_once_with(
+            mock_instance.name, expected_format, rescue=mock.sentinel.rescue)
+        expected_path = mock_get_configdrive_path.return_value
+        mock_write_iso.assert_called_once_with(
+            expected_path, mock_inst_md.metadata_for_config_drive.return_value,
+            volume_id=vmops.CONFIG_DRIVE_LABEL, publisher=mock.ANY)
+
+        if write_exc:
+            self.assertIsNone(path)
+            mock_delete.assert_called_once_with(expected_path)
+            return
+
+        self.assertEqual(expected_path, path)
+        self.assertFalse(mock_delete.called)
+        if config_drive_cdrom:
+            self.assertFalse(mock_append_fixed_vhd_footer.called)
+        else:
+            mock_append_fixed_vhd_footer.assert_called_once_with(
+                expected_path)
+
+    def test_create_config_drive_natively(self):
+        self._test_create_config_drive_natively()
+
+    def test_create_config_drive_natively_cdrom(self):
+        self._test_create_config_drive_natively(config_drive_cdrom=True)
+
+    def test_create_config_drive_natively_unsupported_files(self):
+        self._test_create_config_drive_natively(
+            write_exc=vmutils.HyperVException)
+
+    def test_create_config_drive_natively_disabled(self):
+        self.flags(native_config_drive=False, group='hyperv')
+
+        path = self._vmops._create_config_drive_natively(
+            mock.sentinel.instance, mock.sentinel.inst_md,
+            mock.sentinel.rescue)
+
+        self.assertIsNone(path)
+        self.assertFalse(self._vmops._pathutils.get_configdrive_path.called)
+
     def test_attach_config_drive_exception(self):
         instance = fake_instance.fake_instance_obj(self.context)
         self.assertRaises(exception.InvalidDiskFormat,
@@ -889,6 +1009,10 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
     def test_delete_disk_files(self):
         mock_instance = fake_instance.fake_instance_obj(self.context)
         self._vmops._delete_disk_files(mock_instance.name)
+
+        serialops = self._vmops._serial_console_ops
+        serialops.wait_for_console_handler_stop.assert_called_once_with(
+            mock_instance.name)
         self._vmops._pathutils.get_instance_dir.assert_called_once_with(
             mock_instance.name, create_dir=False, remove_dir=True)
 
@@ -1055,7 +1179,7 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
             self._vmops.power_off(instance, timeout)
 
             serialops = self._vmops._serial_console_ops
-            serialops.stop_console_handler.assert_called_once_with(
+            serialops.stop_console_handler_async.assert_called_once_with(
                 instance.name)
             if set_state_expected:
                 mock_set_state.assert_called_once_with(
@@ -1628,6 +1752,92 @@ class VMOpsTestCase(test_base.HyperVBaseTestCase):
 
         self.assertEqual(fake_local_disks, ret_val)
 
+    @mock.patch('os.path.getsize')
+    @mock.patch.object(vmops.VMOps, '_get_instance_local_disks')
+    def test_get_instance_disk_info(self, mock_get_local_disks,
+                                    mock_getsize):
+        mock_get_local_disks.return_value = [
+            'root.vhdx', 'eph0.vhd', 'configdrive.iso', 'missing.vhd',
+            'locked.vhdx']
+        mock_get_allocation_info = (
+            self._vmops._vhdutils.get_vhd_allocation_info)
+        mock_get_allocation_info.side_effect = [
+            {'MaxInternalSize': 10 * units.Gi, 'FileSize': 2 * units.Gi,
+             'ParentPath': mock.sentinel.parent_path,
+             'AllocatedBytes': mock.sentinel.root_allocated_bytes},
+            {'MaxInternalSize': units.Gi, 'FileSize': units.Gi + 512,
+             'ParentPath': None,
+             'AllocatedBytes': mock.sentinel.eph_allocated_bytes},
+            vmutils.HyperVException,
+            vmutils.HyperVException]
+        # The images opened by running instances cannot be parsed, their
+        # details being retrieved through WMI, without the file size.
+        self._vmops._vhdutils.get_vhd_info.side_effect = [
+            vmutils.HyperVException,
+            {'MaxInternalSize': 4 * units.Gi, 'ParentPath': None}]
+        mock_getsize.return_value = units.Gi
+
+        disk_info = self._vmops.get_instance_disk_info(
+            mock.sentinel.instance_name)
+
+        expected_disk_info = [
+            {'type': 'vhdx', 'path': 'root.vhdx',
+             'virt_disk_size': 10 * units.Gi,
+             'backing_file': mock.sentinel.parent_path,
+             'disk_size': 2 * units.Gi,
+             'allocated_size': mock.sentinel.root_allocated_bytes,
+             'over_committed_disk_size': 8 * units.Gi},
+            {'type': 'vhd', 'path': 'eph0.vhd',
+             'virt_disk_size': units.Gi,
+             'backing_file': '',
+             'disk_size': units.Gi + 512,
+             'allocated_size': mock.sentinel.eph_allocated_bytes,
+             'over_committed_disk_size': 0},
+            {'type': 'vhdx', 'path': 'locked.vhdx',
+             'virt_disk_size': 4 * units.Gi,
+             'backing_file': '',
+             'disk_size': units.Gi,
+             'allocated_size': units.Gi,
+             'over_committed_disk_size': 3 * units.Gi}]
+        self.assertEqual(expected_disk_info, disk_info)
+        mock_get_local_disks.assert_called_once_with(
+            mock.sentinel.instance_name)
+        mock_get_allocation_info.assert_has_calls(
+            [mock.call('root.vhdx'), mock.call('eph0.vhd'),
+             mock.call('missing.vhd'), mock.call('locked.vhdx')])
+        mock_getsize.assert_called_once_with('locked.vhdx')
+
+    @mock.patch('os.path.getsize')
+    @mock.patch.object(vmops.VMOps, '_get_instance_local_disks')
+    def test_get_instance_over_committed_disk_size(self,
+                                                   mock_get_local_disks,
+                                                   mock_getsize):
+        mock_get_local_disks.return_value = [
+            'root.vhdx', 'configdrive.iso', 'locked.vhdx', 'missing.vhd',
+            'removed.vhd']
+        mock_get_vhd_info = self._vmops._vhdutils.get_vhd_info
+        # The locked image details are retrieved through WMI, without the
+        # file size.
+        mock_get_vhd_info.side_effect = [
+            {'MaxInternalSize': 10 * units.Gi, 'FileSize': 2 * units.Gi},
+            {'MaxInternalSize': 4 * units.Gi, 'ParentPath': None},
+            vmutils.HyperVException,
+            {'MaxInternalSize': units.Gi}]
+        mock_getsize.side_effect = [2 * units.Gi, units.Gi, OSError]
+
+        over_committed_size = (
+            self._vmops.get_instance_over_committed_disk_size(
+                mock.sentinel.instance_name))
+
+        self.assertEqual(11 * units.Gi, over_committed_size)
+        mock_get_vhd_info.assert_has_calls(
+            [mock.call('root.vhdx'), mock.call('locked.vhdx'),
+             mock.call('missing.vhd'), mock.call('removed.vhd')])
+        mock_getsize.assert_has_calls(
+            [mock.call('root.vhdx'), mock.call('locked.vhdx'),
+             mock.call('removed.vhd')])
+        self.assertFalse(self._vmops._vhdutils.get_vhd_allocation_info.called)
+
     @mock.patch.object(vmops.VMOps, '_get_storage_qos_specs')
     @mock.patch.object(vmops.VMOps, '_get_instance_local_disks')
     def test_set_instance_disk_qos_specs(self, mock_get_local_disks,
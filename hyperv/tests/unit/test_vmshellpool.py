@@ -0,0 +1,281 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+
+import mock
+
+from hyperv.nova import constants
+from hyperv.nova import vmshellpool
+from hyperv.nova import vmutils
+from hyperv.tests.unit import test_base
+
+
+class VMShellPoolTestCase(test_base.HyperVBaseTestCase):
+    """Unit tests for the Hyper-V VMShellPool class."""
+
+    _FAKE_POOL_DIR = 'C:\\Instances\\_vm_shells'
+    _FAKE_SHAPE = vmshellpool.VMShape(
+        vm_gen=constants.VM_GEN_2, vnuma_enabled=False, memory_mb=2048,
+        memory_per_numa_node=None, vcpus=2, vcpus_per_numa_node=None,
+        limit_cpu_features=False, dynamic_memory_ratio=1.0)
+    _FAKE_OTHER_SHAPE = _FAKE_SHAPE._replace(vcpus=4)
+
+    def setUp(self):
+        super(VMShellPoolTestCase, self).setUp()
+        self.flags(vm_shell_pool_size=2, group='hyperv')
+
+        self._pool = vmshellpool.VMShellPool()
+        self._pool._vmutils = mock.MagicMock()
+        self._pool._pathutils = mock.MagicMock()
+        self._pool._pathutils.get_vm_shell_pool_dir.return_value = (
+            self._FAKE_POOL_DIR)
+
+        self._vms = {}
+        self._pool._vmutils.list_instance_notes.side_effect = (
+            lambda: list(self._vms.items()))
+
+        for attr, value in (('_pool_stats', collections.Counter()),
+                            ('_requested_shapes',
+                             collections.OrderedDict())):
+            patcher = mock.patch.object(vmshellpool, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(vmshellpool.utils, 'synchronized')
+        self._mock_synchronized = patcher.start()
+        self._mock_synchronized.return_value = lambda f: f
+        self.addCleanup(patcher.stop)
+
+    def _add_shell(self, shell_id, vm_shape):
+        self._vms[vmshellpool._SHELL_NAME_PREFIX + shell_id] = [
+            vmshellpool._serialize_shape(vm_shape)]
+
+    def test_is_vm_shell(self):
+        self.assertTrue(vmshellpool.is_vm_shell(
+            vmshellpool._SHELL_NAME_PREFIX + 'fake_id'))
+        self.assertTrue(vmshellpool.is_vm_shell(
+            vmshellpool._TMP_SHELL_NAME_PREFIX + 'fake_id'))
+        self.assertFalse(vmshellpool.is_vm_shell('instance-00000001'))
+
+    def test_shape_serialization(self):
+        notes = [vmshellpool._serialize_shape(self._FAKE_SHAPE)]
+
+        self.assertEqual(self._FAKE_SHAPE,
+                         vmshellpool._deserialize_shape(notes))
+        self.assertIsNone(vmshellpool._deserialize_shape([]))
+        self.assertIsNone(vmshellpool._deserialize_shape(['{"a": 1}']))
+
+    def test_add_requested_shape(self):
+        self.flags(vm_shell_pool_max_shapes=2, group='hyperv')
+        third_shape = self._FAKE_SHAPE._replace(vcpus=8)
+
+        for vm_shape in (self._FAKE_SHAPE, self._FAKE_OTHER_SHAPE,
+                         self._FAKE_SHAPE, third_shape):
+            vmshellpool._add_requested_shape(vm_shape)
+
+        self.assertEqual([self._FAKE_SHAPE, third_shape],
+                         list(vmshellpool._requested_shapes))
+
+    @mock.patch.object(vmshellpool, 'eventlet')
+    def test_start(self, mock_eventlet):
+        self._pool.start()
+
+        mock_eventlet.spawn_n.assert_called_once_with(
+            self._pool._refill_periodically)
+
+    @mock.patch.object(vmshellpool, 'eventlet')
+    def test_start_disabled(self, mock_eventlet):
+        self.flags(vm_shell_pool_size=0, group='hyperv')
+
+        self._pool.start()
+
+        self.assertFalse(mock_eventlet.spawn_n.called)
+
+    @mock.patch.object(vmshellpool, 'eventlet')
+    def test_start_unsupported(self, mock_eventlet):
+        self._pool._rename_supported = False
+
+        self._pool.start()
+
+        self.assertFalse(mock_eventlet.spawn_n.called)
+
+    def test_list_shells(self):
+        self._add_shell('a', self._FAKE_SHAPE)
+        self._vms[vmshellpool._TMP_SHELL_NAME_PREFIX + 'b'] = [
+            vmshellpool._serialize_shape(self._FAKE_SHAPE)]
+        self._vms['instance-00000001'] = [mock.sentinel.uuid]
+
+        expected_shells = {
+            vmshellpool._SHELL_NAME_PREFIX + 'a': self._FAKE_SHAPE,
+            vmshellpool._TMP_SHELL_NAME_PREFIX + 'b': None}
+        self.assertEqual(expected_shells, self._pool._list_shells())
+
+    def test_claim_vm(self):
+        self._add_shell('a', self._FAKE_OTHER_SHAPE)
+        self._add_shell('b', self._FAKE_SHAPE)
+
+        claimed = self._pool.claim_vm(self._FAKE_SHAPE,
+                                      mock.sentinel.vm_name,
+                                      mock.sentinel.instance_path,
+                                      [mock.sentinel.uuid])
+
+        self.assertTrue(claimed)
+        self._mock_synchronized.assert_called_once_with(
+            vmshellpool._POOL_LOCK_NAME)
+        self._pool._vmutils.rename_vm.assert_called_once_with(
+            vmshellpool._SHELL_NAME_PREFIX + 'b', mock.sentinel.vm_name,
+            mock.sentinel.instance_path, [mock.sentinel.uuid])
+        self.assertEqual([self._FAKE_SHAPE],
+                         list(vmshellpool._requested_shapes))
+        self.assertEqual({'hits': 1}, vmshellpool._pool_stats)
+
+    def test_claim_vm_rename_failed(self):
+        self._add_shell('a', self._FAKE_SHAPE)
+        self._add_shell('b', self._FAKE_SHAPE)
+        mock_rename_vm = self._pool._vmutils.rename_vm
+        mock_rename_vm.side_effect = [vmutils.HyperVException, None]
+
+        claimed = self._pool.claim_vm(self._FAKE_SHAPE,
+                                      mock.sentinel.vm_name,
+                                      mock.sentinel.instance_path,
+                                      [mock.sentinel.uuid])
+
+        self.assertTrue(claimed)
+        self._pool._vmutils.destroy_vm.assert_called_once_with(
+            vmshellpool._SHELL_NAME_PREFIX + 'a')
+        self.assertEqual(2, mock_rename_vm.call_count)
+
+    def test_claim_vm_pool_empty(self):
+        self._add_shell('a', self._FAKE_OTHER_SHAPE)
+
+        claimed = self._pool.claim_vm(self._FAKE_SHAPE,
+                                      mock.sentinel.vm_name,
+                                      mock.sentinel.instance_path,
+                                      [mock.sentinel.uuid])
+
+        self.assertFalse(claimed)
+        self.assertFalse(self._pool._vmutils.rename_vm.called)
+        # The shape is pooled starting with the next refill.
+        self.assertEqual([self._FAKE_SHAPE],
+                         list(vmshellpool._requested_shapes))
+        self.assertEqual({'misses': 1}, vmshellpool._pool_stats)
+
+    def _test_claim_vm_disabled(self, rename_supported=True):
+        if rename_supported:
+            self.flags(vm_shell_pool_size=0, group='hyperv')
+        else:
+            self._pool._rename_supported = False
+
+        claimed = self._pool.claim_vm(self._FAKE_SHAPE,
+                                      mock.sentinel.vm_name,
+                                      mock.sentinel.instance_path,
+                                      [mock.sentinel.uuid])
+
+        self.assertFalse(claimed)
+        self.assertFalse(self._pool._vmutils.list_instance_notes.called)
+        self.assertFalse(self._pool._vmutils.rename_vm.called)
+        self.assertEqual({}, vmshellpool._pool_stats)
+
+    def test_claim_vm_disabled(self):
+        self._test_claim_vm_disabled()
+
+    def test_claim_vm_unsupported(self):
+        # VMs cannot be renamed using the V1 WMI namespace.
+        self._test_claim_vm_disabled(rename_supported=False)
+
+    @mock.patch.object(vmshellpool.VMShellPool, '_throttle')
+    @mock.patch.object(vmshellpool.VMShellPool, '_create_shell')
+    def test_refill(self, mock_create_shell, mock_throttle):
+        vmshellpool._requested_shapes[self._FAKE_SHAPE] = None
+        self._add_shell('a', self._FAKE_SHAPE)
+        self._add_shell('b', self._FAKE_OTHER_SHAPE)
+        self._vms[vmshellpool._TMP_SHELL_NAME_PREFIX + 'c'] = []
+
+        def fake_create_shell(vm_shape):
+            self._add_shell('new', vm_shape)
+
+        def fake_destroy_vm(vm_name):
+            del self._vms[vm_name]
+
+        mock_create_shell.side_effect = fake_create_shell
+        self._pool._vmutils.destroy_vm.side_effect = fake_destroy_vm
+
+        self._pool.refill()
+
+        self._pool._vmutils.destroy_vm.assert_has_calls(
+            [mock.call(vmshellpool._SHELL_NAME_PREFIX + 'b'),
+             mock.call(vmshellpool._TMP_SHELL_NAME_PREFIX + 'c')],
+            any_order=True)
+        mock_create_shell.assert_called_once_with(self._FAKE_SHAPE)
+        mock_throttle.assert_called_once_with()
+
+    def test_remove_stale_shells_pool_size_lowered(self):
+        self._add_shell('a', self._FAKE_SHAPE)
+        self._add_shell('b', self._FAKE_SHAPE)
+
+        self._pool._remove_stale_shells([self._FAKE_SHAPE], 1)
+
+        self._pool._vmutils.destroy_vm.assert_called_once_with(
+            vmshellpool._SHELL_NAME_PREFIX + 'b')
+
+    @mock.patch.object(vmshellpool, 'uuidutils')
+    def test_create_shell(self, mock_uuidutils):
+        mock_uuidutils.generate_uuid.return_value = 'fake_id'
+        tmp_name = vmshellpool._TMP_SHELL_NAME_PREFIX + 'fake_id'
+
+        self._pool._create_shell(self._FAKE_SHAPE)
+
+        mock_vmutils = self._pool._vmutils
+        mock_vmutils.create_vm.assert_called_once_with(
+            tmp_name, False, constants.VM_GEN_2, self._FAKE_POOL_DIR)
+        mock_vmutils.update_vm.assert_called_once_with(
+            tmp_name, 2048, None, 2, None, False, 1.0)
+        mock_vmutils.create_scsi_controller.assert_called_once_with(tmp_name)
+        mock_vmutils.rename_vm.assert_called_once_with(
+            tmp_name, vmshellpool._SHELL_NAME_PREFIX + 'fake_id',
+            self._FAKE_POOL_DIR,
+            [vmshellpool._serialize_shape(self._FAKE_SHAPE)])
+
+    @mock.patch.object(vmshellpool, 'uuidutils')
+    def test_create_shell_failed(self, mock_uuidutils):
+        mock_uuidutils.generate_uuid.return_value = 'fake_id'
+        tmp_name = vmshellpool._TMP_SHELL_NAME_PREFIX + 'fake_id'
+        mock_vmutils = self._pool._vmutils
+        mock_vmutils.update_vm.side_effect = vmutils.HyperVException
+        mock_vmutils.vm_exists.return_value = True
+
+        self.assertRaises(vmutils.HyperVException, self._pool._create_shell,
+                          self._FAKE_SHAPE)
+
+        mock_vmutils.destroy_vm.assert_called_once_with(tmp_name)
+        self.assertFalse(mock_vmutils.rename_vm.called)
+
+    def test_get_pool_stats(self):
+        self._add_shell('a', self._FAKE_SHAPE)
+        self._add_shell('b', self._FAKE_OTHER_SHAPE)
+        self._vms[vmshellpool._TMP_SHELL_NAME_PREFIX + 'c'] = []
+        vmshellpool._pool_stats.update(hits=3, misses=1)
+
+        expected_stats = {'vm_shell_pool_hits': 3,
+                          'vm_shell_pool_misses': 1,
+                          'vm_shell_pool_size': 2}
+        self.assertEqual(expected_stats, self._pool.get_pool_stats())
+
+    def test_get_pool_stats_disabled(self):
+        self.flags(vm_shell_pool_size=0, group='hyperv')
+
+        self.assertEqual({}, self._pool.get_pool_stats())
+        self.assertFalse(self._pool._vmutils.list_instance_notes.called)
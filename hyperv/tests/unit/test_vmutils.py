@@ -92,6 +92,11 @@ class VMUtilsTestCase(test.NoDBTestCase):
                           self._vmutils.enable_vm_metrics_collection,
                           self._FAKE_VM_NAME)
 
+    def test_rename_vm(self):
+        self.assertRaises(NotImplementedError, self._vmutils.rename_vm,
+                          self._FAKE_VM_NAME, mock.sentinel.new_vm_name,
+                          mock.sentinel.instance_path, None)
+
     def test_get_vm_summary_info(self):
         self._lookup_vm()
 
@@ -435,6 +435,26 @@ class VMUtilsV2TestCase(test_vmutils.VMUtilsTestCase):
                           self._vmutils._set_secure_boot,
                           mock.MagicMock(), True)
 
+    @mock.patch.object(vmutilsv2.VMUtilsV2, '_modify_virtual_system')
+    @mock.patch.object(vmutils.VMUtils, '_lookup_vm_check')
+    def test_rename_vm(self, mock_lookup_vm_check,
+                       mock_modify_virtual_system):
+        vs_data = mock_lookup_vm_check.return_value
+
+        self._vmutils.rename_vm(mock.sentinel.VM_NAME,
+                                mock.sentinel.NEW_VM_NAME,
+                                mock.sentinel.instance_path,
+                                [mock.sentinel.notes])
+
+        mock_lookup_vm_check.assert_called_once_with(mock.sentinel.VM_NAME)
+        self.assertEqual(mock.sentinel.NEW_VM_NAME, vs_data.ElementName)
+        self.assertEqual([mock.sentinel.notes], vs_data.Notes)
+        for data_root in ('LogDataRoot', 'SnapshotDataRoot',
+                          'SuspendDataRoot', 'SwapFileDataRoot'):
+            self.assertEqual(mock.sentinel.instance_path,
+                             getattr(vs_data, data_root))
+        mock_modify_virtual_system.assert_called_once_with(None, vs_data)
+
     @mock.patch.object(vmutilsv2.VMUtilsV2, '_modify_virtual_system')
     @mock.patch.object(vmutils.VMUtils, '_lookup_vm_check')
     def test_enable_secure_boot(self, mock_lookup_vm_check,
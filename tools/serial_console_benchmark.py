@@ -0,0 +1,429 @@
+# Copyright 2015 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Serial console throughput and latency benchmark.
+
+Drives the serial console path used by the Hyper-V driver (SerialProxy,
+IOQueue, NamedPipeHandler and the console log writer) on Linux. The
+instance named pipes are replaced by unix sockets, the simulated guests
+and the console clients running in a separate process, so that the CPU
+usage reported is the one of the console handling code.
+
+Two scenarios are available:
+
+* throughput: the guests write console output as fast as possible (or
+  at the requested rate), the clients reading it through the proxies.
+* latency: the clients send one byte at a time, which the guests echo
+  back, measuring the round trip time.
+
+Example:
+    python tools/serial_console_benchmark.py --instances 10,100,500
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from oslo_config import cfg
+
+from hyperv.nova import ioutils
+from hyperv.nova import namedpipe
+from hyperv.nova import pathutils
+from hyperv.nova import serialproxy
+from hyperv.nova import utilsfactory
+
+CONF = cfg.CONF
+CONF.import_opt('serial_console_queue_size',
+                'hyperv.nova.serialconsolehandler', 'hyperv')
+CONF.import_opt('serial_console_output_overflow_policy',
+                'hyperv.nova.serialconsolehandler', 'hyperv')
+CONF.import_opt('console_log_tail_buffer_size',
+                'hyperv.nova.serialconsolehandler', 'hyperv')
+
+EVENT_READ = serialproxy.EVENT_READ
+EVENT_WRITE = serialproxy.EVENT_WRITE
+
+SCENARIO_THROUGHPUT = 'throughput'
+SCENARIO_LATENCY = 'latency'
+
+_RECV_SIZE = 64 * 1024
+
+
+class _Overlapped(object):
+    hEvent = None
+
+
+class SocketPipeIOUtils(object):
+    """Stand-in for IOUtils, backing the named pipes by unix sockets."""
+
+    def wait_named_pipe(self, pipe_name,
+                        timeout=ioutils.WAIT_PIPE_DEFAULT_TIMEOUT):
+        pass
+
+    def open(self, path, desired_access=None, share_mode=None,
+             creation_disposition=None, flags_and_attributes=None):
+        handle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        handle.connect(path)
+        return handle
+
+    def cancel_io(self, handle, overlapped_structure=None):
+        try:
+            handle.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close_handle(self, handle):
+        handle.close()
+
+    def set_event(self, event):
+        pass
+
+    def get_completion_routine(self, callback=None):
+        return callback
+
+    def get_new_overlapped_structure(self):
+        return _Overlapped()
+
+    def read(self, handle, buff, num_bytes,
+             overlapped_structure, completion_routine):
+        bytes_read = handle.recv_into(buff, num_bytes)
+        if not bytes_read:
+            raise IOError('The pipe was closed.')
+        completion_routine(bytes_read)
+
+    def write(self, handle, buff, num_bytes,
+              overlapped_structure, completion_routine):
+        handle.sendall(memoryview(buff)[:num_bytes])
+        if completion_routine:
+            completion_routine(num_bytes)
+
+    def get_buffer(self, buff_size):
+        return bytearray(buff_size)
+
+    def get_buffer_data(self, buff, num_bytes):
+        return bytes(buff[:num_bytes])
+
+    def write_buffer_data(self, buff, data):
+        buff[:len(data)] = data
+
+
+class BenchNamedPipeHandler(namedpipe.NamedPipeHandler):
+    def _setup_io_structures(self):
+        self._ioutils = SocketPipeIOUtils()
+        super(BenchNamedPipeHandler, self)._setup_io_structures()
+
+
+class BenchPathUtils(pathutils.PathUtils):
+    def _set_smb_conn(self):
+        # The SMB WMI namespace is not available on Linux.
+        self._smb_conn_attr = None
+
+
+class SimulatedConsole(object):
+    """The console handling components used for an instance."""
+
+    def __init__(self, idx, pipe_path, log_dir):
+        instance_name = 'instance-%05d' % idx
+        self.client_connected = threading.Event()
+        queue_size = CONF.hyperv.serial_console_queue_size
+        self.input_queue = ioutils.IOQueue(
+            client_connected=self.client_connected,
+            max_size_bytes=queue_size)
+        self.output_queue = ioutils.IOQueue(
+            client_connected=self.client_connected,
+            max_size_bytes=queue_size,
+            overflow_policy=CONF.hyperv.serial_console_output_overflow_policy)
+
+        self.proxy = serialproxy.SerialProxy(
+            instance_name, '127.0.0.1', 0, self.input_queue,
+            self.output_queue, self.client_connected)
+
+        log_file = None
+        log_tail_buffer = None
+        if log_dir:
+            log_file = os.path.join(log_dir, instance_name + '.log')
+            log_tail_buffer = ioutils.RingBuffer(
+                CONF.hyperv.console_log_tail_buffer_size)
+        self.pipe_handler = BenchNamedPipeHandler(
+            pipe_path,
+            input_queue=self.input_queue,
+            output_queue=self.output_queue,
+            connect_event=self.client_connected,
+            log_file=log_file,
+            log_tail_buffer=log_tail_buffer)
+
+    def start(self):
+        self.proxy.start()
+        self.pipe_handler.start()
+        return self.proxy._sock.getsockname()[1]
+
+    def stop(self):
+        self.proxy.stop()
+        self.pipe_handler.stop()
+
+
+class _Stats(object):
+    def __init__(self, instance_count):
+        self.bytes_received = [0] * instance_count
+        self.round_trip_times = []
+
+
+def _run_throughput(selector, guests, clients, duration, chunk_size, rate,
+                    stats):
+    payload = b'x' * chunk_size
+    bytes_sent = [0] * len(guests)
+    for idx, guest in enumerate(guests):
+        selector.register(guest, EVENT_WRITE, ('guest', idx))
+    for idx, client in enumerate(clients):
+        selector.register(client, EVENT_READ, ('client', idx))
+
+    start_time = time.time()
+    end_time = start_time + duration
+    while True:
+        now = time.time()
+        if now >= end_time:
+            break
+
+        for key, events in selector.select(min(end_time - now, 0.1)):
+            kind, idx = key.data
+            try:
+                if kind == 'client':
+                    stats.bytes_received[idx] += len(
+                        key.fileobj.recv(_RECV_SIZE))
+                elif not rate or bytes_sent[idx] < rate * (now - start_time):
+                    bytes_sent[idx] += key.fileobj.send(payload)
+            except socket.error:
+                pass
+
+        if rate:
+            # Avoid spinning while the guests are throttled.
+            time.sleep(0.001)
+
+
+def _run_latency(selector, guests, clients, duration, probe_interval,
+                 stats):
+    probe_sent_at = [None] * len(clients)
+    next_probe_at = [0] * len(clients)
+    for idx, guest in enumerate(guests):
+        selector.register(guest, EVENT_READ, ('guest', idx))
+    for idx, client in enumerate(clients):
+        selector.register(client, EVENT_READ, ('client', idx))
+
+    end_time = time.time() + duration
+    while True:
+        now = time.time()
+        if now >= end_time:
+            break
+
+        for idx, client in enumerate(clients):
+            if probe_sent_at[idx] is None and next_probe_at[idx] <= now:
+                client.send(b'a')
+                probe_sent_at[idx] = now
+
+        for key, events in selector.select(min(end_time - now,
+                                               probe_interval or 0.01)):
+            kind, idx = key.data
+            try:
+                data = key.fileobj.recv(_RECV_SIZE)
+            except socket.error:
+                continue
+
+            if kind == 'guest':
+                # Echo the input, as a guest shell would do.
+                key.fileobj.sendall(data)
+            elif data and probe_sent_at[idx] is not None:
+                received_at = time.time()
+                stats.round_trip_times.append(
+                    received_at - probe_sent_at[idx])
+                probe_sent_at[idx] = None
+                next_probe_at[idx] = received_at + probe_interval
+
+
+def _run_simulator(conn, sock_dir, instance_count, args):
+    listeners = []
+    pipe_paths = []
+    for idx in range(instance_count):
+        pipe_path = os.path.join(sock_dir, 'pipe-%05d' % idx)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(pipe_path)
+        listener.listen(1)
+        listeners.append(listener)
+        pipe_paths.append(pipe_path)
+    conn.send(pipe_paths)
+
+    ports = conn.recv()
+    guests = [listener.accept()[0] for listener in listeners]
+    clients = [socket.create_connection(('127.0.0.1', port))
+               for port in ports]
+    for sock in guests + clients:
+        sock.setblocking(False)
+    for sock in clients:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Let the proxies accept the client connections.
+    time.sleep(args.warmup)
+
+    stats = _Stats(instance_count)
+    selector = serialproxy._get_selector()
+    conn.send('started')
+    if args.scenario == SCENARIO_THROUGHPUT:
+        _run_throughput(selector, guests, clients, args.duration,
+                        args.chunk_size, args.rate, stats)
+    else:
+        _run_latency(selector, guests, clients, args.duration,
+                     args.probe_interval, stats)
+    conn.send((stats.bytes_received, stats.round_trip_times))
+
+    for sock in guests + clients + listeners:
+        sock.close()
+
+
+def _get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    idx = min(int(len(values) * percent / 100.0), len(values) - 1)
+    return values[idx]
+
+
+def run_benchmark(instance_count, args):
+    work_dir = tempfile.mkdtemp(prefix='serial-console-bench-')
+    log_dir = None
+    if not args.no_log:
+        log_dir = os.path.join(work_dir, 'logs')
+        os.mkdir(log_dir)
+
+    conn, child_conn = multiprocessing.Pipe()
+    simulator = multiprocessing.Process(
+        target=_run_simulator,
+        args=(child_conn, work_dir, instance_count, args))
+    simulator.daemon = True
+    simulator.start()
+
+    consoles = []
+    try:
+        pipe_paths = conn.recv()
+        consoles = [SimulatedConsole(idx, pipe_path, log_dir)
+                    for idx, pipe_path in enumerate(pipe_paths)]
+        conn.send([console.start() for console in consoles])
+
+        conn.recv()
+        start_time = time.time()
+        start_cpu_time = _get_cpu_time()
+
+        bytes_received, round_trip_times = conn.recv()
+        elapsed = time.time() - start_time
+        cpu_time = _get_cpu_time() - start_cpu_time
+
+        bytes_dropped = sum(console.output_queue.bytes_dropped
+                            for console in consoles)
+    finally:
+        stop_workers = [threading.Thread(target=console.stop)
+                        for console in consoles]
+        for worker in stop_workers:
+            worker.start()
+        for worker in stop_workers:
+            worker.join()
+        simulator.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    total_bytes = sum(bytes_received)
+    return {'instances': instance_count,
+            'throughput': total_bytes / elapsed,
+            'throughput_per_console': total_bytes / elapsed / instance_count,
+            'dropped': bytes_dropped,
+            'probes': len(round_trip_times),
+            'latency_p50': _percentile(round_trip_times, 50) * 1000,
+            'latency_p99': _percentile(round_trip_times, 99) * 1000,
+            'latency_max': max(round_trip_times or [0]) * 1000,
+            'cpu': cpu_time / elapsed * 100,
+            'cpu_per_console': cpu_time / elapsed * 100 / instance_count}
+
+
+def _print_results(scenario, results):
+    if scenario == SCENARIO_THROUGHPUT:
+        print('%9s %14s %16s %14s %8s %14s' % (
+            'instances', 'total KiB/s', 'console KiB/s', 'dropped KiB',
+            'CPU %', 'console CPU %'))
+        for res in results:
+            print('%9d %14.1f %16.1f %14.1f %8.1f %14.3f' % (
+                res['instances'], res['throughput'] / 1024,
+                res['throughput_per_console'] / 1024,
+                res['dropped'] / 1024.0, res['cpu'],
+                res['cpu_per_console']))
+    else:
+        print('%9s %8s %10s %10s %10s %8s %14s' % (
+            'instances', 'probes', 'p50 ms', 'p99 ms', 'max ms',
+            'CPU %', 'console CPU %'))
+        for res in results:
+            print('%9d %8d %10.2f %10.2f %10.2f %8.1f %14.3f' % (
+                res['instances'], res['probes'], res['latency_p50'],
+                res['latency_p99'], res['latency_max'], res['cpu'],
+                res['cpu_per_console']))
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--instances', default='10,100,500',
+                        help='Comma separated simulated instance counts.')
+    parser.add_argument('--scenario', default=SCENARIO_THROUGHPUT,
+                        choices=[SCENARIO_THROUGHPUT, SCENARIO_LATENCY])
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Measurement duration, in seconds.')
+    parser.add_argument('--warmup', type=float, default=1,
+                        help='Time allowed for the clients to connect, in '
+                             'seconds.')
+    parser.add_argument('--chunk-size', type=int, default=1024,
+                        help='Size of the guest console writes, in bytes.')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='Console output rate per guest, in bytes per '
+                             'second. 0 means unlimited.')
+    parser.add_argument('--probe-interval', type=float, default=0.05,
+                        help='Delay between echo probes sent by each '
+                             'client, in seconds.')
+    parser.add_argument('--no-log', action='store_true',
+                        help='Do not write console logs.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    CONF(args=[], default_config_files=[])
+    utilsfactory.get_pathutils = BenchPathUtils
+
+    results = []
+    for instance_count in map(int, args.instances.split(',')):
+        results.append(run_benchmark(instance_count, args))
+        _print_results(args.scenario, results[-1:])
+    print()
+    _print_results(args.scenario, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main())